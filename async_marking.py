@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+
+"""
+Native asyncio path for Bedrock calls and essay marking.
+
+The thread-based functions in automarking need one OS thread per in-flight
+request, and a streamed response holds its thread until the last chunk. This
+module offers async versions of invoke_claude_sonnet, bedrock_generator,
+generate_essay_feedback and generate_class_feedback on an aiobotocore
+bedrock-runtime client, whose aiohttp connection pool is sized to
+ASYNC_MAX_IN_FLIGHT (or on fake_bedrock.AsyncFakeBedrockClient with
+BEDROCK_BACKEND=fake). Calls go through an AsyncRateLimiter that shares the
+request and token quotas of automarking.rate_limiter, so hundreds of streams
+can be in flight on one event loop. mark_essays_async runs a fixed pool of
+worker coroutines rather than one task per essay, which keeps memory bounded
+by the number of essays in flight.
+
+Prompts, the feedback cache, score extraction, token usage and call metrics
+are shared with automarking. Async code awaits the coroutines directly:
+
+    records, errors = asyncio.run(mark_essays_async(essays, rubric_text, feedback_guidance))
+
+Synchronous callers (the Streamlit app, batch_marking.py --async) use
+mark_essays_on_event_loop(), which has the signature of
+automarking.mark_essays and runs the work on a process-wide background event
+loop, or run_on_background_loop() for any other coroutine.
+
+Setup (for the real Bedrock backend):
+    uv pip install aiobotocore
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from automarking import (
+    BEDROCK_BACKEND,
+    BEDROCK_LARGE_MODEL_ID,
+    BEDROCK_MAX_RETRIES,
+    BEDROCK_REGION,
+    BEDROCK_RETRY_BUDGET_RATIO,
+    CLASS_DIGEST_CHUNK_TOKENS,
+    CLASS_DIGEST_MAX_CONTINUATIONS,
+    CLASS_DIGEST_MAX_LEVELS,
+    CLASS_DIGEST_MAX_TOKENS,
+    CLASS_FEEDBACK_TOKEN_BUDGET,
+    CLASS_MAX_TOKENS,
+    DEFAULT_INFERENCE_PARAMS,
+    ESSAY_MAX_TOKENS,
+    FEEDBACK_CACHE_ENABLED,
+    DigestTruncated,
+    add_usage,
+    build_class_prompt,
+    build_digest_prompt,
+    build_essay_prompt,
+    chunk_by_tokens,
+    class_cache_key,
+    class_statistics_table,
+    digest_cache_key,
+    essay_cache_key,
+    estimate_tokens,
+    feedback_cache,
+    last_stop_reason,
+    log_usage,
+    parse_stream_event,
+    planned_max_tokens,
+    prompt_messages,
+    rate_limiter,
+    record_call,
+    request_body,
+    response_text,
+    save_feedback_file,
+    set_stop_reason,
+    warn_if_over_budget,
+)
+from contextlib import AsyncExitStack
+from fair_scheduler import bind_flow_async
+from fake_bedrock import AsyncFakeBedrockClient, FakeBedrockConfig
+from metrics import call_context, current_labels
+from rate_limiter import AsyncRateLimitedClient, AsyncRateLimiter, CallStats, error_code
+from scoring import extract_scores
+from typing import AsyncIterator, Callable, Coroutine, Dict, Iterable, List, Optional, Tuple, Union
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:  # only needed for the real Bedrock backend
+    AioConfig = get_session = None
+
+logger = logging.getLogger(__name__)
+
+ASYNC_BEDROCK_ENABLED = os.getenv('ASYNC_BEDROCK_ENABLED', 'false').lower() == 'true'
+# Size of an event loop's HTTP connection pool, and its calls in flight when the fair scheduler is off;
+# with the scheduler, its window (see automarking.fair_scheduler) limits them
+ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', '256'))
+
+# One client per event loop: an aiohttp session cannot be shared between loops
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+async def _create_client(stack: AsyncExitStack) -> AsyncRateLimitedClient:
+    if BEDROCK_BACKEND == 'fake':
+        logger.warning("Using the local fake Bedrock backend for asyncio calls (BEDROCK_BACKEND=fake)")
+        backend = AsyncFakeBedrockClient(FakeBedrockConfig.from_env())
+    else:
+        if get_session is None:
+            raise RuntimeError("The asyncio Bedrock client needs aiobotocore: uv pip install aiobotocore")
+        # Retries are handled by the rate limiter, so aiobotocore makes a single attempt
+        config = AioConfig(
+            read_timeout=1000,
+            retries={'total_max_attempts': 1, 'mode': 'standard'},
+            max_pool_connections=ASYNC_MAX_IN_FLIGHT
+        )
+        backend = await stack.enter_async_context(
+            get_session().create_client('bedrock-runtime', region_name=BEDROCK_REGION, config=config)
+        )
+    limiter = AsyncRateLimiter(
+        max_concurrency=ASYNC_MAX_IN_FLIGHT,
+        max_retries=BEDROCK_MAX_RETRIES,
+        retry_budget_ratio=BEDROCK_RETRY_BUDGET_RATIO,
+        shared=rate_limiter
+    )
+    return AsyncRateLimitedClient(backend, limiter)
+
+
+async def get_async_bedrock_client() -> AsyncRateLimitedClient:
+    """Rate-limited async Bedrock client of the running event loop, created on first use"""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        if loop not in _clients:
+            stack = AsyncExitStack()
+            _clients[loop] = (asyncio.ensure_future(_create_client(stack)), stack)
+        client, _ = _clients[loop]
+    return await client
+
+
+def set_async_bedrock_client(client):
+    """Replace the running event loop's client, e.g. with a fake backend behind its own AsyncRateLimiter"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    future.set_result(client)
+    with _clients_lock:
+        _clients[loop] = (future, AsyncExitStack())
+
+
+async def close_async_bedrock_client():
+    """Close the running event loop's client and its connection pool"""
+    with _clients_lock:
+        entry = _clients.pop(asyncio.get_running_loop(), None)
+    if entry:
+        await entry[1].aclose()
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop running in a daemon thread, started on first use"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="bedrock-asyncio", daemon=True).start()
+            _background_loop = loop
+    return _background_loop
+
+
+def run_on_background_loop(coroutine: Coroutine):
+    """Run a coroutine on the background event loop, in the caller's flow and context, and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(bind_flow_async(coroutine), background_loop()).result()
+
+
+def _limiter_stats(client) -> Optional[CallStats]:
+    limiter = getattr(client, 'limiter', None)
+    return limiter.last_call_stats() if limiter else None
+
+
+async def invoke_claude_sonnet_async(prompt: Union[str, List[Dict]], client=None,
+                                     model_id: str = BEDROCK_LARGE_MODEL_ID, prefill: str = "", **kwargs):
+    """Async automarking.invoke_claude_sonnet: records token usage, call metrics and the stop reason the same way"""
+    body = request_body(prompt_messages(prompt, prefill), **kwargs)
+
+    client = client or await get_async_bedrock_client()
+    labels = current_labels()
+    start = time.perf_counter()
+    try:
+        response = await client.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body)
+        )
+        response_body = json.loads(await response['body'].read())
+    except Exception as e:
+        record_call(model_id, 'invoke', start, {}, _limiter_stats(client), labels, error=error_code(e))
+        raise
+
+    usage = response_body.get("usage", {})
+    set_stop_reason(response_body.get("stop_reason"))
+    add_usage(usage, model_id)
+    record_call(model_id, 'invoke', start, usage, _limiter_stats(client), labels,
+                stop_reason=last_stop_reason())
+    log_usage(usage)
+    return response_text(response_body)
+
+
+async def bedrock_generator_async(model_name: str, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+    """Async automarking.bedrock_generator: yields text chunks as they arrive
+
+    The stream occupies a rate limiter slot, not a thread, until it is
+    consumed; only the current chunk is held in memory.
+    """
+    client = kwargs.pop('client', None) or await get_async_bedrock_client()
+    labels = current_labels()
+    start = time.perf_counter()
+    ttft_seconds = None
+    usage = {}
+    stats = None
+    try:
+        response = await client.invoke_model_with_response_stream(
+            modelId=model_name,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(request_body(messages, **kwargs))
+        )
+        stats = _limiter_stats(client)
+        async for event in response['body']:
+            text = parse_stream_event(event, usage)
+            if text:
+                if ttft_seconds is None:
+                    ttft_seconds = time.perf_counter() - start
+                yield text
+    except Exception as e:
+        record_call(model_name, 'stream', start, usage, stats or _limiter_stats(client), labels,
+                    ttft_seconds, error=error_code(e))
+        raise
+    add_usage(usage, model_name)
+    record_call(model_name, 'stream', start, usage, stats, labels, ttft_seconds, stop_reason=last_stop_reason())
+
+
+async def generate_essay_feedback_async(essay_text: str, essay_name: str, rubric_text: str,
+                                        feedback_guidance: str, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                                        model_id: str = BEDROCK_LARGE_MODEL_ID,
+                                        max_tokens: Optional[int] = None) -> str:
+    """Async automarking.generate_essay_feedback, sharing its feedback cache entries
+
+    A reply that reaches a planned `max_tokens` is continued up to
+    ESSAY_MAX_TOKENS in total, as in the sync version.
+    """
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    cache_key = essay_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            return cached
+
+    prompt = build_essay_prompt(essay_text, rubric_text, feedback_guidance)
+
+    logger.info(f"Generating feedback for essay: {essay_name}")
+    first_limit = planned_max_tokens(max_tokens)
+    feedback = await invoke_claude_sonnet_async(prompt, model_id=model_id, **{**params, "max_tokens": first_limit})
+    if first_limit < ESSAY_MAX_TOKENS and last_stop_reason() == 'max_tokens':
+        logger.info(f"Feedback for {essay_name} reached its planned {first_limit} tokens; continuing")
+        feedback = feedback.rstrip() + await invoke_claude_sonnet_async(
+            prompt,
+            model_id=model_id,
+            prefill=feedback,
+            **{**params, "max_tokens": ESSAY_MAX_TOKENS - first_limit}
+        )
+    if use_cache:
+        feedback_cache.set(cache_key, feedback)
+    return feedback
+
+
+async def stream_essay_feedback_async(essay_text: str, essay_name: str, rubric_text: str,
+                                      feedback_guidance: str, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                                      model_id: str = BEDROCK_LARGE_MODEL_ID,
+                                      max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+    """Async automarking.stream_essay_feedback, continuing a planned `max_tokens` the same way"""
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    cache_key = essay_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            yield cached
+            return
+
+    messages = [{"role": "user", "content": build_essay_prompt(essay_text, rubric_text, feedback_guidance)}]
+
+    logger.info(f"Streaming feedback for essay: {essay_name}")
+    first_limit = planned_max_tokens(max_tokens)
+    chunks = []
+    async for text in bedrock_generator_async(model_id, messages, **{**params, "max_tokens": first_limit}):
+        chunks.append(text)
+        yield text
+    if first_limit < ESSAY_MAX_TOKENS and last_stop_reason() == 'max_tokens':
+        logger.info(f"Feedback for {essay_name} reached its planned {first_limit} tokens; continuing")
+        partial = ''.join(chunks).rstrip()
+        chunks = [partial]
+        continuation = messages + [{"role": "assistant", "content": partial}]
+        remaining = {**params, "max_tokens": ESSAY_MAX_TOKENS - first_limit}
+        async for text in bedrock_generator_async(model_id, continuation, **remaining):
+            chunks.append(text)
+            yield text
+    if use_cache:
+        feedback_cache.set(cache_key, ''.join(chunks))
+
+
+async def generate_feedback_digest_async(chunk_text: str, rubric_text: str,
+                                         use_cache: bool = FEEDBACK_CACHE_ENABLED) -> str:
+    """Async automarking.generate_feedback_digest, continuing or raising DigestTruncated the same way"""
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CLASS_DIGEST_MAX_TOKENS}
+    cache_key = digest_cache_key(chunk_text, rubric_text, params)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    prompt = build_digest_prompt(chunk_text, rubric_text)
+    with call_context(kind='digest'):
+        digest = await invoke_claude_sonnet_async(prompt, **params)
+        for _ in range(CLASS_DIGEST_MAX_CONTINUATIONS):
+            if last_stop_reason() != 'max_tokens':
+                break
+            logger.info(f"Class digest reached {CLASS_DIGEST_MAX_TOKENS} tokens; continuing")
+            digest = digest.rstrip() + await invoke_claude_sonnet_async(prompt, prefill=digest, **params)
+    if last_stop_reason() == 'max_tokens':
+        raise DigestTruncated(f"Class digest still cut off after {CLASS_DIGEST_MAX_CONTINUATIONS} continuation(s)")
+    if use_cache:
+        feedback_cache.set(cache_key, digest)
+    return digest
+
+
+async def split_truncated_digests_async(chunk: List[str], rubric_text: str, use_cache: bool,
+                                        separator: str) -> List[str]:
+    """Async automarking.split_truncated_digests; the two halves are digested concurrently"""
+    try:
+        return [await generate_feedback_digest_async(separator.join(chunk), rubric_text, use_cache)]
+    except DigestTruncated:
+        if len(chunk) == 1:
+            logger.warning("A feedback part could not be condensed within the digest limit; keeping it in full")
+            return chunk
+        logger.info(f"Digest of {len(chunk)} feedback part(s) was cut off; splitting the chunk in two")
+        half = len(chunk) // 2
+        first, second = await asyncio.gather(
+            split_truncated_digests_async(chunk[:half], rubric_text, use_cache, separator),
+            split_truncated_digests_async(chunk[half:], rubric_text, use_cache, separator)
+        )
+        return first + second
+
+
+async def summarise_feedbacks_async(all_feedbacks: List[Dict[str, str]], rubric_text: str,
+                                    use_cache: bool = FEEDBACK_CACHE_ENABLED) -> str:
+    """Async automarking.summarise_feedbacks: the digests of each level are generated concurrently"""
+    separator = "\n\n---\n\n"
+    parts = [f"Essay: {item['name']}\n{item['feedback']}" for item in all_feedbacks]
+
+    summary_tokens = estimate_tokens(separator.join(parts))
+    level = 0
+    while summary_tokens > CLASS_FEEDBACK_TOKEN_BUDGET and level < CLASS_DIGEST_MAX_LEVELS:
+        level += 1
+        chunks = chunk_by_tokens(parts, CLASS_DIGEST_CHUNK_TOKENS)
+        logger.info(f"Condensing {len(parts)} feedback part(s) into {len(chunks)} digest(s) (level {level})")
+        digests = await asyncio.gather(*(
+            split_truncated_digests_async(chunk, rubric_text, use_cache, separator) for chunk in chunks
+        ))
+        parts = [part for chunk_digests in digests for part in chunk_digests]
+        previous_tokens, summary_tokens = summary_tokens, estimate_tokens(separator.join(parts))
+        if summary_tokens >= previous_tokens:
+            break
+
+    warn_if_over_budget(summary_tokens, level)
+    return separator.join(parts)
+
+
+async def generate_class_feedback_async(all_feedbacks: List[Dict[str, str]], rubric_text: str,
+                                        use_cache: bool = FEEDBACK_CACHE_ENABLED) -> str:
+    """Async automarking.generate_class_feedback, sharing its feedback cache entries"""
+    feedback_summary = await summarise_feedbacks_async(all_feedbacks, rubric_text, use_cache)
+    statistics_table = class_statistics_table(all_feedbacks, rubric_text)
+
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CLASS_MAX_TOKENS}
+    cache_key = class_cache_key(feedback_summary, rubric_text, statistics_table, params)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Feedback cache hit for class overall feedback")
+            return cached
+
+    logger.info("Generating class overall feedback")
+    with call_context(kind='class'):
+        class_feedback = await invoke_claude_sonnet_async(
+            build_class_prompt(feedback_summary, rubric_text, statistics_table),
+            **params
+        )
+    if use_cache:
+        feedback_cache.set(cache_key, class_feedback)
+    return class_feedback
+
+
+async def mark_essays_async(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                            max_in_flight: int = ASYNC_MAX_IN_FLIGHT, output_dir: str = "outputs",
+                            use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                            on_complete: Optional[Callable[[int, int, str, Optional[Exception]], None]] = None,
+                            on_delta: Optional[Callable[[str, str], None]] = None,
+                            route: Optional[Callable[[str, str], str]] = None,
+                            max_tokens: Optional[Dict[str, int]] = None
+                            ) -> Tuple[List[Dict], Dict[str, str]]:
+    """Mark essays on the running event loop with `max_in_flight` worker coroutines
+
+    The records, errors and callbacks match automarking.mark_essays, except
+    that `on_complete` and `on_delta` are called on the event loop.
+    `max_tokens` holds planned output limits by essay name. `route`
+    may make blocking calls (the cascade estimate does), so it runs in a
+    thread. Feedback files are written from a thread as well.
+    """
+    essay_names = list(essays.keys())
+    total_essays = len(essay_names)
+    results = {}
+    errors = {}
+    completed = 0
+    pending = iter(essay_names)
+
+    async def mark_one(essay_name: str):
+        nonlocal completed
+        start = time.perf_counter()
+        error = None
+        essay_max_tokens = (max_tokens or {}).get(essay_name)
+        try:
+            with call_context(essay=essay_name, kind='essay'):
+                model_id = await asyncio.to_thread(route, essay_name, essays[essay_name]) if route \
+                    else BEDROCK_LARGE_MODEL_ID
+                if on_delta is None:
+                    raw_feedback = await generate_essay_feedback_async(
+                        essays[essay_name], essay_name, rubric_text, feedback_guidance, use_cache, model_id,
+                        essay_max_tokens
+                    )
+                else:
+                    chunks = []
+                    async for text in stream_essay_feedback_async(essays[essay_name], essay_name, rubric_text,
+                                                                  feedback_guidance, use_cache, model_id,
+                                                                  essay_max_tokens):
+                        chunks.append(text)
+                        on_delta(essay_name, text)
+                    raw_feedback = ''.join(chunks)
+            seconds = time.perf_counter() - start
+            feedback, scores = extract_scores(raw_feedback, rubric_text)
+            feedback_path = await asyncio.to_thread(save_feedback_file, essay_name, feedback, output_dir)
+            results[essay_name] = {
+                'name': essay_name,
+                'feedback': feedback,
+                'path': feedback_path,
+                'scores': scores,
+                'model': model_id,
+                'seconds': round(seconds, 3)
+            }
+        except Exception as e:
+            error = e
+            errors[essay_name] = str(e)
+            logger.error(f"Error processing {essay_name}: {str(e)}")
+
+        completed += 1
+        if on_complete:
+            on_complete(completed, total_essays, essay_name, error)
+
+    async def worker():
+        # Workers share one iterator, so each essay is taken by exactly one of them
+        for essay_name in pending:
+            await mark_one(essay_name)
+
+    workers = max(1, min(max_in_flight, total_essays))
+    client = await get_async_bedrock_client()
+    with client.limiter.reserve(workers):
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    return [results[name] for name in essay_names if name in results], errors
+
+
+def mark_essays_on_event_loop(essays: Union[Dict[str, str], Iterable[Tuple[str, str]]], rubric_text: str,
+                              feedback_guidance: str,
+                              max_workers: int = ASYNC_MAX_IN_FLIGHT, output_dir: str = "outputs",
+                              use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                              on_complete: Optional[Callable[[int, int, str, Optional[Exception]], None]] = None,
+                              on_delta: Optional[Callable[[str, str], None]] = None,
+                              on_tick: Optional[Callable[[], None]] = None,
+                              tick_interval: float = 0.25,
+                              route: Optional[Callable[[str, str], str]] = None,
+                              pack: bool = False,
+                              fanout: bool = False,
+                              max_tokens: Optional[Dict[str, int]] = None
+                              ) -> Tuple[List[Dict], Dict[str, str]]:
+    """Drop-in replacement for automarking.mark_essays that marks on the background event loop
+
+    `max_workers` essays are in flight at once without a thread each.
+    `on_complete` and `on_tick` are called from the calling thread, as with
+    mark_essays, and `on_delta` from the event loop thread. Packing and
+    per-criterion fan-out are not supported on this path and raise
+    ValueError. A stream of (name, text) pairs is read in full before
+    marking starts.
+    """
+    if pack or fanout:
+        raise ValueError("Packing and per-criterion fan-out are not supported on the asyncio path")
+    if not isinstance(essays, dict):
+        essays = dict(essays)
+    completions = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(bind_flow_async(
+        mark_essays_async(
+            essays,
+            rubric_text,
+            feedback_guidance,
+            max_in_flight=max_workers,
+            output_dir=output_dir,
+            use_cache=use_cache,
+            on_complete=lambda *completion: completions.put(completion),
+            on_delta=on_delta,
+            route=route,
+            max_tokens=max_tokens
+        )),
+        background_loop()
+    )
+
+    # Completions are queued before the coroutine returns, so none is left behind once it is done
+    while not (future.done() and completions.empty()):
+        try:
+            completion = completions.get(timeout=tick_interval)
+        except queue.Empty:
+            completion = None
+        if on_tick:
+            on_tick()
+        if completion and on_complete:
+            on_complete(*completion)
+    return future.result()
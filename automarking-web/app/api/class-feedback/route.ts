@@ -1,9 +1,11 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { generateClassFeedback } from '@/lib/bedrock';
+import { forwardToMarkingService, markingServiceEnabled } from '@/lib/marking-service';
 
 export async function POST(request: NextRequest) {
   try {
-    const { allFeedbacks, rubricText } = await request.json();
+    const body = await request.json();
+    const { allFeedbacks, rubricText } = body;
 
     if (!allFeedbacks || !rubricText) {
       return NextResponse.json(
@@ -12,6 +14,10 @@ export async function POST(request: NextRequest) {
       );
     }
 
+    if (markingServiceEnabled()) {
+      return await forwardToMarkingService('/api/class-feedback', body, request.headers.get('x-marking-flow'));
+    }
+
     const classFeedback = await generateClassFeedback(allFeedbacks, rubricText);
 
     return NextResponse.json({ classFeedback });
@@ -1,9 +1,11 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { generateEssayFeedback } from '@/lib/bedrock';
+import { forwardToMarkingService, markingServiceEnabled } from '@/lib/marking-service';
 
 export async function POST(request: NextRequest) {
   try {
-    const { essayText, essayName, rubricText, feedbackGuidance } = await request.json();
+    const body = await request.json();
+    const { essayText, essayName, rubricText, feedbackGuidance } = body;
 
     if (!essayText || !essayName || !rubricText || !feedbackGuidance) {
       return NextResponse.json(
@@ -12,6 +14,10 @@ export async function POST(request: NextRequest) {
       );
     }
 
+    if (markingServiceEnabled()) {
+      return await forwardToMarkingService('/api/mark-essay', body, request.headers.get('x-marking-flow'));
+    }
+
     const feedback = await generateEssayFeedback(
       essayText,
       essayName,
@@ -0,0 +1,31 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { forwardToMarkingService, markingServiceEnabled } from '@/lib/marking-service';
+
+export async function POST(request: NextRequest) {
+  if (!markingServiceEnabled()) {
+    return NextResponse.json(
+      { error: 'Batch marking needs the marking service (set MARKING_SERVICE_URL)' },
+      { status: 501 }
+    );
+  }
+
+  try {
+    const body = await request.json();
+    const { essays, rubricText, feedbackGuidance } = body;
+
+    if (!Array.isArray(essays) || essays.length === 0 || !rubricText || !feedbackGuidance) {
+      return NextResponse.json(
+        { error: 'Missing required fields' },
+        { status: 400 }
+      );
+    }
+
+    return await forwardToMarkingService('/api/mark-essays', body, request.headers.get('x-marking-flow'));
+  } catch (error) {
+    console.error('Error marking essays:', error);
+    return NextResponse.json(
+      { error: 'Failed to generate feedback' },
+      { status: 500 }
+    );
+  }
+}
@@ -0,0 +1,36 @@
+// Client for the Python marking service (marking_service.py in the parent folder).
+// When MARKING_SERVICE_URL is set, the API routes forward requests to it, so this app
+// and the Streamlit app share one set of prompts, one rate limit and single-flight
+// coalescing of identical requests, instead of calling Bedrock directly.
+
+const MARKING_SERVICE_URL = (process.env.MARKING_SERVICE_URL || '').replace(/\/+$/, '');
+const MARKING_SERVICE_FLOW = process.env.MARKING_SERVICE_FLOW || 'automarking-web';
+
+export function markingServiceEnabled(): boolean {
+  return MARKING_SERVICE_URL !== '';
+}
+
+// Forward a request body to the service and relay its reply; streamed (NDJSON) replies are passed through as they arrive
+export async function forwardToMarkingService(
+  path: string,
+  body: unknown,
+  flow?: string | null
+): Promise<Response> {
+  const response = await fetch(`${MARKING_SERVICE_URL}${path}`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'X-Marking-Flow': flow || MARKING_SERVICE_FLOW,
+    },
+    body: JSON.stringify(body),
+    cache: 'no-store',
+  });
+
+  return new Response(response.body, {
+    status: response.status,
+    headers: {
+      'Content-Type': response.headers.get('Content-Type') || 'application/json',
+      'Cache-Control': 'no-cache',
+    },
+  });
+}
@@ -0,0 +1,1486 @@
+#!/usr/bin/env python
+
+"""
+Core marking logic for automated essay marking using Amazon Bedrock.
+
+This module contains everything that does not depend on Streamlit:
+- Invoking Amazon Bedrock Claude models
+- Building prompts and generating essay and class feedback
+- Loading essays, rubrics and feedback guidance from folders
+- Saving feedback files
+- Marking a set of essays concurrently
+
+It is shared by the Streamlit app (streamlit_automarking.py) and the headless
+batch marking CLI (batch_marking.py), and can be imported without Streamlit.
+
+Setup:
+    uv pip install boto3 python-dotenv
+"""
+
+import boto3
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+from botocore.config import Config
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager, nullcontext
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from essay_ingest import load_essays
+from fair_scheduler import FAIR_SCHEDULER_ENABLED, FairScheduler, bind_flow
+from fake_bedrock import FakeBedrockClient, FakeBedrockConfig
+from feedback_cache import FeedbackCache, make_cache_key
+from metrics import CallRecord, MetricsRecorder, call_context, current_labels
+from pathlib import Path
+from rate_limiter import CallStats, RateLimitedClient, RateLimiter, error_code
+from scoring import (
+    Criterion,
+    class_statistics,
+    extract_scores,
+    format_statistics_table,
+    parse_rubric,
+    scores_instruction,
+)
+from typing import Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Load environment variables
+load_dotenv()
+
+# ----- Logging -----
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s|%(levelname)s|%(name)s|%(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# ----- Bedrock -----
+BEDROCK_LARGE_MODEL_ID = os.getenv('BEDROCK_LARGE_MODEL_ID', 'global.anthropic.claude-sonnet-4-20250514-v1:0')
+BEDROCK_SMALL_MODEL_ID = os.getenv('BEDROCK_SMALL_MODEL_ID', 'global.anthropic.claude-haiku-4-5-20251001-v1:0')
+BEDROCK_REGION = os.getenv('BEDROCK_REGION', 'us-west-2')
+BEDROCK_PROMPT_CACHING = os.getenv('BEDROCK_PROMPT_CACHING', 'true').lower() == 'true'
+# 'bedrock', or 'fake' for the local stand-in in fake_bedrock.py
+BEDROCK_BACKEND = os.getenv('BEDROCK_BACKEND', 'bedrock').lower()
+
+# USD per million input/output tokens, used for cost estimates only
+MODEL_PRICES = {
+    BEDROCK_LARGE_MODEL_ID: tuple(float(price) for price in os.getenv('BEDROCK_LARGE_MODEL_PRICE', '3,15').split(',')),
+    BEDROCK_SMALL_MODEL_ID: tuple(float(price) for price in os.getenv('BEDROCK_SMALL_MODEL_PRICE', '1,5').split(',')),
+}
+
+DEFAULT_INFERENCE_PARAMS = {
+    "max_tokens": 2048,
+    "temperature": 0.5,
+    "top_k": 250,
+    "top_p": 1,
+}
+
+# ----- Marking -----
+MARKING_CONCURRENCY = int(os.getenv('MARKING_CONCURRENCY', '8'))
+ESSAY_MAX_TOKENS = 3000
+CLASS_MAX_TOKENS = 4000
+
+# ----- Packed marking -----
+# Several short essays per request against one copy of the rubric and guidance
+PACKED_MARKING_ENABLED = os.getenv('PACKED_MARKING_ENABLED', 'false').lower() == 'true'
+PACKED_INPUT_TOKEN_BUDGET = int(os.getenv('PACKED_INPUT_TOKEN_BUDGET', '6000'))
+PACKED_OUTPUT_TOKENS_PER_ESSAY = int(os.getenv('PACKED_OUTPUT_TOKENS_PER_ESSAY', '1500'))
+PACKED_MAX_OUTPUT_TOKENS = int(os.getenv('PACKED_MAX_OUTPUT_TOKENS', '16000'))
+PACKED_FEEDBACK_PATTERN = re.compile(r'<feedback id="(\d+)">\s*(.*?)\s*</feedback>', re.DOTALL)
+
+# ----- Per-criterion fan-out -----
+# One short request per rubric criterion, run concurrently, then a brief synthesis
+CRITERION_FANOUT_ENABLED = os.getenv('CRITERION_FANOUT_ENABLED', 'false').lower() == 'true'
+CRITERION_MAX_TOKENS = int(os.getenv('CRITERION_MAX_TOKENS', '800'))
+SYNTHESIS_MAX_TOKENS = int(os.getenv('SYNTHESIS_MAX_TOKENS', '500'))
+SYNTHESIS_SECTION_PATTERN = re.compile(r"<(overall|closing)>\s*(.*?)\s*</\1>", re.DOTALL)
+
+# ----- Class analysis -----
+CLASS_FEEDBACK_TOKEN_BUDGET = int(os.getenv('CLASS_FEEDBACK_TOKEN_BUDGET', '60000'))
+CLASS_DIGEST_CHUNK_TOKENS = int(os.getenv('CLASS_DIGEST_CHUNK_TOKENS', '16000'))
+CLASS_DIGEST_MAX_TOKENS = 2500
+# A digest cut off at max_tokens is continued this many times before its chunk is split in two
+CLASS_DIGEST_MAX_CONTINUATIONS = 1
+CLASS_DIGEST_MAX_LEVELS = 4
+
+# ----- Feedback cache -----
+FEEDBACK_CACHE_ENABLED = os.getenv('FEEDBACK_CACHE_ENABLED', 'true').lower() == 'true'
+FEEDBACK_CACHE_DIR = os.getenv('FEEDBACK_CACHE_DIR', '.cache/feedback')
+FEEDBACK_CACHE_MAX_MB = int(os.getenv('FEEDBACK_CACHE_MAX_MB', '256'))
+
+# Feedback from the fake backend is kept apart so it is never served as real feedback
+FEEDBACK_CACHE_PATH = f"{FEEDBACK_CACHE_DIR}-fake" if BEDROCK_BACKEND == 'fake' else FEEDBACK_CACHE_DIR
+
+feedback_cache = FeedbackCache(FEEDBACK_CACHE_PATH, max_bytes=FEEDBACK_CACHE_MAX_MB * 1024 * 1024)
+
+# ----- Rate limiting -----
+BEDROCK_REQUESTS_PER_MINUTE = float(os.getenv('BEDROCK_REQUESTS_PER_MINUTE', '0'))
+BEDROCK_TOKENS_PER_MINUTE = float(os.getenv('BEDROCK_TOKENS_PER_MINUTE', '0'))
+BEDROCK_MAX_RETRIES = int(os.getenv('BEDROCK_MAX_RETRIES', '6'))
+BEDROCK_RETRY_BUDGET_RATIO = float(os.getenv('BEDROCK_RETRY_BUDGET_RATIO', '0.2'))
+# Most Bedrock calls in flight at once however much concurrency runs ask for; size it from the account quota
+BEDROCK_MAX_CONCURRENCY = int(os.getenv('BEDROCK_MAX_CONCURRENCY', '64'))
+
+# Shares the process's calls fairly between sessions and jobs (see fair_scheduler.py). It is the rate
+# limiter's only admission point: its AIMD window (MARKING_CONCURRENCY, raised by runs' reservations up to
+# BEDROCK_MAX_CONCURRENCY) caps the calls in flight across every session, job and event loop of the process
+fair_scheduler = FairScheduler(
+    max_concurrency=MARKING_CONCURRENCY,
+    requests_per_minute=BEDROCK_REQUESTS_PER_MINUTE,
+    tokens_per_minute=BEDROCK_TOKENS_PER_MINUTE,
+    ceiling=BEDROCK_MAX_CONCURRENCY
+) if FAIR_SCHEDULER_ENABLED else None
+
+rate_limiter = RateLimiter(
+    requests_per_minute=BEDROCK_REQUESTS_PER_MINUTE,
+    tokens_per_minute=BEDROCK_TOKENS_PER_MINUTE,
+    max_concurrency=MARKING_CONCURRENCY,
+    max_retries=BEDROCK_MAX_RETRIES,
+    retry_budget_ratio=BEDROCK_RETRY_BUDGET_RATIO,
+    scheduler=fair_scheduler,
+    concurrency_ceiling=BEDROCK_MAX_CONCURRENCY
+)
+
+# The rate limiter caps in-flight requests at BEDROCK_MAX_CONCURRENCY, so the
+# HTTP pool only needs to be that large (with a little headroom)
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv('BEDROCK_MAX_POOL_CONNECTIONS', str(max(10, BEDROCK_MAX_CONCURRENCY + 2))))
+
+# Retries are handled by rate_limiter, so botocore makes a single attempt
+config = Config(
+    read_timeout=1000,
+    retries={'total_max_attempts': 1, 'mode': 'standard'},
+    max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS
+)
+bedrock_runtime = None
+_bedrock_runtime_lock = threading.Lock()
+
+
+def get_bedrock_client() -> RateLimitedClient:
+    """Process-wide rate-limited Bedrock client, created on first use
+
+    Creating a boto3 client loads the service model and resolves the endpoint,
+    so it is done once and shared by every thread, session and script rerun.
+    """
+    global bedrock_runtime
+    if bedrock_runtime is None:
+        with _bedrock_runtime_lock:
+            if bedrock_runtime is None:
+                if BEDROCK_BACKEND == 'fake':
+                    logger.warning("Using the local fake Bedrock backend (BEDROCK_BACKEND=fake)")
+                    backend = FakeBedrockClient(FakeBedrockConfig.from_env())
+                else:
+                    backend = boto3.client(
+                        service_name='bedrock-runtime',
+                        config=config,
+                        region_name=BEDROCK_REGION
+                    )
+                bedrock_runtime = RateLimitedClient(backend, rate_limiter)
+    return bedrock_runtime
+
+
+def reserve_concurrency(slots: int, client=None):
+    """Let `slots` Bedrock calls be in flight at once while the block runs
+
+    The limiter otherwise stays at MARKING_CONCURRENCY; a run that asks for
+    more workers reserves them here, up to BEDROCK_MAX_CONCURRENCY across the
+    runs in progress (see RateLimiter.reserve).
+    """
+    limiter = getattr(client or get_bedrock_client(), 'limiter', None)
+    return limiter.reserve(slots) if limiter is not None else nullcontext()
+
+
+def effective_concurrency(concurrency: int) -> int:
+    """Bedrock calls a run of `concurrency` workers gets in flight: its reservation, up to the ceiling"""
+    return max(1, min(concurrency, max(MARKING_CONCURRENCY, BEDROCK_MAX_CONCURRENCY)))
+
+
+def set_bedrock_client(client):
+    """Replace the process-wide client, e.g. with a fake backend behind its own RateLimiter"""
+    global bedrock_runtime
+    with _bedrock_runtime_lock:
+        bedrock_runtime = client
+
+
+class TokenUsage:
+    """Thread-safe running totals of the `usage` block returned by Bedrock, overall and per model"""
+
+    FIELDS = ['input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.totals = {field: 0 for field in self.FIELDS}
+            self.by_model = {}
+
+    def add(self, usage: Dict, model_id: str = BEDROCK_LARGE_MODEL_ID):
+        with self._lock:
+            self.calls += 1
+            model_totals = self.by_model.setdefault(model_id, {'calls': 0, **{field: 0 for field in self.FIELDS}})
+            model_totals['calls'] += 1
+            for field in self.FIELDS:
+                self.totals[field] += usage.get(field) or 0
+                model_totals[field] += usage.get(field) or 0
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {'calls': self.calls, **self.totals}
+
+    def snapshot_by_model(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {model_id: dict(totals) for model_id, totals in self.by_model.items()}
+
+
+def estimate_cost(usage: Dict, model_id: str) -> float:
+    """Estimated USD cost of a usage block at the configured per-million-token prices"""
+    input_price, output_price = MODEL_PRICES.get(model_id, MODEL_PRICES[BEDROCK_LARGE_MODEL_ID])
+    return ((usage.get('input_tokens') or 0) * input_price
+            + (usage.get('cache_read_input_tokens') or 0) * input_price * 0.1
+            + (usage.get('cache_creation_input_tokens') or 0) * input_price * 1.25
+            + (usage.get('output_tokens') or 0) * output_price) / 1_000_000
+
+
+# ----- Metrics -----
+METRICS_DIR = os.getenv('METRICS_DIR', 'outputs/metrics')
+
+# Process-wide totals; never reset, so concurrent sessions and jobs do not clear each other's counts
+token_usage = TokenUsage()
+call_metrics = MetricsRecorder()
+
+# The per-run counters (see count_usage) the current thread or asyncio task is making calls for
+_run_usage: ContextVar[Tuple[TokenUsage, ...]] = ContextVar('run_usage', default=())
+
+
+@contextmanager
+def count_usage(usage: TokenUsage) -> Iterator[TokenUsage]:
+    """Also add the usage of the Bedrock calls made inside the block to `usage`
+
+    Worker threads started with fair_scheduler.bind_flow() inside the block
+    count towards it too, so a marking run, job or ingest can report its own
+    usage while others run in the same process. Blocks nest.
+    """
+    token = _run_usage.set(_run_usage.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _run_usage.reset(token)
+
+
+def add_usage(usage: Dict, model_id: str = BEDROCK_LARGE_MODEL_ID):
+    """Add a call's usage block to `token_usage` and to the runs counting it"""
+    token_usage.add(usage, model_id)
+    for run_usage in _run_usage.get():
+        run_usage.add(usage, model_id)
+
+
+def _limiter_stats(client) -> Optional[CallStats]:
+    """Retry stats of the call just made on this thread, if the client is rate limited"""
+    limiter = getattr(client, 'limiter', None)
+    return limiter.last_call_stats() if limiter else None
+
+
+def record_call(model_id: str, operation: str, start: float, usage: Dict, stats: Optional[CallStats],
+                labels: Dict[str, str], ttft_seconds: Optional[float] = None, error: str = "",
+                stop_reason: str = ""):
+    """Add one Bedrock call to `call_metrics`"""
+    call_metrics.record(CallRecord(
+        timestamp=time.time(),
+        model=model_id,
+        operation=operation,
+        kind=labels.get('kind', ""),
+        essay=labels.get('essay', ""),
+        wall_seconds=round(time.perf_counter() - start, 4),
+        ttft_seconds=round(ttft_seconds, 4) if ttft_seconds is not None else None,
+        input_tokens=usage.get('input_tokens') or 0,
+        output_tokens=usage.get('output_tokens') or 0,
+        cache_read_input_tokens=usage.get('cache_read_input_tokens') or 0,
+        cache_creation_input_tokens=usage.get('cache_creation_input_tokens') or 0,
+        attempts=stats.attempts if stats else 1,
+        throttles=stats.throttles if stats else 0,
+        retry_wait_seconds=round(stats.retry_wait_seconds, 3) if stats else 0.0,
+        rate_wait_seconds=round(stats.rate_wait_seconds + stats.concurrency_wait_seconds, 3) if stats else 0.0,
+        queue_wait_seconds=round(stats.queue_wait_seconds, 3) if stats else 0.0,
+        cost_usd=estimate_cost(usage, model_id),
+        stop_reason=stop_reason or "",
+        error=error
+    ))
+
+
+def request_body(messages: List[Dict], **kwargs) -> Dict:
+    """Anthropic Messages request body with the default inference parameters, overridden by `kwargs`"""
+    body = {
+        "messages": messages,
+        **DEFAULT_INFERENCE_PARAMS,
+        "stop_sequences": [
+            "\\n\\nHuman:"
+        ],
+        "anthropic_version": "bedrock-2023-05-31"
+    }
+
+    for parameter in ['max_tokens', 'temperature', 'top_k', 'top_p']:
+        if parameter in kwargs:
+            body[parameter] = kwargs[parameter]
+    return body
+
+
+def prompt_messages(prompt: Union[str, List[Dict]], prefill: str = "") -> List[Dict]:
+    """A user message from a text prompt or a list of content blocks, plus any assistant prefill
+
+    A prefill (e.g. a reply cut off at max_tokens) makes the model continue
+    from where that text ends.
+    """
+    content = [{"type": "text", "text": prompt}] if isinstance(prompt, str) else prompt
+    messages = [{"role": "user", "content": content}]
+    if prefill:
+        # Bedrock rejects a final assistant message that ends in whitespace
+        messages.append({"role": "assistant", "content": prefill.rstrip()})
+    return messages
+
+
+# Stop reason of the last call made by this thread (or asyncio task), e.g. 'end_turn' or 'max_tokens'
+_stop_reason: ContextVar[str] = ContextVar('stop_reason', default="")
+
+
+def last_stop_reason() -> str:
+    return _stop_reason.get()
+
+
+def set_stop_reason(stop_reason: str):
+    """Record the stop reason of a call made by another client (e.g. the asyncio one) for last_stop_reason()"""
+    _stop_reason.set(stop_reason or "")
+
+
+def log_usage(usage: Dict):
+    logger.info(
+        f"Token usage: input={usage.get('input_tokens', 0)} output={usage.get('output_tokens', 0)} "
+        f"cache_read={usage.get('cache_read_input_tokens', 0)} "
+        f"cache_write={usage.get('cache_creation_input_tokens', 0)}"
+    )
+
+
+def response_text(response_body: Dict) -> Union[str, Dict]:
+    """The text of a Messages response, or the whole response if it has no text blocks"""
+    content = response_body.get("content", [])
+    completion = [c['text'] for c in content if c['type'] == 'text']
+    if len(completion) > 0:
+        return '\n'.join(completion)
+    else:
+        return response_body
+
+
+def parse_stream_event(event: Dict, usage: Dict) -> Optional[str]:
+    """Text of a response stream event, if any; usage from message_start/message_delta is merged into `usage`"""
+    chunk = event.get('chunk')
+    if not chunk:
+        return None
+    chunk_obj = json.loads(chunk.get('bytes').decode())
+    if chunk_obj['type'] == 'content_block_delta':
+        return chunk_obj['delta'].get('text') or None
+    if chunk_obj['type'] == 'message_start':
+        usage.update(chunk_obj.get('message', {}).get('usage', {}))
+    elif chunk_obj['type'] == 'message_delta':
+        usage.update(chunk_obj.get('usage', {}))
+        _stop_reason.set(chunk_obj.get('delta', {}).get('stop_reason') or "")
+    return None
+
+
+def invoke_claude_sonnet(prompt: Union[str, List[Dict]], client=None,
+                         model_id: str = BEDROCK_LARGE_MODEL_ID, prefill: str = "", **kwargs):
+    """Invoke a Claude model (Sonnet by default) with a text prompt or a list of content blocks
+
+    Token usage from the response, including prompt cache reads and writes, is
+    added to `token_usage` (see add_usage), and the call's timing, usage and retries to
+    `call_metrics`; last_stop_reason() then returns its stop reason. `client`
+    defaults to the shared Bedrock runtime client and can be replaced with a
+    stub for local testing. With `prefill`, the reply continues that text.
+    """
+    body = request_body(prompt_messages(prompt, prefill), **kwargs)
+
+    client = client or get_bedrock_client()
+    labels = current_labels()
+    start = time.perf_counter()
+    try:
+        response = client.invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body)
+        )
+        response_body = json.loads(response.get('body').read())
+    except Exception as e:
+        record_call(model_id, 'invoke', start, {}, _limiter_stats(client), labels, error=error_code(e))
+        raise
+
+    usage = response_body.get("usage", {})
+    _stop_reason.set(response_body.get("stop_reason") or "")
+    add_usage(usage, model_id)
+    record_call(model_id, 'invoke', start, usage, _limiter_stats(client), labels,
+                stop_reason=last_stop_reason())
+    log_usage(usage)
+    return response_text(response_body)
+
+
+def invoke_claude_with_response_stream(messages, client=None, model_id: str = BEDROCK_LARGE_MODEL_ID, **kwargs):
+    """Invoke Claude model with streaming response"""
+    body = request_body(messages, **kwargs)
+
+    response_stream = (client or get_bedrock_client()).invoke_model_with_response_stream(
+        modelId=model_id,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps(body)
+    )
+    stream = response_stream.get('body')
+    return stream
+
+
+def bedrock_generator(model_name: str, messages: List[Dict], **kwargs) -> Generator:
+    """Generator for streaming responses from Bedrock
+
+    Keyword arguments (max_tokens, temperature, top_k, top_p, client) are
+    passed through to invoke_claude_with_response_stream. Token usage from the
+    message_start and message_delta events is added with add_usage once the
+    stream finishes, and the call (with its time to first token) to
+    `call_metrics`.
+    """
+    client = kwargs.pop('client', None) or get_bedrock_client()
+    labels = current_labels()
+    start = time.perf_counter()
+    ttft_seconds = None
+    usage = {}
+    stats = None
+    _stop_reason.set("")
+    try:
+        stream = invoke_claude_with_response_stream(messages, client=client, model_id=model_name, **kwargs)
+        stats = _limiter_stats(client)
+        # Closing frees the stream's rate limiter slot even if the consumer stops early
+        with closing(stream):
+            for event in stream:
+                text = parse_stream_event(event, usage)
+                if text:
+                    if ttft_seconds is None:
+                        ttft_seconds = time.perf_counter() - start
+                    yield text
+    except Exception as e:
+        record_call(model_name, 'stream', start, usage, stats or _limiter_stats(client), labels,
+                    ttft_seconds, error=error_code(e))
+        raise
+    add_usage(usage, model_name)
+    record_call(model_name, 'stream', start, usage, stats, labels, ttft_seconds, stop_reason=last_stop_reason())
+
+
+def essay_prompt_prefix(rubric_text: str, feedback_guidance: str) -> Dict:
+    """Content block with the rubric and guidance shared by every essay prompt of a class"""
+    shared_prefix = {
+        "type": "text",
+        "text": f"""You are an expert educator providing detailed feedback on student essays.
+
+<rubric>
+{rubric_text}
+</rubric>
+
+<feedback_guidance>
+{feedback_guidance}
+</feedback_guidance>"""
+    }
+    if BEDROCK_PROMPT_CACHING:
+        shared_prefix["cache_control"] = {"type": "ephemeral"}
+    return shared_prefix
+
+
+def build_essay_prompt(essay_text: str, rubric_text: str, feedback_guidance: str) -> List[Dict]:
+    """Build the essay marking prompt as content blocks
+
+    The rubric and feedback guidance are identical for every essay in a class,
+    so they form a stable prefix marked for Bedrock prompt caching; the essay
+    follows as the variable suffix.
+    """
+    essay_block = {
+        "type": "text",
+        "text": f"""<essay>
+{essay_text}
+</essay>
+
+Based on the essay, rubric, and feedback guidance provided above, generate comprehensive feedback for this student essay. 
+Follow the structure and tone guidelines specified in the feedback guidance.
+
+Provide specific band levels, justifications, and actionable recommendations."""
+    }
+    criteria = parse_rubric(rubric_text)
+    if criteria:
+        essay_block["text"] += "\n\n" + scores_instruction(criteria)
+    return [essay_prompt_prefix(rubric_text, feedback_guidance), essay_block]
+
+
+def prompt_texts(prompt: Union[str, List[Dict]]) -> List[str]:
+    """The text of a prompt's content blocks, without prompt-caching markers, for cache keys"""
+    return [prompt] if isinstance(prompt, str) else [block["text"] for block in prompt]
+
+
+def essay_cache_key(essay_text: str, rubric_text: str, feedback_guidance: str, params: Dict,
+                    model_id: str = BEDROCK_LARGE_MODEL_ID) -> str:
+    """Feedback cache key for a single essay
+
+    The rendered prompt is hashed rather than its inputs, so a change to the
+    prompt template (such as the scores instruction) is a cache miss instead
+    of serving feedback generated with the old prompt.
+    """
+    return make_cache_key(
+        kind="essay",
+        prompt=prompt_texts(build_essay_prompt(essay_text, rubric_text, feedback_guidance)),
+        model=model_id,
+        params=params
+    )
+
+
+def planned_max_tokens(max_tokens: Optional[int]) -> int:
+    """The max_tokens to request first: a planned limit if below ESSAY_MAX_TOKENS, else ESSAY_MAX_TOKENS"""
+    return max_tokens if max_tokens and 0 < max_tokens < ESSAY_MAX_TOKENS else ESSAY_MAX_TOKENS
+
+
+def generate_essay_feedback(essay_text: str, essay_name: str, rubric_text: str, 
+                            feedback_guidance: str, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                            model_id: str = BEDROCK_LARGE_MODEL_ID, max_tokens: Optional[int] = None) -> str:
+    """Generate feedback for a single essay, served from the feedback cache when possible
+
+    `max_tokens` is a planned output limit (see token_planner). A reply that
+    reaches it is continued up to ESSAY_MAX_TOKENS in total, so feedback is
+    never cut shorter than with the fixed limit, and the cache key is that of
+    the fixed limit.
+    """
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    cache_key = essay_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            return cached
+
+    prompt = build_essay_prompt(essay_text, rubric_text, feedback_guidance)
+
+    logger.info(f"Generating feedback for essay: {essay_name}")
+    first_limit = planned_max_tokens(max_tokens)
+    feedback = invoke_claude_sonnet(prompt, model_id=model_id, **{**params, "max_tokens": first_limit})
+    if first_limit < ESSAY_MAX_TOKENS and last_stop_reason() == 'max_tokens':
+        logger.info(f"Feedback for {essay_name} reached its planned {first_limit} tokens; continuing")
+        feedback = feedback.rstrip() + invoke_claude_sonnet(
+            prompt,
+            model_id=model_id,
+            prefill=feedback,
+            **{**params, "max_tokens": ESSAY_MAX_TOKENS - first_limit}
+        )
+    if use_cache:
+        feedback_cache.set(cache_key, feedback)
+    return feedback
+
+
+def stream_essay_feedback(essay_text: str, essay_name: str, rubric_text: str,
+                          feedback_guidance: str, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                          model_id: str = BEDROCK_LARGE_MODEL_ID, max_tokens: Optional[int] = None) -> Generator:
+    """Stream feedback for a single essay as text chunks
+
+    A cache hit is yielded as a single chunk. The completed feedback is stored
+    in the feedback cache once the stream has been fully consumed. A stream
+    that reaches a planned `max_tokens` is continued as in
+    generate_essay_feedback.
+    """
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    cache_key = essay_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            yield cached
+            return
+
+    messages = [{"role": "user", "content": build_essay_prompt(essay_text, rubric_text, feedback_guidance)}]
+
+    logger.info(f"Streaming feedback for essay: {essay_name}")
+    first_limit = planned_max_tokens(max_tokens)
+    chunks = []
+    for text in bedrock_generator(model_id, messages, **{**params, "max_tokens": first_limit}):
+        chunks.append(text)
+        yield text
+    if first_limit < ESSAY_MAX_TOKENS and last_stop_reason() == 'max_tokens':
+        logger.info(f"Feedback for {essay_name} reached its planned {first_limit} tokens; continuing")
+        partial = ''.join(chunks).rstrip()
+        chunks = [partial]
+        continuation = messages + [{"role": "assistant", "content": partial}]
+        remaining = {**params, "max_tokens": ESSAY_MAX_TOKENS - first_limit}
+        for text in bedrock_generator(model_id, continuation, **remaining):
+            chunks.append(text)
+            yield text
+    if use_cache:
+        feedback_cache.set(cache_key, ''.join(chunks))
+
+
+def plan_essay_packs(essays: Dict[str, str], input_token_budget: int = PACKED_INPUT_TOKEN_BUDGET,
+                     max_output_tokens: int = PACKED_MAX_OUTPUT_TOKENS,
+                     output_tokens_per_essay: int = PACKED_OUTPUT_TOKENS_PER_ESSAY) -> List[List[str]]:
+    """Group essay names, in order, into packs for packed marking
+
+    A pack holds as many essays as fit in `input_token_budget` (essay text
+    only; the rubric and guidance are sent once per request) and whose
+    expected feedback fits in `max_output_tokens`. An essay larger than the
+    budget gets a pack of its own.
+    """
+    max_essays = max(1, max_output_tokens // max(1, output_tokens_per_essay))
+    packs = []
+    current = []
+    current_tokens = 0
+    for essay_name, essay_text in essays.items():
+        essay_tokens = estimate_tokens(essay_text)
+        if current and (current_tokens + essay_tokens > input_token_budget or len(current) >= max_essays):
+            packs.append(current)
+            current = []
+            current_tokens = 0
+        current.append(essay_name)
+        current_tokens += essay_tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def build_packed_essay_prompt(essays: Dict[str, str], rubric_text: str, feedback_guidance: str) -> List[Dict]:
+    """Build a prompt that marks several essays in one request
+
+    Essays are numbered from 1 and the model is asked to answer with one
+    <feedback id="n"> block per essay, each with its own <scores> block.
+    """
+    essays_text = "\n\n".join(f'<essay id="{index}">\n{essay_text}\n</essay>'
+                               for index, essay_text in enumerate(essays.values(), 1))
+    essays_block = {
+        "type": "text",
+        "text": f"""{essays_text}
+
+Based on the rubric and feedback guidance provided above, generate comprehensive feedback for each of the {len(essays)} student essays above.
+Mark every essay independently, following the structure and tone guidelines specified in the feedback guidance.
+
+Provide specific band levels, justifications, and actionable recommendations.
+
+Wrap the complete feedback for each essay in <feedback id="n"></feedback> tags, where n is the essay's id, with one block per essay in id order and nothing outside the blocks."""
+    }
+    criteria = parse_rubric(rubric_text)
+    if criteria:
+        essays_block["text"] += ("\n\nEach <feedback> block must end with its own scores block. "
+                                 + scores_instruction(criteria))
+    return [essay_prompt_prefix(rubric_text, feedback_guidance), essays_block]
+
+
+def parse_packed_feedback(response: str, essay_count: int, require_scores: bool = True) -> Dict[int, str]:
+    """Per-essay feedback from a packed response, by essay id
+
+    Blocks with an unknown id, empty text or (when `require_scores`) no
+    <scores> block are dropped, so the caller can re-mark those essays
+    individually. The first block wins if an id is repeated.
+    """
+    feedbacks = {}
+    for match in PACKED_FEEDBACK_PATTERN.finditer(response):
+        index = int(match.group(1))
+        text = match.group(2)
+        if 1 <= index <= essay_count and index not in feedbacks and text \
+                and (not require_scores or '<scores>' in text):
+            feedbacks[index] = text
+    return feedbacks
+
+
+def packed_cache_key(essay_text: str, rubric_text: str, feedback_guidance: str, params: Dict,
+                     model_id: str = BEDROCK_LARGE_MODEL_ID) -> str:
+    """Feedback cache key for an essay marked in a pack
+
+    Packed feedback comes from a different prompt than single-essay feedback,
+    so it is keyed on the essay and the packed prompt template (rendered
+    around an empty essay) instead of sharing essay_cache_key.
+    """
+    return make_cache_key(
+        kind="essay",
+        essay=essay_text,
+        prompt=prompt_texts(build_packed_essay_prompt({"": ""}, rubric_text, feedback_guidance)),
+        model=model_id,
+        params={**params, "mode": "packed"}
+    )
+
+
+def generate_packed_feedback(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                             use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                             model_id: str = BEDROCK_LARGE_MODEL_ID) -> Dict[str, Union[str, Exception]]:
+    """Generate feedback for a pack of essays in a single request
+
+    Essays in the feedback cache are served from it. The rest are marked
+    together; any essay missing or malformed in the response (or all of
+    them, if the packed request fails) is marked with its own request.
+    Packed feedback is cached under packed_cache_key, and feedback from an
+    essay's own request under essay_cache_key. Returns each essay's
+    feedback, or the exception that prevented marking it.
+    """
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    results = {}
+    pending = {}
+    for essay_name, essay_text in essays.items():
+        cached = feedback_cache.get(packed_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id)) \
+            if use_cache else None
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            results[essay_name] = cached
+        else:
+            pending[essay_name] = essay_text
+
+    if len(pending) > 1:
+        packed_params = {
+            **DEFAULT_INFERENCE_PARAMS,
+            "max_tokens": min(PACKED_MAX_OUTPUT_TOKENS, ESSAY_MAX_TOKENS * len(pending))
+        }
+        logger.info(f"Generating packed feedback for {len(pending)} essays: {', '.join(pending)}")
+        try:
+            with call_context(essay=','.join(pending), kind='packed'):
+                response = invoke_claude_sonnet(
+                    build_packed_essay_prompt(pending, rubric_text, feedback_guidance),
+                    model_id=model_id,
+                    **packed_params
+                )
+            parsed = parse_packed_feedback(response if isinstance(response, str) else "",
+                                           len(pending), require_scores=bool(parse_rubric(rubric_text)))
+        except Exception as e:
+            logger.warning(f"Packed request failed ({str(e)}); marking {len(pending)} essays individually")
+            parsed = None
+        for index, (essay_name, essay_text) in enumerate(list(pending.items()), 1):
+            if parsed and index in parsed:
+                results[essay_name] = parsed[index]
+                if use_cache:
+                    feedback_cache.set(
+                        packed_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id),
+                        parsed[index]
+                    )
+                del pending[essay_name]
+        if pending and parsed is not None:
+            logger.warning(f"Packed response missed or malformed {len(pending)} essay(s); "
+                           f"marking individually: {', '.join(pending)}")
+
+    for essay_name, essay_text in pending.items():
+        try:
+            with call_context(essay=essay_name, kind='essay'):
+                results[essay_name] = generate_essay_feedback(essay_text, essay_name, rubric_text,
+                                                              feedback_guidance, use_cache, model_id)
+        except Exception as e:
+            results[essay_name] = e
+    return results
+
+
+def essay_content_block(essay_text: str) -> Dict:
+    """The essay as a content block, cached so every criterion request of the essay reuses it"""
+    essay_block = {"type": "text", "text": f"<essay>\n{essay_text}\n</essay>"}
+    if BEDROCK_PROMPT_CACHING:
+        essay_block["cache_control"] = {"type": "ephemeral"}
+    return essay_block
+
+
+def build_criterion_prompt(essay_text: str, criterion: Criterion, rubric_text: str,
+                           feedback_guidance: str) -> List[Dict]:
+    """Prompt for the feedback on a single rubric criterion
+
+    The rubric/guidance prefix and the essay are both cache points, so the
+    criterion instruction is the only uncached part after the first request.
+    """
+    instruction = {
+        "type": "text",
+        "text": f"""Assess this essay against one rubric criterion only: **{criterion.name}**.
+
+<band_descriptors>
+{criterion.descriptors}
+</band_descriptors>
+
+Write the "{criterion.name}" section of the feedback, following the feedback guidance: the band awarded and its
+point range, a justification quoting the essay, strengths, and areas for improvement. Start with a
+"### {criterion.name}" heading and keep it under 300 words. Do not comment on other criteria.
+
+{scores_instruction((criterion,))}"""
+    }
+    return [essay_prompt_prefix(rubric_text, feedback_guidance), essay_content_block(essay_text), instruction]
+
+
+def build_synthesis_prompt(essay_text: str, sections: List[str], scores_table: str, rubric_text: str,
+                           feedback_guidance: str) -> List[Dict]:
+    """Prompt that turns the per-criterion sections into the opening and closing of the feedback"""
+    assessments = '\n\n'.join(sections)
+    instruction = {
+        "type": "text",
+        "text": f"""Each rubric criterion of this essay has been assessed separately:
+
+<criterion_feedback>
+{assessments}
+</criterion_feedback>
+
+Awarded bands and points:
+{scores_table}
+
+Write only the parts of the feedback that tie these together, following the feedback guidance:
+<overall>an overall assessment with the band for each criterion, the total score and percentage, and a brief
+summary of strengths and areas for improvement</overall>
+<closing>3-5 prioritised action items, then a short encouraging close</closing>
+Do not repeat the criterion sections. Keep both parts under 300 words in total."""
+    }
+    return [essay_prompt_prefix(rubric_text, feedback_guidance), essay_content_block(essay_text), instruction]
+
+
+def generate_fanout_feedback(essay_text: str, essay_name: str, rubric_text: str, feedback_guidance: str,
+                             use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                             model_id: str = BEDROCK_LARGE_MODEL_ID) -> str:
+    """Generate feedback with one concurrent request per rubric criterion plus a short synthesis
+
+    The criterion sections are assembled between the synthesis's overall
+    assessment and closing, followed by a <scores> block built from the
+    criterion scores, so the result has the same shape as monolithic
+    feedback. Rubrics with fewer than two criteria are marked monolithically.
+    """
+    criteria = parse_rubric(rubric_text)
+    if len(criteria) < 2:
+        return generate_essay_feedback(essay_text, essay_name, rubric_text, feedback_guidance, use_cache, model_id)
+
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CRITERION_MAX_TOKENS}
+    templates = [prompt_texts(build_criterion_prompt(essay_text, criterion, rubric_text, feedback_guidance))
+                 for criterion in criteria]
+    templates.append(prompt_texts(build_synthesis_prompt(essay_text, [], "", rubric_text, feedback_guidance)))
+    cache_key = essay_cache_key(essay_text, rubric_text, feedback_guidance,
+                                {**params, "mode": "fanout", "synthesis_max_tokens": SYNTHESIS_MAX_TOKENS,
+                                 "templates": templates}, model_id)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Feedback cache hit for essay: {essay_name}")
+            return cached
+
+    logger.info(f"Generating feedback for essay: {essay_name} ({len(criteria)} criteria in parallel)")
+    labels = current_labels()
+
+    def assess(criterion: Criterion) -> str:
+        with call_context(**{**labels, 'kind': 'criterion'}):
+            return invoke_claude_sonnet(
+                build_criterion_prompt(essay_text, criterion, rubric_text, feedback_guidance),
+                model_id=model_id,
+                **params
+            )
+
+    with ThreadPoolExecutor(max_workers=len(criteria)) as executor:
+        responses = list(executor.map(bind_flow(assess), criteria))
+
+    sections = []
+    criterion_scores = {}
+    for response in responses:
+        section, scores = extract_scores(response, rubric_text)
+        sections.append(section)
+        criterion_scores.update(scores.get('criteria', {}))
+    scores_table = '\n'.join(f"- {name}: Band {score['band']}, {score['points']} points"
+                             for name, score in criterion_scores.items())
+
+    with call_context(kind='synthesis'):
+        synthesis = invoke_claude_sonnet(
+            build_synthesis_prompt(essay_text, sections, scores_table, rubric_text, feedback_guidance),
+            model_id=model_id,
+            **{**DEFAULT_INFERENCE_PARAMS, "max_tokens": SYNTHESIS_MAX_TOKENS}
+        )
+    parts = dict(SYNTHESIS_SECTION_PATTERN.findall(synthesis))
+    overall = parts.get('overall', synthesis if not parts else "")
+    closing = parts.get('closing', "")
+
+    points = [score['points'] for score in criterion_scores.values() if score['points'] is not None]
+    scores_block = {
+        "criteria": [{"criterion": name, "band": score['band'], "points": score['points']}
+                     for name, score in criterion_scores.items()],
+        "total": sum(points) if points else None,
+    }
+    feedback = '\n\n'.join(part for part in [
+        "## Overall Assessment", overall,
+        "## Detailed Category Feedback", *sections,
+        closing,
+        f"<scores>{json.dumps(scores_block)}</scores>",
+    ] if part)
+    if use_cache:
+        feedback_cache.set(cache_key, feedback)
+    return feedback
+
+
+def build_class_prompt(feedback_summary: str, rubric_text: str, statistics_table: str = "") -> str:
+    """Build the class analysis prompt from the summarised individual feedbacks
+
+    When `statistics_table` (computed locally from the structured scores) is
+    given, the model is told to report it rather than count bands itself.
+    """
+    if statistics_table:
+        statistics_section = f"""
+
+<class_statistics>
+{statistics_table}
+</class_statistics>"""
+        distribution_item = "Distribution of band levels across the class, taken from the class statistics above (do not recount)"
+    else:
+        statistics_section = ""
+        distribution_item = "Distribution of band levels across the class"
+
+    return f"""You are an expert educator analyzing overall class performance on an essay assignment.
+
+<rubric>
+{rubric_text}
+</rubric>{statistics_section}
+
+<individual_feedbacks>
+{feedback_summary}
+</individual_feedbacks>
+
+Based on the rubric and the individual student feedbacks provided above, generate a comprehensive class-level analysis that includes:
+
+1. **Overall Performance Summary**
+   - {distribution_item}
+   - General trends and patterns
+
+2. **What Went Well**
+   - Common strengths across multiple students
+   - Successful application of concepts
+   - Positive patterns observed
+
+3. **Areas for Improvement**
+   - Common weaknesses or gaps
+   - Recurring issues across multiple essays
+   - Misconceptions that need addressing
+
+4. **Recommendations for Next Steps**
+   - Specific teaching strategies to address common issues
+   - Topics that need re-teaching or reinforcement
+   - Suggested activities or exercises for the whole class
+   - Differentiation strategies for different performance levels
+
+5. **Positive Observations**
+   - Growth areas
+   - Promising developments
+   - Student engagement indicators
+
+Format the response in clear Markdown with appropriate headings and bullet points."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) used for prompt budgeting"""
+    return len(text) // 4 + 1
+
+
+def chunk_by_tokens(parts: List[str], token_budget: int) -> List[List[str]]:
+    """Greedily pack parts into chunks of at most `token_budget` estimated tokens
+
+    A part larger than the budget gets a chunk of its own.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for part in parts:
+        part_tokens = estimate_tokens(part)
+        if current and current_tokens + part_tokens > token_budget:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(part)
+        current_tokens += part_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_digest_prompt(chunk_text: str, rubric_text: str) -> str:
+    """Build the prompt that condenses a chunk of feedbacks into a class digest"""
+    return f"""You are an expert educator condensing essay feedback for a class-level analysis.
+
+<rubric>
+{rubric_text}
+</rubric>
+
+<feedbacks>
+{chunk_text}
+</feedbacks>
+
+The feedbacks above are either individual essay feedbacks or earlier digests of them. Condense them into a compact digest:
+
+1. A "Bands" section with exactly one line per essay, in the form
+   `Essay: <name> | <criterion>: Band <n> (<points>) | ... | Total: <points>`
+   covering every rubric criterion. If the input is already a digest, copy its band lines unchanged. Never drop an essay.
+2. A "Strengths" section listing common strengths, each with the number of essays showing it.
+3. A "Weaknesses" section listing common weaknesses and misconceptions, each with the number of essays showing it.
+4. A "Notable" section with brief standout observations.
+
+Be concise and factual; do not add recommendations."""
+
+
+def digest_cache_key(chunk_text: str, rubric_text: str, params: Dict) -> str:
+    """Feedback cache key for the digest of a chunk of feedbacks (hashing the rendered prompt)"""
+    return make_cache_key(
+        kind="class_digest",
+        prompt=build_digest_prompt(chunk_text, rubric_text),
+        model=BEDROCK_LARGE_MODEL_ID,
+        params=params
+    )
+
+
+class DigestTruncated(Exception):
+    """A digest still cut off at max_tokens after CLASS_DIGEST_MAX_CONTINUATIONS continuations"""
+
+
+def generate_feedback_digest(chunk_text: str, rubric_text: str,
+                             use_cache: bool = FEEDBACK_CACHE_ENABLED) -> str:
+    """Condense a chunk of feedbacks into a digest (the map step of class analysis)
+
+    A digest that reaches CLASS_DIGEST_MAX_TOKENS is continued; one still cut
+    off raises DigestTruncated rather than silently dropping band lines, and
+    is not cached.
+    """
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CLASS_DIGEST_MAX_TOKENS}
+    cache_key = digest_cache_key(chunk_text, rubric_text, params)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    prompt = build_digest_prompt(chunk_text, rubric_text)
+    with call_context(kind='digest'):
+        digest = invoke_claude_sonnet(prompt, **params)
+        for _ in range(CLASS_DIGEST_MAX_CONTINUATIONS):
+            if last_stop_reason() != 'max_tokens':
+                break
+            logger.info(f"Class digest reached {CLASS_DIGEST_MAX_TOKENS} tokens; continuing")
+            digest = digest.rstrip() + invoke_claude_sonnet(prompt, prefill=digest, **params)
+    if last_stop_reason() == 'max_tokens':
+        raise DigestTruncated(f"Class digest still cut off after {CLASS_DIGEST_MAX_CONTINUATIONS} continuation(s)")
+    if use_cache:
+        feedback_cache.set(cache_key, digest)
+    return digest
+
+
+def split_truncated_digests(chunk: List[str], digest: Callable[[List[str]], str]) -> List[str]:
+    """Digest `chunk`, splitting it in two (recursively) while its digest is cut off
+
+    A single part that still cannot be condensed is kept in full, so no
+    essay's bands are lost.
+    """
+    try:
+        return [digest(chunk)]
+    except DigestTruncated:
+        if len(chunk) == 1:
+            logger.warning("A feedback part could not be condensed within the digest limit; keeping it in full")
+            return chunk
+        logger.info(f"Digest of {len(chunk)} feedback part(s) was cut off; splitting the chunk in two")
+        half = len(chunk) // 2
+        return split_truncated_digests(chunk[:half], digest) + split_truncated_digests(chunk[half:], digest)
+
+
+def warn_if_over_budget(summary_tokens: int, levels: int):
+    """Warn that the class prompt input is still over CLASS_FEEDBACK_TOKEN_BUDGET after condensing"""
+    if summary_tokens > CLASS_FEEDBACK_TOKEN_BUDGET:
+        logger.warning(f"Feedback summary is ~{summary_tokens} tokens after {levels} digest level(s), over "
+                       f"CLASS_FEEDBACK_TOKEN_BUDGET ({CLASS_FEEDBACK_TOKEN_BUDGET}); sending it as is")
+
+
+def summarise_feedbacks(all_feedbacks: List[Dict[str, str]], rubric_text: str,
+                        use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                        max_workers: int = MARKING_CONCURRENCY) -> str:
+    """Prepare the individual feedbacks for the class prompt
+
+    Full feedbacks are used when they fit in CLASS_FEEDBACK_TOKEN_BUDGET.
+    Otherwise they are packed into chunks of CLASS_DIGEST_CHUNK_TOKENS, each
+    chunk is condensed into a digest in parallel, and the digests are reduced
+    again until the result fits, so every essay's bands are carried through.
+    A chunk whose digest is cut off is split in two (see
+    split_truncated_digests). If the result still does not fit after
+    CLASS_DIGEST_MAX_LEVELS levels, or a level stops shrinking it, a warning
+    is logged and it is sent as is.
+    """
+    separator = "\n\n---\n\n"
+    parts = [f"Essay: {item['name']}\n{item['feedback']}" for item in all_feedbacks]
+
+    def digest(chunk: List[str]) -> str:
+        return generate_feedback_digest(separator.join(chunk), rubric_text, use_cache)
+
+    summary_tokens = estimate_tokens(separator.join(parts))
+    level = 0
+    while summary_tokens > CLASS_FEEDBACK_TOKEN_BUDGET and level < CLASS_DIGEST_MAX_LEVELS:
+        level += 1
+        chunks = chunk_by_tokens(parts, CLASS_DIGEST_CHUNK_TOKENS)
+        logger.info(f"Condensing {len(parts)} feedback part(s) into {len(chunks)} digest(s) (level {level})")
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            digests = executor.map(bind_flow(lambda chunk: split_truncated_digests(chunk, digest)), chunks)
+            parts = [part for chunk_digests in digests for part in chunk_digests]
+        previous_tokens, summary_tokens = summary_tokens, estimate_tokens(separator.join(parts))
+        if summary_tokens >= previous_tokens:
+            break
+
+    warn_if_over_budget(summary_tokens, level)
+    return separator.join(parts)
+
+
+def class_statistics_table(all_feedbacks: List[Dict], rubric_text: str) -> str:
+    """Markdown table of class statistics from the feedbacks' structured scores, if any"""
+    records = [item['scores'] for item in all_feedbacks
+               if isinstance(item.get('scores'), dict) and item['scores'].get('criteria')]
+    if not records:
+        return ""
+    return format_statistics_table(class_statistics(records, rubric_text))
+
+
+def class_cache_key(feedback_summary: str, rubric_text: str, statistics_table: str, params: Dict) -> str:
+    """Feedback cache key for the class overall feedback (hashing the rendered prompt)"""
+    return make_cache_key(
+        kind="class",
+        prompt=build_class_prompt(feedback_summary, rubric_text, statistics_table),
+        model=BEDROCK_LARGE_MODEL_ID,
+        params=params
+    )
+
+
+def generate_class_feedback(all_feedbacks: List[Dict[str, str]], rubric_text: str,
+                            use_cache: bool = FEEDBACK_CACHE_ENABLED) -> str:
+    """Generate overall class feedback based on all individual feedbacks"""
+    feedback_summary = summarise_feedbacks(all_feedbacks, rubric_text, use_cache)
+    statistics_table = class_statistics_table(all_feedbacks, rubric_text)
+
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CLASS_MAX_TOKENS}
+    cache_key = class_cache_key(feedback_summary, rubric_text, statistics_table, params)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Feedback cache hit for class overall feedback")
+            return cached
+
+    prompt = build_class_prompt(feedback_summary, rubric_text, statistics_table)
+
+    logger.info("Generating class overall feedback")
+    with call_context(kind='class'):
+        class_feedback = invoke_claude_sonnet(prompt, **params)
+    if use_cache:
+        feedback_cache.set(cache_key, class_feedback)
+    return class_feedback
+
+
+def stream_class_feedback(all_feedbacks: List[Dict[str, str]], rubric_text: str,
+                          use_cache: bool = FEEDBACK_CACHE_ENABLED) -> Generator:
+    """Stream overall class feedback as text chunks"""
+    feedback_summary = summarise_feedbacks(all_feedbacks, rubric_text, use_cache)
+    statistics_table = class_statistics_table(all_feedbacks, rubric_text)
+
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": CLASS_MAX_TOKENS}
+    cache_key = class_cache_key(feedback_summary, rubric_text, statistics_table, params)
+    if use_cache:
+        cached = feedback_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Feedback cache hit for class overall feedback")
+            yield cached
+            return
+
+    messages = [{"role": "user", "content": [{"type": "text", "text": build_class_prompt(feedback_summary, rubric_text, statistics_table)}]}]
+
+    logger.info("Streaming class overall feedback")
+    chunks = []
+    with call_context(kind='class'):
+        for text in bedrock_generator(BEDROCK_LARGE_MODEL_ID, messages, **params):
+            chunks.append(text)
+            yield text
+    if use_cache:
+        feedback_cache.set(cache_key, ''.join(chunks))
+
+
+def atomic_write_text(path: Union[str, Path], text: str):
+    """Write a UTF-8 text file under a temporary name and rename it into place"""
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def feedback_file_path(essay_name: str, output_dir: str = "outputs") -> str:
+    return os.path.join(output_dir, f"{Path(essay_name).stem}.feedback.txt")
+
+
+def save_feedback_file(essay_name: str, feedback: str, output_dir: str = "outputs") -> str:
+    """Save feedback to a file"""
+    os.makedirs(output_dir, exist_ok=True)
+    feedback_path = feedback_file_path(essay_name, output_dir)
+    atomic_write_text(feedback_path, feedback)
+    
+    logger.info(f"Saved feedback to: {feedback_path}")
+    return feedback_path
+
+
+def save_class_feedback(class_feedback: str, output_dir: str = "outputs") -> str:
+    """Save class feedback to a file"""
+    os.makedirs(output_dir, exist_ok=True)
+    class_feedback_path = os.path.join(output_dir, "class_overall.feedback.md")
+    atomic_write_text(class_feedback_path, class_feedback)
+    
+    logger.info(f"Saved class feedback to: {class_feedback_path}")
+    return class_feedback_path
+
+
+def mark_essays(essays: Union[Dict[str, str], Iterable[Tuple[str, str]]], rubric_text: str, feedback_guidance: str,
+                max_workers: int = MARKING_CONCURRENCY, output_dir: str = "outputs",
+                use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                on_complete: Optional[Callable[[int, int, str, Optional[Exception]], None]] = None,
+                on_delta: Optional[Callable[[str, str], None]] = None,
+                on_tick: Optional[Callable[[], None]] = None,
+                tick_interval: float = 0.25,
+                route: Optional[Callable[[str, str], str]] = None,
+                pack: bool = PACKED_MARKING_ENABLED,
+                fanout: bool = CRITERION_FANOUT_ENABLED,
+                max_tokens: Optional[Dict[str, int]] = None
+                ) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
+    """Mark essays concurrently with a bounded worker pool
+
+    `essays` is a mapping of name to text, or an iterable of (name, text)
+    pairs such as essay_ingest.iter_essays(), in which case each essay is
+    submitted as it arrives, so marking starts while the rest are still being
+    read, and the total passed to `on_complete` is the number arrived so far.
+    Feedback files are saved as each essay completes, on a writer thread so
+    disk writes do not hold up the completion loop; all are written by the
+    time this returns. `on_complete` is called from the calling thread with
+    (completed, total, essay_name, error).
+    If `on_delta` is given, feedback is streamed and `on_delta` is called from
+    the worker threads with (essay_name, text) for every chunk; `on_tick` is
+    called from the calling thread every `tick_interval` seconds so it can
+    render the in-flight text. `route`, if given, is called from the worker
+    threads with (essay_name, essay_text) and returns the model ID to mark
+    that essay with (see model_router.ModelRouter).
+    With `pack` (and no `on_delta`), essays (all of them, read first) are
+    grouped by plan_essay_packs() and each pack is marked in one request per model (see
+    generate_packed_feedback); the seconds recorded for a packed essay are
+    those of its whole pack. With `fanout`, each essay not in a pack is marked
+    with one concurrent request per rubric criterion plus a synthesis (see
+    generate_fanout_feedback); streamed essays then arrive as a single chunk.
+    `max_tokens` maps essay names to planned output limits (see
+    token_planner.plan_marking) for essays marked one per request.
+    Each record carries the structured band/points record parsed from the
+    feedback under 'scores', the model used and the seconds taken. Returns the feedback records in the order the
+    essays were given, plus a mapping of essay name to error message for
+    essays that failed.
+    """
+    streamed = not isinstance(essays, dict)
+    if streamed and pack and on_delta is None:
+        essays, streamed = dict(essays), False
+    texts = {} if streamed else essays
+    essay_names = [] if streamed else list(essays.keys())
+    total_essays = len(essay_names)
+    results = {}
+    errors = {}
+
+    def mark_one(essay_name):
+        start = time.perf_counter()
+        with call_context(essay=essay_name, kind='essay'):
+            model_id = route(essay_name, texts[essay_name]) if route else BEDROCK_LARGE_MODEL_ID
+            if fanout:
+                feedback = generate_fanout_feedback(
+                    texts[essay_name],
+                    essay_name,
+                    rubric_text,
+                    feedback_guidance,
+                    use_cache,
+                    model_id
+                )
+                if on_delta is not None:
+                    on_delta(essay_name, feedback)
+            elif on_delta is None:
+                feedback = generate_essay_feedback(
+                    texts[essay_name],
+                    essay_name,
+                    rubric_text,
+                    feedback_guidance,
+                    use_cache,
+                    model_id,
+                    (max_tokens or {}).get(essay_name)
+                )
+            else:
+                chunks = []
+                for text in stream_essay_feedback(texts[essay_name], essay_name, rubric_text, feedback_guidance,
+                                                  use_cache, model_id, (max_tokens or {}).get(essay_name)):
+                    chunks.append(text)
+                    on_delta(essay_name, text)
+                feedback = ''.join(chunks)
+        return {essay_name: (feedback, model_id, time.perf_counter() - start)}
+
+    def mark_pack(pack_names):
+        start = time.perf_counter()
+        names_by_model = {}
+        for essay_name in pack_names:
+            with call_context(essay=essay_name, kind='essay'):
+                model_id = route(essay_name, essays[essay_name]) if route else BEDROCK_LARGE_MODEL_ID
+            names_by_model.setdefault(model_id, []).append(essay_name)
+        outcomes = {}
+        for model_id, names in names_by_model.items():
+            feedbacks = generate_packed_feedback({name: essays[name] for name in names}, rubric_text,
+                                                 feedback_guidance, use_cache, model_id)
+            for essay_name in names:
+                feedback = feedbacks[essay_name]
+                outcomes[essay_name] = feedback if isinstance(feedback, Exception) \
+                    else (feedback, model_id, time.perf_counter() - start)
+        return outcomes
+
+    # Worker threads make their calls in the caller's fair-share flow
+    mark_one = bind_flow(mark_one)
+    mark_pack = bind_flow(mark_pack)
+
+    # Essays read from a stream are submitted by a feeder thread and handed to this loop through `arrivals`
+    arrivals = queue.Queue()
+
+    def feed(executor):
+        try:
+            for essay_name, essay_text in essays:
+                texts[essay_name] = essay_text
+                arrivals.put((essay_name, executor.submit(mark_one, essay_name)))
+        except Exception as e:
+            logger.error(f"Error reading essays: {str(e)}")
+            errors['<essays>'] = str(e)
+        finally:
+            arrivals.put(None)
+
+    # Each worker makes one call at a time, or one per criterion when fanning out
+    calls_per_worker = max(1, len(parse_rubric(rubric_text))) if fanout else 1
+    writes = {}
+    with reserve_concurrency(max(1, max_workers) * calls_per_worker), \
+            ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="feedback-writer") as file_writer:
+        if streamed:
+            futures = {}
+            threading.Thread(target=feed, args=(executor,), name="essay-feed", daemon=True).start()
+        elif pack and on_delta is None:
+            packs = plan_essay_packs(essays)
+            logger.info(f"Marking {total_essays} essays in {len(packs)} packed request(s)")
+            futures = {executor.submit(mark_pack, pack_names): pack_names for pack_names in packs}
+        else:
+            futures = {executor.submit(mark_one, essay_name): [essay_name] for essay_name in essay_names}
+        pending = set(futures)
+        completed = 0
+        feeding = streamed
+
+        while pending or feeding:
+            # Take every essay that has arrived; wait for one only when nothing else is in flight
+            while feeding:
+                try:
+                    arrival = arrivals.get(block=not pending, timeout=tick_interval)
+                except queue.Empty:
+                    break
+                if arrival is None:
+                    feeding = False
+                    break
+                essay_names.append(arrival[0])
+                futures[arrival[1]] = [arrival[0]]
+                pending.add(arrival[1])
+            total_essays = len(essay_names)
+            if not pending:
+                if on_tick:
+                    on_tick()
+                continue
+
+            done, pending = wait(pending, timeout=tick_interval if on_tick or feeding else None,
+                                 return_when=FIRST_COMPLETED)
+            if on_tick:
+                on_tick()
+
+            for future in done:
+                try:
+                    outcomes = future.result()
+                except Exception as e:
+                    outcomes = {essay_name: e for essay_name in futures[future]}
+
+                for essay_name in futures[future]:
+                    completed += 1
+                    error = None
+                    try:
+                        outcome = outcomes[essay_name]
+                        if isinstance(outcome, Exception):
+                            raise outcome
+                        raw_feedback, model_id, seconds = outcome
+                        feedback, scores = extract_scores(raw_feedback, rubric_text)
+                        writes[essay_name] = file_writer.submit(save_feedback_file, essay_name, feedback, output_dir)
+                        results[essay_name] = {
+                            'name': essay_name,
+                            'feedback': feedback,
+                            'path': feedback_file_path(essay_name, output_dir),
+                            'scores': scores,
+                            'model': model_id,
+                            'seconds': round(seconds, 3)
+                        }
+                    except Exception as e:
+                        error = e
+                        errors[essay_name] = str(e)
+                        logger.error(f"Error processing {essay_name}: {str(e)}")
+
+                    if on_complete:
+                        on_complete(completed, total_essays, essay_name, error)
+
+    for essay_name, write in writes.items():
+        if write.exception() is not None:
+            # The feedback is still returned (and stored by the caller); only the file is missing
+            logger.error(f"Error saving feedback for {essay_name}: {str(write.exception())}")
+            results[essay_name]['path'] = ''
+
+    generated_feedbacks = [results[name] for name in essay_names if name in results]
+    return generated_feedbacks, errors
+
+
+_text_file_cache = {}
+_text_file_cache_lock = threading.Lock()
+
+
+def read_text_file_cached(file_path: Union[str, Path]) -> str:
+    """Read a UTF-8 text file, reusing the previous read while its mtime and size are unchanged"""
+    stat = os.stat(file_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cache_key = os.path.abspath(file_path)
+    with _text_file_cache_lock:
+        cached = _text_file_cache.get(cache_key)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    with _text_file_cache_lock:
+        _text_file_cache[cache_key] = (signature, content)
+    return content
+
+
+def load_essays_from_folder(folder_path: str = "essays") -> Dict[str, str]:
+    """Load all essay files (.txt, .docx, .pdf) from the essays folder; see essay_ingest for what is skipped"""
+    return load_essays(folder_path)
+
+
+def load_rubrics_from_folder(folder_path: str = "rubric") -> Dict[str, str]:
+    """Load all rubric files from the rubric folder"""
+    rubrics = {}
+    
+    if not os.path.exists(folder_path):
+        logger.warning(f"Rubric folder not found: {folder_path}")
+        return rubrics
+    
+    md_files = Path(folder_path).glob("*.md")
+    for file_path in md_files:
+        try:
+            rubrics[file_path.name] = read_text_file_cached(file_path)
+            logger.info(f"Loaded rubric: {file_path.name}")
+        except Exception as e:
+            logger.error(f"Error loading rubric {file_path.name}: {str(e)}")
+    
+    return rubrics
+
+
+def load_feedback_guidance(file_path: str = "feedback_guidance.md") -> str:
+    """Load feedback guidance from file"""
+    if not os.path.exists(file_path):
+        logger.warning(f"Feedback guidance file not found: {file_path}")
+        return ""
+    
+    try:
+        content = read_text_file_cached(file_path)
+        logger.info(f"Loaded feedback guidance from: {file_path}")
+        return content
+    except Exception as e:
+        logger.error(f"Error loading feedback guidance: {str(e)}")
+        return ""
@@ -0,0 +1,696 @@
+#!/usr/bin/env python
+
+"""
+Offline bulk marking with Bedrock batch inference.
+
+End-of-term runs of thousands of essays do not need interactive latency, so
+instead of one rate-limited on-demand call per essay, the whole cohort can
+be marked as a batch inference job, billed at the batch discount:
+1. submit: every essay that needs marking is stored in the results
+   database and written as one JSONL record of model input, keyed by its
+   essay ID (record ID ESSAY000042 for essay 42), to BATCH_S3_URI, and a
+   model invocation job is created. Essays unchanged since the last run
+   (per the incremental manifest) or already in the feedback cache are not
+   sent. The job is saved in <output>/batch_jobs/<job name>.json.
+2. status: the job's status is polled (Submitted, InProgress, Completed,
+   PartiallyCompleted, Failed, ...).
+3. ingest: the output JSONL is read back into per-essay feedback files,
+   the feedback cache and the incremental manifest; a run is stored in the
+   results database with the class report, generated with one on-demand
+   call, and exported as batch_marking.py does.
+
+With BATCH_INFERENCE_BACKEND=local (the default with BEDROCK_BACKEND=fake)
+the job API and S3 are replaced by LocalBatchInferenceClient and
+LocalObjectStore, which keep jobs and objects under BATCH_LOCAL_DIR and
+mark the records with the fake backend, so the whole pipeline runs without
+network access.
+
+Usage:
+    uv run python batch_inference.py submit --essays essays --rubric rubric/rubric1.md --output outputs
+    uv run python batch_inference.py status --output outputs
+    uv run python batch_inference.py ingest JOB_NAME --output outputs --wait
+"""
+
+import argparse
+import boto3
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from automarking import (
+    BEDROCK_BACKEND,
+    BEDROCK_LARGE_MODEL_ID,
+    BEDROCK_REGION,
+    DEFAULT_INFERENCE_PARAMS,
+    ESSAY_MAX_TOKENS,
+    FEEDBACK_CACHE_ENABLED,
+    TokenUsage,
+    add_usage,
+    build_essay_prompt,
+    call_metrics,
+    count_usage,
+    essay_cache_key,
+    estimate_cost,
+    feedback_cache,
+    generate_class_feedback,
+    request_body,
+    response_text,
+    save_class_feedback,
+    save_feedback_file,
+)
+from batch_marking import read_text_file, write_results
+from botocore.exceptions import ClientError
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from fake_bedrock import FakeBedrockClient, FakeBedrockConfig
+from marking_manifest import MarkingManifest, load_essays_incremental, plan_incremental_marking, record_marked_essays
+from metrics import CallRecord, RunMetrics, record_run
+from pathlib import Path
+from results_export import export_paths, export_run
+from results_store import ResultsStore
+from scoring import class_statistics, extract_scores, format_statistics_table
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 'bedrock', or 'local' for the filesystem stand-in below
+BATCH_INFERENCE_BACKEND = os.getenv('BATCH_INFERENCE_BACKEND', 'local' if BEDROCK_BACKEND == 'fake' else 'bedrock').lower()
+BATCH_MODEL_ID = os.getenv('BATCH_MODEL_ID', BEDROCK_LARGE_MODEL_ID)
+# S3 prefix for job input and output, and a service role Bedrock can use to read and write it
+BATCH_S3_URI = os.getenv('BATCH_S3_URI', '').rstrip('/')
+BATCH_ROLE_ARN = os.getenv('BATCH_ROLE_ARN', '')
+BATCH_LOCAL_DIR = os.getenv('BATCH_LOCAL_DIR', 'outputs/batch_inference')
+# Bedrock rejects jobs with fewer records than its minimum (100 for most models)
+BATCH_MIN_RECORDS = int(os.getenv('BATCH_MIN_RECORDS', '100'))
+BATCH_MAX_RECORDS_PER_FILE = int(os.getenv('BATCH_MAX_RECORDS_PER_FILE', '10000'))
+BATCH_TIMEOUT_HOURS = int(os.getenv('BATCH_TIMEOUT_HOURS', '72'))
+BATCH_POLL_SECONDS = float(os.getenv('BATCH_POLL_SECONDS', '60'))
+# Fraction off on-demand prices, used for cost estimates only
+BATCH_PRICE_DISCOUNT = float(os.getenv('BATCH_PRICE_DISCOUNT', '0.5'))
+
+LOCAL_S3_URI = 's3://local-batch/automarking'
+TERMINAL_STATUSES = ('Completed', 'PartiallyCompleted', 'Failed', 'Stopped', 'Expired')
+
+
+def split_s3_uri(uri: str) -> Tuple[str, str]:
+    """(bucket, key) of an s3:// URI"""
+    if not uri.startswith('s3://'):
+        raise ValueError(f"Not an s3:// URI: {uri}")
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class S3ObjectStore:
+    """The S3 objects a batch job reads and writes"""
+
+    def __init__(self, client=None):
+        self.client = client or boto3.client('s3', region_name=BEDROCK_REGION)
+
+    def put(self, uri: str, data: bytes):
+        bucket, key = split_s3_uri(uri)
+        self.client.put_object(Bucket=bucket, Key=key, Body=data)
+
+    def get(self, uri: str) -> bytes:
+        bucket, key = split_s3_uri(uri)
+        return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    def list(self, prefix: str) -> List[str]:
+        bucket, key = split_s3_uri(prefix)
+        uris = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+            uris.extend(f"s3://{bucket}/{item['Key']}" for item in page.get('Contents', []))
+        return sorted(uris)
+
+
+class LocalObjectStore:
+    """Filesystem stand-in for S3: s3://bucket/key is kept at <root>/bucket/key"""
+
+    def __init__(self, root: str = BATCH_LOCAL_DIR):
+        self.root = Path(root)
+
+    def path(self, uri: str) -> Path:
+        bucket, key = split_s3_uri(uri)
+        return self.root / bucket / key
+
+    def put(self, uri: str, data: bytes):
+        path = self.path(uri)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+
+    def get(self, uri: str) -> bytes:
+        try:
+            return self.path(uri).read_bytes()
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f"No such object: {uri}"}}, 'GetObject')
+
+    def list(self, prefix: str) -> List[str]:
+        bucket, key = split_s3_uri(prefix)
+        bucket_root = self.root / bucket
+        if not bucket_root.is_dir():
+            return []
+        return sorted(f"s3://{bucket}/{path.relative_to(bucket_root).as_posix()}" for path in bucket_root.rglob('*')
+                      if path.is_file() and not path.name.endswith('.tmp')
+                      and path.relative_to(bucket_root).as_posix().startswith(key))
+
+
+class LocalBatchInferenceClient:
+    """Filesystem-backed stand-in for the model invocation job API of boto3's bedrock client
+
+    Offers create_model_invocation_job, get_model_invocation_job and
+    stop_model_invocation_job with boto3's request and response shapes. Jobs
+    are kept as JSON under <store root>/jobs/. Each get_model_invocation_job
+    advances a job one step (Submitted, then InProgress, then done), so
+    status can be followed from separate processes; the step past
+    InProgress marks every record of the input files with `runtime` (by
+    default the fake backend with no simulated latency) and writes
+    <input file>.out and manifest.json.out under <output URI>/<job ID>/, as
+    Bedrock does. Records that fail are written with an error instead of a
+    modelOutput, and the job ends PartiallyCompleted (Failed if none
+    succeeded).
+    """
+
+    def __init__(self, store: LocalObjectStore, runtime=None):
+        self.store = store
+        self.runtime = runtime or FakeBedrockClient(FakeBedrockConfig.from_env(), sleep=lambda seconds: None)
+        self.jobs_dir = store.root / 'jobs'
+
+    def _job_path(self, job_arn: str) -> Path:
+        return self.jobs_dir / f"{job_arn.rsplit('/', 1)[-1]}.json"
+
+    def _load(self, job_arn: str) -> Dict:
+        try:
+            return json.loads(self._job_path(job_arn).read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            raise ClientError({'Error': {'Code': 'ResourceNotFoundException', 'Message': f"No job {job_arn}"}},
+                              'GetModelInvocationJob')
+
+    def _save(self, job: Dict):
+        job['lastModifiedTime'] = datetime.now(timezone.utc).isoformat()
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        path = self._job_path(job['jobArn'])
+        path.with_name(path.name + '.tmp').write_text(json.dumps(job, indent=2), encoding='utf-8')
+        os.replace(path.with_name(path.name + '.tmp'), path)
+
+    def create_model_invocation_job(self, jobName: str, roleArn: str, modelId: str, inputDataConfig: Dict,
+                                    outputDataConfig: Dict, timeoutDurationInHours: int = 24, **kwargs) -> Dict:
+        input_uri = inputDataConfig['s3InputDataConfig']['s3Uri']
+        if not self.store.list(input_uri):
+            raise ClientError({'Error': {'Code': 'ValidationException', 'Message': f"No input files at {input_uri}"}},
+                              'CreateModelInvocationJob')
+        job_arn = f"arn:aws:bedrock:local:000000000000:model-invocation-job/{uuid.uuid4().hex[:12]}"
+        self._save({
+            'jobArn': job_arn,
+            'jobName': jobName,
+            'roleArn': roleArn,
+            'modelId': modelId,
+            'status': 'Submitted',
+            'message': '',
+            'submitTime': datetime.now(timezone.utc).isoformat(),
+            'inputDataConfig': inputDataConfig,
+            'outputDataConfig': outputDataConfig,
+            'timeoutDurationInHours': timeoutDurationInHours,
+        })
+        return {'jobArn': job_arn}
+
+    def get_model_invocation_job(self, jobIdentifier: str) -> Dict:
+        job = self._load(jobIdentifier)
+        if job['status'] == 'Submitted':
+            job['status'] = 'InProgress'
+            self._save(job)
+        elif job['status'] == 'InProgress':
+            self._run(job)
+        elif job['status'] == 'Stopping':
+            job['status'] = 'Stopped'
+            self._save(job)
+        return job
+
+    def stop_model_invocation_job(self, jobIdentifier: str) -> Dict:
+        job = self._load(jobIdentifier)
+        if job['status'] not in TERMINAL_STATUSES:
+            job['status'] = 'Stopping'
+            self._save(job)
+        return {}
+
+    def _run(self, job: Dict):
+        """Mark every record of the job's input files and write the output files"""
+        input_uri = job['inputDataConfig']['s3InputDataConfig']['s3Uri']
+        output_prefix = f"{job['outputDataConfig']['s3OutputDataConfig']['s3Uri'].rstrip('/')}/" \
+                        f"{job['jobArn'].rsplit('/', 1)[-1]}"
+        counts = {'totalRecordCount': 0, 'processedRecordCount': 0, 'successRecordCount': 0,
+                  'errorRecordCount': 0, 'inputTokenCount': 0, 'outputTokenCount': 0}
+        for uri in self.store.list(input_uri):
+            if not uri.endswith('.jsonl'):
+                continue
+            lines = []
+            for line in self.store.get(uri).decode('utf-8').splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                counts['totalRecordCount'] += 1
+                counts['processedRecordCount'] += 1
+                try:
+                    response = self.runtime.invoke_model(modelId=job['modelId'], body=json.dumps(record['modelInput']))
+                    model_output = json.loads(response['body'].read())
+                    record['modelOutput'] = model_output
+                    counts['successRecordCount'] += 1
+                    counts['inputTokenCount'] += model_output.get('usage', {}).get('input_tokens') or 0
+                    counts['outputTokenCount'] += model_output.get('usage', {}).get('output_tokens') or 0
+                except Exception as e:
+                    record['error'] = {'errorCode': 400, 'errorMessage': str(e)}
+                    counts['errorRecordCount'] += 1
+                lines.append(json.dumps(record, ensure_ascii=False))
+            self.store.put(f"{output_prefix}/{uri.rsplit('/', 1)[-1]}.out", ('\n'.join(lines) + '\n').encode('utf-8'))
+        self.store.put(f"{output_prefix}/manifest.json.out", json.dumps(counts).encode('utf-8'))
+
+        job['endTime'] = datetime.now(timezone.utc).isoformat()
+        if counts['errorRecordCount'] == 0:
+            job['status'] = 'Completed'
+        elif counts['successRecordCount'] > 0:
+            job['status'] = 'PartiallyCompleted'
+        else:
+            job['status'] = 'Failed'
+            job['message'] = "Every record failed"
+        self._save(job)
+
+
+def batch_backend(backend: str = BATCH_INFERENCE_BACKEND):
+    """(job client, object store, S3 prefix) for 'bedrock' or the 'local' stand-in"""
+    if backend == 'local':
+        store = LocalObjectStore(BATCH_LOCAL_DIR)
+        return LocalBatchInferenceClient(store), store, BATCH_S3_URI or LOCAL_S3_URI
+    if not BATCH_S3_URI or not BATCH_ROLE_ARN:
+        raise ValueError("Bedrock batch inference needs BATCH_S3_URI and BATCH_ROLE_ARN "
+                         "(or BATCH_INFERENCE_BACKEND=local to run offline)")
+    return boto3.client('bedrock', region_name=BEDROCK_REGION), S3ObjectStore(), BATCH_S3_URI
+
+
+@dataclass
+class BatchJob:
+    """A bulk marking job, saved as JSON in <output_dir>/batch_jobs/"""
+    job_name: str
+    backend: str
+    model_id: str
+    input_uri: str
+    output_uri: str
+    rubric_name: str
+    rubric_text: str
+    feedback_guidance: str
+    essays_dir: str
+    essay_ids: Dict[str, int]
+    records: Dict[str, str] = field(default_factory=dict)
+    cached: List[str] = field(default_factory=list)
+    reused: List[Dict] = field(default_factory=list)
+    job_arn: str = ""
+    status: str = "Submitted"
+    message: str = ""
+    submitted_at: float = 0.0
+    updated_at: float = 0.0
+    run_id: Optional[int] = None
+
+    @staticmethod
+    def path_for(job_name: str, output_dir: str = "outputs") -> str:
+        return os.path.join(output_dir, "batch_jobs", f"{job_name}.json")
+
+    def save(self, output_dir: str = "outputs"):
+        path = self.path_for(self.job_name, output_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(asdict(self), f, indent=2, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, job_name: str, output_dir: str = "outputs") -> 'BatchJob':
+        with open(cls.path_for(job_name, output_dir), 'r', encoding='utf-8') as f:
+            return cls(**json.load(f))
+
+
+def list_batch_jobs(output_dir: str = "outputs") -> List[BatchJob]:
+    """Every bulk job saved in an output folder, oldest first"""
+    jobs_dir = Path(output_dir) / "batch_jobs"
+    jobs = [BatchJob.load(path.stem, output_dir) for path in jobs_dir.glob('*.json')] if jobs_dir.is_dir() else []
+    return sorted(jobs, key=lambda job: job.submitted_at)
+
+
+def record_id(essay_id: int) -> str:
+    """Batch record ID of a results-store essay ID"""
+    return f"ESSAY{essay_id:06d}"
+
+
+def essay_model_input(essay_text: str, rubric_text: str, feedback_guidance: str) -> Dict:
+    """The request body of one essay, as for an on-demand call but without prompt-cache markers"""
+    content = [{key: value for key, value in block.items() if key != 'cache_control'}
+               for block in build_essay_prompt(essay_text, rubric_text, feedback_guidance)]
+    return request_body([{"role": "user", "content": content}], **{**DEFAULT_INFERENCE_PARAMS,
+                                                                   "max_tokens": ESSAY_MAX_TOKENS})
+
+
+def submit_bulk_job(essays_dir: str, rubric_path: str, guidance_path: str, output_dir: str = "outputs",
+                    incremental: bool = True, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                    model_id: str = BATCH_MODEL_ID, min_records: int = BATCH_MIN_RECORDS,
+                    backend: str = BATCH_INFERENCE_BACKEND) -> BatchJob:
+    """Write the model inputs of every essay that needs marking and create the batch job
+
+    Raises ValueError if fewer than `min_records` essays need marking; mark
+    those with batch_marking.py instead.
+    """
+    rubric_text = read_text_file(rubric_path)
+    feedback_guidance = read_text_file(guidance_path)
+    essays, _ = load_essays_incremental(essays_dir, MarkingManifest(output_dir))
+    essays = dict(sorted(essays.items()))
+    to_mark, reused = plan_incremental_marking(essays, rubric_text, feedback_guidance, output_dir, not incremental)
+
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    cached = [name for name, text in to_mark.items() if use_cache and feedback_cache.get(
+        essay_cache_key(text, rubric_text, feedback_guidance, params, model_id)) is not None]
+    to_send = {name: text for name, text in to_mark.items() if name not in cached}
+    if not to_send:
+        raise ValueError(f"No essays need marking ({len(reused)} unchanged, {len(cached)} with cached feedback)")
+    if len(to_send) < min_records:
+        raise ValueError(f"{len(to_send)} essay(s) need marking, fewer than the {min_records} records a batch job "
+                         f"needs; mark them on demand with batch_marking.py")
+
+    results_store = ResultsStore(os.path.join(output_dir, "results.db"))
+    essay_ids = results_store.add_essays(essays)
+    results_store.close()
+
+    client, store, s3_uri = batch_backend(backend)
+    job_name = f"automarking-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    input_uri = f"{s3_uri}/{job_name}/input/"
+    output_uri = f"{s3_uri}/{job_name}/output/"
+    records = {record_id(essay_ids[name]): name for name in to_send}
+    lines = [json.dumps({'recordId': record, 'modelInput': essay_model_input(to_send[name], rubric_text,
+                                                                             feedback_guidance)},
+                        ensure_ascii=False) for record, name in records.items()]
+    for index in range(0, len(lines), BATCH_MAX_RECORDS_PER_FILE):
+        chunk = lines[index:index + BATCH_MAX_RECORDS_PER_FILE]
+        store.put(f"{input_uri}records-{index // BATCH_MAX_RECORDS_PER_FILE:04d}.jsonl",
+                  ('\n'.join(chunk) + '\n').encode('utf-8'))
+
+    job = BatchJob(
+        job_name=job_name,
+        backend=backend,
+        model_id=model_id,
+        input_uri=input_uri,
+        output_uri=output_uri,
+        rubric_name=os.path.basename(rubric_path),
+        rubric_text=rubric_text,
+        feedback_guidance=feedback_guidance,
+        essays_dir=essays_dir,
+        essay_ids=essay_ids,
+        records=records,
+        cached=cached,
+        reused=[{key: item[key] for key in ('name', 'path', 'scores', 'model')} for item in reused],
+        submitted_at=time.time(),
+    )
+    response = client.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=BATCH_ROLE_ARN or 'arn:aws:iam::000000000000:role/local',
+        modelId=model_id,
+        inputDataConfig={'s3InputDataConfig': {'s3Uri': input_uri, 's3InputFormat': 'JSONL'}},
+        outputDataConfig={'s3OutputDataConfig': {'s3Uri': output_uri}},
+        timeoutDurationInHours=BATCH_TIMEOUT_HOURS
+    )
+    job.job_arn = response['jobArn']
+    job.updated_at = time.time()
+    job.save(output_dir)
+    logger.info(f"Submitted batch job {job_name} with {len(records)} record(s) "
+                f"({len(cached)} cached, {len(reused)} unchanged)")
+    return job
+
+
+def refresh_bulk_job(job: BatchJob, output_dir: str = "outputs") -> BatchJob:
+    """Poll the job's status and save it"""
+    if job.status not in TERMINAL_STATUSES:
+        client, _, _ = batch_backend(job.backend)
+        response = client.get_model_invocation_job(jobIdentifier=job.job_arn)
+        job.status = response['status']
+        job.message = response.get('message', '') or ''
+        job.updated_at = time.time()
+        job.save(output_dir)
+    return job
+
+
+def wait_for_bulk_job(job: BatchJob, output_dir: str = "outputs", poll_seconds: float = BATCH_POLL_SECONDS,
+                      timeout: Optional[float] = None) -> BatchJob:
+    """Poll the job until it ends (or `timeout` seconds pass)"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while refresh_bulk_job(job, output_dir).status not in TERMINAL_STATUSES:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        logger.info(f"Batch job {job.job_name}: {job.status}")
+        time.sleep(poll_seconds if job.backend != 'local' else 0)
+    return job
+
+
+def read_bulk_output(job: BatchJob) -> Dict[str, Dict]:
+    """The job's output records by record ID"""
+    _, store, _ = batch_backend(job.backend)
+    prefix = f"{job.output_uri.rstrip('/')}/{job.job_arn.rsplit('/', 1)[-1]}/"
+    outputs = {}
+    for uri in store.list(prefix):
+        if not uri.endswith('.jsonl.out'):
+            continue
+        for line in store.get(uri).decode('utf-8').splitlines():
+            if line.strip():
+                record = json.loads(line)
+                outputs[record['recordId']] = record
+    return outputs
+
+
+def ingest_bulk_job(job: BatchJob, output_dir: str = "outputs", class_feedback: bool = True,
+                    use_cache: bool = FEEDBACK_CACHE_ENABLED, reingest: bool = False) -> Dict:
+    """Turn a finished job's output into feedback files, a results run and the class report; return a summary
+
+    A job is ingested once: later calls return the summary of its existing
+    run unless `reingest` is set, which stores a new run. Records cut off at
+    max_tokens are reported as failed and not cached, so the next submit
+    sends them again.
+    """
+    if job.status not in TERMINAL_STATUSES or job.status == 'Failed':
+        raise ValueError(f"Batch job {job.job_name} is {job.status}{': ' + job.message if job.message else ''}")
+    rubric_text, feedback_guidance = job.rubric_text, job.feedback_guidance
+    results_store = ResultsStore(os.path.join(output_dir, "results.db"))
+    run = results_store.get_run(job.run_id) if not reingest else {}
+    if run:
+        results_store.close()
+        logger.info(f"Batch job {job.job_name} was already ingested as run {job.run_id}")
+        errors = run['metadata'].get('errors', {})
+        return {
+            'job': job.job_name,
+            'status': job.status,
+            'run_id': job.run_id,
+            'already_ingested': True,
+            'essays': len(job.essay_ids),
+            'failed': len(errors),
+            'errors': errors,
+            'export': export_paths(job.run_id, os.path.join(output_dir, "exports")),
+        }
+    essays = results_store.get_essay_texts(job.essay_ids)
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    run_usage = TokenUsage()
+    run_metrics = RunMetrics(job.job_name)
+
+    raw_feedbacks = {}
+    errors = {}
+    for record, output in read_bulk_output(job).items():
+        essay_name = job.records.get(record)
+        if essay_name is None:
+            continue
+        if 'modelOutput' not in output:
+            error = output.get('error', {})
+            errors[essay_name] = error.get('errorMessage', str(error)) if isinstance(error, dict) else str(error)
+            continue
+        model_output = output['modelOutput']
+        usage = model_output.get('usage', {})
+        with count_usage(run_usage), record_run(run_metrics):
+            add_usage(usage, job.model_id)
+            call_metrics.record(CallRecord(
+                timestamp=time.time(),
+                model=job.model_id,
+                operation='BatchInference',
+                kind='essay',
+                essay=essay_name,
+                input_tokens=usage.get('input_tokens') or 0,
+                output_tokens=usage.get('output_tokens') or 0,
+                cost_usd=estimate_cost(usage, job.model_id) * (1 - BATCH_PRICE_DISCOUNT),
+                stop_reason=model_output.get('stop_reason') or ""
+            ))
+        text = response_text(model_output)
+        if not isinstance(text, str):
+            errors[essay_name] = "No text in the model output"
+            continue
+        if model_output.get('stop_reason') == 'max_tokens':
+            errors[essay_name] = f"Feedback was cut off at {ESSAY_MAX_TOKENS} tokens"
+            continue
+        raw_feedbacks[essay_name] = text
+        if use_cache:
+            feedback_cache.set(essay_cache_key(essays[essay_name], rubric_text, feedback_guidance, params,
+                                               job.model_id), text)
+    for essay_name in job.records.values():
+        if essay_name not in raw_feedbacks and essay_name not in errors:
+            errors[essay_name] = f"No output record (job {job.status})"
+    for essay_name in job.cached:
+        cached = feedback_cache.get(essay_cache_key(essays[essay_name], rubric_text, feedback_guidance, params,
+                                                    job.model_id)) if use_cache else None
+        if cached is None:
+            errors[essay_name] = "Cached feedback is no longer in the feedback cache; mark it again"
+        else:
+            raw_feedbacks[essay_name] = cached
+
+    marked = []
+    for essay_name in essays:
+        if essay_name not in raw_feedbacks:
+            continue
+        feedback, scores = extract_scores(raw_feedbacks[essay_name], rubric_text)
+        marked.append({
+            'name': essay_name,
+            'feedback': feedback,
+            'path': save_feedback_file(essay_name, feedback, output_dir),
+            'scores': scores,
+            'model': job.model_id,
+        })
+    record_marked_essays(essays, rubric_text, feedback_guidance, marked, output_dir, job.essays_dir)
+
+    reused = []
+    for item in job.reused:
+        try:
+            with open(item['path'], 'r', encoding='utf-8') as f:
+                reused.append({**item, 'feedback': f.read()})
+        except OSError as e:
+            errors[item['name']] = f"Unchanged essay's feedback file is missing: {str(e)}"
+    by_name = {item['name']: item for item in marked + reused}
+    generated_feedbacks = [by_name[name] for name in essays if name in by_name]
+
+    statuses = {item['name']: 'ok' for item in marked}
+    statuses.update({item['name']: 'reused' for item in reused})
+    write_results([{
+        'name': essay_name,
+        'status': 'failed' if essay_name in errors else statuses.get(essay_name, ''),
+        'path': by_name.get(essay_name, {}).get('path', ''),
+        'model': by_name.get(essay_name, {}).get('model', ''),
+        'total_points': by_name.get(essay_name, {}).get('scores', {}).get('total'),
+        'bands': '; '.join(f"{criterion}: {score['band']}" for criterion, score in
+                           by_name.get(essay_name, {}).get('scores', {}).get('criteria', {}).items()),
+        'scores': by_name.get(essay_name, {}).get('scores', {}),
+        'error': errors.get(essay_name, ''),
+    } for essay_name in essays], output_dir)
+
+    statistics = class_statistics([item['scores'] for item in generated_feedbacks], rubric_text)
+    with open(os.path.join(output_dir, "class_statistics.json"), 'w', encoding='utf-8') as f:
+        json.dump(statistics, f, indent=2)
+
+    class_feedback_text = ""
+    if class_feedback and generated_feedbacks:
+        try:
+            with count_usage(run_usage), record_run(run_metrics):
+                class_feedback_text = generate_class_feedback(generated_feedbacks, rubric_text, use_cache=use_cache)
+            save_class_feedback(class_feedback_text, output_dir)
+        except Exception as e:
+            logger.error(f"Error generating class feedback: {str(e)}")
+            errors['<class feedback>'] = str(e)
+
+    # Stored after the class feedback, so the run's errors (and a later "already ingested" summary) include it
+    run_id = results_store.create_run(
+        job.rubric_name,
+        rubric_text,
+        feedback_guidance,
+        metadata={'errors': errors, 'reused': len(reused), 'batch_job': job.job_arn}
+    )
+    results_store.add_feedbacks(run_id, generated_feedbacks, job.essay_ids)
+    results_store.set_class_feedback(run_id, class_feedback_text, format_statistics_table(statistics))
+    export_files = export_run(results_store, run_id, os.path.join(output_dir, "exports"))
+    results_store.close()
+
+    job.run_id = run_id
+    job.save(output_dir)
+    calls = run_metrics.summary()
+    return {
+        'job': job.job_name,
+        'status': job.status,
+        'run_id': run_id,
+        'already_ingested': False,
+        'essays': len(essays),
+        'marked': len(marked),
+        'cached': len(job.cached),
+        'reused': len(reused),
+        'failed': len(errors),
+        'errors': errors,
+        'tokens': run_usage.snapshot(),
+        'estimated_cost_usd': round(sum(item.get('cost_usd', 0.0) for item in calls.values()), 4),
+        'calls': calls,
+        'metrics_files': run_metrics.export(os.path.join(output_dir, "metrics")),
+        'export': export_files,
+    }
+
+
+def job_status(job: BatchJob) -> Dict:
+    return {
+        'job': job.job_name,
+        'status': job.status,
+        'message': job.message,
+        'records': len(job.records),
+        'cached': len(job.cached),
+        'reused': len(job.reused),
+        'run_id': job.run_id,
+        'submitted': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job.submitted_at)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark a cohort of essays offline with Bedrock batch inference")
+    parser.add_argument('--output', default='outputs', help="Output folder for feedback, results and job files")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit = commands.add_parser('submit', help="Write the job input and create the batch job")
+    submit.add_argument('--essays', default='essays', help="Folder of student essays (.txt, .docx, .pdf)")
+    submit.add_argument('--rubric', default='rubric/rubric1.md', help="Rubric file (.md)")
+    submit.add_argument('--guidance', default='feedback_guidance.md', help="Feedback guidance file (.md)")
+    submit.add_argument('--all', action='store_true', help="Mark every essay, not only new or changed ones")
+    submit.add_argument('--cache', action=argparse.BooleanOptionalAction, default=FEEDBACK_CACHE_ENABLED,
+                        help="Take cached feedback for unchanged essays (--no-cache sends them as well)")
+    submit.add_argument('--min-records', type=int, default=BATCH_MIN_RECORDS,
+                        help="Refuse to submit fewer essays than this")
+    submit.add_argument('--backend', choices=['bedrock', 'local'], default=BATCH_INFERENCE_BACKEND,
+                        help="Bedrock, or the local filesystem stand-in")
+
+    status = commands.add_parser('status', help="Poll and print the status of one or every job")
+    status.add_argument('job', nargs='?', help="Job name (default: every job in the output folder)")
+
+    ingest = commands.add_parser('ingest', help="Read a finished job's output into feedback and the class report")
+    ingest.add_argument('job', help="Job name")
+    ingest.add_argument('--wait', action='store_true', help="Wait for the job to finish first")
+    ingest.add_argument('--no-class-feedback', action='store_true', help="Skip class overall feedback")
+    ingest.add_argument('--reingest', action='store_true',
+                        help="Ingest the output again into a new run, even if the job was already ingested")
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        try:
+            job = submit_bulk_job(args.essays, args.rubric, args.guidance, args.output, incremental=not args.all,
+                                  use_cache=args.cache,
+                                  min_records=args.min_records, backend=args.backend)
+        except ValueError as e:
+            parser.exit(1, f"{str(e)}\n")
+        print(json.dumps(job_status(job), indent=2))
+    elif args.command == 'status':
+        jobs = [BatchJob.load(args.job, args.output)] if args.job else list_batch_jobs(args.output)
+        print(json.dumps([job_status(refresh_bulk_job(job, args.output)) for job in jobs], indent=2))
+    else:
+        job = BatchJob.load(args.job, args.output)
+        job = wait_for_bulk_job(job, args.output) if args.wait else refresh_bulk_job(job, args.output)
+        try:
+            summary = ingest_bulk_job(job, args.output, class_feedback=not args.no_class_feedback,
+                                      reingest=args.reingest)
+        except ValueError as e:
+            parser.exit(1, f"{str(e)}\n")
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""
+Headless batch marking for automated essay marking using Amazon Bedrock.
+
+Marks every essay in a folder (.txt, .docx or .pdf) concurrently without
+starting Streamlit, writes per-essay feedback files, the class feedback,
+machine-readable results (results.jsonl and results.csv), a ZIP of all of them
+(exports/) and the run's Bedrock call trace and metrics (metrics/) to the
+output directory, then prints a summary of throughput, failures, skipped
+files, token usage and per-kind call latency. With --submit, the essays are
+queued as a durable job for marking_worker.py processes instead; with --plan,
+the run's estimated tokens, cost and time are printed and nothing is marked.
+
+Usage:
+    uv run python batch_marking.py --essays essays --rubric rubric/rubric1.md \\
+        --guidance feedback_guidance.md --output outputs --concurrency 8
+"""
+
+import argparse
+import csv
+import functools
+import json
+import logging
+import os
+import sys
+import time
+
+from async_marking import (
+    ASYNC_BEDROCK_ENABLED,
+    generate_class_feedback_async,
+    mark_essays_on_event_loop,
+    run_on_background_loop,
+)
+from automarking import (
+    CRITERION_FANOUT_ENABLED,
+    FEEDBACK_CACHE_ENABLED,
+    MARKING_CONCURRENCY,
+    PACKED_MARKING_ENABLED,
+    TokenUsage,
+    count_usage,
+    feedback_cache,
+    generate_class_feedback,
+    load_essays_from_folder,
+    mark_essays,
+    rate_limiter,
+    save_class_feedback,
+)
+from essay_ingest import IngestReport
+from job_queue import JOB_QUEUE_PATH, JobQueue
+from marking_manifest import (
+    MarkingManifest,
+    iter_essays_incremental,
+    load_essays_incremental,
+    mark_essays_incremental,
+)
+from marking_worker import submit_marking_job
+from metrics import RunMetrics, record_run
+from model_router import CASCADE_ENABLED, ModelRouter
+from near_duplicates import NEAR_DUPLICATE_MODE, NEAR_DUPLICATE_MODES, NearDuplicateIndex, mark_essays_with_reuse
+from results_export import export_run
+from results_store import ResultsStore
+from scoring import class_statistics, format_statistics_table
+from token_planner import (
+    PLANNER_DYNAMIC_MAX_TOKENS,
+    estimate_prompt_tokens,
+    fit_output_model,
+    load_call_history,
+    plan_marking,
+)
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+def read_text_file(file_path: str) -> str:
+    """Read a UTF-8 text file"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def write_results(results: List[Dict], output_dir: str):
+    """Write per-essay results as JSONL and CSV"""
+    os.makedirs(output_dir, exist_ok=True)
+    fields = ['name', 'status', 'path', 'elapsed_seconds', 'model', 'total_points', 'bands', 'duplicate_of',
+              'error']
+
+    with open(os.path.join(output_dir, "results.jsonl"), 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    with open(os.path.join(output_dir, "results.csv"), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({field: result.get(field, '') for field in fields})
+
+
+def run_batch(essays_dir: str, rubric_path: str, guidance_path: str, output_dir: str,
+              concurrency: int = MARKING_CONCURRENCY, use_cache: bool = FEEDBACK_CACHE_ENABLED,
+              class_feedback: bool = True, cascade: bool = CASCADE_ENABLED,
+              incremental: bool = True, pack: bool = PACKED_MARKING_ENABLED,
+              near_duplicates: str = NEAR_DUPLICATE_MODE, fanout: bool = CRITERION_FANOUT_ENABLED,
+              async_client: bool = ASYNC_BEDROCK_ENABLED,
+              plan_max_tokens: bool = PLANNER_DYNAMIC_MAX_TOKENS) -> Dict:
+    """Mark a folder of essays and return a run summary
+
+    With `incremental`, only essays that are new or changed since the last run
+    into `output_dir` (per its manifest) are sent for marking. Near-duplicate
+    essays are found with the index in `output_dir` and, depending on
+    `near_duplicates` ('off', 'reuse' or 'adapt'), derive their feedback from
+    the matching essay's. With `fanout`, each essay is marked with one
+    concurrent request per rubric criterion plus a short synthesis. With
+    `async_client`, essays and the class feedback are marked on the asyncio
+    Bedrock client (async_marking.py), `concurrency` essays in flight at once.
+    With `plan_max_tokens`, each essay's max_tokens is sized by the token
+    planner (token_planner.py) from the output lengths of earlier runs.
+    Essays are read on a pool of threads (essay_ingest.py); unless
+    near-duplicates are reused, packed or marked on the asyncio client, each
+    is sent for marking as soon as it has been read.
+    """
+    rubric_text = read_text_file(rubric_path)
+    feedback_guidance = read_text_file(guidance_path)
+    duplicate_index = NearDuplicateIndex(os.path.join(output_dir, "near_duplicates.db"))
+    output_model = fit_output_model(load_call_history())
+    ingest_report = IngestReport()
+    essays = {}
+    planned_max_tokens = {}
+
+    def read_essays():
+        for essay_name, essay_text in iter_essays_incremental(essays_dir, MarkingManifest(output_dir),
+                                                              report=ingest_report):
+            essays[essay_name] = essay_text
+            planned_max_tokens[essay_name] = output_model.max_tokens(
+                estimate_prompt_tokens(essay_text, rubric_text, feedback_guidance))
+            yield essay_name, essay_text
+
+    run_usage = TokenUsage()
+    run_metrics = RunMetrics()
+    start = time.perf_counter()
+    completed_at = {}
+
+    streamed = near_duplicates == 'off' and not pack and not async_client
+    if streamed:
+        to_mark = read_essays()
+    else:
+        to_mark = dict(sorted(read_essays()))
+        duplicate_clusters = duplicate_index.clusters(to_mark)
+
+    def log_progress(completed, total, essay_name, error):
+        completed_at[essay_name] = round(time.perf_counter() - start, 3)
+        status = "failed" if error is not None else "done"
+        logger.info(f"[{completed}/{total}] {essay_name}: {status}")
+
+    router = ModelRouter(rubric_text, use_cache=use_cache) if cascade else None
+    with count_usage(run_usage), record_run(run_metrics):
+        generated_feedbacks, errors, reused = mark_essays_incremental(
+            to_mark,
+            rubric_text,
+            feedback_guidance,
+            output_dir=output_dir,
+            essays_dir=essays_dir,
+            force=not incremental,
+            mark=functools.partial(
+                mark_essays_with_reuse,
+                index=duplicate_index,
+                mode=near_duplicates,
+                mark=mark_essays_on_event_loop if async_client else mark_essays
+            ),
+            max_workers=concurrency,
+            use_cache=use_cache,
+            on_complete=log_progress,
+            route=router,
+            pack=pack,
+            fanout=fanout,
+            max_tokens=planned_max_tokens if plan_max_tokens else None
+        )
+    marking_seconds = time.perf_counter() - start
+    essays = dict(sorted(essays.items()))
+    if streamed:
+        duplicate_clusters = duplicate_index.clusters(essays)
+    plan = plan_marking(essays, rubric_text, feedback_guidance, concurrency=concurrency, model=output_model)
+
+    feedbacks_by_name = {item['name']: item for item in generated_feedbacks}
+    results = []
+    for essay_name in essays:
+        item = feedbacks_by_name.get(essay_name, {})
+        scores = item.get('scores', {})
+        results.append({
+            'name': essay_name,
+            'status': 'failed' if essay_name in errors else 'ok' if essay_name in completed_at else 'reused',
+            'path': item.get('path', ''),
+            'elapsed_seconds': completed_at.get(essay_name),
+            'model': item.get('model', ''),
+            'total_points': scores.get('total'),
+            'bands': '; '.join(f"{criterion}: {score['band']}"
+                               for criterion, score in scores.get('criteria', {}).items()),
+            'scores': scores,
+            'duplicate_of': item.get('duplicate_of', ''),
+            'error': errors.get(essay_name, ''),
+        })
+    write_results(results, output_dir)
+
+    statistics = class_statistics([item['scores'] for item in generated_feedbacks], rubric_text)
+    with open(os.path.join(output_dir, "class_statistics.json"), 'w', encoding='utf-8') as f:
+        json.dump(statistics, f, indent=2)
+
+    results_store = ResultsStore(os.path.join(output_dir, "results.db"))
+    essay_ids = results_store.add_essays(essays)
+    run_id = results_store.create_run(
+        os.path.basename(rubric_path),
+        rubric_text,
+        feedback_guidance,
+        metadata={
+            'errors': errors,
+            'reused': reused,
+            'cascade': cascade,
+            'fanout': fanout,
+            'near_duplicates': {item['name']: item['duplicate_of'] for item in generated_feedbacks
+                                if 'duplicate_of' in item},
+        }
+    )
+    results_store.add_feedbacks(run_id, generated_feedbacks, essay_ids)
+
+    class_feedback_text = ""
+    if class_feedback and generated_feedbacks:
+        try:
+            with count_usage(run_usage), record_run(run_metrics):
+                if async_client:
+                    class_feedback_text = run_on_background_loop(
+                        generate_class_feedback_async(generated_feedbacks, rubric_text, use_cache=use_cache)
+                    )
+                else:
+                    class_feedback_text = generate_class_feedback(generated_feedbacks, rubric_text,
+                                                                  use_cache=use_cache)
+            save_class_feedback(class_feedback_text, output_dir)
+        except Exception as e:
+            logger.error(f"Error generating class feedback: {str(e)}")
+            errors['<class feedback>'] = str(e)
+    results_store.set_class_feedback(run_id, class_feedback_text, format_statistics_table(statistics))
+    export_paths = export_run(results_store, run_id, os.path.join(output_dir, "exports"))
+    results_store.close()
+    duplicate_index.close()
+
+    total_seconds = time.perf_counter() - start
+    summary = {
+        'run_id': run_id,
+        'essays': len(essays),
+        'marked': len(generated_feedbacks) - reused,
+        'reused': reused,
+        'failed': len(errors),
+        'marking_seconds': round(marking_seconds, 2),
+        'total_seconds': round(total_seconds, 2),
+        'near_duplicate_clusters': duplicate_clusters,
+        'derived_from_near_duplicates': sum(1 for item in generated_feedbacks if 'duplicate_of' in item),
+        'essays_per_minute': round(len(completed_at) / marking_seconds * 60, 2) if marking_seconds > 0 else 0.0,
+        'ingest': {**ingest_report.summary(), 'streamed_into_marking': streamed},
+        'tokens': run_usage.snapshot(),
+        'plan': {**plan['totals'], 'dynamic_max_tokens': plan_max_tokens},
+        'feedback_cache': feedback_cache.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'calls': run_metrics.summary(),
+        'metrics_files': run_metrics.export(os.path.join(output_dir, "metrics")),
+        'export': export_paths,
+    }
+    if router:
+        summary['tiers'] = router.summary(generated_feedbacks, run_usage)
+    return summary
+
+
+def plan_batch(essays_dir: str, rubric_path: str, guidance_path: str,
+               concurrency: int = MARKING_CONCURRENCY) -> Dict:
+    """Estimated tokens, cost and time of marking every essay in a folder, and the essays flagged"""
+    essays = load_essays_from_folder(essays_dir)
+    plan = plan_marking(essays, read_text_file(rubric_path), read_text_file(guidance_path), concurrency=concurrency)
+    return {
+        'totals': plan['totals'],
+        'history': plan['history'],
+        'flagged': {item['name']: item['flags'] for item in plan['essays'] if item['flags']},
+        'max_tokens': plan['max_tokens'],
+    }
+
+
+def submit_batch(essays_dir: str, rubric_path: str, guidance_path: str, output_dir: str,
+                 queue_path: str = JOB_QUEUE_PATH, incremental: bool = True,
+                 plan_max_tokens: bool = PLANNER_DYNAMIC_MAX_TOKENS, **options) -> Dict:
+    """Queue a folder of essays as a marking job and return its ID and progress"""
+    essays, _ = load_essays_incremental(essays_dir, MarkingManifest(output_dir))
+    rubric_text = read_text_file(rubric_path)
+    feedback_guidance = read_text_file(guidance_path)
+    if plan_max_tokens:
+        options['max_tokens'] = plan_marking(essays, rubric_text, feedback_guidance)['max_tokens']
+    queue = JobQueue(queue_path)
+    job_id = submit_marking_job(
+        queue,
+        essays,
+        os.path.basename(rubric_path),
+        rubric_text,
+        feedback_guidance,
+        output_dir=output_dir,
+        essays_dir=essays_dir,
+        force=not incremental,
+        **options
+    )
+    return {'job_id': job_id, 'queue': queue_path, **queue.job_progress(job_id)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark a folder of essays without the Streamlit UI")
+    parser.add_argument('--essays', default='essays', help="Folder of student essays (.txt, .docx, .pdf)")
+    parser.add_argument('--rubric', default='rubric/rubric1.md', help="Rubric file (.md)")
+    parser.add_argument('--guidance', default='feedback_guidance.md', help="Feedback guidance file (.md)")
+    parser.add_argument('--output', default='outputs', help="Output folder for feedback and results")
+    parser.add_argument('--concurrency', type=int, default=MARKING_CONCURRENCY,
+                        help="Number of essays to mark concurrently")
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, default=FEEDBACK_CACHE_ENABLED,
+                        help="Serve unchanged essays from the feedback cache (--no-cache regenerates them)")
+    parser.add_argument('--no-class-feedback', action='store_true', help="Skip class overall feedback")
+    parser.add_argument('--all', action='store_true',
+                        help="Re-mark every essay, not just new or changed ones")
+    parser.add_argument('--cascade', action=argparse.BooleanOptionalAction, default=CASCADE_ENABLED,
+                        help="Estimate with the small model first and only escalate borderline essays")
+    parser.add_argument('--pack', action=argparse.BooleanOptionalAction, default=PACKED_MARKING_ENABLED,
+                        help="Mark several short essays per request")
+    parser.add_argument('--fanout', action=argparse.BooleanOptionalAction, default=CRITERION_FANOUT_ENABLED,
+                        help="Mark each essay with one concurrent request per rubric criterion")
+    parser.add_argument('--async', dest='async_client', action=argparse.BooleanOptionalAction,
+                        default=ASYNC_BEDROCK_ENABLED,
+                        help="Use the asyncio Bedrock client (--concurrency essays in flight on one event loop)")
+    parser.add_argument('--near-duplicates', choices=NEAR_DUPLICATE_MODES, default=NEAR_DUPLICATE_MODE,
+                        help="Reuse or adapt the feedback of near-duplicate essays instead of marking them")
+    parser.add_argument('--fixed-max-tokens', action=argparse.BooleanOptionalAction,
+                        default=not PLANNER_DYNAMIC_MAX_TOKENS,
+                        help="Give every essay ESSAY_MAX_TOKENS instead of sizing it from past output lengths")
+    parser.add_argument('--plan', action='store_true',
+                        help="Print the estimated tokens, cost and time of the run and exit without marking")
+    parser.add_argument('--submit', action='store_true',
+                        help="Queue the essays as a job for marking_worker.py instead of marking them here")
+    parser.add_argument('--queue', default=JOB_QUEUE_PATH, help="Job queue database used with --submit")
+    parser.add_argument('--flow', help="Teacher or class a --submit job is for; workers share out capacity "
+                                       "fairly between flows (default: one flow per job)")
+    parser.add_argument('--weight', type=float, help="Relative share of worker capacity for a --submit job")
+    args = parser.parse_args()
+    if args.async_client and (args.pack or args.fanout):
+        parser.error("--async cannot be combined with --pack or --fanout")
+
+    if args.plan:
+        print(json.dumps(plan_batch(args.essays, args.rubric, args.guidance, args.concurrency), indent=2))
+        return
+
+    if args.submit:
+        print(json.dumps(submit_batch(
+            args.essays,
+            args.rubric,
+            args.guidance,
+            args.output,
+            queue_path=args.queue,
+            incremental=not args.all,
+            plan_max_tokens=not args.fixed_max_tokens,
+            use_cache=args.cache,
+            class_feedback=not args.no_class_feedback,
+            cascade=args.cascade,
+            pack=args.pack,
+            fanout=args.fanout,
+            async_client=args.async_client,
+            near_duplicates=args.near_duplicates,
+            near_duplicate_index=os.path.join(args.output, "near_duplicates.db"),
+            flow=args.flow,
+            weight=args.weight
+        ), indent=2))
+        return
+
+    summary = run_batch(
+        args.essays,
+        args.rubric,
+        args.guidance,
+        args.output,
+        concurrency=args.concurrency,
+        use_cache=args.cache,
+        class_feedback=not args.no_class_feedback,
+        cascade=args.cascade,
+        incremental=not args.all,
+        pack=args.pack,
+        near_duplicates=args.near_duplicates,
+        fanout=args.fanout,
+        async_client=args.async_client,
+        plan_max_tokens=not args.fixed_max_tokens
+    )
+    print(json.dumps(summary, indent=2))
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+End-to-end marking throughput benchmark against the local fake Bedrock backend.
+
+Marks synthetic cohorts of essays (10, 100 and 1000 by default) through
+automarking.mark_essays with a FakeBedrockClient behind its own RateLimiter,
+so no Bedrock quota is used, and reports for each cohort:
+- essays/sec over the whole cohort
+- p50/p95 per-essay latency (including rate limiter waits and retries)
+- p50/p95 time to first token when streaming (--stream)
+- peak traced Python memory and the process's maximum RSS
+- requests sent, token usage, retries and throttles
+
+Results can be saved with --json and compared with a previous run with
+--baseline; the exit code is 1 if throughput drops or p95 latency rises by
+more than --tolerance. Compare monolithic marking with per-criterion fan-out
+by running the same cohorts with and without --fanout, and threads with the
+asyncio client (--async, where --concurrency is the number of essays in flight).
+
+Usage:
+    uv run python benchmark.py --cohorts 10 100 1000 --concurrency 8 --stream \\
+        --json outputs/benchmark.json --baseline outputs/benchmark_baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import numpy as np
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from async_marking import mark_essays_async, set_async_bedrock_client
+from automarking import (
+    BEDROCK_BACKEND,
+    BEDROCK_LARGE_MODEL_ID,
+    TokenUsage,
+    count_usage,
+    mark_essays,
+    read_text_file_cached,
+    set_bedrock_client,
+)
+from fake_bedrock import AsyncFakeBedrockClient, FakeBedrockClient, FakeBedrockConfig
+from rate_limiter import AsyncRateLimitedClient, AsyncRateLimiter, RateLimitedClient, RateLimiter
+from scoring import parse_rubric
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ESSAY_WORDS = (
+    "school community technology students learning future environment society family friends "
+    "important believe because however therefore example experience challenge opportunity "
+    "government responsibility people should would could important change education online"
+).split()
+
+
+def synthetic_essays(count: int, seed: int = 0, min_words: int = 300, max_words: int = 900) -> Dict[str, str]:
+    """Distinct pseudo-random essays, so neither the feedback cache nor the fake's prompt cache dedupes them"""
+    generator = random.Random(seed)
+    essays = {}
+    for index in range(count):
+        words = [generator.choice(ESSAY_WORDS) for _ in range(generator.randint(min_words, max_words))]
+        sentences = [' '.join(words[i:i + 15]).capitalize() + '.' for i in range(0, len(words), 15)]
+        essays[f"synthetic_{index:04d}.txt"] = ' '.join(sentences)
+    return essays
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {'p50': None, 'p95': None}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {'p50': round(float(p50), 3), 'p95': round(float(p95), 3)}
+
+
+def run_cohort(size: int, rubric_text: str, feedback_guidance: str, fake_config: FakeBedrockConfig,
+               concurrency: int, stream: bool, use_cache: bool, seed: int, pack: bool = False,
+               fanout: bool = False, use_async: bool = False) -> Dict:
+    """Mark one synthetic cohort against a fresh fake backend and return its metrics
+
+    With `use_async`, the cohort is marked by async_marking.mark_essays_async
+    on one event loop, `concurrency` essays in flight, instead of on threads.
+    """
+    essays = synthetic_essays(size, seed=seed)
+    if use_async:
+        fake = AsyncFakeBedrockClient(fake_config)
+        limiter = AsyncRateLimiter(max_concurrency=concurrency)
+    else:
+        fake = FakeBedrockClient(fake_config)
+        # Fan-out sends one request per criterion, so give each essay that many request slots
+        requests_per_essay = len(parse_rubric(rubric_text)) if fanout else 1
+        limiter = RateLimiter(max_concurrency=concurrency * max(1, requests_per_essay))
+        set_bedrock_client(RateLimitedClient(fake, limiter))
+    run_usage = TokenUsage()
+
+    started = {}
+    first_token = {}
+    lock = threading.Lock()
+
+    def record_start(essay_name, essay_text):
+        with lock:
+            started[essay_name] = time.perf_counter()
+        return BEDROCK_LARGE_MODEL_ID
+
+    def record_first_token(essay_name, text):
+        if essay_name not in first_token:
+            with lock:
+                first_token.setdefault(essay_name, time.perf_counter() - started[essay_name])
+
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as output_dir, count_usage(run_usage):
+        start = time.perf_counter()
+        if use_async:
+            async def mark_on_event_loop():
+                set_async_bedrock_client(AsyncRateLimitedClient(fake, limiter))
+                return await mark_essays_async(
+                    essays,
+                    rubric_text,
+                    feedback_guidance,
+                    max_in_flight=concurrency,
+                    output_dir=output_dir,
+                    use_cache=use_cache,
+                    on_delta=record_first_token if stream else None,
+                    route=record_start
+                )
+
+            generated_feedbacks, errors = asyncio.run(mark_on_event_loop())
+        else:
+            generated_feedbacks, errors = mark_essays(
+                essays,
+                rubric_text,
+                feedback_guidance,
+                max_workers=concurrency,
+                output_dir=output_dir,
+                use_cache=use_cache,
+                on_delta=record_first_token if stream else None,
+                route=record_start,
+                pack=pack,
+                fanout=fanout
+            )
+        elapsed = time.perf_counter() - start
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    limiter_stats = limiter.stats()
+    return {
+        'essays': size,
+        'marked': len(generated_feedbacks),
+        'failed': len(errors),
+        'seconds': round(elapsed, 3),
+        'essays_per_second': round(len(generated_feedbacks) / elapsed, 3) if elapsed > 0 else 0.0,
+        'latency_seconds': _percentiles([item['seconds'] for item in generated_feedbacks]),
+        'ttft_seconds': _percentiles(list(first_token.values())) if stream else None,
+        'peak_traced_mb': round(peak_traced / 2 ** 20, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        'requests': fake.calls,
+        'tokens': run_usage.snapshot(),
+        'retries': limiter_stats['retries'],
+        'throttles': limiter_stats['throttles'],
+    }
+
+
+def compare_with_baseline(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Describe cohorts whose throughput fell or p95 latency rose by more than `tolerance`"""
+    regressions = []
+    for size, result in results.items():
+        previous = baseline.get(size)
+        if not previous:
+            continue
+        if result['essays_per_second'] < previous['essays_per_second'] * (1 - tolerance):
+            regressions.append(f"{size} essays: {result['essays_per_second']} essays/s "
+                               f"(baseline {previous['essays_per_second']})")
+        p95, previous_p95 = result['latency_seconds']['p95'], previous['latency_seconds']['p95']
+        if p95 is not None and previous_p95 is not None and p95 > previous_p95 * (1 + tolerance):
+            regressions.append(f"{size} essays: p95 latency {p95}s (baseline {previous_p95}s)")
+    return regressions
+
+
+def print_table(results: Dict[str, Dict]):
+    print(f"{'essays':>7} {'ok':>6} {'fail':>5} {'secs':>8} {'ess/s':>8} {'p50':>7} {'p95':>7} "
+          f"{'ttft50':>7} {'ttft95':>7} {'peakMB':>8} {'requests':>9} {'in_tokens':>10} {'retries':>8}")
+    for result in results.values():
+        ttft = result['ttft_seconds'] or {'p50': None, 'p95': None}
+        print(f"{result['essays']:>7} {result['marked']:>6} {result['failed']:>5} {result['seconds']:>8} "
+              f"{result['essays_per_second']:>8} {result['latency_seconds']['p50']!s:>7} "
+              f"{result['latency_seconds']['p95']!s:>7} {ttft['p50']!s:>7} {ttft['p95']!s:>7} "
+              f"{result['peak_traced_mb']:>8} {result['requests']:>9} "
+              f"{result['tokens']['input_tokens'] + result['tokens']['cache_read_input_tokens'] + result['tokens']['cache_creation_input_tokens']:>10} "
+              f"{result['retries']:>8}")
+
+
+def main():
+    defaults = FakeBedrockConfig()
+    parser = argparse.ArgumentParser(description="Benchmark essay marking against a local fake Bedrock backend")
+    parser.add_argument('--cohorts', type=int, nargs='+', default=[10, 100, 1000], help="Cohort sizes to mark")
+    parser.add_argument('--concurrency', type=int, default=8, help="Essays marked concurrently")
+    parser.add_argument('--stream', action='store_true', help="Stream feedback and measure time to first token")
+    parser.add_argument('--cache', action='store_true',
+                        help="Use the on-disk feedback cache (requires BEDROCK_BACKEND=fake, whose cache is separate)")
+    parser.add_argument('--pack', action='store_true', help="Mark several essays per request (ignored with --stream)")
+    parser.add_argument('--fanout', action='store_true',
+                        help="Mark each essay with one concurrent request per rubric criterion plus a synthesis")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Mark on one asyncio event loop instead of threads (ignores --pack and --fanout)")
+    parser.add_argument('--rubric', default='rubric/rubric1.md', help="Rubric file (.md)")
+    parser.add_argument('--guidance', default='feedback_guidance.md', help="Feedback guidance file (.md)")
+    parser.add_argument('--latency-median', type=float, default=0.05,
+                        help=f"Median time to first token in seconds (fake default {defaults.latency_median})")
+    parser.add_argument('--latency-sigma', type=float, default=defaults.latency_sigma,
+                        help="Log-normal sigma of the time to first token")
+    parser.add_argument('--tokens-per-second', type=float, default=4000.0,
+                        help=f"Output token rate (fake default {defaults.tokens_per_second})")
+    parser.add_argument('--output-tokens', type=int, default=defaults.output_tokens, help="Output tokens per reply")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of calls throttled")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Fraction of calls failing outright")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for essays and the fake backend")
+    parser.add_argument('--json', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare with the results JSON of a previous run")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed relative regression vs the baseline")
+    parser.add_argument('--verbose', action='store_true', help="Keep per-essay INFO logging")
+    args = parser.parse_args()
+    if args.cache and BEDROCK_BACKEND != 'fake':
+        parser.error("--cache requires BEDROCK_BACKEND=fake, so fake feedback never enters the real feedback cache")
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('automarking').setLevel(logging.WARNING)
+
+    fake_config = FakeBedrockConfig(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        throttle_rate=args.throttle_rate,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    rubric_text = read_text_file_cached(args.rubric)
+    feedback_guidance = read_text_file_cached(args.guidance)
+
+    results = {}
+    for size in args.cohorts:
+        results[str(size)] = run_cohort(size, rubric_text, feedback_guidance, fake_config,
+                                        args.concurrency, args.stream, args.cache, args.seed, args.pack,
+                                        args.fanout, args.use_async)
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
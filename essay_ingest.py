@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+Parallel, streaming ingestion of a folder of essay submissions.
+
+iter_essays() discovers files lazily with os.scandir and reads and decodes
+them on a pool of threads. It yields (name, text) pairs as each file is
+ready, so marking can start on the first essays while the rest are still
+being read. Supported formats:
+- .txt: the encoding is detected from a byte-order mark, else UTF-8, else
+  charset_normalizer's guess (if installed; a Windows code page when one
+  fits as well), else Windows-1252.
+- .docx: text is extracted from word/document.xml with the standard library.
+- .pdf: text is extracted with pypdf (uv pip install pypdf).
+
+Some files are skipped and recorded in an IngestReport with the reason:
+- files larger than INGEST_MAX_FILE_BYTES (checked before they are opened);
+- binary files;
+- unreadable files and files with no text;
+- unsupported file types;
+- a second file with the same name but a different extension, since both
+  would share a feedback file.
+Hidden files and Office lock files (~$name.docx) are ignored.
+"""
+
+import logging
+import os
+import time
+import zipfile
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+from xml.etree import ElementTree
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:  # only needed for text files that are not UTF-8
+    from_bytes = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # only needed for .pdf essays
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+ESSAY_EXTENSIONS = ('.txt', '.docx', '.pdf')
+INGEST_MAX_FILE_BYTES = int(os.getenv('INGEST_MAX_FILE_BYTES', str(10 * MB)))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '8'))
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+BYTE_ORDER_MARKS = [
+    (b'\xef\xbb\xbf', 'utf-8'),
+    (b'\xff\xfe', 'utf-16-le'),
+    (b'\xfe\xff', 'utf-16-be'),
+]
+
+
+class SkippedEssayFile(Exception):
+    """A submission that cannot be used as an essay; the message is the reason"""
+
+
+@dataclass
+class IngestReport:
+    """What one pass over an essays folder loaded, reused and skipped"""
+    loaded: int = 0
+    reused: int = 0
+    bytes_read: int = 0
+    skipped: Dict[str, str] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    def skip(self, name: str, reason: str):
+        self.skipped[name] = reason
+        logger.warning(f"Skipping {name}: {reason}")
+
+    def summary(self) -> Dict:
+        return {
+            'loaded': self.loaded,
+            'reused': self.reused,
+            'skipped': self.skipped,
+            'megabytes_read': round(self.bytes_read / MB, 2),
+            'seconds': round(self.seconds, 3),
+        }
+
+
+def decode_text(data: bytes) -> str:
+    """Decode a text file's bytes, detecting the encoding, with newlines normalised to \\n"""
+    for mark, encoding in BYTE_ORDER_MARKS:
+        if data.startswith(mark):
+            text = data[len(mark):].decode(encoding, errors='replace')
+            break
+    else:
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            # Short texts fit several code pages equally well; among those, prefer the Windows ones
+            matches = list(from_bytes(data)) if from_bytes is not None else []
+            least_chaos = min((match.chaos for match in matches), default=0.0)
+            best = min(matches, default=None, key=lambda match: (
+                match.chaos > least_chaos,
+                0 if match.encoding == 'cp1252' else 1 if match.encoding.startswith('cp125') else 2
+            ))
+            text = str(best) if best is not None else data.decode('cp1252', errors='replace')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def looks_binary(data: bytes) -> bool:
+    """Whether a file without a UTF-16 byte-order mark has NUL bytes in its first 8 KB"""
+    return not data.startswith((b'\xff\xfe', b'\xfe\xff')) and b'\x00' in data[:8192]
+
+
+def extract_docx_text(file_path: Path, max_bytes: int = INGEST_MAX_FILE_BYTES) -> str:
+    """Paragraph text of a Word document, one paragraph per line"""
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            info = archive.getinfo('word/document.xml')
+            # The XML is several times larger than its text; refuse anything that inflates absurdly
+            if info.file_size > max_bytes * 10:
+                raise SkippedEssayFile(f"document text too large ({info.file_size / MB:.1f} MB uncompressed)")
+            root = ElementTree.fromstring(archive.read(info))
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError) as e:
+        raise SkippedEssayFile(f"not a readable .docx file ({str(e)})")
+
+    paragraphs = []
+    for paragraph in root.iter(f'{WORD_NAMESPACE}p'):
+        parts = []
+        for element in paragraph.iter():
+            if element.tag == f'{WORD_NAMESPACE}t':
+                parts.append(element.text or '')
+            elif element.tag == f'{WORD_NAMESPACE}tab':
+                parts.append('\t')
+            elif element.tag in (f'{WORD_NAMESPACE}br', f'{WORD_NAMESPACE}cr'):
+                parts.append('\n')
+        paragraphs.append(''.join(parts))
+    return '\n'.join(paragraphs)
+
+
+def extract_pdf_text(file_path: Path) -> str:
+    """Text of every page of a PDF, pages separated by blank lines"""
+    if PdfReader is None:
+        raise SkippedEssayFile("PDF text extraction needs pypdf: uv pip install pypdf")
+    try:
+        reader = PdfReader(str(file_path))
+        return '\n\n'.join(page.extract_text() or '' for page in reader.pages)
+    except Exception as e:
+        raise SkippedEssayFile(f"unreadable PDF ({str(e)})")
+
+
+def read_essay_file(file_path: Path, max_bytes: int = INGEST_MAX_FILE_BYTES) -> str:
+    """Read one submission as text; raises SkippedEssayFile with the reason it cannot be used"""
+    suffix = file_path.suffix.lower()
+    if suffix == '.docx':
+        text = extract_docx_text(file_path, max_bytes)
+    elif suffix == '.pdf':
+        text = extract_pdf_text(file_path)
+    else:
+        with open(file_path, 'rb') as f:
+            data = f.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise SkippedEssayFile(f"larger than {max_bytes / MB:.1f} MB")
+        if looks_binary(data):
+            raise SkippedEssayFile("binary file")
+        text = decode_text(data)
+    if not text.strip():
+        raise SkippedEssayFile("no text")
+    return text
+
+
+def discover_essay_files(folder_path: str, report: IngestReport,
+                         max_bytes: int = INGEST_MAX_FILE_BYTES) -> Iterator[Tuple[Path, os.stat_result]]:
+    """Lazily yield (path, stat) for each candidate essay file, skipping oversized and unsupported files"""
+    stems = {}
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.startswith(('.', '~$')) or not entry.is_file():
+                continue
+            file_path = Path(entry.path)
+            if file_path.suffix.lower() not in ESSAY_EXTENSIONS:
+                report.skip(entry.name, f"unsupported file type (supported: {', '.join(ESSAY_EXTENSIONS)})")
+                continue
+            stat = entry.stat()
+            if stat.st_size > max_bytes:
+                report.skip(entry.name, f"{stat.st_size / MB:.1f} MB is larger than {max_bytes / MB:.1f} MB")
+                continue
+            if file_path.stem in stems:
+                report.skip(entry.name, f"same name as {stems[file_path.stem]}")
+                continue
+            stems[file_path.stem] = entry.name
+            yield file_path, stat
+
+
+def iter_essays(folder_path: str, report: Optional[IngestReport] = None, max_workers: int = INGEST_WORKERS,
+                max_bytes: int = INGEST_MAX_FILE_BYTES,
+                known: Optional[Callable[[str, os.stat_result], Optional[str]]] = None) -> Iterator[Tuple[str, str]]:
+    """Yield (file name, text) for each essay in a folder as soon as it has been read
+
+    Files are read `max_workers` at a time, up to twice that many ahead of the
+    consumer, and yielded in the order they finish. `known`, if given, is
+    called with (name, stat) and returns text already in memory for a file
+    that has not changed, which is then yielded without reading it.
+    """
+    report = report if report is not None else IngestReport()
+    start = time.perf_counter()
+    if not os.path.isdir(folder_path):
+        logger.warning(f"Essays folder not found: {folder_path}")
+        return
+
+    files = discover_essay_files(folder_path, report, max_bytes)
+    window = max(1, max_workers) * 2
+    pending = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="ingest") as executor:
+        while True:
+            while not exhausted and len(pending) < window:
+                entry = next(files, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                file_path, stat = entry
+                text = known(file_path.name, stat) if known else None
+                if text is not None:
+                    report.reused += 1
+                    yield file_path.name, text
+                    continue
+                pending[executor.submit(read_essay_file, file_path, max_bytes)] = (file_path, stat)
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path, stat = pending.pop(future)
+                try:
+                    text = future.result()
+                except SkippedEssayFile as e:
+                    report.skip(file_path.name, str(e))
+                    continue
+                except Exception as e:
+                    report.skip(file_path.name, f"unreadable ({str(e)})")
+                    continue
+                report.loaded += 1
+                report.bytes_read += stat.st_size
+                logger.info(f"Loaded essay: {file_path.name}")
+                yield file_path.name, text
+    report.seconds = time.perf_counter() - start
+
+
+def load_essays(folder_path: str, report: Optional[IngestReport] = None, **kwargs) -> Dict[str, str]:
+    """Every essay in a folder (see iter_essays), in file name order"""
+    return dict(sorted(iter_essays(folder_path, report, **kwargs)))
+
+
+def collect_essays(essays: Iterable[Tuple[str, str]], into: Dict[str, str]) -> Iterator[Tuple[str, str]]:
+    """Pass (name, text) pairs through, keeping each in `into` for use once the stream is consumed"""
+    for essay_name, essay_text in essays:
+        into[essay_name] = essay_text
+        yield essay_name, essay_text
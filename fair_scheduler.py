@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+
+"""
+Process-wide fair-share scheduling of Bedrock calls.
+
+Every Streamlit session, job and CLI run marks essays through the same
+process-wide rate limiter. Without a scheduler, whichever run has the most
+threads in flight gets the most of the account's quota, so one 300-essay run
+starves a colleague's 10-essay run. FairScheduler sits in front of the rate
+limiter. Each call waits in one queue shared by the threaded and asyncio
+paths and is tagged with the flow (session, class or job) it was made for,
+taken from flow_context().
+
+Calls are dispatched:
+- by start-time fair queueing: each flow's calls are tagged with a virtual
+  start time that advances by the call's estimated tokens divided by the
+  flow's weight, and the queued call with the earliest tag goes next, so
+  flows share capacity in proportion to their weights however many calls
+  each has queued;
+- small runs (at most SCHEDULER_SMALL_JOB_ESSAYS essays) and interactive
+  flows first, when SCHEDULER_SMALL_JOB_PRIORITY is on;
+- only while fewer than the concurrency limit are in flight (halved on
+  throttles and grown back slowly, like AIMDLimiter) and the request and
+  token rate limits allow it; runs reserve() the concurrency they ask for,
+  which raises the limit up to the scheduler's ceiling.
+
+Worker threads do not inherit context variables, so functions run on an
+executor are wrapped with bind_flow() to carry the caller's flow (and its
+other context, such as metric labels and run usage counters) with them, and
+coroutines run on another thread's event loop with bind_flow_async().
+status() reports a flow's queue position and estimated wait for the UI.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from rate_limiter import AIMDLimiter, TokenBucket
+from typing import Awaitable, Callable, Coroutine, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+FAIR_SCHEDULER_ENABLED = os.getenv('FAIR_SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_SMALL_JOB_ESSAYS = int(os.getenv('SCHEDULER_SMALL_JOB_ESSAYS', '10'))
+SCHEDULER_SMALL_JOB_PRIORITY = os.getenv('SCHEDULER_SMALL_JOB_PRIORITY', 'true').lower() == 'true'
+# Relative shares by flow name, e.g. "year-12=2,year-7=1"; unnamed flows have weight 1
+SCHEDULER_WEIGHTS = {
+    name.strip(): float(weight) for name, _, weight in
+    (item.partition('=') for item in os.getenv('SCHEDULER_WEIGHTS', '').split(',') if '=' in item)
+}
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+
+
+@dataclass(frozen=True)
+class Flow:
+    """Who a Bedrock call is made for; flows share the scheduler's capacity by weight"""
+    name: str = "default"
+    weight: float = 1.0
+    essays: int = 0
+    interactive: bool = False
+
+    def priority(self, small_job_essays: int = SCHEDULER_SMALL_JOB_ESSAYS,
+                 small_job_priority: bool = SCHEDULER_SMALL_JOB_PRIORITY) -> int:
+        small = small_job_priority and 0 < self.essays <= small_job_essays
+        return PRIORITY_INTERACTIVE if self.interactive or small else PRIORITY_NORMAL
+
+
+_flow: ContextVar[Flow] = ContextVar('scheduler_flow', default=Flow())
+
+
+@contextmanager
+def flow_context(name: str, weight: Optional[float] = None, essays: int = 0, interactive: bool = False):
+    """Schedule the Bedrock calls made inside the block as flow `name`
+
+    `weight` defaults to the flow's entry in SCHEDULER_WEIGHTS (else 1);
+    `essays` is the size of the run, which makes small runs eligible for
+    priority; `interactive` gives the calls priority regardless of size.
+    """
+    weight = weight if weight is not None else SCHEDULER_WEIGHTS.get(name, 1.0)
+    token = _flow.set(Flow(name, max(weight, 0.01), essays, interactive))
+    try:
+        yield
+    finally:
+        _flow.reset(token)
+
+
+def current_flow() -> Flow:
+    return _flow.get()
+
+
+def bind_flow(fn: Callable) -> Callable:
+    """Wrap `fn` so that it runs in the caller's flow and context on whichever thread calls it"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A copy per call: one context cannot be entered by two threads at once
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def bind_flow_async(awaitable: Awaitable) -> Coroutine:
+    """Wrap `awaitable` so that it runs in the caller's flow and context on whichever event loop awaits it
+
+    For work handed to an event loop on another thread (e.g. with
+    asyncio.run_coroutine_threadsafe), whose tasks would otherwise start in
+    that thread's context.
+    """
+    context = contextvars.copy_context()
+
+    async def run():
+        for variable, value in context.items():
+            variable.set(value)
+        return await awaitable
+    return run()
+
+
+class _FlowState:
+    """Scheduler bookkeeping for one flow"""
+
+    def __init__(self, flow: Flow):
+        self.flow = flow
+        self.finish_tag = 0.0
+        self.waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.tokens = 0
+        self.last_active = time.monotonic()
+
+
+class _Ticket:
+    """One call waiting for (or holding) a slot"""
+
+    __slots__ = ('state', 'cost', 'priority', 'start_tag', 'seq', 'granted', 'cancelled', 'event', 'loop')
+
+    def __init__(self, state: _FlowState, cost: float, priority: int, start_tag: float, seq: int, event, loop=None):
+        self.state = state
+        self.cost = cost
+        self.priority = priority
+        self.start_tag = start_tag
+        self.seq = seq
+        self.granted = False
+        self.cancelled = False
+        self.event = event
+        self.loop = loop
+
+    def sort_key(self):
+        return (self.priority, self.start_tag, self.seq)
+
+    def __lt__(self, other: '_Ticket') -> bool:
+        return self.sort_key() < other.sort_key()
+
+
+class FairScheduler(AIMDLimiter):
+    """Weighted fair queueing of calls across flows under global concurrency and rate limits
+
+    The request and token buckets are the process's rate limits: a
+    RateLimiter given this scheduler draws from them here, in fair order,
+    instead of on its own.
+    """
+
+    def __init__(self, max_concurrency: int, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 small_job_essays: int = SCHEDULER_SMALL_JOB_ESSAYS,
+                 small_job_priority: bool = SCHEDULER_SMALL_JOB_PRIORITY, idle_seconds: float = 600.0,
+                 ceiling: Optional[int] = None):
+        super().__init__(max_concurrency, ceiling=ceiling)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.small_job_essays = small_job_essays
+        self.small_job_priority = small_job_priority
+        self.idle_seconds = idle_seconds
+        self.virtual_time = 0.0
+        self.flows: Dict[str, _FlowState] = {}
+        self._queue: List[_Ticket] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._releases = deque(maxlen=200)
+
+    # ----- Queueing -----
+    def _flow_state(self, flow: Flow) -> _FlowState:
+        state = self.flows.get(flow.name)
+        if state is None:
+            now = time.monotonic()
+            for name in [name for name, idle in self.flows.items()
+                         if not idle.waiting and not idle.in_flight and now - idle.last_active > self.idle_seconds]:
+                del self.flows[name]
+            state = self.flows[flow.name] = _FlowState(flow)
+        state.flow = flow
+        return state
+
+    def _enqueue(self, cost: float, event, loop=None) -> _Ticket:
+        flow = current_flow()
+        cost = max(1.0, float(cost))
+        with self._lock:
+            state = self._flow_state(flow)
+            # A flow that was idle starts from the current virtual time rather than banking credit
+            start_tag = max(self.virtual_time, state.finish_tag)
+            state.finish_tag = start_tag + cost / state.flow.weight
+            state.waiting += 1
+            state.last_active = time.monotonic()
+            ticket = _Ticket(state, cost, flow.priority(self.small_job_essays, self.small_job_priority),
+                             start_tag, next(self._seq), event, loop)
+            heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _wake(self, ticket: _Ticket):
+        if ticket.loop is not None:
+            ticket.loop.call_soon_threadsafe(ticket.event.set)
+        else:
+            ticket.event.set()
+
+    def _dispatch(self) -> Optional[float]:
+        """Grant slots to queued calls in fair order
+
+        Returns None when the next call waits for a slot (a release will
+        dispatch it), or the seconds until the rate limits admit it.
+        """
+        wake = []
+        delay = None
+        with self._lock:
+            while self._queue:
+                ticket = self._queue[0]
+                if ticket.cancelled:
+                    heapq.heappop(self._queue)
+                    continue
+                if self.in_flight >= int(self.limit):
+                    break
+                delay = self.request_bucket.try_take(1)
+                if delay == 0.0:
+                    delay = self.token_bucket.try_take(min(ticket.cost, self.token_bucket.capacity))
+                    if delay > 0.0:
+                        self.request_bucket.adjust(-1)
+                if delay > 0.0:
+                    # The head of the queue waits for the rate limits; wake it so it waits with a timeout
+                    wake.append(ticket)
+                    break
+                delay = None
+                heapq.heappop(self._queue)
+                ticket.granted = True
+                self.in_flight += 1
+                self.virtual_time = max(self.virtual_time, ticket.start_tag)
+                state = ticket.state
+                state.waiting -= 1
+                state.in_flight += 1
+                state.calls += 1
+                state.tokens += int(ticket.cost)
+                wake.append(ticket)
+        for ticket in wake:
+            self._wake(ticket)
+        return delay
+
+    def _cancel(self, ticket: _Ticket):
+        with self._lock:
+            if ticket.granted:
+                self.in_flight -= 1
+                ticket.state.in_flight = max(0, ticket.state.in_flight - 1)
+            elif not ticket.cancelled:
+                ticket.cancelled = True
+                ticket.state.waiting -= 1
+        self._dispatch()
+
+    def acquire(self, cost: float = 0) -> float:
+        """Block until this thread's flow is granted a slot for a call of `cost` tokens; returns the seconds waited"""
+        start = time.monotonic()
+        ticket = self._enqueue(cost, threading.Event())
+        try:
+            while True:
+                ticket.event.clear()
+                delay = self._dispatch()
+                if ticket.granted:
+                    break
+                ticket.event.wait(delay)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        return time.monotonic() - start
+
+    async def acquire_async(self, cost: float = 0) -> float:
+        """Like acquire(), but waits without blocking the event loop"""
+        start = time.monotonic()
+        ticket = self._enqueue(cost, asyncio.Event(), asyncio.get_running_loop())
+        try:
+            while True:
+                ticket.event.clear()
+                delay = self._dispatch()
+                if ticket.granted:
+                    break
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        return time.monotonic() - start
+
+    def release(self, throttled: bool = False):
+        """Free the slot of a call made in the current flow and dispatch the next"""
+        flow = current_flow()
+        with self._lock:
+            self._update(throttled)
+            state = self.flows.get(flow.name)
+            if state is not None:
+                state.in_flight = max(0, state.in_flight - 1)
+                state.last_active = time.monotonic()
+            self._releases.append(time.monotonic())
+        self._dispatch()
+
+    def _resize(self, slots: int):
+        with self._lock:
+            self._set_reserved(self.reserved + slots)
+        self._dispatch()
+
+    # ----- Reporting -----
+    def calls_per_second(self) -> Optional[float]:
+        """Recent rate at which calls finish, or None before there is enough history"""
+        with self._lock:
+            releases = list(self._releases)
+        if len(releases) < 2 or releases[-1] <= releases[0]:
+            return None
+        return (len(releases) - 1) / (releases[-1] - releases[0])
+
+    def _active(self) -> Dict[str, _FlowState]:
+        return {name: state for name, state in self.flows.items() if state.waiting or state.in_flight}
+
+    def status(self, flow_name: str, remaining_calls: int = 0) -> Dict:
+        """Queue position and estimated waits of a flow
+
+        'position' is the place of the flow's next call in the shared queue
+        (0 when none is waiting), 'share' the fraction of capacity it gets
+        while the current flows stay busy, and 'wait_seconds' the estimated
+        time until its next call starts. With `remaining_calls`,
+        'finish_seconds' estimates the time to make that many more calls.
+        """
+        rate = self.calls_per_second()
+        with self._lock:
+            queued = sorted(ticket for ticket in self._queue if not ticket.cancelled)
+            active = self._active()
+            state = self.flows.get(flow_name)
+            position = next((index + 1 for index, ticket in enumerate(queued) if ticket.state is state), 0)
+            if state is None:
+                share = 1.0
+            else:
+                priority = state.flow.priority(self.small_job_essays, self.small_job_priority)
+                rivals = [other for other in active.values()
+                          if other.flow.priority(self.small_job_essays, self.small_job_priority) <= priority]
+                total_weight = sum(other.flow.weight for other in rivals if other is not state) + state.flow.weight
+                share = state.flow.weight / total_weight
+            limit = int(self.limit)
+            in_flight = self.in_flight
+            summary = {
+                'flow': flow_name,
+                'active_flows': len(active),
+                'queued': state.waiting if state else 0,
+                'in_flight': state.in_flight if state else 0,
+                'position': position,
+                'queue_length': len(queued),
+                'share': round(share, 3),
+                'limit': limit,
+                'total_in_flight': in_flight,
+            }
+        if not position:
+            summary['wait_seconds'] = 0.0
+        else:
+            summary['wait_seconds'] = round((position - 1) / rate, 1) if rate else None
+        if remaining_calls:
+            summary['finish_seconds'] = round(remaining_calls / (rate * share), 1) if rate else None
+        return summary
+
+    def snapshot(self) -> List[Dict]:
+        """Every active flow with its calls queued and in flight, in queue order"""
+        with self._lock:
+            return [{
+                'flow': name,
+                'weight': state.flow.weight,
+                'priority': state.flow.priority(self.small_job_essays, self.small_job_priority) == PRIORITY_INTERACTIVE,
+                'queued': state.waiting,
+                'in_flight': state.in_flight,
+                'calls': state.calls,
+                'tokens': state.tokens,
+            } for name, state in sorted(self._active().items(), key=lambda item: item[1].finish_tag)]
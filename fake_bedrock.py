@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+Local fake of the bedrock-runtime client for offline experiments and benchmarks.
+
+FakeBedrockClient implements invoke_model and invoke_model_with_response_stream
+with the same response shapes as boto3 (a JSON body with `content` and `usage`,
+or an event stream of message_start, content_block_delta, message_delta and
+message_stop chunks), so it can stand in for the real client anywhere,
+including behind rate_limiter.RateLimitedClient. Latency (time to first token
+drawn from a log-normal distribution), output token rate, throttling and
+failure rates are configurable. Prompt caching is emulated for content blocks
+marked with cache_control, and prompts that ask for a <scores> block or a band
+estimate get plausible JSON back so score extraction and the cascade work.
+
+AsyncFakeBedrockClient offers the same API as coroutines for the asyncio path
+(async_marking.py).
+
+Select it for the app or CLI with BEDROCK_BACKEND=fake (see FAKE_BEDROCK_* in
+env.example), or construct it directly as benchmark.py does.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from dataclasses import dataclass
+from rate_limiter import AsyncBody
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+SCORES_EXAMPLE_PATTERN = re.compile(r"<scores>(\{.*?\})</scores>", re.DOTALL)
+PACKED_ESSAY_PATTERN = re.compile(r'<essay id="(\d+)">')
+ESTIMATE_EXAMPLE_PATTERN = re.compile(r"(\{\"criteria\": \[.*?\], \"confidence\": 0\.0\})", re.DOTALL)
+
+FILLER_SENTENCES = [
+    "The essay presents a clear position and supports it with relevant examples.",
+    "Paragraphs are generally well organised, although transitions could be smoother.",
+    "Vocabulary is varied and mostly precise, with occasional awkward phrasing.",
+    "The argument would be stronger with a more developed counterpoint.",
+    "Grammar and punctuation are largely accurate with a few minor slips.",
+    "The conclusion restates the main ideas but could offer a final insight.",
+]
+
+
+@dataclass
+class FakeBedrockConfig:
+    """Latency, throughput and error behaviour of the fake backend"""
+    latency_median: float = 0.5
+    latency_sigma: float = 0.4
+    tokens_per_second: float = 150.0
+    output_tokens: int = 600
+    chunk_tokens: int = 8
+    throttle_rate: float = 0.0
+    failure_rate: float = 0.0
+    failure_code: str = 'ModelErrorException'
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> 'FakeBedrockConfig':
+        seed = os.getenv('FAKE_BEDROCK_SEED')
+        return cls(
+            latency_median=float(os.getenv('FAKE_BEDROCK_LATENCY_MEDIAN', cls.latency_median)),
+            latency_sigma=float(os.getenv('FAKE_BEDROCK_LATENCY_SIGMA', cls.latency_sigma)),
+            tokens_per_second=float(os.getenv('FAKE_BEDROCK_TOKENS_PER_SECOND', cls.tokens_per_second)),
+            output_tokens=int(os.getenv('FAKE_BEDROCK_OUTPUT_TOKENS', cls.output_tokens)),
+            throttle_rate=float(os.getenv('FAKE_BEDROCK_THROTTLE_RATE', cls.throttle_rate)),
+            failure_rate=float(os.getenv('FAKE_BEDROCK_FAILURE_RATE', cls.failure_rate)),
+            seed=int(seed) if seed else None,
+        )
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': f"Injected by fake backend: {code}"}}, operation)
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeBedrockClient:
+    """Drop-in stand-in for boto3's bedrock-runtime client"""
+
+    def __init__(self, config: Optional[FakeBedrockConfig] = None, sleep=time.sleep):
+        self.config = config or FakeBedrockConfig()
+        self.sleep = sleep
+        self.calls = 0
+        self.throttles = 0
+        self.failures = 0
+        self._random = random.Random(self.config.seed)
+        self._cached_prefixes = set()
+        self._lock = threading.Lock()
+
+    # ----- Simulation -----
+    def _draw(self) -> Tuple[float, float]:
+        """Draw (uniform sample for error injection, time to first token)"""
+        with self._lock:
+            self.calls += 1
+            roll = self._random.random()
+            ttft = self._random.lognormvariate(math.log(self.config.latency_median), self.config.latency_sigma)
+        return roll, ttft
+
+    def _maybe_fail(self, roll: float, operation: str):
+        if roll < self.config.throttle_rate:
+            with self._lock:
+                self.throttles += 1
+            raise _client_error('ThrottlingException', operation)
+        if roll < self.config.throttle_rate + self.config.failure_rate:
+            with self._lock:
+                self.failures += 1
+            raise _client_error(self.config.failure_code, operation)
+
+    def _usage(self, request: Dict) -> Dict[str, int]:
+        """Input token usage, with prompt caching emulated for cache_control prefixes"""
+        blocks = []
+        for message in request.get('messages', []):
+            content = message.get('content', '')
+            blocks.extend(content if isinstance(content, list) else [{'type': 'text', 'text': content}])
+
+        usage = {'input_tokens': 0, 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+        prefix = hashlib.sha256()
+        cacheable = 0
+        for block in blocks:
+            tokens = _estimate_tokens(block.get('text', ''))
+            prefix.update(block.get('text', '').encode('utf-8'))
+            cacheable += tokens
+            if 'cache_control' in block:
+                digest = prefix.hexdigest()
+                with self._lock:
+                    hit = digest in self._cached_prefixes
+                    self._cached_prefixes.add(digest)
+                usage['cache_read_input_tokens' if hit else 'cache_creation_input_tokens'] += cacheable
+                cacheable = 0
+        usage['input_tokens'] = cacheable
+        return usage
+
+    def _completion(self, request: Dict) -> Tuple[str, str]:
+        """Synthetic completion of roughly `output_tokens` tokens, capped by max_tokens, and its stop reason"""
+        prompt = '\n'.join(
+            block.get('text', '') if isinstance(block, dict) else str(block)
+            for message in request.get('messages', [])
+            for block in (message['content'] if isinstance(message.get('content'), list) else [message.get('content', '')])
+        )
+        with self._lock:
+            draw = self._random.random
+            estimate = ESTIMATE_EXAMPLE_PATTERN.search(prompt)
+            if estimate:
+                example = json.loads(estimate.group(1))
+                for item in example['criteria']:
+                    item['band'] = 1 + int(draw() * 5)
+                    item['points'] = item['band'] * 4
+                example['confidence'] = round(0.7 + draw() * 0.3, 2)
+                return json.dumps(example), 'end_turn'
+
+            # Packed prompts get one <feedback id="n"> block per essay, sharing max_tokens; a
+            # prefilled reply (a continuation) only has the rest of `output_tokens` left to write
+            packed_ids = PACKED_ESSAY_PATTERN.findall(prompt)
+            messages = request.get('messages', [])
+            prefill = messages[-1]['content'] if messages and messages[-1].get('role') == 'assistant' else ''
+            wanted_tokens = max(1, self.config.output_tokens - _estimate_tokens(
+                prefill if isinstance(prefill, str) else ' '.join(block.get('text', '') for block in prefill)))
+            max_tokens = int(request.get('max_tokens') or self.config.output_tokens)
+            target_tokens = min(wanted_tokens, max_tokens // max(1, len(packed_ids)))
+            scores = SCORES_EXAMPLE_PATTERN.search(prompt)
+
+            def feedback(target_tokens: int = target_tokens) -> str:
+                sentences = []
+                while _estimate_tokens(' '.join(sentences)) < target_tokens:
+                    sentences.append(FILLER_SENTENCES[int(draw() * len(FILLER_SENTENCES))])
+                text = ' '.join(sentences)
+                if scores:
+                    example = json.loads(scores.group(1))
+                    for item in example['criteria']:
+                        item['band'] = 1 + int(draw() * 5)
+                        item['points'] = item['band'] * 4
+                    example['total'] = sum(item['points'] for item in example['criteria'])
+                    text += f"\n\n<scores>{json.dumps(example)}</scores>"
+                return text
+
+            if packed_ids:
+                return "\n\n".join(f'<feedback id="{essay_id}">\n{feedback()}\n</feedback>'
+                                   for essay_id in packed_ids), 'end_turn'
+            # A continuation starts with the space the prefill's trailing whitespace was stripped of
+            lead = ' ' if prefill else ''
+            if wanted_tokens > max_tokens:
+                # The whole reply cut off at max_tokens (about 6 characters per word), as the real model's
+                # would be, so the scores block at its end is left for a continuation to write
+                return lead + ' '.join(feedback(wanted_tokens).split(' ')[:max(1, max_tokens * 4 // 6)]), 'max_tokens'
+            return lead + feedback(), 'end_turn'
+
+    def _chunks(self, text: str) -> List[str]:
+        words = text.split(' ')
+        size = max(1, self.config.chunk_tokens)
+        return [' '.join(words[i:i + size]) + (' ' if i + size < len(words) else '')
+                for i in range(0, len(words), size)]
+
+    # ----- bedrock-runtime API -----
+    def invoke_model(self, modelId: str, body, **kwargs) -> Dict:
+        request = json.loads(body)
+        roll, ttft = self._draw()
+        self._maybe_fail(roll, 'InvokeModel')
+        usage = self._usage(request)
+        text, stop_reason = self._completion(request)
+        usage['output_tokens'] = _estimate_tokens(text)
+        self.sleep(ttft + usage['output_tokens'] / self.config.tokens_per_second)
+        response = {
+            'id': f"msg_fake_{self.calls}",
+            'type': 'message',
+            'role': 'assistant',
+            'model': modelId,
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': stop_reason,
+            'usage': usage,
+        }
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8')), 'contentType': 'application/json'}
+
+    def count_tokens(self, modelId: str, input: Dict, **kwargs) -> Dict:
+        request = json.loads(input['invokeModel']['body'])
+        tokens = 0
+        for message in request.get('messages', []):
+            content = message.get('content', '')
+            for block in content if isinstance(content, list) else [{'type': 'text', 'text': content}]:
+                tokens += _estimate_tokens(block.get('text', ''))
+        return {'inputTokens': tokens}
+
+    def invoke_model_with_response_stream(self, modelId: str, body, **kwargs) -> Dict:
+        request = json.loads(body)
+        roll, ttft = self._draw()
+        self._maybe_fail(roll, 'InvokeModelWithResponseStream')
+        usage = self._usage(request)
+        text, stop_reason = self._completion(request)
+        return {'body': self._events(modelId, text, usage, ttft, stop_reason), 'contentType': 'application/json'}
+
+    def _timed_events(self, model_id: str, text: str, usage: Dict, ttft: float,
+                      stop_reason: str) -> Iterator[Tuple[float, Dict]]:
+        """Stream events, each with the seconds to wait before it is delivered"""
+        def event(payload: Dict) -> Dict:
+            return {'chunk': {'bytes': json.dumps(payload).encode('utf-8')}}
+
+        yield 0.0, event({'type': 'message_start', 'message': {
+            'id': f"msg_fake_{self.calls}", 'type': 'message', 'role': 'assistant', 'model': model_id,
+            'content': [], 'usage': {**usage, 'output_tokens': 1},
+        }})
+        yield 0.0, event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        delay = ttft
+        for chunk in self._chunks(text):
+            delay += _estimate_tokens(chunk) / self.config.tokens_per_second
+            yield delay, event({'type': 'content_block_delta', 'index': 0,
+                                'delta': {'type': 'text_delta', 'text': chunk}})
+            delay = 0.0
+        yield 0.0, event({'type': 'content_block_stop', 'index': 0})
+        yield 0.0, event({'type': 'message_delta', 'delta': {'stop_reason': stop_reason},
+                          'usage': {'output_tokens': _estimate_tokens(text)}})
+        yield 0.0, event({'type': 'message_stop'})
+
+    def _events(self, model_id: str, text: str, usage: Dict, ttft: float, stop_reason: str) -> Iterator[Dict]:
+        for delay, event in self._timed_events(model_id, text, usage, ttft, stop_reason):
+            if delay:
+                self.sleep(delay)
+            yield event
+
+
+class AsyncFakeBedrockClient(FakeBedrockClient):
+    """Stand-in for an aiobotocore bedrock-runtime client: the same API as coroutines
+
+    Waits use asyncio.sleep, so hundreds of calls and streams can be in flight
+    on one event loop.
+    """
+
+    def __init__(self, config: Optional[FakeBedrockConfig] = None, sleep=asyncio.sleep):
+        super().__init__(config, sleep=sleep)
+
+    async def invoke_model(self, modelId: str, body, **kwargs) -> Dict:
+        request = json.loads(body)
+        roll, ttft = self._draw()
+        self._maybe_fail(roll, 'InvokeModel')
+        usage = self._usage(request)
+        text, stop_reason = self._completion(request)
+        usage['output_tokens'] = _estimate_tokens(text)
+        await self.sleep(ttft + usage['output_tokens'] / self.config.tokens_per_second)
+        response = {
+            'id': f"msg_fake_{self.calls}",
+            'type': 'message',
+            'role': 'assistant',
+            'model': modelId,
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': stop_reason,
+            'usage': usage,
+        }
+        return {'body': AsyncBody(json.dumps(response).encode('utf-8')), 'contentType': 'application/json'}
+
+    async def invoke_model_with_response_stream(self, modelId: str, body, **kwargs) -> Dict:
+        request = json.loads(body)
+        roll, ttft = self._draw()
+        self._maybe_fail(roll, 'InvokeModelWithResponseStream')
+        usage = self._usage(request)
+        text, stop_reason = self._completion(request)
+        return {'body': self._async_events(modelId, text, usage, ttft, stop_reason),
+                'contentType': 'application/json'}
+
+    async def _async_events(self, model_id: str, text: str, usage: Dict, ttft: float,
+                            stop_reason: str) -> AsyncIterator[Dict]:
+        for delay, event in self._timed_events(model_id, text, usage, ttft, stop_reason):
+            if delay:
+                await self.sleep(delay)
+            yield event
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed on-disk cache for generated feedback.
+
+Entries are keyed by a SHA-256 hash of everything that determines a generation
+(the rendered prompt, model ID and sampling parameters), so a byte-identical
+request is served from disk instead of calling Bedrock again.
+Each entry is stored as a small JSON file under the cache directory; the file
+modification time doubles as the last-access time for LRU eviction.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(**parts) -> str:
+    """Build a stable hash from the keyword arguments that define a generation"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class FeedbackCache:
+    """Persistent LRU cache of generated feedback, capped by total size on disk"""
+
+    def __init__(self, cache_dir: str = ".cache/feedback", max_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._scan()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _scan(self):
+        """Index existing entries so size accounting survives restarts"""
+        if not self.cache_dir.exists():
+            return
+        for entry_path in self.cache_dir.glob("*/*.json"):
+            size = entry_path.stat().st_size
+            self._sizes[entry_path.stem] = size
+            self._total_bytes += size
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached feedback for `key`, or None on a miss"""
+        entry_path = self._path(key)
+        with self._lock:
+            try:
+                with open(entry_path, 'r', encoding='utf-8') as f:
+                    value = json.load(f)['value']
+                os.utime(entry_path)
+            except (OSError, ValueError, KeyError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str):
+        """Store feedback under `key`, evicting least recently used entries if needed"""
+        entry_path = self._path(key)
+        data = json.dumps({'value': value, 'created': time.time()}, ensure_ascii=False)
+        with self._lock:
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = entry_path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, entry_path)
+
+            size = entry_path.stat().st_size
+            self._total_bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            self._evict()
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        by_access = sorted(
+            self._sizes,
+            key=lambda k: self._path(k).stat().st_mtime if self._path(k).exists() else 0
+        )
+        for key in by_access:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+            self._total_bytes -= self._sizes.pop(key)
+            self.evictions += 1
+            logger.info(f"Evicted feedback cache entry: {key}")
+
+    def clear(self):
+        """Remove every entry from the cache"""
+        with self._lock:
+            for key in list(self._sizes):
+                try:
+                    self._path(key).unlink()
+                except OSError:
+                    pass
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._sizes),
+                'bytes': self._total_bytes,
+            }
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+"""
+Durable SQLite job queue for marking runs.
+
+A job is one marking run (rubric, guidance, options and output folder) and
+holds one task per essay. Tasks move pending -> leased -> done (or failed).
+Workers (marking_worker.py, any number of processes, possibly on other hosts
+sharing the database and output folder) lease tasks for a limited time and
+renew the lease while they work, for at most JOB_TASK_DEADLINE_SECONDS after
+leasing a task; a task whose lease expires, because its worker died or is stuck
+on a hung call, is handed to another worker. Completion is idempotent:
+the first result recorded for a task wins and later ones are ignored, so a
+task that was re-leased after a slow worker finished is not counted twice.
+When every task of a job is done or failed, exactly one worker claims the job
+to finalise it (class feedback, manifest and results store).
+
+Workers lease from the active jobs in fair-share order rather than oldest
+first, so a large job does not hold up a colleague's small one: small or
+interactive jobs first (as in fair_scheduler.py), then the job with the
+fewest tasks in progress for its weight (options 'weight', default 1), then
+the oldest. queue_status() reports a job's place in that order and its
+estimated time to finish.
+
+Because the queue lives on disk, a page reload or server restart loses
+nothing: the UI just polls job_progress() again, and restarting workers
+resumes from the tasks not yet done. Essays reused from a previous run are
+submitted as already-done tasks.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from fair_scheduler import SCHEDULER_SMALL_JOB_ESSAYS, SCHEDULER_SMALL_JOB_PRIORITY
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', 'outputs/jobs.db')
+# WAL is faster but needs shared memory, so it is unsafe on network filesystems;
+# set JOB_QUEUE_WAL=false when workers on several hosts share the database
+JOB_QUEUE_WAL = os.getenv('JOB_QUEUE_WAL', 'true').lower() == 'true'
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Heartbeats stop renewing a task's lease this long after it was leased
+JOB_TASK_DEADLINE_SECONDS = float(os.getenv('JOB_TASK_DEADLINE_SECONDS', '1800'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    status TEXT NOT NULL,
+    rubric_name TEXT,
+    rubric_text TEXT NOT NULL,
+    feedback_guidance TEXT NOT NULL,
+    output_dir TEXT NOT NULL,
+    options TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    run_id INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    essay_name TEXT NOT NULL,
+    essay_text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reused INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (job_id, essay_name)
+);
+CREATE INDEX IF NOT EXISTS tasks_job_status ON tasks (job_id, status);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    started_at REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+"""
+
+ACTIVE_JOB_STATUSES = ('queued', 'running', 'finalizing')
+TASK_STATUSES = ('pending', 'leased', 'done', 'failed')
+JOB_COLUMNS = ("id, created_at, updated_at, status, rubric_name, rubric_text, feedback_guidance, "
+               "output_dir, options, run_id, error")
+# Queued and running jobs with their ready, in-progress and remaining task counts, in the order workers lease them
+FAIR_JOB_ORDER = """
+SELECT j.id, c.ready, c.leased, c.remaining, c.priority, c.weight FROM jobs j JOIN (
+    SELECT t.job_id,
+           SUM(t.status = 'pending' OR (t.status = 'leased' AND t.lease_expires < :now)) AS ready,
+           SUM(t.status = 'leased' AND t.lease_expires >= :now) AS leased,
+           SUM(t.status IN ('pending', 'leased')) AS remaining,
+           CASE WHEN COALESCE(json_extract(jj.options, '$.interactive'), 0)
+                     OR (:small_job_priority AND SUM(t.reused = 0) <= :small_job_essays) THEN 0 ELSE 1 END
+               AS priority,
+           MAX(COALESCE(json_extract(jj.options, '$.weight'), 1.0), 0.01) AS weight
+    FROM tasks t JOIN jobs jj ON jj.id = t.job_id
+    WHERE jj.status IN ('queued', 'running') GROUP BY t.job_id
+) c ON c.job_id = j.id
+WHERE c.remaining > 0
+ORDER BY c.ready = 0, c.priority, CAST(c.leased AS REAL) / c.weight, j.id
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _job_from_row(row) -> Dict:
+    return {
+        'id': row[0],
+        'created_at': row[1],
+        'updated_at': row[2],
+        'status': row[3],
+        'rubric_name': row[4],
+        'rubric_text': row[5],
+        'feedback_guidance': row[6],
+        'output_dir': row[7],
+        'options': json.loads(row[8] or '{}'),
+        'run_id': row[9],
+        'error': row[10],
+    }
+
+
+class JobQueue:
+    """Persistent queue of marking jobs and their per-essay tasks
+
+    Every operation opens its own short-lived connection, so one JobQueue can be
+    shared by threads and a database file by processes. Times come from
+    `clock` (wall-clock seconds, shared by the processes using the database).
+    """
+
+    def __init__(self, db_path: str = JOB_QUEUE_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, task_deadline_seconds: float = JOB_TASK_DEADLINE_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        self.db_path = db_path
+        self.clock = clock
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.task_deadline_seconds = task_deadline_seconds
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(f"PRAGMA journal_mode={'WAL' if JOB_QUEUE_WAL else 'DELETE'}")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction that takes the database lock up front, so lease races cannot interleave"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # ----- Submission -----
+    def submit(self, essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+               rubric_name: str = "", output_dir: str = "outputs", options: Optional[Dict] = None,
+               reused: Optional[List[Dict]] = None) -> int:
+        """Queue a marking job and return its ID
+
+        `essays` holds every essay of the run. Those with a record in `reused`
+        (e.g. from marking_manifest.plan_incremental_marking) are stored as
+        tasks that are already done, so the job's results cover the whole set.
+        """
+        now = self.clock()
+        reused_by_name = {item['name']: item for item in reused or []}
+        with self._transaction() as conn:
+            job_id = conn.execute(
+                "INSERT INTO jobs (created_at, updated_at, status, rubric_name, rubric_text, feedback_guidance, "
+                "output_dir, options) VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (now, now, rubric_name, rubric_text, feedback_guidance, output_dir, json.dumps(options or {}))
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO tasks (job_id, essay_name, essay_text, status, reused, result, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(job_id, name, text, 'done' if name in reused_by_name else 'pending', int(name in reused_by_name),
+                  json.dumps(reused_by_name[name], ensure_ascii=False) if name in reused_by_name else None, now)
+                 for name, text in essays.items()]
+            )
+        return job_id
+
+    # ----- Workers -----
+    def heartbeat(self, worker_id: str) -> int:
+        """Record that a worker is alive and extend the leases it holds
+
+        A task's lease is only extended until `task_deadline_seconds` after it
+        was leased, so a task stuck on a hung call expires and is leased again
+        (or failed after max_attempts) even though its worker is alive.
+        Returns the number of the worker's leased tasks past their deadline.
+        """
+        now = self.clock()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO workers (id, host, pid, started_at, last_seen) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET last_seen = excluded.last_seen",
+                (worker_id, socket.gethostname(), os.getpid(), now, now)
+            )
+            # A leased task's updated_at is the time it was leased: nothing else changes it until it finishes
+            conn.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE lease_owner = ? AND status = 'leased' AND updated_at >= ?",
+                (now + self.lease_seconds, worker_id, now - self.task_deadline_seconds)
+            )
+            conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? AND status = 'finalizing'",
+                (now + self.lease_seconds, worker_id)
+            )
+            overdue = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE lease_owner = ? AND status = 'leased' AND updated_at < ?",
+                (worker_id, now - self.task_deadline_seconds)
+            ).fetchone()[0]
+        return overdue
+
+    def unregister_worker(self, worker_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def active_workers(self, max_age: float = 30.0) -> List[Dict]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, host, pid, last_seen FROM workers WHERE last_seen >= ? ORDER BY id",
+                (self.clock() - max_age,)
+            ).fetchall()
+        return [{'id': row[0], 'host': row[1], 'pid': row[2], 'last_seen': row[3]} for row in rows]
+
+    def lease(self, worker_id: str, max_tasks: int = 1,
+              packed_max_tasks: Optional[int] = None) -> Tuple[Optional[Dict], List[Dict]]:
+        """Lease up to `max_tasks` pending tasks of the next job in fair-share order that has any
+
+        Jobs submitted with options['pack'] lease up to `packed_max_tasks`
+        instead, so one worker can pack them into shared requests. Tasks whose
+        lease expired are leased again, or failed once they have used up
+        max_attempts. Returns the job and its leased tasks, or (None, []).
+        """
+        now = self.clock()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', lease_owner = NULL, updated_at = ?, "
+                "error = COALESCE(error, 'Lease expired') "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            row = conn.execute(f"{FAIR_JOB_ORDER} LIMIT 1", self._order_params(now)).fetchone()
+            if not row or not row[1]:
+                return None, []
+            job = _job_from_row(conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (row[0],)).fetchone())
+            limit = (packed_max_tasks or max_tasks) if job['options'].get('pack') else max_tasks
+            rows = conn.execute(
+                "SELECT id, essay_name, essay_text, attempts FROM tasks WHERE job_id = ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) ORDER BY id LIMIT ?",
+                (job['id'], now, max(1, limit))
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                [(worker_id, now + self.lease_seconds, now, task_row[0]) for task_row in rows]
+            )
+            conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                         (now, job['id']))
+        tasks = [{'id': task_row[0], 'essay_name': task_row[1], 'essay_text': task_row[2],
+                  'attempts': task_row[3] + 1} for task_row in rows]
+        return job, tasks
+
+    @staticmethod
+    def _order_params(now: float) -> Dict:
+        return {'now': now, 'small_job_essays': SCHEDULER_SMALL_JOB_ESSAYS,
+                'small_job_priority': int(SCHEDULER_SMALL_JOB_PRIORITY)}
+
+    def queue_status(self, job_id: int, window: float = 120.0) -> Dict:
+        """A job's place among the jobs sharing the workers and its estimated time to finish
+
+        'position' is the job's place in lease order (0 once it has nothing
+        left to lease), 'share' the fraction of the workers it gets while the
+        current jobs stay busy, 'tasks_per_minute' the rate at which workers
+        finished tasks over the last `window` seconds, and 'wait_seconds' the
+        estimated time to finish its remaining tasks at its share of that rate.
+        """
+        now = self.clock()
+        with self._connect() as conn:
+            rows = conn.execute(FAIR_JOB_ORDER, self._order_params(now)).fetchall()
+            finished, first = conn.execute(
+                "SELECT COUNT(*), MIN(updated_at) FROM tasks WHERE status = 'done' AND reused = 0 AND updated_at >= ?",
+                (now - window,)
+            ).fetchone()
+        row = next((row for row in rows if row[0] == job_id), None)
+        if row is None:
+            return {'position': 0, 'active_jobs': len(rows), 'share': 1.0, 'remaining': 0,
+                    'tasks_per_minute': None, 'wait_seconds': 0.0}
+        rivals = [other for other in rows if other[4] <= row[4]]
+        share = row[5] / sum(other[5] for other in rivals)
+        rate = finished / max(now - first, 1.0) if finished else None
+        return {
+            'position': rows.index(row) + 1 if row[1] else 0,
+            'active_jobs': len(rows),
+            'share': round(share, 3),
+            'remaining': row[3],
+            'tasks_per_minute': round(rate * 60, 1) if rate else None,
+            'wait_seconds': round(row[3] / (rate * share), 1) if rate else None,
+        }
+
+    # ----- Task results -----
+    def complete(self, task_id: int, result: Dict) -> bool:
+        """Record a task's feedback record; False if the task was already done"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_owner = NULL, updated_at = ? "
+                "WHERE id = ? AND status != 'done'",
+                (json.dumps(result, ensure_ascii=False), self.clock(), task_id)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, task_id: int, worker_id: str, error: str, retry: bool = True) -> str:
+        """Release a failed task for another attempt (or fail it for good) and return its new status
+
+        Ignored, returning the current status, if the lease has meanwhile passed
+        to another worker.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status, attempts, lease_owner FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if not row or row[0] != 'leased' or row[2] != worker_id:
+                return row[0] if row else ''
+            status = 'pending' if retry and row[1] < self.max_attempts else 'failed'
+            conn.execute(
+                "UPDATE tasks SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ?",
+                (status, error, self.clock(), task_id)
+            )
+        return status
+
+    def results(self, job_id: int) -> Tuple[Dict[str, str], List[Dict], Dict[str, str]]:
+        """The job's essays and feedback records in submission order, and the errors of failed tasks
+
+        Each feedback record has 'reused' set if it came from a previous run.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT essay_name, essay_text, status, reused, result, error FROM tasks WHERE job_id = ? ORDER BY id",
+                (job_id,)
+            ).fetchall()
+        essays = {name: text for name, text, *_ in rows}
+        records = [{**json.loads(result), 'reused': bool(reused)}
+                   for _, _, status, reused, result, _ in rows if status == 'done']
+        errors = {name: error or "" for name, _, status, _, _, error in rows if status == 'failed'}
+        return essays, records, errors
+
+    # ----- Jobs -----
+    def job(self, job_id: Optional[int]) -> Dict:
+        if job_id is None:
+            return {}
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_from_row(row) if row else {}
+
+    def latest_job(self) -> Dict:
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT 1").fetchone()
+        return _job_from_row(row) if row else {}
+
+    def list_jobs(self, limit: int = 20) -> List[Dict]:
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [_job_from_row(row) for row in rows]
+
+    def job_progress(self, job_id: int) -> Dict[str, int]:
+        """Task counts by status, plus 'total' and 'reused'"""
+        with self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+            reused = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE job_id = ? AND reused = 1", (job_id,)
+            ).fetchone()[0]
+        progress = {status: counts.get(status, 0) for status in TASK_STATUSES}
+        progress['total'] = sum(progress.values())
+        progress['reused'] = reused
+        return progress
+
+    def claim_finalization(self, job_id: int, worker_id: str) -> bool:
+        """Claim the right to finalise a job whose tasks are all done or failed
+
+        Only one worker succeeds; a claim whose worker stopped renewing it can
+        be taken over once its lease expires.
+        """
+        now = self.clock()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'finalizing', lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND (status IN ('queued', 'running') "
+                "OR (status = 'finalizing' AND lease_expires < ?)) "
+                "AND NOT EXISTS (SELECT 1 FROM tasks WHERE job_id = ? AND status IN ('pending', 'leased'))",
+                (worker_id, now + self.lease_seconds, now, job_id, now, job_id)
+            )
+        return cursor.rowcount == 1
+
+    def unfinalized_jobs(self) -> List[int]:
+        """IDs of jobs with no work left whose finalisation has not been claimed (or was abandoned)"""
+        now = self.clock()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE (status IN ('queued', 'running') "
+                "OR (status = 'finalizing' AND lease_expires < ?)) "
+                "AND NOT EXISTS (SELECT 1 FROM tasks WHERE job_id = jobs.id AND status IN ('pending', 'leased')) "
+                "ORDER BY id",
+                (now,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def finish_job(self, job_id: int, run_id: Optional[int] = None, error: str = ""):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, run_id = ?, error = ?, lease_owner = NULL, updated_at = ? WHERE id = ?",
+                ('failed' if error and run_id is None else 'done', run_id, error or None, self.clock(), job_id)
+            )
+
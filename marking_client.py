@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+Client for the marking service (marking_service.py).
+
+With MARKING_SERVICE_URL set, the Streamlit app marks essays and generates
+the class feedback through the service instead of calling Bedrock itself, so
+its requests share the service's rate limits, fair scheduling and
+single-flight coalescing with the Next.js frontend. mark_essays_remote() is
+a drop-in for automarking.mark_essays. Requests carry the caller's flow
+(fair_scheduler.flow_context) in the X-Marking-Flow and X-Marking-Weight
+headers.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import urllib.error
+import urllib.request
+
+from automarking import FEEDBACK_CACHE_ENABLED, MARKING_CONCURRENCY, save_feedback_file
+from concurrent.futures import ThreadPoolExecutor
+from fair_scheduler import bind_flow, current_flow
+from typing import Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+MARKING_SERVICE_URL = os.getenv('MARKING_SERVICE_URL', '').rstrip('/')
+MARKING_SERVICE_TIMEOUT = float(os.getenv('MARKING_SERVICE_TIMEOUT', '1000'))
+# Essays sent per batch request; two batches are in flight so the next starts while one finishes
+MARKING_SERVICE_BATCH_SIZE = int(os.getenv('MARKING_SERVICE_BATCH_SIZE', '50'))
+
+
+class MarkingServiceError(Exception):
+    """The marking service refused a request, failed it or could not be reached"""
+
+
+def _open(path: str, payload: Dict, url: str):
+    if not url:
+        raise MarkingServiceError("No marking service URL given (set MARKING_SERVICE_URL)")
+    flow = current_flow()
+    headers = {'Content-Type': 'application/json'}
+    if flow.name != 'default':
+        headers.update({'X-Marking-Flow': flow.name, 'X-Marking-Weight': str(flow.weight)})
+    request = urllib.request.Request(f"{url}{path}", data=json.dumps(payload).encode('utf-8'),
+                                     headers=headers, method='POST')
+    try:
+        return urllib.request.urlopen(request, timeout=MARKING_SERVICE_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.load(e).get('error') or str(e)
+        except ValueError:
+            message = str(e)
+        raise MarkingServiceError(f"{path}: {message}")
+    except urllib.error.URLError as e:
+        raise MarkingServiceError(f"Marking service at {url} is unreachable: {e.reason}")
+
+
+def post_json(path: str, payload: Dict, url: str = MARKING_SERVICE_URL) -> Dict:
+    """POST a request and return the JSON reply"""
+    with _open(path, payload, url) as response:
+        return json.load(response)
+
+
+def post_events(path: str, payload: Dict, url: str = MARKING_SERVICE_URL) -> Iterator[Dict]:
+    """POST a streamed request and yield the reply's events as they arrive"""
+    with _open(path, {**payload, 'stream': True}, url) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+def mark_essays_remote(essays: Union[Dict[str, str], Iterable[Tuple[str, str]]], rubric_text: str,
+                       feedback_guidance: str, max_workers: int = MARKING_CONCURRENCY, output_dir: str = "outputs",
+                       use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                       on_complete: Optional[Callable[[int, int, str, Optional[Exception]], None]] = None,
+                       on_delta: Optional[Callable[[str, str], None]] = None,
+                       on_tick: Optional[Callable[[], None]] = None,
+                       tick_interval: float = 0.25,
+                       route: Optional[Callable[[str, str], str]] = None,
+                       pack: bool = False,
+                       fanout: bool = False,
+                       max_tokens: Optional[Dict[str, int]] = None,
+                       url: str = MARKING_SERVICE_URL,
+                       batch_size: int = MARKING_SERVICE_BATCH_SIZE
+                       ) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
+    """Mark essays through the service's batch endpoint, with the signature and results of automarking.mark_essays
+
+    Essays (a mapping, or a stream of (name, text) pairs) are sent
+    `batch_size` at a time as they arrive and the service marks each batch
+    `max_workers` essays at a time. `route` is called here and its model sent
+    as the essay's modelId; the service does not pack or fan out, so `pack`
+    and `fanout` are ignored. Feedback files are saved here, under
+    `output_dir`.
+    """
+    events = queue.Queue()
+
+    def post(batch: List[Dict]):
+        payload = {
+            'essays': batch,
+            'rubricText': rubric_text,
+            'feedbackGuidance': feedback_guidance,
+            'useCache': use_cache,
+            'concurrency': max_workers,
+            'deltas': on_delta is not None,
+        }
+        answered = set()
+        try:
+            for event in post_events('/api/mark-essays', payload, url):
+                if event['event'] == 'delta':
+                    on_delta(event['essayName'], event['text'])
+                elif event['event'] in ('result', 'error'):
+                    answered.add(event['essayName'])
+                    events.put(event)
+        except Exception as e:
+            logger.error(f"Error marking a batch of {len(batch)} essay(s) through the service: {str(e)}")
+            for essay in batch:
+                if essay['essayName'] not in answered:
+                    events.put({'event': 'error', 'essayName': essay['essayName'], 'error': str(e)})
+
+    def feed(executor: ThreadPoolExecutor):
+        batch = []
+        try:
+            for essay_name, essay_text in (essays.items() if isinstance(essays, dict) else essays):
+                essay = {'essayName': essay_name, 'essayText': essay_text}
+                if route:
+                    essay['modelId'] = route(essay_name, essay_text)
+                if max_tokens and max_tokens.get(essay_name):
+                    essay['maxTokens'] = max_tokens[essay_name]
+                events.put({'event': 'arrived', 'essayName': essay_name})
+                batch.append(essay)
+                if len(batch) >= batch_size:
+                    executor.submit(bind_flow(post), batch)
+                    batch = []
+            if batch:
+                executor.submit(bind_flow(post), batch)
+            events.put({'event': 'fed'})
+        except Exception as e:
+            events.put({'event': 'fed', 'exception': e})
+
+    essay_names = []
+    results = {}
+    errors = {}
+    completed = 0
+    fed = False
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="service-client") as executor:
+        threading.Thread(target=bind_flow(feed), args=(executor,), name="service-feed", daemon=True).start()
+        while not fed or completed < len(essay_names):
+            try:
+                event = events.get(timeout=tick_interval if on_tick else None)
+            except queue.Empty:
+                on_tick()
+                continue
+            if event['event'] == 'arrived':
+                essay_names.append(event['essayName'])
+                continue
+            if event['event'] == 'fed':
+                fed = True
+                if 'exception' in event:
+                    raise event['exception']
+                continue
+
+            completed += 1
+            essay_name = event['essayName']
+            error = None
+            if event['event'] == 'result':
+                try:
+                    path = save_feedback_file(essay_name, event['feedback'], output_dir)
+                except Exception as e:
+                    # The feedback is still returned (and stored by the caller); only the file is missing
+                    logger.error(f"Error saving feedback for {essay_name}: {str(e)}")
+                    path = ''
+                results[essay_name] = {
+                    'name': essay_name,
+                    'feedback': event['feedback'],
+                    'path': path,
+                    'scores': event['scores'],
+                    'model': event['model'],
+                    'seconds': event['seconds']
+                }
+            else:
+                error = MarkingServiceError(event['error'])
+                errors[essay_name] = event['error']
+                logger.error(f"Error processing {essay_name}: {event['error']}")
+
+            if on_tick:
+                on_tick()
+            if on_complete:
+                on_complete(completed, len(essay_names), essay_name, error)
+
+    generated_feedbacks = [results[name] for name in essay_names if name in results]
+    return generated_feedbacks, errors
+
+
+def _class_payload(all_feedbacks: List[Dict], rubric_text: str, use_cache: bool) -> Dict:
+    return {
+        'allFeedbacks': [{'name': item['name'], 'feedback': item['feedback'], 'scores': item.get('scores', {})}
+                         for item in all_feedbacks],
+        'rubricText': rubric_text,
+        'useCache': use_cache,
+    }
+
+
+def generate_class_feedback_remote(all_feedbacks: List[Dict], rubric_text: str,
+                                   use_cache: bool = FEEDBACK_CACHE_ENABLED, url: str = MARKING_SERVICE_URL) -> str:
+    """Class overall feedback from the service, as automarking.generate_class_feedback"""
+    return post_json('/api/class-feedback', _class_payload(all_feedbacks, rubric_text, use_cache), url)['classFeedback']
+
+
+def stream_class_feedback_remote(all_feedbacks: List[Dict], rubric_text: str,
+                                 use_cache: bool = FEEDBACK_CACHE_ENABLED, url: str = MARKING_SERVICE_URL) -> Generator:
+    """Stream class overall feedback from the service as text chunks, as automarking.stream_class_feedback"""
+    for event in post_events('/api/class-feedback', _class_payload(all_feedbacks, rubric_text, use_cache), url):
+        if event['event'] == 'delta':
+            yield event['text']
+        elif event['event'] == 'error':
+            raise MarkingServiceError(event['error'])
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Content-hash manifest for incremental re-marking.
+
+The manifest (outputs/manifest.json) records, for every marked essay, its
+content hash, size, mtime, the feedback file written and the structured scores,
+together with hashes of the rubric and feedback guidance used. With it:
+- load_essays_incremental() and iter_essays_incremental() stat the essays
+  folder and only read files whose size or mtime changed since they were last
+  seen (see essay_ingest for the formats read and the files skipped)
+- mark_essays_incremental() only marks new or changed essays (or all of them
+  when the rubric or guidance changed) and merges the previous feedback back
+  in, so the class report is computed over the whole set. Given a stream of
+  essays it starts marking them as they are read
+- plan_incremental_marking() and record_marked_essays() are the two halves of
+  that, for callers such as the job queue that mark essays elsewhere
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from automarking import mark_essays
+from essay_ingest import IngestReport, collect_essays, iter_essays
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class MarkingManifest:
+    """Persisted record of which essays were marked with which rubric and guidance"""
+
+    def __init__(self, output_dir: str = "outputs"):
+        self.path = Path(output_dir) / MANIFEST_FILENAME
+        self.rubric_hash = ""
+        self.guidance_hash = ""
+        self.essays = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.rubric_hash = data.get('rubric_hash', "")
+                self.guidance_hash = data.get('guidance_hash', "")
+                self.essays = data.get('essays', {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable manifest {self.path}: {str(e)}")
+
+    def save(self):
+        """Write the manifest atomically"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'rubric_hash': self.rubric_hash,
+                'guidance_hash': self.guidance_hash,
+                'essays': self.essays,
+            }, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def unchanged_on_disk(self, essay_name: str, stat: os.stat_result) -> bool:
+        entry = self.essays.get(essay_name)
+        return bool(entry) and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime
+
+    def needs_marking(self, essay_name: str, essay_text: str) -> bool:
+        entry = self.essays.get(essay_name)
+        return (not entry
+                or entry.get('content_hash') != content_hash(essay_text)
+                or not entry.get('feedback_path')
+                or not os.path.exists(entry['feedback_path']))
+
+
+def iter_essays_incremental(folder_path: str, manifest: MarkingManifest,
+                            loaded: Optional[Dict[str, str]] = None, report: Optional[IngestReport] = None,
+                            read_names: Optional[List[str]] = None) -> Iterator[Tuple[str, str]]:
+    """Yield (name, text) for each essay as it is read, re-reading only files that changed
+
+    `loaded` holds essay texts already in memory (e.g. from the session). A
+    file is read when it is not in `loaded` or its size/mtime differs from the
+    manifest; the names read are appended to `read_names`.
+    """
+    loaded = loaded or {}
+    unchanged = set()
+
+    def known(essay_name: str, stat: os.stat_result) -> Optional[str]:
+        if essay_name in loaded and manifest.unchanged_on_disk(essay_name, stat):
+            unchanged.add(essay_name)
+            return loaded[essay_name]
+        return None
+
+    for essay_name, essay_text in iter_essays(folder_path, report, known=known):
+        if read_names is not None and essay_name not in unchanged:
+            read_names.append(essay_name)
+        yield essay_name, essay_text
+
+
+def load_essays_incremental(folder_path: str, manifest: MarkingManifest,
+                            loaded: Optional[Dict[str, str]] = None,
+                            report: Optional[IngestReport] = None) -> Tuple[Dict[str, str], List[str]]:
+    """Load essays, re-reading only files that changed since they were last seen
+
+    Returns the essays in filename order and the names that were read.
+    """
+    read_names = []
+    essays = dict(sorted(iter_essays_incremental(folder_path, manifest, loaded, report, read_names)))
+    return essays, sorted(read_names)
+
+
+def _fresh_manifest(output_dir: str, rubric_text: str, feedback_guidance: str, force: bool) -> MarkingManifest:
+    """The manifest, emptied when `force` is set or the rubric or guidance changed"""
+    manifest = MarkingManifest(output_dir)
+    changed = (manifest.rubric_hash != content_hash(rubric_text)
+               or manifest.guidance_hash != content_hash(feedback_guidance))
+    if force or changed:
+        if manifest.essays and not force:
+            logger.info("Rubric or feedback guidance changed; re-marking all essays")
+        manifest.essays = {}
+    return manifest
+
+
+def _reused_record(manifest: MarkingManifest, essay_name: str) -> Dict:
+    """The feedback record of an unchanged essay, read back from its feedback file"""
+    entry = manifest.essays[essay_name]
+    with open(entry['feedback_path'], 'r', encoding='utf-8') as f:
+        feedback = f.read()
+    return {
+        'name': essay_name,
+        'feedback': feedback,
+        'path': entry['feedback_path'],
+        'scores': entry.get('scores', {}),
+        'model': entry.get('model', ''),
+    }
+
+
+def plan_incremental_marking(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                             output_dir: str = "outputs", force: bool = False) -> Tuple[Dict[str, str], List[Dict]]:
+    """Split essays into those that need marking and the feedback records reused from the manifest"""
+    manifest = _fresh_manifest(output_dir, rubric_text, feedback_guidance, force)
+    to_mark = {name: text for name, text in essays.items() if manifest.needs_marking(name, text)}
+    reused = [_reused_record(manifest, essay_name) for essay_name in essays if essay_name not in to_mark]
+    logger.info(f"Marking {len(to_mark)} new or changed essay(s); reusing {len(reused)}")
+    return to_mark, reused
+
+
+def record_marked_essays(essays: Dict[str, str], rubric_text: str, feedback_guidance: str, marked: List[Dict],
+                         output_dir: str = "outputs", essays_dir: Optional[str] = None, force: bool = False):
+    """Add freshly marked essays to the manifest and drop entries for essays no longer in `essays`"""
+    manifest = _fresh_manifest(output_dir, rubric_text, feedback_guidance, force)
+    manifest.rubric_hash = content_hash(rubric_text)
+    manifest.guidance_hash = content_hash(feedback_guidance)
+    for item in marked:
+        entry = {
+            'content_hash': content_hash(essays[item['name']]),
+            'feedback_path': item['path'],
+            'scores': item.get('scores', {}),
+            'model': item.get('model', ''),
+        }
+        essay_path = Path(essays_dir) / item['name'] if essays_dir else None
+        if essay_path and essay_path.exists():
+            stat = essay_path.stat()
+            entry.update({'size': stat.st_size, 'mtime': stat.st_mtime})
+        manifest.essays[item['name']] = entry
+    manifest.essays = {name: entry for name, entry in manifest.essays.items() if name in essays}
+    manifest.save()
+
+
+def mark_essays_incremental(essays: Union[Dict[str, str], Iterable[Tuple[str, str]]], rubric_text: str, feedback_guidance: str,
+                            output_dir: str = "outputs", essays_dir: Optional[str] = None,
+                            force: bool = False, mark: Callable = mark_essays,
+                            **mark_kwargs) -> Tuple[List[Dict], Dict[str, str], int]:
+    """Mark only new or changed essays and merge in the previous feedback
+
+    Everything is re-marked when `force` is set or the rubric or guidance
+    changed since the manifest was written. The essays are marked by `mark`
+    (automarking.mark_essays, or a wrapper with the same signature such as
+    near_duplicates.mark_essays_with_reuse), which receives the keyword
+    arguments. `essays` may be a stream of (name, text) pairs (see
+    iter_essays_incremental): each new or changed essay is then passed on to
+    `mark` as it arrives. Returns the merged feedback records in essay order,
+    the errors, and the number of essays reused from the manifest.
+    """
+    if isinstance(essays, dict):
+        to_mark, reused = plan_incremental_marking(essays, rubric_text, feedback_guidance, output_dir, force)
+    else:
+        manifest = _fresh_manifest(output_dir, rubric_text, feedback_guidance, force)
+        reused = []
+
+        def changed(stream: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+            for essay_name, essay_text in stream:
+                if manifest.needs_marking(essay_name, essay_text):
+                    yield essay_name, essay_text
+                else:
+                    reused.append(_reused_record(manifest, essay_name))
+
+        # Every essay that arrives is kept in `essays` for the manifest and the merged records
+        stream, essays = essays, {}
+        to_mark = changed(collect_essays(stream, essays))
+    marked, errors = mark(to_mark, rubric_text, feedback_guidance, output_dir=output_dir, **mark_kwargs)
+    record_marked_essays(essays, rubric_text, feedback_guidance, marked, output_dir, essays_dir, force)
+
+    by_name = {item['name']: item for item in marked + reused}
+    generated_feedbacks = [by_name[essay_name] for essay_name in essays if essay_name in by_name]
+    return generated_feedbacks, errors, len(reused)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+"""
+HTTP marking service shared by the Streamlit app and the Next.js frontend.
+
+Both frontends can mark through this one process, so the prompts in
+automarking.py are the only ones, and the process-wide rate limiter and fair
+scheduler see every request. Endpoints (JSON bodies, camelCase fields as used
+by automarking-web):
+- POST /api/mark-essay {essayText, essayName, rubricText, feedbackGuidance}
+  returns {essayName, feedback, scores, model, seconds, coalesced}.
+- POST /api/mark-essays {essays: [{essayName, essayText}], rubricText,
+  feedbackGuidance} marks a batch, `concurrency` essays at a time, and
+  returns {results, errors}.
+- POST /api/class-feedback {allFeedbacks, rubricText} returns
+  {classFeedback, statistics}.
+- GET /health returns coalescing, rate limiter and scheduler statistics;
+  GET /metrics the Prometheus text of every Bedrock call.
+
+With "stream": true the reply is newline-delimited JSON events sent as they
+happen: {"event": "delta", "text"} chunks (per essay in a batch only with
+"deltas": true), a {"event": "result"} or {"event": "error"} per essay or
+class report, and a final {"event": "done"} for batches. Optional fields:
+useCache (default true), maxTokens (a planned output limit) and modelId
+(BEDROCK_LARGE_MODEL_ID or BEDROCK_SMALL_MODEL_ID).
+
+Identical requests in flight at the same time are coalesced (single flight):
+the first makes the Bedrock call and every other one replays its chunks as
+they arrive, so a class submitted twice, or the same essay from both
+frontends, costs one call. The generation runs to completion even if the
+client that started it disconnects. Requests are scheduled as the flow named
+by the X-Marking-Flow header (weight X-Marking-Weight, at most
+MARKING_SERVICE_MAX_WEIGHT; see fair_scheduler.py); single essays are
+interactive.
+
+Usage:
+    uv run python marking_service.py --host 127.0.0.1 --port 8600
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from automarking import (
+    BEDROCK_LARGE_MODEL_ID,
+    BEDROCK_SMALL_MODEL_ID,
+    DEFAULT_INFERENCE_PARAMS,
+    ESSAY_MAX_TOKENS,
+    FEEDBACK_CACHE_ENABLED,
+    MARKING_CONCURRENCY,
+    call_metrics,
+    class_statistics_table,
+    essay_cache_key,
+    fair_scheduler,
+    planned_max_tokens,
+    rate_limiter,
+    reserve_concurrency,
+    stream_class_feedback,
+    stream_essay_feedback,
+)
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fair_scheduler import bind_flow, flow_context
+from feedback_cache import make_cache_key
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import call_context
+from scoring import extract_scores
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MARKING_SERVICE_HOST = os.getenv('MARKING_SERVICE_HOST', '127.0.0.1')
+MARKING_SERVICE_PORT = int(os.getenv('MARKING_SERVICE_PORT', '8600'))
+# Essays of one batch request marked at once (the fair scheduler still caps Bedrock calls process-wide)
+MARKING_SERVICE_BATCH_CONCURRENCY = int(os.getenv('MARKING_SERVICE_BATCH_CONCURRENCY', str(MARKING_CONCURRENCY)))
+MARKING_SERVICE_MAX_REQUEST_MB = float(os.getenv('MARKING_SERVICE_MAX_REQUEST_MB', '50'))
+# Largest fair-share weight a client may ask for with X-Marking-Weight
+MARKING_SERVICE_MAX_WEIGHT = float(os.getenv('MARKING_SERVICE_MAX_WEIGHT', '4'))
+
+SERVICE_MODELS = (BEDROCK_LARGE_MODEL_ID, BEDROCK_SMALL_MODEL_ID)
+
+
+class BadRequest(Exception):
+    """A request the service cannot serve; the message is returned to the client"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class _Flight:
+    """The chunks of one generation so far, shared by every request waiting on it"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, text: str):
+        with self.condition:
+            self.chunks.append(text)
+            self.condition.notify_all()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def replay(self) -> Iterator[str]:
+        """Every chunk from the first, waiting for new ones until the generation ends"""
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                chunks = self.chunks[index:]
+                finished = self.done and index + len(chunks) == len(self.chunks)
+                error = self.error
+            index += len(chunks)
+            yield from chunks
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """Share one generation between identical requests that are in flight at the same time
+
+    The first request for a key (the leader) runs the generation on its own
+    thread as it reads the chunks, publishing each one; later requests for the key
+    replay the chunks published so far and then wait for the rest. Once the
+    generation ends the key is forgotten, so a later identical request goes
+    to the feedback cache instead.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def stream(self, key: str, generate: Callable[[], Iterable[str]]) -> Tuple[Iterator[str], bool]:
+        """Chunks of the generation for `key`, and whether it was already in flight"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight.replay(), True
+            flight = self._flights[key] = _Flight()
+            self.leaders += 1
+        return self._lead(key, flight, generate), False
+
+    def _lead(self, key: str, flight: _Flight, generate: Callable[[], Iterable[str]]) -> Iterator[str]:
+        chunks = iter(generate())
+        try:
+            for text in chunks:
+                flight.publish(text)
+                yield text
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+            raise
+        finally:
+            if not flight.done:
+                # The leader stopped reading; finish the generation for the requests sharing it
+                try:
+                    for text in chunks:
+                        flight.publish(text)
+                    flight.finish()
+                except Exception as e:
+                    flight.finish(e)
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._flights)
+        return {'in_flight': in_flight, 'leaders': self.leaders, 'coalesced': self.followers}
+
+
+flights = SingleFlight()
+
+
+def _required(body: Dict, *fields: str):
+    if any(not body.get(field) for field in fields):
+        raise BadRequest("Missing required fields")
+
+
+def _model_id(body: Dict) -> str:
+    model_id = body.get('modelId') or BEDROCK_LARGE_MODEL_ID
+    if model_id not in SERVICE_MODELS:
+        raise BadRequest(f"Unsupported modelId: {model_id}")
+    return model_id
+
+
+def _max_tokens(body: Dict) -> Optional[int]:
+    max_tokens = body.get('maxTokens')
+    if max_tokens is not None and (isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1):
+        raise BadRequest(f"Invalid maxTokens: {max_tokens}")
+    return max_tokens
+
+
+def request_weight(header: Optional[str]) -> Optional[float]:
+    """Fair-share weight from an X-Marking-Weight header, capped at MARKING_SERVICE_MAX_WEIGHT"""
+    if not header:
+        return None
+    try:
+        weight = float(header)
+    except ValueError:
+        raise BadRequest(f"Invalid X-Marking-Weight: {header}")
+    if not math.isfinite(weight) or weight <= 0:
+        raise BadRequest(f"Invalid X-Marking-Weight: {header}")
+    return min(weight, MARKING_SERVICE_MAX_WEIGHT)
+
+
+def essay_stream(essay: Dict, rubric_text: str, feedback_guidance: str, use_cache: bool) -> Tuple[Iterator[str], bool]:
+    """Feedback chunks for one essay of a request, coalesced with identical essays in flight"""
+    essay_text, essay_name = essay['essayText'], essay['essayName']
+    model_id = _model_id(essay)
+    max_tokens = _max_tokens(essay)
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    # Requests with different planned limits make different calls, so only identical limits share one
+    key = make_cache_key(request=essay_cache_key(essay_text, rubric_text, feedback_guidance, params, model_id),
+                         max_tokens=planned_max_tokens(max_tokens), use_cache=use_cache)
+
+    def generate() -> Iterator[str]:
+        with call_context(essay=essay_name, kind='essay'):
+            yield from stream_essay_feedback(essay_text, essay_name, rubric_text, feedback_guidance,
+                                             use_cache=use_cache, model_id=model_id,
+                                             max_tokens=max_tokens)
+
+    return flights.stream(key, generate)
+
+
+def mark_essay(essay: Dict, rubric_text: str, feedback_guidance: str, use_cache: bool,
+               on_delta: Optional[Callable[[str], None]] = None) -> Dict:
+    """Mark one essay of a request and return its result record"""
+    start = time.perf_counter()
+    chunks, coalesced = essay_stream(essay, rubric_text, feedback_guidance, use_cache)
+    parts = []
+    for text in chunks:
+        parts.append(text)
+        if on_delta:
+            on_delta(text)
+    feedback, scores = extract_scores(''.join(parts), rubric_text)
+    return {
+        'essayName': essay['essayName'],
+        'feedback': feedback,
+        'scores': scores,
+        'model': _model_id(essay),
+        'seconds': round(time.perf_counter() - start, 3),
+        'coalesced': coalesced
+    }
+
+
+def class_feedback_stream(all_feedbacks: List[Dict], rubric_text: str, use_cache: bool) -> Tuple[Iterator[str], bool]:
+    """Class feedback chunks, coalesced with an identical class report in flight"""
+    key = make_cache_key(kind="class-request", feedbacks=all_feedbacks, rubric=rubric_text, use_cache=use_cache)
+    return flights.stream(key, lambda: stream_class_feedback(all_feedbacks, rubric_text, use_cache=use_cache))
+
+
+class MarkingRequestHandler(BaseHTTPRequestHandler):
+    """Routes the service's endpoints; each request is handled on its own thread"""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AutomaticMarking/1.0'
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {
+                'status': 'ok',
+                'coalescing': flights.stats(),
+                'rate_limiter': rate_limiter.stats(),
+                'scheduler': fair_scheduler.snapshot() if fair_scheduler is not None else [],
+            })
+        elif self.path == '/metrics':
+            self.send_body(200, call_metrics.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': f"Not found: {self.path}"})
+
+    def do_POST(self):
+        handlers = {
+            '/api/mark-essay': self.handle_mark_essay,
+            '/api/mark-essays': self.handle_mark_essays,
+            '/api/class-feedback': self.handle_class_feedback,
+        }
+        handler = handlers.get(self.path)
+        if handler is None:
+            self.send_json(404, {'error': f"Not found: {self.path}"})
+            return
+        try:
+            body = self.read_json()
+        except BadRequest as e:
+            self.send_json(e.status, {'error': str(e)})
+            return
+        flow_name = self.headers.get('X-Marking-Flow') or f"service-{self.client_address[0]}"
+        try:
+            weight = request_weight(self.headers.get('X-Marking-Weight'))
+            with flow_context(flow_name, weight, essays=len(body.get('essays') or []),
+                              interactive=self.path == '/api/mark-essay'):
+                handler(body)
+        except BadRequest as e:
+            self.send_json(e.status, {'error': str(e)})
+
+    def read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MARKING_SERVICE_MAX_REQUEST_MB * 1024 * 1024:
+            self.close_connection = True
+            raise BadRequest(f"Request larger than {MARKING_SERVICE_MAX_REQUEST_MB:g} MB", status=413)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            raise BadRequest("Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise BadRequest("Request body must be a JSON object")
+        return body
+
+    def send_body(self, status: int, data: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status: int, payload: Dict):
+        self.send_body(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def event_writer(self) -> Callable[[Optional[Dict]], None]:
+        """Start a chunked NDJSON reply; returns a function that sends one event, or ends the reply with None
+
+        Events may be sent from several threads. If the client goes away,
+        further events are dropped so that the work still completes.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        lock = threading.Lock()
+        connected = True
+
+        def send(event: Optional[Dict]):
+            nonlocal connected
+            data = (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8') if event is not None else b''
+            with lock:
+                if not connected:
+                    return
+                try:
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.info(f"Client {self.address_string()} disconnected from {self.path}")
+                    connected = False
+                    self.close_connection = True
+        return send
+
+    def handle_mark_essay(self, body: Dict):
+        _required(body, 'essayText', 'essayName', 'rubricText', 'feedbackGuidance')
+        _model_id(body)
+        _max_tokens(body)
+        use_cache = bool(body.get('useCache', FEEDBACK_CACHE_ENABLED))
+        if not body.get('stream'):
+            try:
+                record = mark_essay(body, body['rubricText'], body['feedbackGuidance'], use_cache)
+            except Exception as e:
+                logger.error(f"Error marking {body['essayName']}: {str(e)}")
+                self.send_json(500, {'error': f"Failed to generate feedback: {str(e)}"})
+                return
+            self.send_json(200, record)
+            return
+
+        send = self.event_writer()
+        try:
+            record = mark_essay(body, body['rubricText'], body['feedbackGuidance'], use_cache,
+                                on_delta=lambda text: send({'event': 'delta', 'text': text}))
+            send({'event': 'result', **record})
+        except Exception as e:
+            logger.error(f"Error marking {body['essayName']}: {str(e)}")
+            send({'event': 'error', 'essayName': body['essayName'], 'error': str(e)})
+        send(None)
+
+    def handle_mark_essays(self, body: Dict):
+        _required(body, 'essays', 'rubricText', 'feedbackGuidance')
+        essays = body['essays']
+        if not isinstance(essays, list) or not all(isinstance(essay, dict) for essay in essays):
+            raise BadRequest("essays must be a list of {essayName, essayText} objects")
+        for essay in essays:
+            _required(essay, 'essayName', 'essayText')
+            _model_id(essay)
+            _max_tokens(essay)
+        rubric_text, feedback_guidance = body['rubricText'], body['feedbackGuidance']
+        use_cache = bool(body.get('useCache', FEEDBACK_CACHE_ENABLED))
+        try:
+            concurrency = int(body.get('concurrency') or MARKING_SERVICE_BATCH_CONCURRENCY)
+        except (TypeError, ValueError):
+            raise BadRequest(f"Invalid concurrency: {body.get('concurrency')}")
+        concurrency = max(1, min(concurrency, MARKING_SERVICE_BATCH_CONCURRENCY, len(essays)))
+        stream = bool(body.get('stream'))
+        send = self.event_writer() if stream else None
+
+        def mark(essay: Dict) -> Dict:
+            def on_delta(text: str):
+                send({'event': 'delta', 'essayName': essay['essayName'], 'text': text})
+            return mark_essay(essay, rubric_text, feedback_guidance, use_cache,
+                              on_delta if stream and body.get('deltas') else None)
+
+        results = {}
+        errors = {}
+        with reserve_concurrency(concurrency), \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="service-batch") as executor:
+            futures = {executor.submit(bind_flow(mark), essay): index for index, essay in enumerate(essays)}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    essay_name = essays[futures[future]]['essayName']
+                    try:
+                        results[futures[future]] = future.result()
+                        if stream:
+                            send({'event': 'result', **results[futures[future]]})
+                    except Exception as e:
+                        errors[essay_name] = str(e)
+                        logger.error(f"Error marking {essay_name}: {str(e)}")
+                        if stream:
+                            send({'event': 'error', 'essayName': essay_name, 'error': str(e)})
+
+        if stream:
+            send({'event': 'done', 'completed': len(results), 'errors': errors})
+            send(None)
+        else:
+            self.send_json(200, {'results': [results[index] for index in sorted(results)], 'errors': errors})
+
+    def handle_class_feedback(self, body: Dict):
+        _required(body, 'allFeedbacks', 'rubricText')
+        all_feedbacks, rubric_text = body['allFeedbacks'], body['rubricText']
+        if not isinstance(all_feedbacks, list) or not all(
+                isinstance(item, dict) and 'name' in item and 'feedback' in item for item in all_feedbacks):
+            raise BadRequest("allFeedbacks must be a list of {name, feedback} objects")
+        use_cache = bool(body.get('useCache', FEEDBACK_CACHE_ENABLED))
+        statistics = class_statistics_table(all_feedbacks, rubric_text)
+        send = self.event_writer() if body.get('stream') else None
+        parts = []
+        try:
+            chunks, coalesced = class_feedback_stream(all_feedbacks, rubric_text, use_cache)
+            for text in chunks:
+                parts.append(text)
+                if send:
+                    send({'event': 'delta', 'text': text})
+        except Exception as e:
+            logger.error(f"Error generating class feedback: {str(e)}")
+            if send:
+                send({'event': 'error', 'error': str(e)})
+                send(None)
+            else:
+                self.send_json(500, {'error': f"Failed to generate class feedback: {str(e)}"})
+            return
+
+        result = {'classFeedback': ''.join(parts), 'statistics': statistics, 'coalesced': coalesced}
+        if send:
+            send({'event': 'result', **result})
+            send(None)
+        else:
+            self.send_json(200, result)
+
+
+class MarkingService(ThreadingHTTPServer):
+    """The marking HTTP service; serve_forever() handles each request on a daemon thread"""
+    daemon_threads = True
+
+    def __init__(self, host: str = MARKING_SERVICE_HOST, port: int = MARKING_SERVICE_PORT):
+        super().__init__((host, port), MarkingRequestHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve essay marking over HTTP for the Streamlit and Next.js frontends")
+    parser.add_argument('--host', default=MARKING_SERVICE_HOST, help="Interface to listen on")
+    parser.add_argument('--port', type=int, default=MARKING_SERVICE_PORT, help="Port to listen on")
+    args = parser.parse_args()
+
+    service = MarkingService(args.host, args.port)
+    logger.info(f"Marking service listening on {service.url}")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+
+
+if __name__ == '__main__':
+    main()
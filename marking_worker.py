@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+"""
+Marking worker for the durable job queue (job_queue.py).
+
+A worker process leases essay tasks from the queue, marks them with
+automarking.mark_essays on a pool of threads, and records each result as soon
+as it is ready; a heartbeat thread keeps its leases alive. When a job has no
+tasks left, one worker finalises it: it updates the incremental manifest,
+generates the class feedback and stores the run in the results database,
+whose run ID the UI then shows. Any number of workers can serve one queue,
+on this host or on others that share the queue database and output folder.
+
+The Streamlit app submits jobs and starts a local worker if none is running;
+start more (or run them elsewhere) with:
+    uv run python marking_worker.py --queue outputs/jobs.db --concurrency 8
+
+and submit a folder of essays without the UI with:
+    uv run python batch_marking.py --essays essays --submit
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from async_marking import mark_essays_on_event_loop
+from automarking import (
+    FEEDBACK_CACHE_ENABLED,
+    MARKING_CONCURRENCY,
+    METRICS_DIR,
+    class_statistics_table,
+    generate_class_feedback,
+    mark_essays,
+    save_class_feedback,
+)
+from fair_scheduler import flow_context
+from job_queue import ACTIVE_JOB_STATUSES, JOB_QUEUE_PATH, JobQueue, default_worker_id
+from marking_manifest import plan_incremental_marking, record_marked_essays
+from metrics import RunMetrics, record_run
+from model_router import ModelRouter
+from near_duplicates import NearDuplicateIndex, mark_essays_with_reuse
+from results_store import ResultsStore
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_PACK_TASKS = int(os.getenv('WORKER_PACK_TASKS', '8'))
+WORKER_POLL_SECONDS = float(os.getenv('WORKER_POLL_SECONDS', '2'))
+
+
+def submit_marking_job(queue: JobQueue, essays: Dict[str, str], rubric_name: str, rubric_text: str,
+                       feedback_guidance: str, output_dir: str = "outputs", essays_dir: Optional[str] = None,
+                       force: bool = False, **options) -> int:
+    """Queue a marking job, reusing feedback for essays unchanged since the last run into `output_dir`
+
+    `options` (use_cache, cascade, pack, fanout, async_client, max_tokens,
+    class_feedback, results_db, near_duplicates and near_duplicate_index) are
+    stored with the job and read by the worker that marks it, as are the
+    fair-share options flow (the flow name, default job-<id>), weight and
+    interactive (see fair_scheduler.flow_context). The asyncio client does
+    not pack or fan out, so those options together raise ValueError.
+    """
+    if options.get('async_client') and (options.get('pack') or options.get('fanout')):
+        raise ValueError("The asyncio client cannot be combined with packing or per-criterion fan-out")
+    _, reused = plan_incremental_marking(essays, rubric_text, feedback_guidance, output_dir, force)
+    return queue.submit(
+        essays,
+        rubric_text,
+        feedback_guidance,
+        rubric_name=rubric_name,
+        output_dir=output_dir,
+        options={**options, 'essays_dir': essays_dir, 'force': force, 'essays_to_mark': len(essays) - len(reused)},
+        reused=reused
+    )
+
+
+def spawn_worker(queue_path: str = JOB_QUEUE_PATH, concurrency: int = MARKING_CONCURRENCY,
+                 exit_when_idle: float = 120.0, log_path: str = "outputs/worker.log") -> subprocess.Popen:
+    """Start a detached local worker process that exits after `exit_when_idle` seconds without work"""
+    os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+    with open(log_path, 'a', encoding='utf-8') as log_file:
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--queue', queue_path,
+             '--concurrency', str(concurrency), '--exit-when-idle', str(exit_when_idle)],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+
+
+def job_flow(job: Dict):
+    """Fair-share flow for a job's Bedrock calls (see fair_scheduler.flow_context)"""
+    options = job['options']
+    return flow_context(options.get('flow') or f"job-{job['id']}", options.get('weight'),
+                        options.get('essays_to_mark', 0), bool(options.get('interactive')))
+
+
+def finalize_job(queue: JobQueue, job: Dict) -> int:
+    """Update the manifest, generate the class feedback and store the job's run; returns the run ID"""
+    options = job['options']
+    essays, records, errors = queue.results(job['id'])
+    record_marked_essays(
+        essays,
+        job['rubric_text'],
+        job['feedback_guidance'],
+        [item for item in records if not item['reused']],
+        job['output_dir'],
+        options.get('essays_dir'),
+        options.get('force', False)
+    )
+
+    class_feedback = ""
+    if records and options.get('class_feedback', True):
+        try:
+            class_feedback = generate_class_feedback(
+                records,
+                job['rubric_text'],
+                use_cache=options.get('use_cache', FEEDBACK_CACHE_ENABLED)
+            )
+            save_class_feedback(class_feedback, job['output_dir'])
+        except Exception as e:
+            logger.error(f"Error generating class feedback for job {job['id']}: {str(e)}")
+            errors['<class feedback>'] = str(e)
+
+    results_store = ResultsStore(options.get('results_db') or os.path.join(job['output_dir'], "results.db"))
+    try:
+        essay_ids = results_store.add_essays(essays)
+        run_id = results_store.create_run(
+            job['rubric_name'],
+            job['rubric_text'],
+            job['feedback_guidance'],
+            metadata={
+                'job_id': job['id'],
+                'errors': errors,
+                'reused': sum(1 for item in records if item['reused']),
+                'cascade': bool(options.get('cascade')),
+                'fanout': bool(options.get('fanout')),
+                'near_duplicates': {item['name']: item['duplicate_of'] for item in records if 'duplicate_of' in item},
+            }
+        )
+        results_store.add_feedbacks(run_id, records, essay_ids)
+        results_store.set_class_feedback(run_id, class_feedback, class_statistics_table(records, job['rubric_text']))
+    finally:
+        results_store.close()
+    return run_id
+
+
+class MarkingWorker:
+    """Lease essay tasks from a JobQueue and mark them on `concurrency` threads"""
+
+    def __init__(self, queue: JobQueue, worker_id: Optional[str] = None,
+                 concurrency: int = MARKING_CONCURRENCY, pack_tasks: int = WORKER_PACK_TASKS,
+                 poll_interval: float = WORKER_POLL_SECONDS, exit_when_idle: Optional[float] = None):
+        self.queue = queue
+        self.worker_id = worker_id or default_worker_id()
+        self.concurrency = concurrency
+        self.pack_tasks = pack_tasks
+        self.poll_interval = poll_interval
+        self.exit_when_idle = exit_when_idle
+        self.stop_event = threading.Event()
+        self._routers = {}
+        self._indexes = {}
+        self._runs = {}
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._last_work = time.monotonic()
+
+    def stop(self, *_):
+        logger.info(f"Worker {self.worker_id} stopping after the tasks in hand")
+        self.stop_event.set()
+
+    def _router(self, job: Dict) -> Optional[ModelRouter]:
+        if not job['options'].get('cascade'):
+            return None
+        with self._lock:
+            if job['id'] not in self._routers:
+                self._routers[job['id']] = ModelRouter(
+                    job['rubric_text'], use_cache=job['options'].get('use_cache', FEEDBACK_CACHE_ENABLED))
+            return self._routers[job['id']]
+
+    def _index(self, job: Dict) -> Optional[NearDuplicateIndex]:
+        path = job['options'].get('near_duplicate_index')
+        if not path:
+            return None
+        with self._lock:
+            if path not in self._indexes:
+                self._indexes[path] = NearDuplicateIndex(path)
+            return self._indexes[path]
+
+    def _run(self, job: Dict) -> RunMetrics:
+        """The call metrics of this worker's share of a job, exported when the job is finished"""
+        with self._lock:
+            if job['id'] not in self._runs:
+                self._runs[job['id']] = RunMetrics(f"job-{job['id']}-{self.worker_id.replace(':', '-')}")
+            return self._runs[job['id']]
+
+    def export_finished_runs(self, everything: bool = False):
+        """Export and forget the call metrics of jobs that are finished (or of every job)"""
+        with self._lock:
+            job_ids = list(self._runs)
+        for job_id in job_ids:
+            if everything or self.queue.job(job_id).get('status') not in ACTIVE_JOB_STATUSES:
+                with self._lock:
+                    run = self._runs.pop(job_id, None)
+                if run:
+                    run.export(METRICS_DIR)
+
+    def process(self, job: Dict, tasks: List[Dict]):
+        """Mark a batch of leased tasks of one job and record each outcome"""
+        essays = {task['essay_name']: task['essay_text'] for task in tasks}
+        task_ids = {task['essay_name']: task['id'] for task in tasks}
+        options = job['options']
+        index = self._index(job)
+        marker = mark_essays_on_event_loop if options.get('async_client') else mark_essays
+        mark = functools.partial(mark_essays_with_reuse, index=index, mode=options.get('near_duplicates', 'off'),
+                                 mark=marker) if index else marker
+        try:
+            with job_flow(job), record_run(self._run(job)):
+                records, errors = mark(
+                    essays,
+                    job['rubric_text'],
+                    job['feedback_guidance'],
+                    max_workers=len(essays),
+                    output_dir=job['output_dir'],
+                    use_cache=options.get('use_cache', FEEDBACK_CACHE_ENABLED),
+                    route=self._router(job),
+                    pack=bool(options.get('pack')),
+                    fanout=bool(options.get('fanout')),
+                    max_tokens=options.get('max_tokens')
+                )
+        except Exception as e:
+            logger.error(f"Error marking job {job['id']}: {str(e)}")
+            records, errors = [], {name: str(e) for name in essays}
+
+        for item in records:
+            if not self.queue.complete(task_ids[item['name']], item):
+                logger.info(f"Job {job['id']}: {item['name']} was already completed by another worker")
+        for essay_name, error in errors.items():
+            status = self.queue.fail(task_ids[essay_name], self.worker_id, error)
+            logger.warning(f"Job {job['id']}: {essay_name} failed ({error}); task is now {status}")
+
+    def finalize_ready_jobs(self):
+        """Finalise every job that has no tasks left and that no other worker is finalising"""
+        for job_id in self.queue.unfinalized_jobs():
+            if not self.queue.claim_finalization(job_id, self.worker_id):
+                continue
+            job = self.queue.job(job_id)
+            logger.info(f"Finalising job {job_id}")
+            try:
+                with job_flow(job), record_run(self._run(job)):
+                    run_id = finalize_job(self.queue, job)
+                self.queue.finish_job(job_id, run_id)
+                logger.info(f"Job {job_id} done (results run {run_id})")
+            except Exception as e:
+                logger.error(f"Error finalising job {job_id}: {str(e)}")
+                self.queue.finish_job(job_id, error=str(e))
+        self.export_finished_runs()
+
+    def _idle(self) -> bool:
+        with self._lock:
+            return (self.exit_when_idle is not None and self._busy == 0
+                    and time.monotonic() - self._last_work > self.exit_when_idle)
+
+    def _work_loop(self):
+        while not self.stop_event.is_set():
+            job, tasks = self.queue.lease(self.worker_id, max_tasks=1, packed_max_tasks=self.pack_tasks)
+            if not tasks:
+                self.finalize_ready_jobs()
+                if self._idle():
+                    self.stop_event.set()
+                self.stop_event.wait(self.poll_interval)
+                continue
+            with self._lock:
+                self._busy += 1
+            try:
+                self.process(job, tasks)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._last_work = time.monotonic()
+            self.finalize_ready_jobs()
+
+    def _heartbeat_loop(self):
+        interval = min(10.0, self.queue.lease_seconds / 3)
+        while not self.stop_event.wait(interval):
+            try:
+                overdue = self.queue.heartbeat(self.worker_id)
+            except Exception as e:
+                logger.warning(f"Heartbeat failed: {str(e)}")
+                continue
+            if overdue:
+                logger.warning(f"{overdue} task(s) passed their deadline; their leases will lapse for another worker")
+
+    def run(self):
+        """Serve the queue until stopped (or idle for `exit_when_idle` seconds)"""
+        self.queue.heartbeat(self.worker_id)
+        logger.info(f"Worker {self.worker_id} serving {self.queue.db_path} with {self.concurrency} thread(s)")
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        threads = [threading.Thread(target=self._work_loop, name=f"marking-{index}")
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.queue.unregister_worker(self.worker_id)
+        self.export_finished_runs(everything=True)
+        logger.info(f"Worker {self.worker_id} stopped")
+
+
+def print_status(queue: JobQueue):
+    jobs = [{
+        'id': job['id'],
+        'status': job['status'],
+        'rubric': job['rubric_name'],
+        'run_id': job['run_id'],
+        'error': job['error'],
+        **queue.job_progress(job['id']),
+    } for job in queue.list_jobs()]
+    print(json.dumps({'jobs': jobs, 'workers': queue.active_workers()}, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mark essays from the durable marking job queue")
+    parser.add_argument('--queue', default=JOB_QUEUE_PATH, help="Job queue database")
+    parser.add_argument('--concurrency', type=int, default=MARKING_CONCURRENCY, help="Tasks marked concurrently")
+    parser.add_argument('--worker-id', help="Worker name (default host:pid)")
+    parser.add_argument('--pack-tasks', type=int, default=WORKER_PACK_TASKS,
+                        help="Tasks leased at once for jobs submitted with packing")
+    parser.add_argument('--exit-when-idle', type=float,
+                        help="Exit after this many seconds without work (default: run until stopped)")
+    parser.add_argument('--status', action='store_true', help="Print recent jobs and live workers, then exit")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    if args.status:
+        print_status(queue)
+        return
+
+    worker = MarkingWorker(queue, args.worker_id, args.concurrency, args.pack_tasks,
+                           exit_when_idle=args.exit_when_idle)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+Per-call instrumentation of Bedrock requests.
+
+Every model call made through automarking is recorded as a CallRecord with its
+wall time, time to first token (streams), input/output/cached tokens, retries
+and throttles from the rate limiter, estimated cost, model ID, and the essay
+and kind of request (essay, class, digest, estimate) taken from the thread's
+(or asyncio task's) call_context(). Records are aggregated into Prometheus-style histograms and
+counters for the whole process and for each marking run recording them (see
+record_run), and a run can be exported as a JSONL trace plus a Prometheus
+text-format snapshot.
+"""
+
+import json
+import numpy as np
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SECONDS_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+TOKEN_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+# A context variable rather than a thread-local, so each asyncio task has its own labels too
+_labels: ContextVar[Dict[str, str]] = ContextVar('call_labels', default={})
+
+
+@contextmanager
+def call_context(**labels):
+    """Label the Bedrock calls made by this thread inside the block (e.g. essay=..., kind=...)
+
+    Contexts nest; inner labels override outer ones for the duration of the block.
+    """
+    previous = _labels.get()
+    _labels.set({**previous, **labels})
+    try:
+        yield
+    finally:
+        _labels.set(previous)
+
+
+def current_labels() -> Dict[str, str]:
+    return dict(_labels.get())
+
+
+@dataclass
+class CallRecord:
+    """Timing, token usage and retry statistics of one Bedrock call"""
+    timestamp: float
+    model: str
+    operation: str
+    kind: str = ""
+    essay: str = ""
+    wall_seconds: float = 0.0
+    ttft_seconds: Optional[float] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    attempts: int = 1
+    throttles: int = 0
+    retry_wait_seconds: float = 0.0
+    rate_wait_seconds: float = 0.0
+    queue_wait_seconds: float = 0.0
+    cost_usd: float = 0.0
+    stop_reason: str = ""
+    error: str = ""
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        return list(zip(bounds, np.cumsum(self.counts).tolist()))
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    return ",".join(f'{name}="{str(value)}"' for name, value in sorted(labels.items()))
+
+
+class _Aggregate:
+    """Histograms and counters keyed by (model, kind)"""
+
+    HISTOGRAMS = {
+        'bedrock_call_seconds': ('wall_seconds', SECONDS_BUCKETS, "Wall time of Bedrock calls including retries"),
+        'bedrock_time_to_first_token_seconds': ('ttft_seconds', TTFT_BUCKETS, "Time to first streamed token"),
+        'bedrock_input_tokens': ('input_tokens', TOKEN_BUCKETS, "Uncached input tokens per call"),
+        'bedrock_output_tokens': ('output_tokens', TOKEN_BUCKETS, "Output tokens per call"),
+    }
+    COUNTERS = {
+        'bedrock_calls_total': "Bedrock calls",
+        'bedrock_errors_total': "Bedrock calls that failed after retries",
+        'bedrock_retries_total': "Retried attempts",
+        'bedrock_throttles_total': "Throttled attempts",
+        'bedrock_input_tokens_total': "Uncached input tokens",
+        'bedrock_output_tokens_total': "Output tokens",
+        'bedrock_cache_read_tokens_total': "Input tokens read from the prompt cache",
+        'bedrock_cache_write_tokens_total': "Input tokens written to the prompt cache",
+        'bedrock_cost_usd_total': "Estimated cost in USD",
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def add(self, record: CallRecord):
+        key = (record.model, record.kind or "other")
+        for name, (field, buckets, _) in self.HISTOGRAMS.items():
+            value = getattr(record, field)
+            if value is not None and not record.error:
+                self.histograms.setdefault((name, key), Histogram(buckets)).observe(value)
+        increments = {
+            'bedrock_calls_total': 1,
+            'bedrock_errors_total': int(bool(record.error)),
+            'bedrock_retries_total': max(0, record.attempts - 1),
+            'bedrock_throttles_total': record.throttles,
+            'bedrock_input_tokens_total': record.input_tokens,
+            'bedrock_output_tokens_total': record.output_tokens,
+            'bedrock_cache_read_tokens_total': record.cache_read_input_tokens,
+            'bedrock_cache_write_tokens_total': record.cache_creation_input_tokens,
+            'bedrock_cost_usd_total': record.cost_usd,
+        }
+        for name, increment in increments.items():
+            self.counters[(name, key)] = self.counters.get((name, key), 0) + increment
+
+    def prometheus_lines(self) -> List[str]:
+        lines = []
+        for name, (_, _, help_text) in self.HISTOGRAMS.items():
+            series = sorted((key, histogram) for (metric, key), histogram in self.histograms.items() if metric == name)
+            if not series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (model, kind), histogram in series:
+                labels = {'model': model, 'kind': kind}
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket{{{_label_text({**labels, 'le': bound})}}} {count}")
+                lines.append(f"{name}_sum{{{_label_text(labels)}}} {histogram.sum:g}")
+                lines.append(f"{name}_count{{{_label_text(labels)}}} {histogram.count}")
+        for name, help_text in self.COUNTERS.items():
+            series = sorted((key, value) for (metric, key), value in self.counters.items() if metric == name)
+            if not series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (model, kind), value in series:
+                lines.append(f"{name}{{{_label_text({'model': model, 'kind': kind})}}} {value:g}")
+        return lines
+
+
+class RunMetrics:
+    """Call records and metrics of one marking run, job or ingest (see record_run)"""
+
+    def __init__(self, run_label: Optional[str] = None):
+        self._lock = threading.Lock()
+        self.run_label = run_label or time.strftime("%Y%m%d-%H%M%S")
+        self.aggregate = _Aggregate()
+        self._records = []
+
+    def add(self, record: CallRecord):
+        with self._lock:
+            self.aggregate.add(record)
+            self._records.append(record)
+
+    def records(self) -> List[CallRecord]:
+        with self._lock:
+            return list(self._records)
+
+    def summary(self) -> Dict[str, Dict]:
+        """Per-kind call counts, latency percentiles, mean tokens, retries and cost"""
+        by_kind = {}
+        for record in self.records():
+            by_kind.setdefault(record.kind or "other", []).append(record)
+        summary = {}
+        for kind, records in sorted(by_kind.items()):
+            ok = [record for record in records if not record.error]
+            seconds = np.array([record.wall_seconds for record in ok])
+            ttft = np.array([record.ttft_seconds for record in ok if record.ttft_seconds is not None])
+            summary[kind] = {
+                'calls': len(records),
+                'errors': len(records) - len(ok),
+                'p50_seconds': round(float(np.percentile(seconds, 50)), 2) if seconds.size else None,
+                'p95_seconds': round(float(np.percentile(seconds, 95)), 2) if seconds.size else None,
+                'p50_ttft_seconds': round(float(np.percentile(ttft, 50)), 2) if ttft.size else None,
+                'mean_input_tokens': round(float(np.mean([r.input_tokens + r.cache_read_input_tokens
+                                                          + r.cache_creation_input_tokens for r in ok])))
+                if ok else None,
+                'mean_output_tokens': round(float(np.mean([r.output_tokens for r in ok]))) if ok else None,
+                'retries': sum(record.attempts - 1 for record in records),
+                'throttles': sum(record.throttles for record in records),
+                'cost_usd': round(sum(record.cost_usd for record in records), 4),
+            }
+        return summary
+
+    def prometheus_text(self) -> str:
+        """Prometheus text exposition of the run's metrics"""
+        with self._lock:
+            lines = self.aggregate.prometheus_lines()
+        return "\n".join(lines) + "\n"
+
+    def trace_jsonl(self) -> str:
+        return "".join(json.dumps(asdict(record), ensure_ascii=False) + "\n" for record in self.records())
+
+    def export(self, output_dir: str = "outputs/metrics") -> Dict[str, str]:
+        """Write the run's trace (JSONL) and metrics (Prometheus text) and return their paths"""
+        directory = Path(output_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        trace_path = directory / f"run-{self.run_label}.jsonl"
+        prometheus_path = directory / f"run-{self.run_label}.prom"
+        trace_path.write_text(self.trace_jsonl(), encoding='utf-8')
+        prometheus_path.write_text(self.prometheus_text(), encoding='utf-8')
+        return {'trace': str(trace_path), 'prometheus': str(prometheus_path)}
+
+
+# The runs (see record_run) the current thread or asyncio task is making calls for
+_runs: ContextVar[Tuple[RunMetrics, ...]] = ContextVar('metrics_runs', default=())
+
+
+@contextmanager
+def record_run(run: RunMetrics) -> Iterator[RunMetrics]:
+    """Also add the Bedrock calls made inside the block to `run`
+
+    Worker threads started with fair_scheduler.bind_flow() inside the block
+    record to it too, so concurrent sessions, jobs and ingests each export
+    only their own calls. Blocks nest.
+    """
+    token = _runs.set(_runs.get() + (run,))
+    try:
+        yield run
+    finally:
+        _runs.reset(token)
+
+
+class MetricsRecorder:
+    """Thread-safe collector of CallRecords for the whole process and the runs recording them"""
+
+    def __init__(self, max_records: int = 10000):
+        self._lock = threading.Lock()
+        self.total = _Aggregate()
+        self._recent = deque(maxlen=max_records)
+
+    def record(self, record: CallRecord):
+        with self._lock:
+            self.total.add(record)
+            self._recent.append(record)
+        for run in _runs.get():
+            run.add(record)
+
+    def records(self) -> List[CallRecord]:
+        """The most recent calls made by this process, whichever run they belong to"""
+        with self._lock:
+            return list(self._recent)
+
+    def prometheus_text(self) -> str:
+        """Prometheus text exposition of the process-wide metrics"""
+        with self._lock:
+            lines = self.total.prometheus_lines()
+        return "\n".join(lines) + "\n"
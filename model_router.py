@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Small-model/large-model cascade for essay marking.
+
+Before marking, the small model (BEDROCK_SMALL_MODEL_ID) makes a quick band
+estimate for each essay with a confidence score. Clear-cut essays get their
+full feedback from the small model; essays with low confidence, estimates close
+to a band boundary, or bands listed in the escalation policy are escalated to
+the large model (BEDROCK_LARGE_MODEL_ID).
+
+A ModelRouter is passed to automarking.mark_essays as its `route` callable and
+afterwards summarises how many essays went to each tier, with latency and
+estimated cost per tier. Estimates are kept in the feedback cache, so an essay
+whose feedback is cached is routed to the same model without another call.
+"""
+
+import json
+import logging
+import numpy as np
+import os
+import re
+import threading
+import time
+
+from automarking import (
+    BEDROCK_LARGE_MODEL_ID,
+    BEDROCK_SMALL_MODEL_ID,
+    DEFAULT_INFERENCE_PARAMS,
+    FEEDBACK_CACHE_ENABLED,
+    TokenUsage,
+    estimate_cost,
+    feedback_cache,
+    invoke_claude_sonnet,
+)
+from dataclasses import dataclass, field
+from feedback_cache import make_cache_key
+from metrics import call_context
+from scoring import match_criterion, parse_rubric
+from typing import Dict, FrozenSet, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CASCADE_ENABLED = os.getenv('CASCADE_ENABLED', 'false').lower() == 'true'
+ESTIMATE_MAX_TOKENS = 300
+
+
+@dataclass
+class CascadePolicy:
+    """When to escalate an essay from the small model to the large model"""
+    min_confidence: float = float(os.getenv('CASCADE_MIN_CONFIDENCE', '0.8'))
+    boundary_margin: float = float(os.getenv('CASCADE_BOUNDARY_MARGIN', '1'))
+    escalate_bands: FrozenSet[int] = field(default_factory=lambda: frozenset(
+        int(band) for band in os.getenv('CASCADE_ESCALATE_BANDS', '').split(',') if band.strip()
+    ))
+
+
+def build_estimate_prompt(essay_text: str, rubric_text: str) -> str:
+    """Prompt for the small model's quick band estimate"""
+    criteria = [criterion.name for criterion in parse_rubric(rubric_text)]
+    example = {
+        "criteria": [{"criterion": name, "band": 0, "points": 0} for name in criteria],
+        "confidence": 0.0
+    }
+    return f"""You are an experienced examiner making a quick first-pass estimate of an essay's bands.
+
+<rubric>
+{rubric_text}
+</rubric>
+
+<essay>
+{essay_text}
+</essay>
+
+Estimate the band and points for each rubric criterion. Set "confidence" between 0 and 1 to the
+probability that a careful examiner would award exactly the same bands.
+Reply with JSON only, in this form:
+{json.dumps(example)}"""
+
+
+def parse_estimate(response: str) -> Optional[Dict]:
+    """Extract the JSON object from the small model's estimate, or None if unusable"""
+    match = re.search(r"\{.*\}", response, re.DOTALL)
+    if not match:
+        return None
+    try:
+        estimate = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(estimate.get('criteria'), list) or 'confidence' not in estimate:
+        return None
+    return estimate
+
+
+class ModelRouter:
+    """Route each essay to the small or large model based on a small-model estimate"""
+
+    def __init__(self, rubric_text: str, policy: Optional[CascadePolicy] = None,
+                 small_model_id: str = BEDROCK_SMALL_MODEL_ID,
+                 large_model_id: str = BEDROCK_LARGE_MODEL_ID, use_cache: bool = FEEDBACK_CACHE_ENABLED):
+        self.rubric_text = rubric_text
+        self.criteria = parse_rubric(rubric_text)
+        self.policy = policy or CascadePolicy()
+        self.small_model_id = small_model_id
+        self.large_model_id = large_model_id
+        self.use_cache = use_cache
+        self.decisions = {}
+        self._lock = threading.Lock()
+
+    def escalation_reason(self, estimate: Optional[Dict]) -> Optional[str]:
+        """Why an estimate should be escalated to the large model, or None if it is clear-cut"""
+        if estimate is None:
+            return "unparseable estimate"
+        if float(estimate.get('confidence') or 0) < self.policy.min_confidence:
+            return f"confidence {estimate.get('confidence')}"
+        if len(estimate['criteria']) < len(self.criteria):
+            return "missing criteria"
+        for item in estimate['criteria']:
+            try:
+                band = int(item.get('band'))
+                points = float(item['points']) if item.get('points') is not None else None
+            except (TypeError, ValueError):
+                return "malformed estimate"
+            if band in self.policy.escalate_bands:
+                return f"band {band} requires review"
+            criterion = match_criterion(str(item.get('criterion', '')), self.criteria)
+            if criterion and band in criterion.bands and points is not None:
+                low, high = criterion.bands[band]
+                near_lower = band > min(criterion.bands) and points - low < self.policy.boundary_margin
+                near_upper = band < max(criterion.bands) and high - points < self.policy.boundary_margin
+                if near_lower or near_upper:
+                    return f"{criterion.name} borderline at {points} points"
+        return None
+
+    def estimate(self, essay_text: str) -> Optional[Dict]:
+        """The small model's band estimate for an essay, served from the feedback cache when possible
+
+        Only parseable estimates are cached; the routing decision is made from
+        the estimate each time, so a policy change applies to cached ones too.
+        """
+        prompt = build_estimate_prompt(essay_text, self.rubric_text)
+        params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESTIMATE_MAX_TOKENS, "temperature": 0}
+        cache_key = make_cache_key(kind="estimate", prompt=prompt, model=self.small_model_id, params=params)
+        if self.use_cache:
+            cached = feedback_cache.get(cache_key)
+            if cached is not None:
+                return parse_estimate(cached)
+
+        with call_context(kind='estimate'):
+            response = invoke_claude_sonnet(prompt, model_id=self.small_model_id, **params)
+        estimate = parse_estimate(response if isinstance(response, str) else "")
+        if estimate is not None and self.use_cache:
+            feedback_cache.set(cache_key, response)
+        return estimate
+
+    def __call__(self, essay_name: str, essay_text: str) -> str:
+        """Estimate with the small model and return the model ID to mark this essay with"""
+        start = time.perf_counter()
+        try:
+            estimate = self.estimate(essay_text)
+        except Exception as e:
+            logger.warning(f"Small-model estimate failed for {essay_name}: {str(e)}")
+            estimate = None
+
+        reason = self.escalation_reason(estimate)
+        model_id = self.large_model_id if reason else self.small_model_id
+        with self._lock:
+            self.decisions[essay_name] = {
+                'model': model_id,
+                'reason': reason or "clear-cut",
+                'estimate': estimate,
+                'estimate_seconds': round(time.perf_counter() - start, 3),
+            }
+        logger.info(f"Routing {essay_name} to {'large' if reason else 'small'} model ({reason or 'clear-cut'})")
+        return model_id
+
+    def summary(self, generated_feedbacks: List[Dict], run_usage: TokenUsage) -> Dict[str, Dict]:
+        """Essays, latency and estimated cost per tier for a completed marking run
+
+        Latency is the per-essay marking time including the small-model
+        estimate; cost uses the run's per-model token totals (see
+        automarking.count_usage), so the small tier includes the estimates
+        for every essay.
+        """
+        usage_by_model = run_usage.snapshot_by_model()
+        tiers = {}
+        for tier, model_id in (('small', self.small_model_id), ('large', self.large_model_id)):
+            seconds = np.array([item['seconds'] for item in generated_feedbacks
+                                if item.get('model') == model_id and 'seconds' in item])
+            usage = usage_by_model.get(model_id, {})
+            tiers[tier] = {
+                'model': model_id,
+                'essays': int(seconds.size),
+                'mean_seconds': round(float(seconds.mean()), 2) if seconds.size else None,
+                'p95_seconds': round(float(np.percentile(seconds, 95)), 2) if seconds.size else None,
+                'calls': usage.get('calls', 0),
+                'input_tokens': usage.get('input_tokens', 0),
+                'output_tokens': usage.get('output_tokens', 0),
+                'estimated_cost_usd': round(estimate_cost(usage, model_id), 4),
+            }
+        return tiers
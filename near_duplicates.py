@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+
+"""
+Near-duplicate essay detection with MinHash and locality-sensitive hashing.
+
+Each essay is reduced to a MinHash signature over its word 3-grams, whose
+agreement between two essays estimates their Jaccard similarity. Signatures
+are split into bands and each band is hashed into a bucket; essays sharing any
+bucket are candidates, and only candidates are compared, so clustering a class
+takes roughly linear time instead of comparing every pair.
+
+The index (outputs/near_duplicates.db, NEAR_DUPLICATE_INDEX_PATH) persists
+signatures, buckets and essay texts across runs, so each new submission is
+checked against past cohorts as well as its own. It also keeps the feedback
+produced for each essay under each rubric and guidance. With
+NEAR_DUPLICATE_MODE set to 'reuse', a near-identical essay
+(NEAR_DUPLICATE_REUSE_THRESHOLD) of one that already has feedback gets that
+feedback and the rest are marked; with 'adapt', near-identical essays reuse it
+and other near-duplicates have it revised by the small model from a diff of
+the two essays instead of being marked from scratch.
+"""
+
+import difflib
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from automarking import (
+    BEDROCK_SMALL_MODEL_ID,
+    DEFAULT_INFERENCE_PARAMS,
+    ESSAY_MAX_TOKENS,
+    FEEDBACK_CACHE_ENABLED,
+    MARKING_CONCURRENCY,
+    essay_prompt_prefix,
+    invoke_claude_sonnet,
+    mark_essays,
+    save_feedback_file,
+)
+from concurrent.futures import ThreadPoolExecutor
+from essay_ingest import collect_essays
+from fair_scheduler import bind_flow
+from metrics import call_context
+from pathlib import Path
+from scoring import extract_scores, parse_rubric, scores_instruction
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUPLICATE_INDEX_PATH = os.getenv('NEAR_DUPLICATE_INDEX_PATH', 'outputs/near_duplicates.db')
+NEAR_DUPLICATE_MODE = os.getenv('NEAR_DUPLICATE_MODE', 'off').lower()
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.6'))
+NEAR_DUPLICATE_REUSE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_REUSE_THRESHOLD', '0.95'))
+NEAR_DUPLICATE_MODES = ('off', 'reuse', 'adapt')
+
+SHINGLE_WORDS = 3
+LSH_BANDS = 30
+LSH_ROWS = 4
+MINHASH_PRIME = (1 << 32) + 15
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS essays (
+    content_hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    cohort TEXT,
+    text BLOB NOT NULL,
+    signature BLOB NOT NULL,
+    added_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    band INTEGER NOT NULL,
+    bucket TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (band, bucket, content_hash)
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    content_hash TEXT NOT NULL,
+    rubric_hash TEXT NOT NULL,
+    guidance_hash TEXT NOT NULL,
+    feedback BLOB NOT NULL,
+    scores TEXT,
+    model TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, rubric_hash, guidance_hash)
+);
+"""
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def shingles(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """CRC32 hashes of the essay's lower-cased word n-grams"""
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        grams = [' '.join(words)] if words else []
+    else:
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.unique(np.array([zlib.crc32(gram.encode('utf-8')) for gram in grams], dtype=np.uint64))
+
+
+class MinHasher:
+    """MinHash signatures from `num_perm` universal hash functions (a * x + b) mod p"""
+
+    def __init__(self, num_perm: int = LSH_BANDS * LSH_ROWS, seed: int = 1):
+        generator = np.random.default_rng(seed)
+        self.a = generator.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """Signature of the text, or None if it has no words"""
+        values = shingles(text)
+        if not values.size:
+            return None
+        return ((self.a[:, None] * values[None, :] + self.b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+
+def similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two essays' shingle sets"""
+    return float(np.mean(signature_a == signature_b))
+
+
+def band_buckets(signature: np.ndarray, bands: int = LSH_BANDS) -> List[str]:
+    rows = len(signature) // bands
+    return [hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8).hexdigest()
+            for band in range(bands)]
+
+
+class _UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        self.parent[self.find(a)] = self.find(b)
+
+
+class NearDuplicateIndex:
+    """Persistent MinHash/LSH index of essays and the feedback they received"""
+
+    def __init__(self, db_path: str = NEAR_DUPLICATE_INDEX_PATH, threshold: float = NEAR_DUPLICATE_THRESHOLD):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.hasher = MinHasher()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    # ----- Indexing -----
+    def add(self, essays: Dict[str, str], cohort: str = "") -> Dict[str, np.ndarray]:
+        """Index essays not seen before and return every essay's signature by name"""
+        cohort = cohort or time.strftime("%Y-%m-%d")
+        signatures = {}
+        with self._lock, self._conn:
+            for name, text in essays.items():
+                content_hash = _hash(text)
+                row = self._conn.execute("SELECT signature FROM essays WHERE content_hash = ?",
+                                         (content_hash,)).fetchone()
+                if row:
+                    signatures[name] = np.frombuffer(row[0], dtype=np.uint64)
+                    continue
+                signature = self.hasher.signature(text)
+                if signature is None:
+                    continue
+                signatures[name] = signature
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO essays (content_hash, name, cohort, text, signature, added_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (content_hash, name, cohort, zlib.compress(text.encode('utf-8')), signature.tobytes(),
+                     time.time())
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO buckets (band, bucket, content_hash) VALUES (?, ?, ?)",
+                    [(band, bucket, content_hash) for band, bucket in enumerate(band_buckets(signature))]
+                )
+        return signatures
+
+    def candidates(self, signature: np.ndarray) -> List[Tuple[str, float]]:
+        """Indexed essays (content hash, similarity) at or above the threshold, most similar first"""
+        buckets = band_buckets(signature)
+        with self._lock:
+            hashes = {row[0] for row in self._conn.execute(
+                "SELECT DISTINCT content_hash FROM buckets WHERE "
+                + " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)),
+                [value for band, bucket in enumerate(buckets) for value in (band, bucket)]
+            )}
+            rows = self._conn.execute(
+                f"SELECT content_hash, signature FROM essays WHERE content_hash IN ({','.join('?' * len(hashes))})",
+                list(hashes)
+            ).fetchall() if hashes else []
+        matches = [(content_hash, similarity(signature, np.frombuffer(data, dtype=np.uint64)))
+                   for content_hash, data in rows]
+        return sorted([match for match in matches if match[1] >= self.threshold], key=lambda match: -match[1])
+
+    def essay(self, content_hash: str) -> Dict:
+        with self._lock:
+            row = self._conn.execute("SELECT name, cohort, text FROM essays WHERE content_hash = ?",
+                                     (content_hash,)).fetchone()
+        return {'name': row[0], 'cohort': row[1], 'text': zlib.decompress(row[2]).decode('utf-8')} if row else {}
+
+    def clusters(self, essays: Dict[str, str], cohort: str = "") -> List[Dict]:
+        """Index the essays and group near-duplicates among them and against past cohorts
+
+        Returns one entry per group of two or more similar essays in `essays`, or
+        per essay resembling an earlier submission, with 'essays' (names),
+        'similarity' (the highest pairwise estimate) and 'past' matches
+        ({name, cohort, similarity}) from other cohorts.
+        """
+        signatures = self.add(essays, cohort)
+        names_by_hash = {}
+        for name in signatures:
+            names_by_hash.setdefault(_hash(essays[name]), []).append(name)
+
+        groups = _UnionFind()
+        best = {}
+        past = {}
+        for content_hash, names in names_by_hash.items():
+            for name in names[1:]:
+                groups.union(names[0], name)
+                best[names[0]] = 1.0
+            for other_hash, score in self.candidates(signatures[names[0]]):
+                if other_hash == content_hash:
+                    continue
+                if other_hash in names_by_hash:
+                    groups.union(names[0], names_by_hash[other_hash][0])
+                    best[names[0]] = max(best.get(names[0], 0.0), score)
+                else:
+                    past.setdefault(names[0], []).append((other_hash, score))
+
+        members = {}
+        for name in signatures:
+            members.setdefault(groups.find(name), []).append(name)
+        clusters = []
+        for names in members.values():
+            past_matches = {}
+            for name in names:
+                for other_hash, score in past.get(name, []):
+                    past_matches[other_hash] = max(past_matches.get(other_hash, 0.0), score)
+            if len(names) < 2 and not past_matches:
+                continue
+            clusters.append({
+                'essays': sorted(names),
+                'similarity': round(max([best.get(name, 0.0) for name in names] + list(past_matches.values())), 3),
+                'past': [{**{key: value for key, value in self.essay(other_hash).items() if key != 'text'},
+                          'similarity': round(score, 3)}
+                         for other_hash, score in sorted(past_matches.items(), key=lambda item: -item[1])],
+            })
+        return sorted(clusters, key=lambda cluster: cluster['essays'])
+
+    # ----- Feedback -----
+    def record_feedback(self, essay_text: str, rubric_text: str, feedback_guidance: str, record: Dict):
+        """Remember the feedback record an essay received under this rubric and guidance"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO feedback (content_hash, rubric_hash, guidance_hash, feedback, scores, model, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (_hash(essay_text), _hash(rubric_text), _hash(feedback_guidance),
+                 zlib.compress(record['feedback'].encode('utf-8')), json.dumps(record.get('scores', {})),
+                 record.get('model', ''), time.time())
+            )
+
+    def feedback_for(self, content_hashes: List[str], rubric_text: str, feedback_guidance: str) -> Dict[str, Dict]:
+        """Stored feedback (feedback, scores, model) by content hash for this rubric and guidance"""
+        if not content_hashes:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_hash, feedback, scores, model FROM feedback WHERE rubric_hash = ? "
+                f"AND guidance_hash = ? AND content_hash IN ({','.join('?' * len(content_hashes))})",
+                [_hash(rubric_text), _hash(feedback_guidance), *content_hashes]
+            ).fetchall()
+        return {row[0]: {'feedback': zlib.decompress(row[1]).decode('utf-8'),
+                         'scores': json.loads(row[2] or '{}'),
+                         'model': row[3]} for row in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_adapt_prompt(essay_text: str, source_text: str, source_feedback: str, source_scores: Dict,
+                       rubric_text: str, feedback_guidance: str) -> List[Dict]:
+    """Prompt asking the small model to revise a near-duplicate's feedback for this essay"""
+    diff = '\n'.join(difflib.unified_diff(source_text.splitlines(), essay_text.splitlines(),
+                                          'marked_essay', 'this_essay', lineterm='', n=1))
+    adapt_block = {
+        "type": "text",
+        "text": f"""<essay>
+{essay_text}
+</essay>
+
+This essay is a near-duplicate of an essay that has already been marked. Here is the feedback that essay received:
+
+<previous_feedback>
+{source_feedback}
+</previous_feedback>
+
+<previous_scores>{json.dumps(source_scores)}</previous_scores>
+
+And here is a unified diff from the marked essay to this one:
+
+<diff>
+{diff}
+</diff>
+
+Revise the previous feedback so it is accurate for this essay. Keep its structure and tone, update quotations,
+examples and recommendations affected by the differences, and change a band only if the differences justify it."""
+    }
+    criteria = parse_rubric(rubric_text)
+    if criteria:
+        adapt_block["text"] += "\n\n" + scores_instruction(criteria)
+    return [essay_prompt_prefix(rubric_text, feedback_guidance), adapt_block]
+
+
+def plan_feedback_reuse(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                        index: NearDuplicateIndex,
+                        min_similarity: float = 0.0) -> Tuple[Dict[str, str], Dict[str, Tuple[str, str, float]]]:
+    """Decide which essays to mark and which to derive from a near-duplicate's feedback
+
+    Only matches at or above `min_similarity` (and the index threshold) are
+    sources. Returns the essays to mark and, for the rest, (source kind,
+    source, similarity) where the source is either 'past' (a content hash with
+    stored feedback) or 'batch' (the name of an essay being marked in this call).
+    """
+    signatures = index.add(essays)
+    to_mark = {}
+    derived = {}
+    representatives = {}
+    for name, text in essays.items():
+        if name not in signatures:
+            to_mark[name] = text
+            continue
+        matches = [match for match in index.candidates(signatures[name]) if match[1] >= min_similarity]
+        stored = index.feedback_for([content_hash for content_hash, _ in matches], rubric_text, feedback_guidance)
+        past = [(content_hash, score) for content_hash, score in matches if content_hash in stored]
+        batch = [(representatives[content_hash], score) for content_hash, score in matches
+                 if content_hash in representatives]
+        if past:
+            derived[name] = ('past', *past[0])
+        elif batch:
+            derived[name] = ('batch', *batch[0])
+        else:
+            to_mark[name] = text
+            representatives.setdefault(_hash(text), name)
+    return to_mark, derived
+
+
+def mark_essays_with_reuse(essays: Union[Dict[str, str], Iterable[Tuple[str, str]]], rubric_text: str, feedback_guidance: str,
+                           index: NearDuplicateIndex, mode: str = NEAR_DUPLICATE_MODE,
+                           max_workers: int = MARKING_CONCURRENCY, output_dir: str = "outputs",
+                           use_cache: bool = FEEDBACK_CACHE_ENABLED,
+                           on_complete: Optional[Callable[[int, int, str, Optional[Exception]], None]] = None,
+                           mark: Callable = mark_essays, **mark_kwargs) -> Tuple[List[Dict], Dict[str, str]]:
+    """Mark essays, deriving the feedback of near-duplicates instead of marking them from scratch
+
+    Distinct essays are marked with `mark` (automarking.mark_essays or a
+    function with its signature; keyword arguments are passed on); near-duplicates of those, or of essays marked in earlier
+    runs, then reuse or adapt that feedback according to `mode`: 'reuse'
+    only takes the feedback of near-identical essays (at least
+    NEAR_DUPLICATE_REUSE_THRESHOLD) and marks the rest. Derived
+    records carry 'duplicate_of' and 'similarity'. Every record is added to
+    the index for future runs. Returns the records in essay order and errors.
+    A stream of (name, text) pairs is marked as it arrives when `mode` is
+    'off', and read in full first otherwise.
+    """
+    if mode not in NEAR_DUPLICATE_MODES or mode == 'off':
+        if isinstance(essays, dict):
+            to_mark = essays
+        else:
+            # Pass the stream straight on, keeping each essay to index it afterwards
+            arrived = {}
+            to_mark, essays = collect_essays(essays, arrived), arrived
+        derived = {}
+    else:
+        # Near-duplicates are found across the whole set, so a stream is read in full first
+        essays = essays if isinstance(essays, dict) else dict(essays)
+        to_mark, derived = plan_feedback_reuse(
+            essays, rubric_text, feedback_guidance, index,
+            min_similarity=NEAR_DUPLICATE_REUSE_THRESHOLD if mode == 'reuse' else 0.0
+        )
+        if derived:
+            logger.info(f"Deriving feedback for {len(derived)} near-duplicate essay(s) ({mode})")
+
+    total = len(essays) if isinstance(to_mark, dict) else None
+    completed = [0]
+
+    def report(_completed, _total, essay_name, error):
+        completed[0] += 1
+        if on_complete:
+            on_complete(completed[0], total or _total, essay_name, error)
+
+    records, errors = mark(to_mark, rubric_text, feedback_guidance, max_workers=max_workers,
+                           output_dir=output_dir, use_cache=use_cache, on_complete=report, **mark_kwargs)
+    by_name = {item['name']: item for item in records}
+
+    sources = {}
+    fallback = {}
+    for name, (kind, source, score) in derived.items():
+        if kind == 'batch' and source not in by_name:
+            fallback[name] = essays[name]
+            continue
+        if kind == 'batch':
+            sources[name] = (source, essays[source], by_name[source], score)
+        else:
+            stored = index.feedback_for([source], rubric_text, feedback_guidance)[source]
+            source_essay = index.essay(source)
+            sources[name] = (source_essay['name'], source_essay['text'], stored, score)
+
+    def derive(essay_name):
+        source_name, source_text, source_record, score = sources[essay_name]
+        start = time.perf_counter()
+        if score >= NEAR_DUPLICATE_REUSE_THRESHOLD:
+            feedback, scores, model_id = source_record['feedback'], source_record.get('scores', {}), \
+                source_record.get('model', '')
+        else:
+            with call_context(essay=essay_name, kind='adapt'):
+                response = invoke_claude_sonnet(
+                    build_adapt_prompt(essays[essay_name], source_text, source_record['feedback'],
+                                       source_record.get('scores', {}), rubric_text, feedback_guidance),
+                    model_id=BEDROCK_SMALL_MODEL_ID,
+                    **{**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+                )
+            feedback, scores = extract_scores(response, rubric_text)
+            model_id = BEDROCK_SMALL_MODEL_ID
+        return {
+            'name': essay_name,
+            'feedback': feedback,
+            'path': save_feedback_file(essay_name, feedback, output_dir),
+            'scores': scores,
+            'model': model_id,
+            'seconds': round(time.perf_counter() - start, 3),
+            'duplicate_of': source_name,
+            'similarity': round(score, 3),
+        }
+
+    if sources:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {essay_name: executor.submit(bind_flow(derive), essay_name) for essay_name in sources}
+            for essay_name, future in futures.items():
+                try:
+                    by_name[essay_name] = future.result()
+                    report(None, None, essay_name, None)
+                except Exception as e:
+                    fallback[essay_name] = essays[essay_name]
+                    logger.warning(f"Could not derive feedback for {essay_name}, marking it instead: {str(e)}")
+
+    if fallback:
+        fallback_records, fallback_errors = mark(fallback, rubric_text, feedback_guidance,
+                                                 max_workers=max_workers, output_dir=output_dir,
+                                                 use_cache=use_cache, on_complete=report, **mark_kwargs)
+        by_name.update({item['name']: item for item in fallback_records})
+        errors.update(fallback_errors)
+
+    for essay_name, item in by_name.items():
+        index.record_feedback(essays[essay_name], rubric_text, feedback_guidance, item)
+    return [by_name[name] for name in essays if name in by_name], errors
@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+
+"""
+Client-side rate limiting and retries for Amazon Bedrock calls.
+
+The pieces are:
+- TokenBucket: caps requests/min and tokens/min
+- AIMDLimiter: concurrency limit that halves on throttles and grows back slowly;
+  runs reserve() the concurrency they ask for, which raises the limit up to a
+  ceiling sized from the account quota
+- RetryBudget: bounds retries to a fraction of recent requests
+- RateLimiter: combines the above and retries retryable errors with jittered
+  exponential backoff, recording per-call stats; given a
+  fair_scheduler.FairScheduler, each attempt is admitted by the scheduler
+  alone, whose AIMD window and request and token buckets replace its own
+- RateLimitedClient: wraps a bedrock-runtime client (or a local fake with the
+  same methods) so invoke_model and invoke_model_with_response_stream go
+  through a RateLimiter transparently; a stream holds its slot until it is
+  exhausted, closed or garbage collected
+- AsyncRateLimiter and AsyncRateLimitedClient: the same for an asyncio client
+  (aiobotocore or the async fake), with waits that yield to the event loop
+"""
+
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'ModelNotReadyException',
+    'ServiceUnavailableException',
+    'InternalServerException',
+    'ModelTimeoutException',
+}
+
+
+def error_code(error: Exception) -> str:
+    """Return the AWS error code of a botocore ClientError, or the exception class name"""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        if code:
+            return code
+    return type(error).__name__
+
+
+def is_throttle(error: Exception) -> bool:
+    return error_code(error) in THROTTLING_ERROR_CODES
+
+
+def is_retryable(error: Exception) -> bool:
+    return error_code(error) in RETRYABLE_ERROR_CODES or isinstance(error, (ConnectionError, TimeoutError))
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_minute`; a rate of 0 disables it"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    def try_take(self, amount: float) -> float:
+        """Take `amount` tokens if available (returns 0) or return the seconds until they will be"""
+        if self.rate_per_second <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate_per_second
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until `amount` tokens are available; returns the seconds waited"""
+        if self.rate_per_second <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self.try_take(amount)
+            if delay == 0.0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, amount: float = 1.0) -> float:
+        """Like acquire(), but waits without blocking the event loop"""
+        if self.rate_per_second <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self.try_take(amount)
+            if delay == 0.0:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount: float):
+        """Charge (positive) or refund (negative) tokens after the real cost is known"""
+        if self.rate_per_second <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AIMDLimiter:
+    """Concurrency limiter with additive increase and multiplicative decrease
+
+    `max_limit` is the limit while no run has reserved more. reserve() raises
+    it to the total concurrency the runs in progress ask for, up to `ceiling`
+    (by default `max_limit`, i.e. fixed), so a run started with 32 workers
+    gets 32 calls in flight rather than the process default.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial_limit: Optional[int] = None,
+                 decrease_factor: float = 0.5, ceiling: Optional[int] = None):
+        self.base_limit = max(1, max_limit)
+        self.ceiling = max(self.base_limit, ceiling or 0)
+        self.max_limit = self.base_limit
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(initial_limit if initial_limit is not None else self.max_limit)
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> float:
+        """Block until a slot is free; returns the seconds waited"""
+        start = time.monotonic()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    def _update(self, throttled: bool):
+        self.in_flight -= 1
+        if throttled:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / max(1.0, self.limit))
+
+    def release(self, throttled: bool = False):
+        with self._condition:
+            self._update(throttled)
+            self._condition.notify_all()
+
+    def _set_reserved(self, reserved: int):
+        """Resize max_limit for `reserved` slots, moving the current limit by the same amount"""
+        self.reserved = reserved
+        max_limit = min(self.ceiling, max(self.base_limit, reserved))
+        self.limit = max(self.min_limit, min(max_limit, self.limit + max_limit - self.max_limit))
+        self.max_limit = max_limit
+
+    def _resize(self, slots: int):
+        with self._condition:
+            self._set_reserved(self.reserved + slots)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, slots: int):
+        """Raise the limit to make room for `slots` concurrent calls (up to the ceiling) while the block runs"""
+        slots = max(0, int(slots))
+        self._resize(slots)
+        try:
+            yield self
+        finally:
+            self._resize(-slots)
+
+
+class AsyncAIMDLimiter(AIMDLimiter):
+    """AIMDLimiter for coroutines; must be used from a single event loop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created on first use so it belongs to the event loop that uses it
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self) -> float:
+        start = time.monotonic()
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    async def release(self, throttled: bool = False):
+        condition = self._get_condition()
+        async with condition:
+            self._update(throttled)
+            condition.notify_all()
+
+    def _resize(self, slots: int):
+        # Waiters re-check the limit on the next release
+        self._set_reserved(self.reserved + slots)
+
+
+class RetryBudget:
+    """Allow retries up to `min_retries` plus `ratio` of the requests made so far"""
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.retries < self.min_retries + self.ratio * self.requests:
+                self.retries += 1
+                return True
+            return False
+
+
+@dataclass
+class CallStats:
+    """Retry and wait statistics for a single rate-limited call"""
+    attempts: int = 0
+    throttles: int = 0
+    retry_wait_seconds: float = 0.0
+    rate_wait_seconds: float = 0.0
+    concurrency_wait_seconds: float = 0.0
+    queue_wait_seconds: float = 0.0
+    error: str = ""
+
+
+class RateLimiter:
+    """Combine request/token rate limits, AIMD concurrency and budgeted retries
+
+    With a `scheduler` (fair_scheduler.FairScheduler), every attempt waits
+    for the scheduler to grant it a slot in fair-share order and nothing
+    else: the scheduler is also the concurrency limiter (its AIMD window
+    shrinks on throttles and reserve() grows it), and the request and token
+    limits are its own. `max_concurrency` and `concurrency_ceiling` are then
+    unused.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_concurrency: int = 8, max_retries: int = 6, base_delay: float = 1.0,
+                 max_delay: float = 60.0, retry_budget_ratio: float = 0.2,
+                 sleep: Callable[[float], None] = time.sleep, history: int = 1000, scheduler=None,
+                 concurrency_ceiling: Optional[int] = None):
+        self.scheduler = scheduler
+        self.request_bucket = scheduler.request_bucket if scheduler else TokenBucket(requests_per_minute)
+        self.token_bucket = scheduler.token_bucket if scheduler else TokenBucket(tokens_per_minute)
+        self.concurrency = scheduler if scheduler else AIMDLimiter(max_concurrency, ceiling=concurrency_ceiling)
+        self.retry_budget = RetryBudget(retry_budget_ratio)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.call_log = deque(maxlen=history)
+        self._local = threading.local()
+
+    def backoff(self, retry: int) -> float:
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+    def acquire(self, estimated_tokens: int, stats: CallStats):
+        if self.scheduler is not None:
+            stats.queue_wait_seconds += self.scheduler.acquire(estimated_tokens)
+            return
+        stats.rate_wait_seconds += self.request_bucket.acquire(1)
+        stats.rate_wait_seconds += self.token_bucket.acquire(estimated_tokens)
+        stats.concurrency_wait_seconds += self.concurrency.acquire()
+
+    def call(self, fn: Callable, estimated_tokens: int = 0, hold: bool = False):
+        """Call `fn()` under the rate limits, retrying retryable errors
+
+        With `hold=True` the concurrency slot is not released on success and
+        the caller must call `release()` (used for streams, which occupy a
+        slot until they are fully consumed).
+        """
+        stats = CallStats()
+        self._local.stats = stats
+        retry = 0
+        while True:
+            self.acquire(estimated_tokens, stats)
+            self.retry_budget.record_request()
+            stats.attempts += 1
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = is_throttle(e)
+                stats.throttles += int(throttled)
+                self.release(throttled=throttled)
+                if (not is_retryable(e) or retry >= self.max_retries
+                        or not self.retry_budget.try_spend()):
+                    stats.error = error_code(e)
+                    self.call_log.append(stats)
+                    raise
+                delay = self.backoff(retry)
+                logger.warning(f"Retrying Bedrock call after {error_code(e)} "
+                               f"(attempt {stats.attempts}, waiting {delay:.1f}s)")
+                self.sleep(delay)
+                stats.retry_wait_seconds += delay
+                retry += 1
+                continue
+            if not hold:
+                self.release()
+            self.call_log.append(stats)
+            return result
+
+    def release(self, throttled: bool = False):
+        self.concurrency.release(throttled=throttled)
+
+    @contextmanager
+    def reserve(self, slots: int):
+        """Let up to `slots` calls be in flight at once while the block runs (see AIMDLimiter.reserve)"""
+        with self.concurrency.reserve(slots):
+            yield self
+
+    def last_call_stats(self) -> Optional[CallStats]:
+        """Stats of the most recent call made from the current thread"""
+        return getattr(self._local, 'stats', None)
+
+    def recent_calls(self) -> List[Dict]:
+        return [asdict(stats) for stats in list(self.call_log)]
+
+    def stats(self) -> Dict:
+        """Aggregate retry and wait statistics over the recorded calls"""
+        calls = list(self.call_log)
+        return {
+            'calls': len(calls),
+            'retries': sum(stats.attempts - 1 for stats in calls),
+            'throttles': sum(stats.throttles for stats in calls),
+            'failures': sum(1 for stats in calls if stats.error),
+            'retry_wait_seconds': round(sum(stats.retry_wait_seconds for stats in calls), 3),
+            'rate_wait_seconds': round(sum(stats.rate_wait_seconds for stats in calls), 3),
+            'concurrency_wait_seconds': round(sum(stats.concurrency_wait_seconds for stats in calls), 3),
+            'queue_wait_seconds': round(sum(stats.queue_wait_seconds for stats in calls), 3),
+            'concurrency_limit': round(self.concurrency.limit, 2),
+        }
+
+
+class AsyncRateLimiter(RateLimiter):
+    """RateLimiter for coroutines: `call` awaits `fn()` and every wait yields to the event loop
+
+    Pass `shared` to draw from another limiter's request and token buckets
+    (and queue in its fair-share scheduler, if it has one, which then limits
+    this limiter's concurrency too), so the thread and asyncio paths of one
+    process stay within the same quota.
+    """
+
+    def __init__(self, *args, shared: Optional[RateLimiter] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if shared is not None:
+            self.scheduler = shared.scheduler
+            self.request_bucket = shared.request_bucket
+            self.token_bucket = shared.token_bucket
+        if self.scheduler is not None:
+            self.concurrency = self.scheduler
+        else:
+            self.concurrency = AsyncAIMDLimiter(self.concurrency.max_limit, ceiling=self.concurrency.ceiling)
+        self._last_stats: ContextVar[Optional[CallStats]] = ContextVar('last_call_stats', default=None)
+
+    async def acquire(self, estimated_tokens: int, stats: CallStats):
+        if self.scheduler is not None:
+            stats.queue_wait_seconds += await self.scheduler.acquire_async(estimated_tokens)
+            return
+        stats.rate_wait_seconds += await self.request_bucket.acquire_async(1)
+        stats.rate_wait_seconds += await self.token_bucket.acquire_async(estimated_tokens)
+        stats.concurrency_wait_seconds += await self.concurrency.acquire()
+
+    async def call(self, fn: Callable[[], Awaitable], estimated_tokens: int = 0, hold: bool = False):
+        """Await `fn()` under the rate limits, retrying retryable errors (see RateLimiter.call)"""
+        stats = CallStats()
+        self._last_stats.set(stats)
+        retry = 0
+        while True:
+            await self.acquire(estimated_tokens, stats)
+            self.retry_budget.record_request()
+            stats.attempts += 1
+            try:
+                result = await fn()
+            except Exception as e:
+                throttled = is_throttle(e)
+                stats.throttles += int(throttled)
+                await self.release(throttled=throttled)
+                if (not is_retryable(e) or retry >= self.max_retries
+                        or not self.retry_budget.try_spend()):
+                    stats.error = error_code(e)
+                    self.call_log.append(stats)
+                    raise
+                delay = self.backoff(retry)
+                logger.warning(f"Retrying Bedrock call after {error_code(e)} "
+                               f"(attempt {stats.attempts}, waiting {delay:.1f}s)")
+                await asyncio.sleep(delay)
+                stats.retry_wait_seconds += delay
+                retry += 1
+                continue
+            if not hold:
+                await self.release()
+            self.call_log.append(stats)
+            return result
+
+    async def release(self, throttled: bool = False):
+        if self.scheduler is not None:
+            self.scheduler.release(throttled=throttled)
+        else:
+            await self.concurrency.release(throttled=throttled)
+
+    def last_call_stats(self) -> Optional[CallStats]:
+        """Stats of the most recent call made from the current asyncio task"""
+        return self._last_stats.get()
+
+
+class AsyncBody:
+    """Response body with an awaitable read(), like aiobotocore's StreamingBody"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+def estimate_request_tokens(body: str) -> int:
+    """Rough token estimate for a request body: ~4 characters per input token plus max_tokens"""
+    try:
+        max_tokens = json.loads(body).get('max_tokens', 0)
+    except ValueError:
+        max_tokens = 0
+    return len(body) // 4 + max_tokens
+
+
+class HeldStream:
+    """Response stream that holds a limiter slot until it is exhausted, fails, is closed or is garbage collected
+
+    Use it as a context manager (or with contextlib.closing) so that a
+    consumer that stops early frees the slot straight away. The slot is
+    released in the context the stream was opened in, so a fair scheduler
+    credits the right flow whichever thread collects it.
+    """
+
+    def __init__(self, stream, release: Callable[..., None]):
+        self.stream = stream
+        self._events = iter(stream)
+        self._finalizer = weakref.finalize(self, contextvars.copy_context().run, release)
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._events)
+        except StopIteration:
+            self._release()
+            raise
+        except Exception as e:
+            self._release(throttled=is_throttle(e))
+            raise
+
+    def _release(self, throttled: bool = False):
+        detached = self._finalizer.detach()
+        if detached is not None:
+            _, run, args, _ = detached
+            run(*args, throttled=throttled)
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        try:
+            if close is not None:
+                close()
+        finally:
+            self._release()
+
+    def __enter__(self) -> 'HeldStream':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RateLimitedClient:
+    """bedrock-runtime client wrapper that routes model invocations through a RateLimiter"""
+
+    def __init__(self, client, limiter: RateLimiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def invoke_model(self, **kwargs):
+        estimated = estimate_request_tokens(kwargs.get('body', ''))
+        response = self.limiter.call(lambda: self.client.invoke_model(**kwargs), estimated)
+
+        # Read the body so the token bucket can be corrected with the real usage
+        data = response['body'].read()
+        try:
+            usage = json.loads(data).get('usage', {})
+            actual = sum(usage.get(field) or 0 for field in
+                         ('input_tokens', 'output_tokens', 'cache_creation_input_tokens'))
+            self.limiter.token_bucket.adjust(actual - estimated)
+        except ValueError:
+            pass
+        return {**response, 'body': io.BytesIO(data)}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        estimated = estimate_request_tokens(kwargs.get('body', ''))
+        response = self.limiter.call(
+            lambda: self.client.invoke_model_with_response_stream(**kwargs),
+            estimated,
+            hold=True
+        )
+        return {**response, 'body': HeldStream(response['body'], self.limiter.release)}
+
+
+class AsyncRateLimitedClient:
+    """Async bedrock-runtime client wrapper that routes model invocations through an AsyncRateLimiter"""
+
+    def __init__(self, client, limiter: AsyncRateLimiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def invoke_model(self, **kwargs):
+        estimated = estimate_request_tokens(kwargs.get('body', ''))
+        response = await self.limiter.call(lambda: self.client.invoke_model(**kwargs), estimated)
+
+        data = await response['body'].read()
+        try:
+            usage = json.loads(data).get('usage', {})
+            actual = sum(usage.get(field) or 0 for field in
+                         ('input_tokens', 'output_tokens', 'cache_creation_input_tokens'))
+            self.limiter.token_bucket.adjust(actual - estimated)
+        except ValueError:
+            pass
+        return {**response, 'body': AsyncBody(data)}
+
+    async def invoke_model_with_response_stream(self, **kwargs):
+        estimated = estimate_request_tokens(kwargs.get('body', ''))
+        response = await self.limiter.call(
+            lambda: self.client.invoke_model_with_response_stream(**kwargs),
+            estimated,
+            hold=True
+        )
+        return {**response, 'body': self._release_when_done(response['body'])}
+
+    async def _release_when_done(self, stream) -> AsyncIterator:
+        throttled = False
+        try:
+            async for event in stream:
+                yield event
+        except Exception as e:
+            throttled = is_throttle(e)
+            raise
+        finally:
+            await self.limiter.release(throttled=throttled)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Bulk export of a marking run from the results store.
+
+export_run() writes one ZIP holding every essay's feedback, the class report,
+the band statistics and the run's structured scores, plus a consolidated
+results.jsonl and results.csv beside it. It makes a single pass over the
+run's feedback, reading one record at a time from the store; each record's
+feedback goes straight into the archive and its row into the JSONL and CSV
+files. Memory therefore stays flat however many essays the run has. Every
+file is written under a temporary name and renamed into place once complete,
+so a download never sees a partial export.
+
+Export a stored run without the UI with:
+    uv run python results_export.py --run-id 3 --db outputs/results.db --output outputs/exports
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+
+from pathlib import Path
+from results_store import ResultsStore
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'outputs/exports')
+EXPORT_FIELDS = ['name', 'status', 'model', 'seconds', 'total_points', 'bands', 'duplicate_of', 'error',
+                 'feedback_file']
+
+
+def export_paths(run_id: int, export_dir: str = EXPORT_DIR) -> Dict[str, str]:
+    """Paths of a run's archive and consolidated results"""
+    return {
+        'zip': os.path.join(export_dir, f"run-{run_id}.zip"),
+        'jsonl': os.path.join(export_dir, f"run-{run_id}.results.jsonl"),
+        'csv': os.path.join(export_dir, f"run-{run_id}.results.csv"),
+    }
+
+
+def export_run(results_store: ResultsStore, run_id: int, export_dir: str = EXPORT_DIR) -> Dict[str, str]:
+    """Export a run as a ZIP plus results JSONL and CSV, replacing any earlier export; returns their paths"""
+    paths = export_paths(run_id, export_dir)
+    run = results_store.get_run(run_id)
+    if not run:
+        raise ValueError(f"No marking run with ID {run_id}")
+
+    os.makedirs(export_dir, exist_ok=True)
+    start = time.perf_counter()
+    metadata = run['metadata']
+    duplicates = metadata.get('near_duplicates', {})
+    tmp_paths = {kind: f"{path}.{threading.get_ident()}.tmp" for kind, path in paths.items()}
+    count = 0
+    try:
+        with zipfile.ZipFile(tmp_paths['zip'], 'w', compression=zipfile.ZIP_DEFLATED) as archive, \
+                open(tmp_paths['jsonl'], 'w', encoding='utf-8') as jsonl_file, \
+                open(tmp_paths['csv'], 'w', encoding='utf-8', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+
+            def write_row(row: Dict):
+                jsonl_file.write(json.dumps(row, ensure_ascii=False) + '\n')
+                writer.writerow({field: row.get(field, '') for field in EXPORT_FIELDS})
+
+            for item in results_store.iter_feedback(run_id):
+                entry = f"feedback/{Path(item['name']).stem}.feedback.txt"
+                archive.writestr(entry, item['feedback'])
+                scores = item['scores']
+                write_row({
+                    'name': item['name'],
+                    'status': 'ok',
+                    'model': item['model'] or '',
+                    'seconds': item['seconds'],
+                    'total_points': scores.get('total'),
+                    'bands': '; '.join(f"{criterion}: {score['band']}"
+                                       for criterion, score in scores.get('criteria', {}).items()),
+                    'scores': scores,
+                    'duplicate_of': duplicates.get(item['name'], ''),
+                    'feedback_file': entry,
+                })
+                count += 1
+            for essay_name, error in metadata.get('errors', {}).items():
+                if not essay_name.startswith('<'):
+                    write_row({'name': essay_name, 'status': 'failed', 'error': error})
+
+            if run['class_feedback']:
+                archive.writestr("class_overall.feedback.md", run['class_feedback'])
+            if run['class_statistics']:
+                archive.writestr("class_statistics.md", run['class_statistics'])
+            archive.writestr("run.json", json.dumps({
+                'run_id': run['id'],
+                'created_at': run['created_at'],
+                'rubric_name': run['rubric_name'],
+                'essays': count,
+                'metadata': metadata,
+            }, indent=2, ensure_ascii=False))
+            jsonl_file.flush()
+            csv_file.flush()
+            archive.write(tmp_paths['jsonl'], "results.jsonl")
+            archive.write(tmp_paths['csv'], "results.csv")
+
+        for kind, path in paths.items():
+            os.replace(tmp_paths[kind], path)
+    finally:
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    logger.info(f"Exported run {run_id} ({count} essays) to {paths['zip']} in {time.perf_counter() - start:.2f}s")
+    return paths
+
+
+def export_latest_run(db_path: str, export_dir: str = EXPORT_DIR, run_id: Optional[int] = None) -> Dict[str, str]:
+    """Export `run_id` (default: the latest run) from the results database at `db_path`"""
+    results_store = ResultsStore(db_path)
+    try:
+        run_id = run_id if run_id is not None else results_store.latest_run_id()
+        if run_id is None:
+            raise ValueError(f"No marking runs in {db_path}")
+        return export_run(results_store, run_id, export_dir)
+    finally:
+        results_store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a marking run as a ZIP plus results JSONL and CSV")
+    parser.add_argument('--db', default='outputs/results.db', help="Results database")
+    parser.add_argument('--run-id', type=int, help="Run to export (default: the latest)")
+    parser.add_argument('--output', default=EXPORT_DIR, help="Folder for the exported files")
+    args = parser.parse_args()
+    print(json.dumps(export_latest_run(args.db, args.output, args.run_id), indent=2))
+
+
+if __name__ == '__main__':
+    main()
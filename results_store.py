@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+SQLite-backed store for essays, feedback, marking runs and structured scores.
+
+Essay and feedback text is zlib-compressed in BLOB columns, and feedback is
+indexed by run and essay name so the UI can page through and search results
+and load a single feedback on demand, keeping only IDs in session state.
+One store (and connection) can be shared by every Streamlit session in the
+process; a lock serialises access and WAL mode lets the batch CLI write to the
+same database concurrently.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS essays (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    text BLOB NOT NULL,
+    loaded_at REAL NOT NULL,
+    UNIQUE (name, content_hash)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    rubric_name TEXT,
+    rubric_hash TEXT,
+    guidance_hash TEXT,
+    metadata TEXT,
+    class_feedback BLOB,
+    class_statistics TEXT
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    essay_id INTEGER REFERENCES essays(id),
+    name TEXT NOT NULL,
+    feedback BLOB NOT NULL,
+    path TEXT,
+    model TEXT,
+    seconds REAL,
+    total_points REAL,
+    scores TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_run_name ON feedback (run_id, name);
+"""
+
+
+def _compress(text: str) -> bytes:
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def _decompress(data: Optional[bytes]) -> str:
+    return zlib.decompress(data).decode('utf-8') if data else ""
+
+
+def _like(search: str) -> str:
+    """LIKE pattern matching `search` anywhere, with wildcards in it escaped"""
+    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultsStore:
+    """Persistent, indexed store of essays and marking results"""
+
+    def __init__(self, db_path: str = "outputs/results.db"):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    # ----- Essays -----
+    def add_essays(self, essays: Dict[str, str]) -> Dict[str, int]:
+        """Store essay texts (deduplicated by name and content) and return their IDs by name"""
+        ids = {}
+        with self._lock, self._conn:
+            for name, text in essays.items():
+                content_hash = _hash(text)
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO essays (name, content_hash, text, loaded_at) VALUES (?, ?, ?, ?)",
+                    (name, content_hash, _compress(text), time.time())
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM essays WHERE name = ? AND content_hash = ?", (name, content_hash)
+                ).fetchone()
+                ids[name] = row[0]
+        return ids
+
+    def get_essay_text(self, essay_id: int) -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM essays WHERE id = ?", (essay_id,)).fetchone()
+        return _decompress(row[0]) if row else ""
+
+    def get_essay_texts(self, essay_ids: Dict[str, int]) -> Dict[str, str]:
+        """Texts for a name -> ID mapping, in the mapping's order"""
+        return {name: self.get_essay_text(essay_id) for name, essay_id in essay_ids.items()}
+
+    # ----- Runs -----
+    def create_run(self, rubric_name: str, rubric_text: str, feedback_guidance: str,
+                   metadata: Optional[Dict] = None) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO runs (created_at, rubric_name, rubric_hash, guidance_hash, metadata) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (time.time(), rubric_name, _hash(rubric_text), _hash(feedback_guidance),
+                 json.dumps(metadata or {}))
+            )
+            return cursor.lastrowid
+
+    def set_class_feedback(self, run_id: int, class_feedback: str, class_statistics: str = ""):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET class_feedback = ?, class_statistics = ? WHERE id = ?",
+                (_compress(class_feedback), class_statistics, run_id)
+            )
+
+    def latest_run_id(self) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(id) FROM runs").fetchone()
+        return row[0]
+
+    def get_run(self, run_id: Optional[int]) -> Dict:
+        if run_id is None:
+            return {}
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, created_at, rubric_name, metadata, class_feedback, class_statistics "
+                "FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        if not row:
+            return {}
+        return {
+            'id': row[0],
+            'created_at': row[1],
+            'rubric_name': row[2],
+            'metadata': json.loads(row[3] or '{}'),
+            'class_feedback': _decompress(row[4]),
+            'class_statistics': row[5] or "",
+        }
+
+    # ----- Feedback -----
+    def add_feedbacks(self, run_id: int, feedbacks: List[Dict], essay_ids: Optional[Dict[str, int]] = None):
+        """Store the feedback records produced by automarking.mark_essays for a run"""
+        essay_ids = essay_ids or {}
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO feedback (run_id, essay_id, name, feedback, path, model, seconds, total_points, "
+                "scores, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, essay_ids.get(item['name']), item['name'], _compress(item['feedback']),
+                  item.get('path'), item.get('model'), item.get('seconds'),
+                  item.get('scores', {}).get('total'), json.dumps(item.get('scores', {})), time.time())
+                 for item in feedbacks]
+            )
+
+    def count_feedback(self, run_id: Optional[int], search: str = "") -> int:
+        if run_id is None:
+            return 0
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM feedback WHERE run_id = ? AND name LIKE ? ESCAPE '\\'",
+                (run_id, _like(search))
+            ).fetchone()[0]
+
+    def list_feedback(self, run_id: Optional[int], search: str = "", limit: int = 50,
+                      offset: int = 0) -> List[Tuple[int, str, Optional[float]]]:
+        """One page of (feedback ID, essay name, total points), ordered by name"""
+        if run_id is None:
+            return []
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, name, total_points FROM feedback WHERE run_id = ? AND name LIKE ? ESCAPE '\\' "
+                "ORDER BY name LIMIT ? OFFSET ?",
+                (run_id, _like(search), limit, offset)
+            ).fetchall()
+
+    def get_feedback(self, feedback_id: int) -> Dict:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, run_id, name, feedback, path, model, seconds, scores FROM feedback WHERE id = ?",
+                (feedback_id,)
+            ).fetchone()
+        if not row:
+            return {}
+        return {
+            'id': row[0],
+            'run_id': row[1],
+            'name': row[2],
+            'feedback': _decompress(row[3]),
+            'path': row[4],
+            'model': row[5],
+            'seconds': row[6],
+            'scores': json.loads(row[7] or '{}'),
+        }
+
+    def iter_feedback(self, run_id: int):
+        """Yield every feedback record of a run, one row at a time"""
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM feedback WHERE run_id = ? ORDER BY id", (run_id,)
+            )]
+        for feedback_id in ids:
+            yield self.get_feedback(feedback_id)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
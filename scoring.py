@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Structured band/score extraction and class statistics.
+
+The rubric markdown is parsed into criteria with their band point ranges. Each
+essay's feedback ends with a <scores> JSON block requested in the marking
+prompt; extract_scores() reads it (falling back to parsing "Band n" mentions in
+the free text) and returns a per-criterion record. Class statistics are then
+computed locally with NumPy instead of asking the model to count bands.
+"""
+
+import json
+import numpy as np
+import re
+
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+MAX_BAND = 5
+
+SCORES_BLOCK_PATTERN = re.compile(r"<scores>\s*(.*?)\s*</scores>", re.DOTALL)
+CRITERION_HEADING_PATTERN = re.compile(r"^#{2,3}\s*(?:\d+\.\s*)?(.+?)\s*$", re.MULTILINE)
+BAND_LINE_PATTERN = re.compile(r"\*\*Band\s+(\d)\*\*\s*\((\d+)(?:\s*-\s*(\d+))?\s*points?\)", re.IGNORECASE)
+BAND_MENTION_PATTERN = re.compile(r"Band\s*(?:Level\s*)?:?\s*\**\s*(\d)", re.IGNORECASE)
+POINTS_MENTION_PATTERN = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*(?:/\s*\d{1,3}|points?|marks?)\b", re.IGNORECASE)
+
+
+@dataclass
+class Criterion:
+    """A rubric criterion, the point range of each band and its band descriptors (markdown)"""
+    name: str
+    bands: Dict[int, Tuple[int, int]] = field(default_factory=dict)
+    descriptors: str = ""
+
+    @property
+    def max_points(self) -> int:
+        return max((high for _, high in self.bands.values()), default=0)
+
+
+@lru_cache(maxsize=32)
+def parse_rubric(rubric_text: str) -> Tuple[Criterion, ...]:
+    """Parse rubric markdown into criteria with band point ranges
+
+    Criteria are `##` headings followed by `**Band n** (low-high points)` lines;
+    headings without band lines (such as the title) are ignored.
+    """
+    criteria = []
+    headings = list(CRITERION_HEADING_PATTERN.finditer(rubric_text))
+    for index, heading in enumerate(headings):
+        end = headings[index + 1].start() if index + 1 < len(headings) else len(rubric_text)
+        section = rubric_text[heading.end():end]
+        bands = {}
+        for band, low, high in BAND_LINE_PATTERN.findall(section):
+            bands[int(band)] = (int(low), int(high or low))
+        if bands:
+            criteria.append(Criterion(name=heading.group(1).strip(), bands=bands, descriptors=section.strip()))
+    return tuple(criteria)
+
+
+def scores_instruction(criteria: Tuple[Criterion, ...]) -> str:
+    """Prompt text asking the model to append a machine-readable scores block"""
+    example = {
+        "criteria": [{"criterion": criterion.name, "band": 0, "points": 0} for criterion in criteria],
+        "total": 0
+    }
+    return ("After the feedback, append the awarded bands and points as JSON inside <scores></scores> tags, "
+            f"using exactly these criterion names:\n<scores>{json.dumps(example)}</scores>")
+
+
+def _normalise(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+
+
+def match_criterion(name: str, criteria: Tuple[Criterion, ...]) -> Optional[Criterion]:
+    target = _normalise(name)
+    for criterion in criteria:
+        candidate = _normalise(criterion.name)
+        if candidate == target or candidate.startswith(target) or target.startswith(candidate):
+            return criterion
+    for criterion in criteria:
+        if _normalise(criterion.name).split(' ')[0] in target.split(' '):
+            return criterion
+    return None
+
+
+def _rubric_band(criterion: Criterion, band) -> Optional[int]:
+    """`band` as an int if it is one of the criterion's bands, else None"""
+    try:
+        band = int(band)
+    except (TypeError, ValueError):
+        return None
+    return band if band in criterion.bands else None
+
+
+def _clamp_points(criterion: Criterion, band: Optional[int], points: Optional[float]) -> Optional[float]:
+    if points is None or band not in criterion.bands:
+        return points
+    low, high = criterion.bands[band]
+    return float(min(max(points, low), high))
+
+
+def _scores_from_json(block: str, criteria: Tuple[Criterion, ...]) -> Dict[str, Dict]:
+    data = json.loads(block)
+    scores = {}
+    for item in data.get('criteria', []):
+        criterion = match_criterion(str(item.get('criterion', '')), criteria)
+        band = _rubric_band(criterion, item.get('band')) if criterion is not None else None
+        if band is None:
+            continue
+        points = float(item['points']) if item.get('points') is not None else None
+        scores[criterion.name] = {'band': band, 'points': _clamp_points(criterion, band, points)}
+    return scores
+
+
+def _scores_from_text(feedback: str, criteria: Tuple[Criterion, ...]) -> Dict[str, Dict]:
+    """Find the first "Band n" (and points) mentioned after each criterion name"""
+    scores = {}
+    lowered = feedback.lower()
+    for criterion in criteria:
+        position = lowered.find(criterion.name.lower())
+        if position < 0:
+            first_word = criterion.name.split()[0].lower()
+            position = lowered.find(first_word)
+        if position < 0:
+            continue
+        window = feedback[position:position + 400]
+        band_match = BAND_MENTION_PATTERN.search(window)
+        band = _rubric_band(criterion, band_match.group(1)) if band_match else None
+        if band is None:
+            continue
+        points_match = POINTS_MENTION_PATTERN.search(window, band_match.end())
+        points = float(points_match.group(1)) if points_match else None
+        scores[criterion.name] = {'band': band, 'points': _clamp_points(criterion, band, points)}
+    return scores
+
+
+def extract_scores(feedback: str, rubric_text: str) -> Tuple[str, Dict]:
+    """Split feedback into the text shown to students and a structured scores record
+
+    Returns (feedback without the <scores> block, record) where record is
+    {'criteria': {name: {'band', 'points'}}, 'total', 'source'} and source is
+    'json', 'text' or 'none'.
+    """
+    criteria = parse_rubric(rubric_text)
+    scores = {}
+    source = 'none'
+
+    match = SCORES_BLOCK_PATTERN.search(feedback)
+    if match:
+        feedback = (feedback[:match.start()] + feedback[match.end():]).strip()
+        try:
+            scores = _scores_from_json(match.group(1), criteria)
+            source = 'json'
+        except (ValueError, TypeError, AttributeError):
+            scores = {}
+    if len(scores) < len(criteria):
+        for name, score in _scores_from_text(feedback, criteria).items():
+            if name not in scores:
+                scores[name] = score
+                source = 'text' if source == 'none' else source
+
+    points = [score['points'] for score in scores.values()]
+    total = sum(points) if points and None not in points and len(scores) == len(criteria) else None
+    return feedback, {'criteria': scores, 'total': total, 'source': source}
+
+
+def class_statistics(records: List[Dict], rubric_text: str) -> Dict:
+    """Compute per-criterion band distributions, means and percentiles with NumPy
+
+    Scores may come from clients (see marking_service.py), so bands that are
+    not in the rubric and non-numeric points are left out.
+    """
+    criteria = parse_rubric(rubric_text)
+    names = [criterion.name for criterion in criteria]
+    bands = np.full((len(records), len(names)), np.nan)
+    points = np.full((len(records), len(names)), np.nan)
+    for row, record in enumerate(records):
+        for column, criterion in enumerate(criteria):
+            record_criteria = record.get('criteria') if isinstance(record, dict) else None
+            score = record_criteria.get(criterion.name) if isinstance(record_criteria, dict) else None
+            band = _rubric_band(criterion, score.get('band')) if isinstance(score, dict) else None
+            if band is None:
+                continue
+            bands[row, column] = band
+            try:
+                points[row, column] = float(score['points'])
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def summary(values: np.ndarray) -> Dict:
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return {'count': 0}
+        p25, p50, p75 = np.percentile(values, [25, 50, 75])
+        return {
+            'count': int(values.size),
+            'mean': round(float(values.mean()), 2),
+            'std': round(float(values.std()), 2),
+            'min': float(values.min()),
+            'p25': round(float(p25), 2),
+            'median': round(float(p50), 2),
+            'p75': round(float(p75), 2),
+            'max': float(values.max()),
+        }
+
+    statistics = {'essays': len(records), 'criteria': {}}
+    for column, name in enumerate(names):
+        column_bands = bands[:, column]
+        scored = column_bands[~np.isnan(column_bands)].astype(int)
+        histogram = np.bincount(scored, minlength=MAX_BAND + 1)
+        statistics['criteria'][name] = {
+            'band_histogram': {band: int(histogram[band]) for band in range(MAX_BAND, -1, -1)},
+            'band': summary(column_bands),
+            'points': summary(points[:, column]),
+        }
+
+    complete = ~np.isnan(points).any(axis=1) if names else np.zeros(len(records), dtype=bool)
+    statistics['total'] = summary(points[complete].sum(axis=1)) if complete.any() else {'count': 0}
+    statistics['total']['max_possible'] = sum(criterion.max_points for criterion in criteria)
+    return statistics
+
+
+def format_statistics_table(statistics: Dict) -> str:
+    """Render class statistics as a compact Markdown table for prompts and the UI"""
+    if not statistics.get('criteria'):
+        return ""
+    bands = list(range(MAX_BAND, -1, -1))
+    lines = [
+        "| Criterion | Scored | " + " | ".join(f"B{band}" for band in bands)
+        + " | Mean band | Mean pts | P25 | Median | P75 |",
+        "|" + "---|" * (len(bands) + 7),
+    ]
+    for name, stats in statistics['criteria'].items():
+        band_stats = stats['band']
+        point_stats = stats['points']
+        lines.append(
+            f"| {name} | {band_stats['count']} | "
+            + " | ".join(str(stats['band_histogram'][band]) for band in bands)
+            + f" | {band_stats.get('mean', '-')} | {point_stats.get('mean', '-')} | {point_stats.get('p25', '-')}"
+            f" | {point_stats.get('median', '-')} | {point_stats.get('p75', '-')} |"
+        )
+    total = statistics['total']
+    if total.get('count'):
+        lines.append("")
+        lines.append(
+            f"Total points (out of {total['max_possible']}, {total['count']} fully scored essays): "
+            f"mean {total['mean']}, median {total['median']}, P25 {total['p25']}, P75 {total['p75']}, "
+            f"range {total['min']}-{total['max']}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Load test of the marking service (marking_service.py) against the local fake Bedrock backend.
+
+Starts the service in this process on a free port, with a FakeBedrockClient
+behind its own RateLimiter so no Bedrock quota is used (or targets a running
+service with --url), and then:
+- sends --requests single-essay requests from --clients concurrent clients,
+  each essay drawn from --distinct essays, so identical requests overlap in
+  flight and are coalesced;
+- sends --batches batch requests of --batch-size distinct essays each.
+Requests ask for useCache false, so every Bedrock call saved is saved by
+coalescing, not by the feedback cache. For each phase it reports
+requests/sec, essays/sec, p50/p95 latency (time to first chunk with
+--stream), the upstream Bedrock calls made and the requests coalesced.
+
+Usage:
+    uv run python service_load_test.py --requests 500 --clients 32 --distinct 100 --concurrency 16 \\
+        --batches 4 --batch-size 100 --json outputs/service_load_test.json
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+
+from automarking import read_text_file_cached, set_bedrock_client
+from benchmark import _percentiles, synthetic_essays
+from concurrent.futures import ThreadPoolExecutor
+from fake_bedrock import FakeBedrockClient, FakeBedrockConfig
+from marking_client import post_events, post_json
+from marking_service import MarkingService
+from rate_limiter import RateLimitedClient, RateLimiter
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+def service_health(url: str) -> Dict:
+    with urllib.request.urlopen(f"{url}/health", timeout=30) as response:
+        return json.load(response)
+
+
+def run_phase(url: str, label: str, payloads: List[Dict], path: str, clients: int, stream: bool,
+              upstream_calls: Callable[[], int]) -> Dict:
+    """Send every payload to `path`, `clients` at a time, and return the phase's throughput and latency"""
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def send(payload: Dict) -> int:
+        start = time.perf_counter()
+        first = None
+        try:
+            if stream:
+                for event in post_events(path, payload, url):
+                    if first is None and event['event'] in ('delta', 'result'):
+                        first = time.perf_counter() - start
+                    if event['event'] == 'error':
+                        raise RuntimeError(event['error'])
+            else:
+                reply = post_json(path, payload, url)
+                if reply.get('errors'):
+                    raise RuntimeError(f"{len(reply['errors'])} essay(s) failed")
+            with lock:
+                latencies.append(first if first is not None else time.perf_counter() - start)
+        except Exception as e:
+            with lock:
+                failures.append(str(e))
+        return len(payload.get('essays') or [payload])
+
+    health = service_health(url)
+    calls_before = upstream_calls()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        essays = sum(executor.map(send, payloads))
+    elapsed = time.perf_counter() - start
+    coalesced = service_health(url)['coalescing']['coalesced'] - health['coalescing']['coalesced']
+
+    return {
+        'phase': label,
+        'requests': len(payloads),
+        'failed': len(failures),
+        'essays': essays,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(payloads) / elapsed, 3) if elapsed > 0 else 0.0,
+        'essays_per_second': round(essays / elapsed, 3) if elapsed > 0 else 0.0,
+        'latency_seconds': _percentiles(latencies),
+        'upstream_calls': upstream_calls() - calls_before,
+        'coalesced': coalesced,
+    }
+
+
+def print_table(results: List[Dict]):
+    print(f"{'phase':>8} {'reqs':>6} {'fail':>5} {'essays':>7} {'secs':>8} {'req/s':>8} {'ess/s':>8} "
+          f"{'p50':>7} {'p95':>7} {'upstream':>9} {'coalesced':>10}")
+    for result in results:
+        print(f"{result['phase']:>8} {result['requests']:>6} {result['failed']:>5} {result['essays']:>7} "
+              f"{result['seconds']:>8} {result['requests_per_second']:>8} {result['essays_per_second']:>8} "
+              f"{result['latency_seconds']['p50']!s:>7} {result['latency_seconds']['p95']!s:>7} "
+              f"{result['upstream_calls']:>9} {result['coalesced']:>10}")
+
+
+def main():
+    defaults = FakeBedrockConfig()
+    parser = argparse.ArgumentParser(description="Load test the marking service against a local fake Bedrock backend")
+    parser.add_argument('--url', help="Test a running service instead of starting one (its backend is not changed)")
+    parser.add_argument('--requests', type=int, default=200, help="Single-essay requests to send")
+    parser.add_argument('--clients', type=int, default=32, help="Requests in flight at once")
+    parser.add_argument('--distinct', type=int, default=50, help="Distinct essays the requests are drawn from")
+    parser.add_argument('--batches', type=int, default=2, help="Batch requests to send after the single essays")
+    parser.add_argument('--batch-size', type=int, default=100, help="Essays per batch request")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="Bedrock calls in flight at once (in-process service only)")
+    parser.add_argument('--stream', action='store_true', help="Stream replies and measure time to first chunk")
+    parser.add_argument('--rubric', default='rubric/rubric1.md', help="Rubric file (.md)")
+    parser.add_argument('--guidance', default='feedback_guidance.md', help="Feedback guidance file (.md)")
+    parser.add_argument('--latency-median', type=float, default=0.2,
+                        help=f"Median time to first token in seconds (fake default {defaults.latency_median})")
+    parser.add_argument('--tokens-per-second', type=float, default=2000.0,
+                        help=f"Output token rate (fake default {defaults.tokens_per_second})")
+    parser.add_argument('--output-tokens', type=int, default=defaults.output_tokens, help="Output tokens per reply")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for essays, request order and the fake backend")
+    parser.add_argument('--json', help="Write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Keep per-request INFO logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('automarking').setLevel(logging.WARNING)
+
+    service = None
+    if args.url:
+        url = args.url.rstrip('/')
+
+        def upstream_calls() -> int:
+            return service_health(url)['rate_limiter']['calls']
+    else:
+        fake = FakeBedrockClient(FakeBedrockConfig(
+            latency_median=args.latency_median,
+            tokens_per_second=args.tokens_per_second,
+            output_tokens=args.output_tokens,
+            seed=args.seed,
+        ))
+        set_bedrock_client(RateLimitedClient(fake, RateLimiter(max_concurrency=args.concurrency)))
+        service = MarkingService('127.0.0.1', 0)
+        threading.Thread(target=service.serve_forever, name="marking-service", daemon=True).start()
+        url = service.url
+
+        def upstream_calls() -> int:
+            return fake.calls
+
+    rubric_text = read_text_file_cached(args.rubric)
+    feedback_guidance = read_text_file_cached(args.guidance)
+    common = {'rubricText': rubric_text, 'feedbackGuidance': feedback_guidance, 'useCache': False}
+
+    distinct = list(synthetic_essays(args.distinct, seed=args.seed).items())
+    generator = random.Random(args.seed)
+    singles = []
+    for _ in range(args.requests):
+        essay_name, essay_text = generator.choice(distinct)
+        singles.append({**common, 'essayName': essay_name, 'essayText': essay_text})
+
+    results = [run_phase(url, 'single', singles, '/api/mark-essay', args.clients, args.stream, upstream_calls)]
+    if args.batches:
+        batch_essays = synthetic_essays(args.batches * args.batch_size, seed=args.seed + 1)
+        names = list(batch_essays)
+        batches = [{
+            **common,
+            'essays': [{'essayName': name, 'essayText': batch_essays[name]}
+                       for name in names[index:index + args.batch_size]],
+        } for index in range(0, len(names), args.batch_size)]
+        results.append(run_phase(url, 'batch', batches, '/api/mark-essays', args.batches, args.stream,
+                                 upstream_calls))
+    print_table(results)
+
+    if service is not None:
+        service.shutdown()
+        service.server_close()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
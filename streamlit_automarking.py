@@ -12,7 +12,7 @@ This application provides a web interface for:
 
 The app uses Streamlit for the UI and Amazon Bedrock for AI capabilities.
 Essays are processed using Claude models to generate detailed feedback based on
-provided rubrics and guidance.
+provided rubrics and guidance. The marking logic lives in automarking.py.
 
 Usage:
     uv run streamlit run streamlit_automarking.py --server.port 8087 --server.runOnSave true
@@ -22,305 +22,282 @@ Setup:
 """
 
 import argparse
-import boto3
+import functools
+import hashlib
 import json
 import logging
 import os
 import streamlit as st
-
-from botocore.config import Config
-from dotenv import load_dotenv
-from pathlib import Path
-from typing import Dict, Generator, List
-
-# Load environment variables
-load_dotenv()
-
-# ----- Logging -----
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s|%(levelname)s|%(name)s|%(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[logging.StreamHandler()]
+import threading
+import uuid
+
+from async_marking import ASYNC_BEDROCK_ENABLED, mark_essays_on_event_loop
+from automarking import (
+    BEDROCK_MAX_CONCURRENCY,
+    CRITERION_FANOUT_ENABLED,
+    FEEDBACK_CACHE_ENABLED,
+    MARKING_CONCURRENCY,
+    METRICS_DIR,
+    PACKED_MARKING_ENABLED,
+    TokenUsage,
+    call_metrics,
+    class_statistics_table,
+    count_usage,
+    fair_scheduler,
+    feedback_cache,
+    generate_class_feedback,
+    load_feedback_guidance,
+    load_rubrics_from_folder,
+    mark_essays,
+    rate_limiter,
+    save_class_feedback,
+    stream_class_feedback,
 )
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# ----- Bedrock -----
-BEDROCK_LARGE_MODEL_ID = os.getenv('BEDROCK_LARGE_MODEL_ID', 'global.anthropic.claude-sonnet-4-20250514-v1:0')
-BEDROCK_SMALL_MODEL_ID = os.getenv('BEDROCK_SMALL_MODEL_ID', 'global.anthropic.claude-haiku-4-5-20251001-v1:0')
-BEDROCK_REGION = os.getenv('BEDROCK_REGION', 'us-west-2')
-
-config = Config(read_timeout=1000)
-bedrock_runtime = boto3.client(
-    service_name='bedrock-runtime',
-    config=config,
-    region_name=BEDROCK_REGION
+from essay_ingest import IngestReport
+from fair_scheduler import flow_context
+from job_queue import ACTIVE_JOB_STATUSES, JOB_QUEUE_PATH, JobQueue
+from marking_client import (
+    MARKING_SERVICE_URL,
+    generate_class_feedback_remote,
+    mark_essays_remote,
+    stream_class_feedback_remote,
 )
+from marking_manifest import (
+    MarkingManifest,
+    iter_essays_incremental,
+    mark_essays_incremental,
+    plan_incremental_marking,
+)
+from marking_worker import spawn_worker, submit_marking_job
+from metrics import RunMetrics, record_run
+from model_router import CASCADE_ENABLED, ModelRouter
+from near_duplicates import (
+    NEAR_DUPLICATE_INDEX_PATH,
+    NEAR_DUPLICATE_MODE,
+    NEAR_DUPLICATE_MODES,
+    NearDuplicateIndex,
+    mark_essays_with_reuse,
+)
+from pathlib import Path
+from results_export import export_run
+from results_store import ResultsStore
+from token_planner import PLANNER_DYNAMIC_MAX_TOKENS, plan_marking
 
+logger = logging.getLogger(__name__)
 
-def invoke_claude_sonnet(prompt, **kwargs):
-    """Invoke Claude Sonnet model with a simple prompt"""
-    messages = {
-        "role": "user",
-        "content": [
-            {
-                "type": "text",
-                "text": prompt
-            }
-        ]
-    }
-    body = {
-        "messages": [messages],
-        "max_tokens": 2048,
-        "temperature": 0.5,
-        "top_k": 250,
-        "top_p": 1,
-        "stop_sequences": [
-            "\\n\\nHuman:"
-        ],
-        "anthropic_version": "bedrock-2023-05-31"
-    }
-
-    for parameter in ['max_tokens', 'temperature', 'top_k', 'top_p']:
-        if parameter in kwargs:
-            body[parameter] = kwargs[parameter]
-
-    response = bedrock_runtime.invoke_model(
-        modelId=BEDROCK_LARGE_MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps(body)
-    )
-    response_body = json.loads(response.get('body').read())
-    content = response_body.get("content", [])
-    completion = [c['text'] for c in content if c['type'] == 'text']
-    if len(completion) > 0:
-        return '\n'.join(completion)
-    else:
-        return response_body
-
-
-def invoke_claude_with_response_stream(messages, **kwargs):
-    """Invoke Claude model with streaming response"""
-    body = {
-        "messages": messages,
-        "max_tokens": 2048,
-        "temperature": 0.5,
-        "top_k": 250,
-        "top_p": 1,
-        "stop_sequences": [
-            "\\n\\nHuman:"
-        ],
-        "anthropic_version": "bedrock-2023-05-31"
-    }
-
-    for parameter in ['max_tokens', 'temperature', 'top_k', 'top_p']:
-        if parameter in kwargs:
-            body[parameter] = kwargs[parameter]
-
-    response_stream = bedrock_runtime.invoke_model_with_response_stream(
-        modelId=BEDROCK_LARGE_MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps(body)
-    )
-    stream = response_stream.get('body')
-    return stream
-
-
-def bedrock_generator(model_name: str, messages: Dict) -> Generator:
-    """Generator for streaming responses from Bedrock"""
-    stream = invoke_claude_with_response_stream(messages)
-    for event in stream:
-        chunk = event.get('chunk')
-        if chunk:
-            chunk_obj = json.loads(chunk.get('bytes').decode())
-            if chunk_obj['type'] == 'content_block_delta':
-                yield chunk_obj['delta']['text']
-
-
-def generate_essay_feedback(essay_text: str, essay_name: str, rubric_text: str, 
-                            feedback_guidance: str) -> str:
-    """Generate feedback for a single essay"""
-    prompt = f"""You are an expert educator providing detailed feedback on student essays.
-
-<essay>
-{essay_text}
-</essay>
-
-<rubric>
-{rubric_text}
-</rubric>
-
-<feedback_guidance>
-{feedback_guidance}
-</feedback_guidance>
-
-Based on the essay, rubric, and feedback guidance provided above, generate comprehensive feedback for this student essay. 
-Follow the structure and tone guidelines specified in the feedback guidance.
-
-Provide specific band levels, justifications, and actionable recommendations."""
-
-    logger.info(f"Generating feedback for essay: {essay_name}")
-    feedback = invoke_claude_sonnet(prompt, max_tokens=3000)
-    return feedback
-
-
-def generate_class_feedback(all_feedbacks: List[Dict[str, str]], rubric_text: str) -> str:
-    """Generate overall class feedback based on all individual feedbacks"""
-    feedback_summary = "\n\n---\n\n".join([
-        f"Essay: {item['name']}\n{item['feedback'][:500]}..." 
-        for item in all_feedbacks
-    ])
-    
-    prompt = f"""You are an expert educator analyzing overall class performance on an essay assignment.
-
-<rubric>
-{rubric_text}
-</rubric>
-
-<individual_feedbacks>
-{feedback_summary}
-</individual_feedbacks>
-
-Based on the rubric and the individual student feedbacks provided above, generate a comprehensive class-level analysis that includes:
-
-1. **Overall Performance Summary**
-   - Distribution of band levels across the class
-   - General trends and patterns
-
-2. **What Went Well**
-   - Common strengths across multiple students
-   - Successful application of concepts
-   - Positive patterns observed
-
-3. **Areas for Improvement**
-   - Common weaknesses or gaps
-   - Recurring issues across multiple essays
-   - Misconceptions that need addressing
-
-4. **Recommendations for Next Steps**
-   - Specific teaching strategies to address common issues
-   - Topics that need re-teaching or reinforcement
-   - Suggested activities or exercises for the whole class
-   - Differentiation strategies for different performance levels
+RESULTS_DB_PATH = os.getenv('RESULTS_DB_PATH', 'outputs/results.db')
+FEEDBACK_PAGE_SIZE = 50
+MARKING_BACKGROUND_JOBS = os.getenv('MARKING_BACKGROUND_JOBS', 'false').lower() == 'true'
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '2'))
+NEAR_DUPLICATE_MODE_LABELS = {
+    'off': "Mark each essay separately",
+    'reuse': "Reuse the matching essay's feedback",
+    'adapt': "Adapt the matching essay's feedback with the small model",
+}
 
-5. **Positive Observations**
-   - Growth areas
-   - Promising developments
-   - Student engagement indicators
+# ----- Streamlit UI -----
+st.set_page_config(layout="wide", page_title="Automatic Essay Marking System")
+st.title("📝 Automatic Essay Marking System")
 
-Format the response in clear Markdown with appropriate headings and bullet points."""
 
-    logger.info("Generating class overall feedback")
-    class_feedback = invoke_claude_sonnet(prompt, max_tokens=4000)
-    return class_feedback
+@st.cache_resource
+def get_results_store() -> ResultsStore:
+    """Results store shared by every session in this process"""
+    return ResultsStore(RESULTS_DB_PATH)
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    return JobQueue(JOB_QUEUE_PATH)
+
+
+@st.cache_resource
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    return NearDuplicateIndex(NEAR_DUPLICATE_INDEX_PATH)
+
+
+def get_marking_plan(essay_ids: dict, rubric_text: str, feedback_guidance: str, concurrency: int) -> dict:
+    """Token, cost and time plan for marking the loaded essays, kept in the session until its inputs change
+
+    Essay IDs identify each essay's name and content, so the plan is only
+    recomputed when the essays, rubric, guidance or concurrency change, or
+    after a run (see initialize_session_state), not on every rerun.
+    """
+    plan_key = hashlib.sha256(json.dumps(
+        [sorted(essay_ids.items()), rubric_text, feedback_guidance, concurrency]
+    ).encode('utf-8')).hexdigest()
+    if st.session_state.marking_plan_key != plan_key:
+        with st.spinner("Counting tokens..."):
+            essays = get_results_store().get_essay_texts(essay_ids)
+            st.session_state.marking_plan = plan_marking(essays, rubric_text, feedback_guidance,
+                                                         concurrency=concurrency)
+        st.session_state.marking_plan_key = plan_key
+    return st.session_state.marking_plan
+
+
+def marking_plan_panel(plan: dict):
+    """Pre-run estimate of tokens, cost and time, with the essays that need attention"""
+    totals = plan['totals']
+    history = plan['history']
+    with st.expander(f"🧮 Estimate: ~${totals['cost_usd']:.2f}, ~{totals['seconds']:.0f}s for "
+                     f"{totals['essays']} essay(s)", expanded=bool(totals['flagged'])):
+        input_tokens = (totals['input_tokens'] + totals['cache_creation_input_tokens']
+                        + totals['cache_read_input_tokens'])
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Input tokens", f"{input_tokens:,}")
+        col2.metric("Output tokens (predicted)", f"{totals['output_tokens']:,}")
+        col3.metric("Estimated cost", f"${totals['cost_usd']:.2f}")
+        col4.metric("Estimated time", f"{totals['seconds']:.0f}s", help=f"Bound by {totals['bottleneck']}")
+        if history['fitted']:
+            st.caption(f"Output lengths predicted from {history['samples']} earlier essay call(s); "
+                       f"reserving {totals['reserved_output_tokens']:,} output tokens instead of "
+                       f"{totals['fixed_reserved_output_tokens']:,}. An upper bound: cached and reused essays "
+                       "are free.")
+        else:
+            st.caption(f"Only {history['samples']} earlier essay call(s) recorded; output lengths are a default "
+                       "guess and every essay keeps the full max_tokens. An upper bound: cached and reused essays "
+                       "are free.")
+        for item in plan['essays']:
+            for flag in item['flags']:
+                st.warning(f"⚠️ {item['name']}: {flag}")
 
 
-def save_feedback_file(essay_name: str, feedback: str, output_dir: str = "outputs") -> str:
-    """Save feedback to a file"""
-    os.makedirs(output_dir, exist_ok=True)
-    base_name = Path(essay_name).stem
-    feedback_filename = f"{base_name}.feedback.txt"
-    feedback_path = os.path.join(output_dir, feedback_filename)
-    
-    with open(feedback_path, 'w', encoding='utf-8') as f:
-        f.write(feedback)
-    
-    logger.info(f"Saved feedback to: {feedback_path}")
-    return feedback_path
+def format_wait(seconds) -> str:
+    if seconds is None:
+        return "unknown"
+    return f"{seconds:.0f}s" if seconds < 90 else f"{seconds / 60:.0f} min"
 
 
-def save_class_feedback(class_feedback: str, output_dir: str = "outputs") -> str:
-    """Save class feedback to a file"""
-    os.makedirs(output_dir, exist_ok=True)
-    class_feedback_path = os.path.join(output_dir, "class_overall.feedback.md")
-    
-    with open(class_feedback_path, 'w', encoding='utf-8') as f:
-        f.write(class_feedback)
-    
-    logger.info(f"Saved class feedback to: {class_feedback_path}")
-    return class_feedback_path
+def bedrock_queue_panel(flow_name: str):
+    """Runs in this app sharing Bedrock capacity right now, with this session's share if it starts one"""
+    if fair_scheduler is None:
+        return
+    flows = fair_scheduler.snapshot()
+    if not flows:
+        return
+    others = [flow for flow in flows if flow['flow'] != flow_name]
+    with st.expander(f"🚦 Bedrock queue: {len(flows)} run(s) marking", expanded=False):
+        st.dataframe(flows, hide_index=True)
+        if others:
+            weight = next((flow['weight'] for flow in flows if flow['flow'] == flow_name), 1.0)
+            share = weight / (weight + sum(flow['weight'] for flow in others))
+            st.caption(f"Capacity is shared fairly between runs by weight, small runs first; a run started now "
+                       f"as `{flow_name}` would get about {share:.0%} of it while these stay busy.")
+
+
+def flow_status_text(flow_name: str, remaining_calls: int) -> str:
+    """This session's place in the shared Bedrock queue, for the progress area"""
+    status = fair_scheduler.status(flow_name, remaining_calls)
+    if status['active_flows'] <= 1:
+        return ""
+    text = (f"🚦 Sharing Bedrock with {status['active_flows'] - 1} other run(s): your share {status['share']:.0%}, "
+            f"{status['in_flight']} call(s) in flight")
+    if status['position']:
+        text += (f", next call at position {status['position']} of {status['queue_length']} "
+                 f"(~{format_wait(status['wait_seconds'])})")
+    if 'finish_seconds' in status:
+        text += f", about {format_wait(status['finish_seconds'])} to finish"
+    return text
 
 
-# ----- Streamlit UI -----
-st.set_page_config(layout="wide", page_title="Automatic Essay Marking System")
-st.title("📝 Automatic Essay Marking System")
+def ensure_worker(concurrency: int):
+    """Start a local marking worker unless one is already serving the queue"""
+    if not get_job_queue().active_workers():
+        spawn_worker(JOB_QUEUE_PATH, concurrency=concurrency)
 
 
 def initialize_session_state():
     """Initialize session state variables"""
-    if "essay_files" not in st.session_state:
-        st.session_state.essay_files = {}
+    if "essay_ids" not in st.session_state:
+        st.session_state.essay_ids = {}
+    if "duplicate_clusters" not in st.session_state:
+        st.session_state.duplicate_clusters = []
     if "rubric_files" not in st.session_state:
         st.session_state.rubric_files = {}
     if "feedback_guidance" not in st.session_state:
         st.session_state.feedback_guidance = ""
-    if "generated_feedbacks" not in st.session_state:
-        st.session_state.generated_feedbacks = []
-    if "class_feedback" not in st.session_state:
-        st.session_state.class_feedback = ""
+    if "run_id" not in st.session_state:
+        # Show the latest stored results after a reload or restart
+        st.session_state.run_id = get_results_store().latest_run_id()
+    if "job_id" not in st.session_state:
+        # Resume polling a job that was still running when the page was reloaded
+        latest_job = get_job_queue().latest_job()
+        st.session_state.job_id = latest_job['id'] if latest_job.get('status') in ACTIVE_JOB_STATUSES else None
     if "marking_complete" not in st.session_state:
         st.session_state.marking_complete = False
-
-
-def load_essays_from_folder(folder_path: str = "essays") -> Dict[str, str]:
-    """Load all essay files from the essays folder"""
-    essays = {}
-    
-    if not os.path.exists(folder_path):
-        logger.warning(f"Essays folder not found: {folder_path}")
-        return essays
-    
-    txt_files = Path(folder_path).glob("*.txt")
-    for file_path in txt_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                essays[file_path.name] = content
-                logger.info(f"Loaded essay: {file_path.name}")
-        except Exception as e:
-            logger.error(f"Error loading essay {file_path.name}: {str(e)}")
-    
-    return essays
-
-
-def load_rubrics_from_folder(folder_path: str = "rubric") -> Dict[str, str]:
-    """Load all rubric files from the rubric folder"""
-    rubrics = {}
-    
-    if not os.path.exists(folder_path):
-        logger.warning(f"Rubric folder not found: {folder_path}")
-        return rubrics
-    
-    md_files = Path(folder_path).glob("*.md")
-    for file_path in md_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                rubrics[file_path.name] = content
-                logger.info(f"Loaded rubric: {file_path.name}")
-        except Exception as e:
-            logger.error(f"Error loading rubric {file_path.name}: {str(e)}")
+    if "finished_job_id" not in st.session_state:
+        st.session_state.finished_job_id = None
+    if "marking_flow_name" not in st.session_state:
+        # Fair-share flow of this session's marking runs (see fair_scheduler.py)
+        st.session_state.marking_flow_name = f"session-{uuid.uuid4().hex[:6]}"
+    if "ingest_skipped" not in st.session_state:
+        st.session_state.ingest_skipped = {}
+    if "run_usage" not in st.session_state:
+        # Bedrock token usage of this session's last in-page run
+        st.session_state.run_usage = TokenUsage().snapshot()
+        # Bedrock call metrics of this session's last in-page run
+        st.session_state.run_metrics = None
+    if "marking_plan_key" not in st.session_state:
+        # Pre-run plan of the loaded essays and the hash of its inputs (see get_marking_plan)
+        st.session_state.marking_plan_key = None
+        st.session_state.marking_plan = None
+    if "exports" not in st.session_state:
+        # Export file paths by run ID, built when "Download All" is first requested
+        st.session_state.exports = {}
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress_panel():
+    """Poll the queue for the current job's progress and rerun the app when it finishes"""
+    job_queue = get_job_queue()
+    job = job_queue.job(st.session_state.job_id)
+    if not job:
+        st.session_state.job_id = None
+        return
+    progress = job_queue.job_progress(job['id'])
+    finished = progress['done'] + progress['failed']
+    st.progress(
+        finished / max(1, progress['total']),
+        text=f"Job {job['id']} ({job['status']}): {progress['done']} of {progress['total']} essay(s) done "
+             f"({progress['reused']} reused), {progress['leased']} in progress, {progress['failed']} failed"
+    )
+    if job['status'] in ACTIVE_JOB_STATUSES:
+        queue_status = job_queue.queue_status(job['id'])
+        if queue_status['active_jobs'] > 1:
+            place = "next in line" if queue_status['position'] == 1 else f"at position {queue_status['position']}"
+            st.caption(f"🚦 {queue_status['active_jobs']} jobs are sharing the workers: this job is {place} "
+                       f"with a {queue_status['share']:.0%} share, about {format_wait(queue_status['wait_seconds'])} "
+                       "to finish")
+        if not job_queue.active_workers():
+            st.warning("⚠️ No marking worker is running for this job.")
+            if st.button("▶️ Start a worker"):
+                ensure_worker(MARKING_CONCURRENCY)
+        return
     
-    return rubrics
+    st.session_state.job_id = None
+    st.session_state.finished_job_id = job['id']
+    st.session_state.marking_plan_key = None
+    if job['run_id'] is not None:
+        st.session_state.run_id = job['run_id']
+        st.session_state.marking_complete = True
+    st.rerun()
 
 
-def load_feedback_guidance(file_path: str = "feedback_guidance.md") -> str:
-    """Load feedback guidance from file"""
-    if not os.path.exists(file_path):
-        logger.warning(f"Feedback guidance file not found: {file_path}")
-        return ""
-    
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            logger.info(f"Loaded feedback guidance from: {file_path}")
-            return content
-    except Exception as e:
-        logger.error(f"Error loading feedback guidance: {str(e)}")
-        return ""
+def finished_job_summary(job_id: int):
+    """Outcome of the last background job this session waited for"""
+    job_queue = get_job_queue()
+    job = job_queue.job(job_id)
+    if not job:
+        return
+    if job['status'] == 'failed':
+        st.error(f"Job {job_id} failed: {job['error']}")
+        return
+    progress = job_queue.job_progress(job_id)
+    st.success(f"✓ Job {job_id} finished: {progress['done']} of {progress['total']} essay(s) marked "
+               f"({progress['reused']} reused from previous runs)")
+    _, _, errors = job_queue.results(job_id)
+    for essay_name, error in errors.items():
+        st.error(f"Error processing {essay_name}: {error}")
 
 
 def tab_upload_and_marking():
@@ -343,8 +320,27 @@ def tab_upload_and_marking():
     col_load1, col_load2, col_load3 = st.columns([1, 2, 1])
     with col_load2:
         if st.button("🔄 Load/Refresh Files from Folders", type="secondary", use_container_width=True):
-            # Load essays from essays/ folder
-            st.session_state.essay_files = load_essays_from_folder("essays")
+            # Load essays from essays/ folder on a pool of threads, re-reading only files that changed
+            results_store = get_results_store()
+            ingest_report = IngestReport()
+            loading_text = st.empty()
+            essays = {}
+            read_names = []
+            for essay_name, essay_text in iter_essays_incremental(
+                "essays",
+                MarkingManifest("outputs"),
+                results_store.get_essay_texts(st.session_state.essay_ids),
+                ingest_report,
+                read_names
+            ):
+                essays[essay_name] = essay_text
+                if len(essays) % 50 == 0:
+                    loading_text.text(f"Loaded {len(essays)} essay(s)...")
+            loading_text.empty()
+            essays = dict(sorted(essays.items()))
+            st.session_state.ingest_skipped = ingest_report.skipped
+            st.session_state.essay_ids = results_store.add_essays(essays)
+            st.session_state.duplicate_clusters = get_near_duplicate_index().clusters(essays)
             
             # Load rubrics from rubric/ folder
             st.session_state.rubric_files = load_rubrics_from_folder("rubric")
@@ -354,8 +350,8 @@ def tab_upload_and_marking():
             if guidance:
                 st.session_state.feedback_guidance = guidance
             
-            if st.session_state.essay_files or st.session_state.rubric_files or st.session_state.feedback_guidance:
-                st.success("✓ Files loaded successfully!")
+            if st.session_state.essay_ids or st.session_state.rubric_files or st.session_state.feedback_guidance:
+                st.success(f"✓ Files loaded successfully! ({len(read_names)} essay file(s) new or changed)")
             else:
                 st.warning("⚠️ No files found. Please check that essays/ and rubric/ folders exist with files.")
     
@@ -366,22 +362,45 @@ def tab_upload_and_marking():
     with col1:
         st.subheader("📄 Student Essays")
         
-        if not st.session_state.essay_files:
+        if not st.session_state.essay_ids:
             st.info("ℹ️ No essays loaded. Click 'Load/Refresh Files' to load from `essays/` folder.")
-            st.markdown("**Expected:** `essays/*.txt`")
+            st.markdown("**Expected:** `essays/*.txt`, `*.docx` or `*.pdf`")
         else:
-            st.success(f"✓ {len(st.session_state.essay_files)} essay(s) loaded from `essays/` folder")
+            st.success(f"✓ {len(st.session_state.essay_ids)} essay(s) loaded from `essays/` folder")
+        
+        if st.session_state.ingest_skipped:
+            with st.expander(f"⚠️ Skipped files ({len(st.session_state.ingest_skipped)})"):
+                st.dataframe(
+                    [{'file': name, 'reason': reason} for name, reason in st.session_state.ingest_skipped.items()],
+                    hide_index=True
+                )
+        
+        if st.session_state.essay_ids:
+            
+            if st.session_state.duplicate_clusters:
+                with st.expander(f"🔁 Near-duplicate essays ({len(st.session_state.duplicate_clusters)} group(s))"):
+                    st.dataframe(
+                        [{
+                            'essays': ', '.join(cluster['essays']),
+                            'similarity': cluster['similarity'],
+                            'earlier submissions': ', '.join(
+                                f"{match['name']} ({match['cohort']}, {match['similarity']})"
+                                for match in cluster['past']
+                            ),
+                        } for cluster in st.session_state.duplicate_clusters],
+                        hide_index=True
+                    )
             
             # Preview selected essay
             selected_essay = st.selectbox(
                 "Select essay to preview:",
-                options=list(st.session_state.essay_files.keys()),
+                options=list(st.session_state.essay_ids.keys()),
                 key="essay_preview_select"
             )
             with st.expander("Preview Essay", expanded=False):
                 st.text_area(
                     "Essay content:",
-                    value=st.session_state.essay_files[selected_essay],
+                    value=get_results_store().get_essay_text(st.session_state.essay_ids[selected_essay]),
                     height=300,
                     key="essay_preview_area",
                     disabled=True
@@ -428,21 +447,101 @@ def tab_upload_and_marking():
             key="marking_rubric_select"
         )
     
+    flow_name = st.text_input(
+        "Marking for (teacher or class; Bedrock capacity is shared fairly between them):",
+        key="marking_flow_name"
+    ).strip() or "default"
+    max_workers = st.number_input(
+        "Essays to mark concurrently:",
+        min_value=1,
+        max_value=max(BEDROCK_MAX_CONCURRENCY, MARKING_CONCURRENCY),
+        value=MARKING_CONCURRENCY,
+        key="marking_concurrency"
+    )
+    force_fresh = st.checkbox(
+        "Force fresh generation (ignore cached feedback)",
+        value=not FEEDBACK_CACHE_ENABLED,
+        key="marking_force_fresh"
+    )
+    incremental = st.checkbox(
+        "Only mark new or changed essays (reuse feedback from previous runs)",
+        value=True,
+        disabled=force_fresh,
+        key="marking_incremental"
+    )
+    # Forcing fresh generation also re-marks essays the manifest would reuse
+    remark_all = force_fresh or not incremental
+    use_cascade = st.checkbox(
+        "Small-model cascade (quick estimate first; only borderline essays use the large model)",
+        value=CASCADE_ENABLED,
+        key="marking_use_cascade"
+    )
+    pack_essays = st.checkbox(
+        "Mark several short essays per request (fewer requests; no live essay feedback)",
+        value=PACKED_MARKING_ENABLED,
+        key="marking_pack_essays"
+    )
+    fanout_criteria = st.checkbox(
+        "Assess each rubric criterion in a separate parallel request (faster per essay; more requests)",
+        value=CRITERION_FANOUT_ENABLED,
+        key="marking_fanout_criteria"
+    )
+    duplicate_mode = st.selectbox(
+        "Near-duplicate essays:",
+        options=NEAR_DUPLICATE_MODES,
+        index=NEAR_DUPLICATE_MODES.index(NEAR_DUPLICATE_MODE) if NEAR_DUPLICATE_MODE in NEAR_DUPLICATE_MODES else 0,
+        format_func=NEAR_DUPLICATE_MODE_LABELS.get,
+        key="marking_duplicate_mode"
+    )
+    use_async_client = st.checkbox(
+        "Use the asyncio Bedrock client (one event loop for all in-flight requests; no packing or fan-out)",
+        value=ASYNC_BEDROCK_ENABLED,
+        disabled=pack_essays or fanout_criteria,
+        key="marking_use_async_client"
+    ) and not (pack_essays or fanout_criteria)
+    size_max_tokens = st.checkbox(
+        "Size max_tokens per essay from past output lengths (long feedback is continued, not cut off)",
+        value=PLANNER_DYNAMIC_MAX_TOKENS,
+        key="marking_size_max_tokens"
+    )
+    run_in_background = st.checkbox(
+        "Run as a background job (survives page reloads and server restarts; no live feedback)",
+        value=MARKING_BACKGROUND_JOBS,
+        key="marking_run_in_background"
+    )
+    stream_live = st.checkbox(
+        "Show feedback live as it is generated",
+        value=True,
+        key="marking_stream_live",
+        disabled=run_in_background
+    )
+    
+    can_mark = (len(st.session_state.essay_ids) > 0 and 
+               len(st.session_state.rubric_files) > 0 and 
+               st.session_state.feedback_guidance)
+    plan = None
+    if can_mark and selected_rubric_for_marking:
+        plan = get_marking_plan(
+            st.session_state.essay_ids,
+            st.session_state.rubric_files[selected_rubric_for_marking],
+            st.session_state.feedback_guidance,
+            max_workers
+        )
+        marking_plan_panel(plan)
+    bedrock_queue_panel(flow_name)
+    planned_max_tokens = plan['max_tokens'] if plan and size_max_tokens else None
+    
     # Start automatic marking button
     col_btn1, col_btn2, col_btn3 = st.columns([1, 2, 1])
     with col_btn2:
-        can_mark = (len(st.session_state.essay_files) > 0 and 
-                   len(st.session_state.rubric_files) > 0 and 
-                   st.session_state.feedback_guidance)
-        
         if st.button(
             "🚀 Start Automatic Marking",
             type="primary",
-            disabled=not can_mark,
+            disabled=not can_mark or st.session_state.job_id is not None,
             use_container_width=True
         ):
             st.session_state.marking_complete = False
-            st.session_state.generated_feedbacks = []
+            st.session_state.run_id = None
             
             # Safety check: ensure rubric is selected
             if not selected_rubric_for_marking:
@@ -451,88 +550,283 @@ def tab_upload_and_marking():
                 
             rubric_text = st.session_state.rubric_files[selected_rubric_for_marking]
             
+            if run_in_background:
+                # Queue the job and let a worker process mark it; the panel below polls its progress
+                st.session_state.job_id = submit_marking_job(
+                    get_job_queue(),
+                    get_results_store().get_essay_texts(st.session_state.essay_ids),
+                    selected_rubric_for_marking,
+                    rubric_text,
+                    st.session_state.feedback_guidance,
+                    output_dir="outputs",
+                    essays_dir="essays",
+                    force=remark_all,
+                    use_cache=not force_fresh,
+                    cascade=use_cascade,
+                    pack=pack_essays,
+                    fanout=fanout_criteria,
+                    async_client=use_async_client,
+                    max_tokens=planned_max_tokens,
+                    near_duplicates=duplicate_mode,
+                    near_duplicate_index=NEAR_DUPLICATE_INDEX_PATH,
+                    results_db=RESULTS_DB_PATH,
+                    flow=flow_name
+                )
+                st.session_state.finished_job_id = None
+                ensure_worker(max_workers)
+                st.rerun()
+            
+            # Tokens and calls of this run only, however many sessions and jobs are marking
+            run_usage = TokenUsage()
+            run_metrics = RunMetrics()
             progress_bar = st.progress(0)
             status_text = st.empty()
+            queue_text = st.empty()
             
-            total_essays = len(st.session_state.essay_files)
+            results_store = get_results_store()
+            essays = results_store.get_essay_texts(st.session_state.essay_ids)
+            total_essays = len(essays)
+            status_text.text(f"Checking {total_essays} essay(s) for changes...")
+            # Small-run priority goes by the essays this run will actually mark, not the class size
+            essays_to_mark = len(plan_incremental_marking(essays, rubric_text, st.session_state.feedback_guidance,
+                                                          "outputs", remark_all)[0])
             
-            for idx, (essay_name, essay_text) in enumerate(st.session_state.essay_files.items()):
-                status_text.text(f"Marking essay {idx + 1} of {total_essays}: {essay_name}")
-                
-                try:
-                    feedback = generate_essay_feedback(
-                        essay_text,
-                        essay_name,
-                        rubric_text,
-                        st.session_state.feedback_guidance
-                    )
-                    
-                    # Save feedback file
-                    feedback_path = save_feedback_file(essay_name, feedback)
-                    
-                    st.session_state.generated_feedbacks.append({
-                        'name': essay_name,
-                        'feedback': feedback,
-                        'path': feedback_path
-                    })
-                    
-                except Exception as e:
-                    st.error(f"Error processing {essay_name}: {str(e)}")
-                    logger.error(f"Error processing {essay_name}: {str(e)}")
-                
-                progress_bar.progress((idx + 1) / total_essays)
+            # One live panel per in-flight essay; worker threads only append to
+            # the buffers, and the panels are redrawn from this thread on each tick
+            live_area = st.container()
+            live_panels = {}
+            live_buffers = {}
+            live_lock = threading.Lock()
+            remaining_essays = total_essays
+            
+            def collect_delta(essay_name, text):
+                with live_lock:
+                    live_buffers.setdefault(essay_name, []).append(text)
+            
+            def refresh_live_panels():
+                with live_lock:
+                    snapshot = {name: ''.join(chunks) for name, chunks in live_buffers.items()}
+                for essay_name, text in snapshot.items():
+                    if essay_name not in live_panels:
+                        live_panels[essay_name] = live_area.empty()
+                    with live_panels[essay_name].container(border=True):
+                        st.markdown(f"**✍️ {essay_name}**")
+                        st.markdown(text)
+            
+            def report_progress(completed, total, essay_name, error):
+                nonlocal remaining_essays
+                if error is not None:
+                    st.error(f"Error processing {essay_name}: {str(error)}")
+                with live_lock:
+                    live_buffers.pop(essay_name, None)
+                if essay_name in live_panels:
+                    live_panels.pop(essay_name).empty()
+                status_text.text(f"Marked {completed} of {total}: {essay_name}")
+                progress_bar.progress(completed / total)
+                remaining_essays = total - completed
+            
+            def on_tick():
+                if stream_live and not pack_essays:
+                    refresh_live_panels()
+                if fair_scheduler is not None:
+                    queue_text.caption(flow_status_text(flow_name, remaining_essays))
+            
+            router = ModelRouter(rubric_text, use_cache=not force_fresh) if use_cascade else None
+            if MARKING_SERVICE_URL:
+                # The shared marking service makes the Bedrock calls (see marking_service.py)
+                mark_with = mark_essays_remote
+                stream_class, generate_class = stream_class_feedback_remote, generate_class_feedback_remote
+            else:
+                mark_with = mark_essays_on_event_loop if use_async_client else mark_essays
+                stream_class, generate_class = stream_class_feedback, generate_class_feedback
+            # Bedrock calls are queued fairly with other sessions' runs as this session's flow, and their
+            # tokens counted for this run only
+            with flow_context(flow_name, essays=essays_to_mark), count_usage(run_usage), record_run(run_metrics):
+                generated_feedbacks, errors, reused_count = mark_essays_incremental(
+                    essays,
+                    rubric_text,
+                    st.session_state.feedback_guidance,
+                    output_dir="outputs",
+                    essays_dir="essays",
+                    force=remark_all,
+                    mark=functools.partial(
+                        mark_essays_with_reuse,
+                        index=get_near_duplicate_index(),
+                        mode=duplicate_mode,
+                        mark=mark_with
+                    ),
+                    max_workers=max_workers,
+                    use_cache=not force_fresh,
+                    on_complete=report_progress,
+                    on_delta=collect_delta if stream_live and not pack_essays else None,
+                    on_tick=on_tick,
+                    route=router,
+                    pack=pack_essays,
+                    fanout=fanout_criteria,
+                    max_tokens=planned_max_tokens
+                )
+            if reused_count:
+                st.info(f"ℹ️ Reused feedback for {reused_count} unchanged essay(s)")
+            
+            run_id = results_store.create_run(
+                selected_rubric_for_marking,
+                rubric_text,
+                st.session_state.feedback_guidance,
+                metadata={
+                    'errors': errors,
+                    'reused': reused_count,
+                    'cascade': use_cascade,
+                    'fanout': fanout_criteria,
+                    'near_duplicates': {item['name']: item['duplicate_of'] for item in generated_feedbacks
+                                        if 'duplicate_of' in item},
+                }
+            )
+            results_store.add_feedbacks(run_id, generated_feedbacks, st.session_state.essay_ids)
+            class_statistics = class_statistics_table(generated_feedbacks, rubric_text)
+            if router:
+                with st.expander("🔀 Model cascade summary", expanded=True):
+                    st.table(router.summary(generated_feedbacks, run_usage))
             
             # Generate class overall feedback
             status_text.text("Generating class overall feedback...")
-            try:
-                class_feedback = generate_class_feedback(
-                    st.session_state.generated_feedbacks,
-                    rubric_text
-                )
-                st.session_state.class_feedback = class_feedback
-                save_class_feedback(class_feedback)
-            except Exception as e:
-                st.error(f"Error generating class feedback: {str(e)}")
-                logger.error(f"Error generating class feedback: {str(e)}")
+            class_feedback = ""
+            with flow_context(flow_name, essays=essays_to_mark), count_usage(run_usage), record_run(run_metrics):
+                try:
+                    if stream_live:
+                        with st.expander("📊 Class overall feedback", expanded=True):
+                            class_feedback = st.write_stream(stream_class(
+                                generated_feedbacks,
+                                rubric_text,
+                                use_cache=not force_fresh
+                            ))
+                    else:
+                        class_feedback = generate_class(
+                            generated_feedbacks,
+                            rubric_text,
+                            use_cache=not force_fresh
+                        )
+                    save_class_feedback(class_feedback)
+                except Exception as e:
+                    st.error(f"Error generating class feedback: {str(e)}")
+                    logger.error(f"Error generating class feedback: {str(e)}")
+            results_store.set_class_feedback(run_id, class_feedback, class_statistics)
+            run_metrics.export(METRICS_DIR)
             
+            queue_text.empty()
             status_text.text("✓ Marking complete!")
+            st.session_state.run_id = run_id
             st.session_state.marking_complete = True
-            st.success(f"✓ Successfully marked {total_essays} essay(s) and generated class feedback!")
+            st.session_state.run_usage = run_usage.snapshot()
+            st.session_state.run_metrics = run_metrics
+            # The run added to the call history, so plan the next run afresh
+            st.session_state.marking_plan_key = None
+            marked_count = len(generated_feedbacks)
+            st.success(f"✓ Successfully marked {marked_count} of {total_essays} essay(s) and generated class feedback!")
             st.balloons()
     
+    if st.session_state.job_id is not None:
+        job_progress_panel()
+    elif st.session_state.finished_job_id is not None:
+        finished_job_summary(st.session_state.finished_job_id)
+    
     if not can_mark:
         st.info("ℹ️ Please load essays, rubric, and feedback guidance using the button above to start marking.")
 
 
+def download_all_panel(run_id: int):
+    """Export the run on request, then offer the archive and consolidated results for download
+
+    Each file is only read when its button is clicked, not on every rerun.
+    """
+    paths = st.session_state.exports.get(run_id)
+    if not paths or not all(os.path.exists(path) for path in paths.values()):
+        if st.button("📦 Prepare Download All (feedback, class report and scores)", key="prepare_export"):
+            with st.spinner("Exporting all results..."):
+                st.session_state.exports[run_id] = export_run(get_results_store(), run_id)
+            st.rerun()
+        return
+    
+    col_zip, col_csv, col_jsonl = st.columns(3)
+    with col_zip:
+        st.download_button(
+            "⬇️ Download All (ZIP)",
+            data=Path(paths['zip']).read_bytes,
+            file_name=os.path.basename(paths['zip']),
+            mime="application/zip",
+            type="primary",
+            use_container_width=True
+        )
+    with col_csv:
+        st.download_button(
+            "⬇️ Scores (CSV)",
+            data=Path(paths['csv']).read_bytes,
+            file_name=os.path.basename(paths['csv']),
+            mime="text/csv",
+            use_container_width=True
+        )
+    with col_jsonl:
+        st.download_button(
+            "⬇️ Scores (JSONL)",
+            data=Path(paths['jsonl']).read_bytes,
+            file_name=os.path.basename(paths['jsonl']),
+            mime="application/jsonl",
+            use_container_width=True
+        )
+
+
 def tab_individual_feedback():
     """Tab 2: View individual feedback files"""
     st.header("📋 Individual Student Feedback")
     
-    if not st.session_state.generated_feedbacks:
+    results_store = get_results_store()
+    total_feedbacks = results_store.count_feedback(st.session_state.run_id)
+    if not total_feedbacks:
         st.info("ℹ️ No feedback generated yet. Please run automatic marking first.")
         return
     
-    st.success(f"✓ {len(st.session_state.generated_feedbacks)} feedback file(s) available")
+    st.success(f"✓ {total_feedbacks} feedback file(s) available")
+    download_all_panel(st.session_state.run_id)
+    
+    # Search and page through feedback; only the selected feedback is loaded
+    col_search, col_page = st.columns([3, 1])
+    with col_search:
+        search = st.text_input("Search by essay name:", key="feedback_search")
+    matching = results_store.count_feedback(st.session_state.run_id, search)
+    page_count = max(1, -(-matching // FEEDBACK_PAGE_SIZE))
+    with col_page:
+        page = st.number_input(f"Page (of {page_count}):", min_value=1, max_value=page_count,
+                               value=1)
+    
+    page_rows = results_store.list_feedback(
+        st.session_state.run_id,
+        search,
+        limit=FEEDBACK_PAGE_SIZE,
+        offset=(page - 1) * FEEDBACK_PAGE_SIZE
+    )
+    if not page_rows:
+        st.info("ℹ️ No essays match your search.")
+        return
     
     # Select feedback to view
-    feedback_names = [f['name'] for f in st.session_state.generated_feedbacks]
-    selected_feedback_name = st.selectbox(
+    feedback_names = {feedback_id: name for feedback_id, name, _ in page_rows}
+    selected_feedback_id = st.selectbox(
         "Select student essay to view feedback:",
-        options=feedback_names,
+        options=list(feedback_names.keys()),
+        format_func=feedback_names.get,
         key="feedback_select"
     )
-    
-    # Find the selected feedback
-    selected_feedback = next(
-        (f for f in st.session_state.generated_feedbacks if f['name'] == selected_feedback_name),
-        None
-    )
+    selected_feedback = results_store.get_feedback(selected_feedback_id)
+    selected_feedback_name = selected_feedback.get('name')
     
     if selected_feedback:
         col1, col2 = st.columns([2, 1])
         
         with col1:
             st.subheader(f"Feedback for: {selected_feedback_name}")
+            duplicate_of = results_store.get_run(st.session_state.run_id).get('metadata', {}) \
+                .get('near_duplicates', {}).get(selected_feedback_name)
+            if duplicate_of:
+                st.caption(f"🔁 Derived from the feedback of near-duplicate essay {duplicate_of}")
         
         with col2:
             if st.download_button(
@@ -545,6 +839,17 @@ def tab_individual_feedback():
         
         st.divider()
         
+        # Structured bands and points parsed from the feedback
+        criteria_scores = selected_feedback.get('scores', {}).get('criteria', {})
+        if criteria_scores:
+            score_columns = st.columns(len(criteria_scores) + 1)
+            for column, (criterion, score) in zip(score_columns, criteria_scores.items()):
+                column.metric(criterion, f"Band {score['band']}",
+                              f"{score['points']:g} pts" if score['points'] is not None else None,
+                              delta_color="off")
+            if selected_feedback['scores'].get('total') is not None:
+                score_columns[-1].metric("Total", f"{selected_feedback['scores']['total']:g} pts")
+        
         # Display feedback in a nice container
         with st.container():
             st.markdown(selected_feedback['feedback'])
@@ -554,7 +859,8 @@ def tab_class_feedback():
     """Tab 3: View class overall feedback"""
     st.header("📊 Class Overall Feedback & Analysis")
     
-    if not st.session_state.class_feedback:
+    run = get_results_store().get_run(st.session_state.run_id)
+    if not run.get('class_feedback'):
         st.info("ℹ️ No class feedback generated yet. Please run automatic marking first.")
         return
     
@@ -566,7 +872,7 @@ def tab_class_feedback():
     with col2:
         if st.download_button(
             "⬇️ Download Analysis",
-            data=st.session_state.class_feedback,
+            data=run['class_feedback'],
             file_name="class_overall.feedback.md",
             mime="text/markdown"
         ):
@@ -574,9 +880,14 @@ def tab_class_feedback():
     
     st.divider()
     
+    # Band distribution computed locally from the structured scores
+    if run['class_statistics']:
+        with st.expander("📈 Band Distribution & Statistics", expanded=True):
+            st.markdown(run['class_statistics'])
+    
     # Display class feedback
     with st.container():
-        st.markdown(st.session_state.class_feedback)
+        st.markdown(run['class_feedback'])
 
 
 def main():
@@ -632,12 +943,47 @@ def main():
         st.divider()
         
         st.subheader("📊 Status")
-        st.write(f"Essays loaded: **{len(st.session_state.essay_files)}**")
+        st.write(f"Essays loaded: **{len(st.session_state.essay_ids)}**")
         st.write(f"Rubrics loaded: **{len(st.session_state.rubric_files)}**")
-        st.write(f"Feedback generated: **{len(st.session_state.generated_feedbacks)}**")
+        st.write(f"Feedback generated: **{get_results_store().count_feedback(st.session_state.run_id)}**")
         
         if st.session_state.marking_complete:
             st.success("✓ Marking complete!")
+        
+        usage = st.session_state.run_usage
+        st.write(f"Bedrock tokens (last run): **{usage['input_tokens']}** in / **{usage['output_tokens']}** out "
+                 f"(prompt cache: {usage['cache_read_input_tokens']} read, "
+                 f"{usage['cache_creation_input_tokens']} written)")
+        
+        limiter_stats = rate_limiter.stats()
+        st.write(f"Bedrock retries: **{limiter_stats['retries']}** "
+                 f"({limiter_stats['throttles']} throttled, {limiter_stats['retry_wait_seconds']}s backoff), "
+                 f"concurrency limit {limiter_stats['concurrency_limit']}")
+        
+        cache_stats = feedback_cache.stats()
+        st.write(f"Feedback cache: **{cache_stats['hits']}** hits / **{cache_stats['misses']}** misses "
+                 f"({cache_stats['entries']} entries)")
+        
+        run_metrics = st.session_state.run_metrics
+        run_summary = run_metrics.summary() if run_metrics else {}
+        if run_summary:
+            with st.expander("📈 Bedrock call metrics (last run)"):
+                st.dataframe(
+                    [{'kind': kind, **summary} for kind, summary in run_summary.items()],
+                    hide_index=True
+                )
+                st.download_button(
+                    "⬇️ Trace (JSONL)",
+                    data=run_metrics.trace_jsonl(),
+                    file_name=f"run-{run_metrics.run_label}.jsonl",
+                    mime="application/x-ndjson"
+                )
+                st.download_button(
+                    "⬇️ Metrics (Prometheus)",
+                    data=call_metrics.prometheus_text(),
+                    file_name="automarking.prom",
+                    mime="text/plain"
+                )
 
 
 if __name__ == '__main__':
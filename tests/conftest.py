@@ -0,0 +1,18 @@
+"""
+Shared pytest setup: run against the local fake Bedrock backend with a
+throwaway feedback cache, so the suite needs no AWS credentials.
+"""
+
+import os
+import sys
+import tempfile
+
+# Must be set before automarking is imported: its configuration is read at import time
+os.environ['BEDROCK_BACKEND'] = 'fake'
+os.environ['FEEDBACK_CACHE_DIR'] = tempfile.mkdtemp(prefix='feedback-cache-')
+os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='metrics-')
+os.environ.setdefault('FAKE_BEDROCK_LATENCY_MEDIAN', '0.01')
+os.environ.setdefault('FAKE_BEDROCK_LATENCY_SIGMA', '0')
+os.environ.setdefault('FAKE_BEDROCK_TOKENS_PER_SECOND', '100000')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
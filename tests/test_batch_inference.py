@@ -0,0 +1,90 @@
+import json
+
+import batch_inference
+import pytest
+
+from automarking import DEFAULT_INFERENCE_PARAMS, ESSAY_MAX_TOKENS, essay_cache_key, feedback_cache
+from batch_inference import (
+    BatchJob,
+    LocalObjectStore,
+    ingest_bulk_job,
+    job_status,
+    refresh_bulk_job,
+    submit_bulk_job,
+)
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_inference, 'BATCH_LOCAL_DIR', str(tmp_path / "batch"))
+    essays_dir = tmp_path / "essays"
+    essays_dir.mkdir()
+    for index in range(3):
+        (essays_dir / f"essay{index}.txt").write_text(f"Batch essay {index}. " + "Rivers shape valleys. " * 30)
+    return str(essays_dir), str(tmp_path / "outputs")
+
+
+def truncate_output(job: BatchJob, essay_name: str):
+    """Rewrite the job's output so that `essay_name`'s record stopped at max_tokens"""
+    record = next(record for record, name in job.records.items() if name == essay_name)
+    store = LocalObjectStore(batch_inference.BATCH_LOCAL_DIR)
+    prefix = f"{job.output_uri.rstrip('/')}/{job.job_arn.rsplit('/', 1)[-1]}/"
+    for uri in store.list(prefix):
+        if uri.endswith('.jsonl.out'):
+            lines = [json.loads(line) for line in store.get(uri).decode('utf-8').splitlines() if line.strip()]
+            for line in lines:
+                if line['recordId'] == record:
+                    line['modelOutput']['stop_reason'] = 'max_tokens'
+            store.put(uri, '\n'.join(json.dumps(line) for line in lines).encode('utf-8'))
+
+
+def test_submit_status_ingest_on_the_local_backend(cohort):
+    essays_dir, output_dir = cohort
+    job = submit_bulk_job(essays_dir, str(REPO / "rubric" / "rubric1.md"), str(REPO / "feedback_guidance.md"),
+                          output_dir, use_cache=False, min_records=1, backend='local')
+    assert sorted(job.records.values()) == ["essay0.txt", "essay1.txt", "essay2.txt"]
+    assert job_status(job)['status'] == 'Submitted'
+    assert refresh_bulk_job(job, output_dir).status == 'InProgress'
+    assert refresh_bulk_job(job, output_dir).status == 'Completed'
+    assert job_status(BatchJob.load(job.job_name, output_dir))['records'] == 3
+
+    truncate_output(job, "essay1.txt")
+    summary = ingest_bulk_job(job, output_dir, class_feedback=False)
+    assert not summary['already_ingested']
+    assert (summary['marked'], summary['failed']) == (2, 1)
+    assert "cut off" in summary['errors']["essay1.txt"]
+    assert all(Path(path).exists() for path in summary['export'].values())
+    params = {**DEFAULT_INFERENCE_PARAMS, "max_tokens": ESSAY_MAX_TOKENS}
+    truncated_text = (Path(essays_dir) / "essay1.txt").read_text()
+    assert feedback_cache.get(essay_cache_key(truncated_text, job.rubric_text, job.feedback_guidance, params,
+                                              job.model_id)) is None
+
+    # A second ingest returns the existing run instead of storing another
+    job = BatchJob.load(job.job_name, output_dir)
+    again = ingest_bulk_job(job, output_dir, class_feedback=False)
+    assert again['already_ingested'] and again['run_id'] == summary['run_id']
+    assert again['errors'] == summary['errors']
+    reingested = ingest_bulk_job(job, output_dir, class_feedback=False, reingest=True)
+    assert reingested['run_id'] != summary['run_id']
+
+
+def test_class_feedback_errors_are_kept_with_the_run(cohort, monkeypatch):
+    essays_dir, output_dir = cohort
+    job = submit_bulk_job(essays_dir, str(REPO / "rubric" / "rubric1.md"), str(REPO / "feedback_guidance.md"),
+                          output_dir, use_cache=False, min_records=1, backend='local')
+    while refresh_bulk_job(job, output_dir).status != 'Completed':
+        pass
+
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("Model unavailable")
+
+    monkeypatch.setattr(batch_inference, 'generate_class_feedback', unavailable)
+    summary = ingest_bulk_job(job, output_dir, use_cache=False)
+    assert summary['errors'] == {'<class feedback>': "Model unavailable"}
+
+    again = ingest_bulk_job(BatchJob.load(job.job_name, output_dir), output_dir, use_cache=False)
+    assert again['already_ingested']
+    assert (again['errors'], again['failed']) == (summary['errors'], summary['failed'])
@@ -0,0 +1,61 @@
+import re
+
+import automarking
+import pytest
+
+from automarking import DigestTruncated, generate_feedback_digest, set_stop_reason, summarise_feedbacks
+
+ESSAY_NAME = re.compile(r"Essay: (\S+)")
+
+
+def fake_digest(max_essays: int):
+    """invoke_claude_sonnet stand-in whose digests are cut off when a chunk has more than `max_essays` essays"""
+    calls = []
+
+    def invoke(prompt, prefill="", **kwargs):
+        names = sorted(set(ESSAY_NAME.findall(prompt)))
+        calls.append((names, prefill))
+        if len(names) > max_essays:
+            set_stop_reason('max_tokens')
+            return "Bands\nEssay: " + names[0]
+        set_stop_reason('end_turn')
+        return "Bands\n" + "\n".join(f"Essay: {name} | Total: 5" for name in names)
+    return invoke, calls
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    monkeypatch.setattr(automarking, 'CLASS_FEEDBACK_TOKEN_BUDGET', 300)
+    monkeypatch.setattr(automarking, 'CLASS_DIGEST_CHUNK_TOKENS', 2000)
+
+
+def test_truncated_digest_is_continued_then_raised_and_not_cached(monkeypatch):
+    invoke, calls = fake_digest(max_essays=1)
+    monkeypatch.setattr(automarking, 'invoke_claude_sonnet', invoke)
+    chunk = "Essay: a\nGood.\n\n---\n\nEssay: b\nFine."
+    with pytest.raises(DigestTruncated):
+        generate_feedback_digest(chunk, "Rubric", use_cache=True)
+    assert len(calls) == 1 + automarking.CLASS_DIGEST_MAX_CONTINUATIONS
+    assert calls[-1][1]
+    assert automarking.feedback_cache.get(
+        automarking.digest_cache_key(chunk, "Rubric", {**automarking.DEFAULT_INFERENCE_PARAMS,
+                                                       "max_tokens": automarking.CLASS_DIGEST_MAX_TOKENS})) is None
+
+
+def test_summary_splits_chunks_whose_digest_is_cut_off(monkeypatch, small_budget):
+    invoke, _ = fake_digest(max_essays=2)
+    monkeypatch.setattr(automarking, 'invoke_claude_sonnet', invoke)
+    feedbacks = [{'name': f"essay{index}", 'feedback': "Detailed feedback. " * 40} for index in range(8)]
+    summary = summarise_feedbacks(feedbacks, "Rubric", use_cache=False)
+    for item in feedbacks:
+        assert f"Essay: {item['name']} | Total: 5" in summary
+
+
+def test_summary_keeps_a_part_that_cannot_be_condensed(monkeypatch, small_budget, caplog):
+    invoke, _ = fake_digest(max_essays=0)
+    monkeypatch.setattr(automarking, 'invoke_claude_sonnet', invoke)
+    feedbacks = [{'name': f"essay{index}", 'feedback': "Detailed feedback. " * 40} for index in range(3)]
+    summary = summarise_feedbacks(feedbacks, "Rubric", use_cache=False)
+    for item in feedbacks:
+        assert f"Essay: {item['name']}\n{item['feedback']}" in summary
+    assert "over CLASS_FEEDBACK_TOKEN_BUDGET" in caplog.text
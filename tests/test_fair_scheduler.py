@@ -0,0 +1,74 @@
+import threading
+import time
+
+from pathlib import Path
+
+from fair_scheduler import FairScheduler, flow_context
+from job_queue import JobQueue
+from marking_manifest import record_marked_essays
+from marking_worker import job_flow, submit_marking_job
+
+REPO = Path(__file__).resolve().parents[1]
+RUBRIC = (REPO / "rubric" / "rubric1.md").read_text()
+GUIDANCE = (REPO / "feedback_guidance.md").read_text()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for the scheduler"
+        time.sleep(0.001)
+
+
+def admission_order(scheduler, flows):
+    """Queue one call per (name, weight, essays) in `flows` behind a held slot and return the order they run in"""
+    order = []
+
+    def call(name, weight, essays):
+        with flow_context(name, weight, essays):
+            scheduler.acquire(100)
+            order.append(name)
+            scheduler.release()
+
+    with flow_context("holder"):
+        scheduler.acquire(100)
+        threads = []
+        for index, flow in enumerate(flows, 1):
+            threads.append(threading.Thread(target=call, args=flow))
+            threads[-1].start()
+            wait_until(lambda: sum(state.waiting for state in scheduler.flows.values()) == index)
+        scheduler.release()
+    for thread in threads:
+        thread.join()
+    return order
+
+
+def test_small_runs_are_admitted_before_large_ones():
+    scheduler = FairScheduler(1, small_job_essays=10, small_job_priority=True)
+    flows = [("large", 1.0, 300)] * 3 + [("small", 1.0, 3)]
+    assert admission_order(scheduler, flows) == ["small", "large", "large", "large"]
+
+
+def test_flows_share_admissions_by_weight():
+    scheduler = FairScheduler(1, small_job_priority=False)
+    flows = [("heavy", 2.0, 0)] * 6 + [("light", 1.0, 0)] * 6
+    assert admission_order(scheduler, flows)[:6] == ["heavy", "light", "heavy", "heavy", "light", "heavy"]
+
+
+def test_a_resubmitted_class_is_small_when_few_essays_changed(tmp_path):
+    essays = {f"essay{index:02d}.txt": f"Essay {index}." for index in range(30)}
+    marked = []
+    for name in essays:
+        feedback_path = tmp_path / f"{name}.feedback.txt"
+        feedback_path.write_text("Feedback.")
+        marked.append({'name': name, 'path': str(feedback_path)})
+    record_marked_essays(essays, RUBRIC, GUIDANCE, marked, str(tmp_path))
+
+    changed = dict(essays, **{"essay00.txt": "Essay 0, revised.", "essay01.txt": "Essay 1, revised."})
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job = queue.job(submit_marking_job(queue, changed, "rubric1", RUBRIC, GUIDANCE, output_dir=str(tmp_path)))
+    assert job['options']['essays_to_mark'] == 2
+    scheduler = FairScheduler(1, small_job_essays=10, small_job_priority=True)
+    with job_flow(job):
+        scheduler.acquire(100)
+    assert scheduler.snapshot()[0]['priority']
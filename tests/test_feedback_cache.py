@@ -0,0 +1,55 @@
+import automarking
+
+from automarking import class_cache_key, digest_cache_key, essay_cache_key, packed_cache_key
+from feedback_cache import FeedbackCache, make_cache_key
+
+PARAMS = {'temperature': 0.0, 'max_tokens': 2000}
+
+
+def test_make_cache_key_ignores_argument_order():
+    assert make_cache_key(a=1, b=[1, 2]) == make_cache_key(b=[1, 2], a=1)
+    assert make_cache_key(a=1) != make_cache_key(a=2)
+
+
+def test_essay_cache_key_is_stable():
+    key = essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS)
+    assert key == essay_cache_key("An essay.", "A rubric.", "Some guidance.", dict(PARAMS))
+    assert key != essay_cache_key("Another essay.", "A rubric.", "Some guidance.", PARAMS)
+    assert key != essay_cache_key("An essay.", "A rubric.", "Some guidance.", {**PARAMS, 'temperature': 0.5})
+    assert key != essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS, model_id='another-model')
+
+
+def test_essay_cache_key_ignores_prompt_caching_markers(monkeypatch):
+    key = essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS)
+    monkeypatch.setattr(automarking, 'BEDROCK_PROMPT_CACHING', not automarking.BEDROCK_PROMPT_CACHING)
+    assert essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS) == key
+
+
+def test_cache_keys_change_with_the_prompt_template(monkeypatch):
+    keys = (
+        essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS),
+        digest_cache_key("Feedback.", "A rubric.", PARAMS),
+        class_cache_key("Summary.", "A rubric.", "Table.", PARAMS),
+        packed_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS),
+    )
+    assert keys[3] != keys[0]
+    monkeypatch.setattr(automarking, 'build_essay_prompt', lambda *args: [{"type": "text", "text": "v2"}])
+    monkeypatch.setattr(automarking, 'build_digest_prompt', lambda *args: "v2")
+    monkeypatch.setattr(automarking, 'build_class_prompt', lambda *args: "v2")
+    monkeypatch.setattr(automarking, 'build_packed_essay_prompt', lambda *args: [{"type": "text", "text": "v2"}])
+    assert essay_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS) != keys[0]
+    assert digest_cache_key("Feedback.", "A rubric.", PARAMS) != keys[1]
+    assert class_cache_key("Summary.", "A rubric.", "Table.", PARAMS) != keys[2]
+    assert packed_cache_key("An essay.", "A rubric.", "Some guidance.", PARAMS) != keys[3]
+
+
+def test_feedback_cache_round_trip_and_eviction(tmp_path):
+    cache = FeedbackCache(str(tmp_path), max_bytes=400)
+    cache.set('aa' * 32, "first")
+    assert cache.get('aa' * 32) == "first"
+    assert cache.get('bb' * 32) is None
+    for index in range(10):
+        cache.set(f"{index:02d}" * 32, "x" * 50)
+    assert cache.get('aa' * 32) is None
+    assert cache.evictions > 0
+    assert FeedbackCache(str(tmp_path), max_bytes=400).get('09' * 32) == "x" * 50
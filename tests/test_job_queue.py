@@ -0,0 +1,54 @@
+from job_queue import JobQueue
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def test_heartbeat_stops_renewing_a_task_past_its_deadline(tmp_path):
+    clock = FakeClock()
+    queue = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=30, task_deadline_seconds=50, clock=clock)
+    job_id = queue.submit({'hung.txt': "Essay."}, "Rubric", "Guidance")
+    _, tasks = queue.lease("worker-a")
+    assert [task['essay_name'] for task in tasks] == ['hung.txt']
+
+    # Renewed while within its deadline, so another worker cannot take it
+    clock.advance(20)
+    assert queue.heartbeat("worker-a") == 0
+    clock.advance(20)
+    assert queue.heartbeat("worker-a") == 0
+    clock.advance(20)
+    assert queue.lease("worker-b") == (None, [])
+
+    # Past the deadline the lease lapses even though worker-a keeps beating
+    assert queue.heartbeat("worker-a") == 1
+    clock.advance(11)
+    job, tasks = queue.lease("worker-b")
+    assert job['id'] == job_id
+    assert [(task['essay_name'], task['attempts']) for task in tasks] == [('hung.txt', 2)]
+
+    # The first result recorded wins
+    assert queue.complete(tasks[0]['id'], {'name': 'hung.txt', 'feedback': "Late."})
+    assert not queue.complete(tasks[0]['id'], {'name': 'hung.txt', 'feedback': "Later."})
+
+
+def test_expired_leases_are_failed_after_max_attempts(tmp_path):
+    clock = FakeClock()
+    queue = JobQueue(str(tmp_path / "jobs.db"), lease_seconds=30, max_attempts=2, clock=clock)
+    job_id = queue.submit({'crashes.txt': "Essay."}, "Rubric", "Guidance")
+    for attempt in (1, 2):
+        _, tasks = queue.lease(f"worker-{attempt}")
+        assert [task['attempts'] for task in tasks] == [attempt]
+        clock.advance(31)
+
+    assert queue.lease("worker-3") == (None, [])
+    _, records, errors = queue.results(job_id)
+    assert records == [] and errors == {'crashes.txt': "Lease expired"}
+    assert queue.unfinalized_jobs() == [job_id]
@@ -0,0 +1,119 @@
+from pathlib import Path
+
+import automarking
+import pytest
+
+from async_marking import mark_essays_on_event_loop
+from automarking import estimate_tokens, feedback_cache, mark_essays
+from fake_bedrock import FakeBedrockClient, FakeBedrockConfig
+from metrics import RunMetrics, record_run
+from rate_limiter import RateLimitedClient, RateLimiter
+
+REPO = Path(__file__).resolve().parents[1]
+RUBRIC = (REPO / "rubric" / "rubric1.md").read_text()
+GUIDANCE = (REPO / "feedback_guidance.md").read_text()
+ESSAYS = {f"essay{index}.txt": f"Essay {index}. " + "Climate change affects every region differently. " * 20
+          for index in range(4)}
+
+
+def test_marks_saves_and_scores_every_essay_then_serves_them_from_the_cache(tmp_path):
+    progress = []
+    records, errors = mark_essays(ESSAYS, RUBRIC, GUIDANCE, max_workers=2, output_dir=str(tmp_path),
+                                  on_complete=lambda *args: progress.append(args))
+    assert errors == {}
+    assert [item['name'] for item in records] == list(ESSAYS)
+    assert [completed for completed, *_ in progress] == [1, 2, 3, 4]
+    for item in records:
+        assert item['feedback'] and "<scores>" not in item['feedback']
+        assert item['scores']['criteria']
+        assert item['model'] == automarking.BEDROCK_LARGE_MODEL_ID
+        assert Path(item['path']).read_text() == item['feedback']
+
+    hits = feedback_cache.hits
+    cached, errors = mark_essays(ESSAYS, RUBRIC, GUIDANCE, max_workers=2, output_dir=str(tmp_path))
+    assert errors == {}
+    assert feedback_cache.hits == hits + len(ESSAYS)
+    assert [item['feedback'] for item in cached] == [item['feedback'] for item in records]
+
+
+def test_streamed_essays_deliver_every_chunk(tmp_path):
+    deltas = {}
+    records, errors = mark_essays(iter(ESSAYS.items()), RUBRIC, GUIDANCE, max_workers=4, output_dir=str(tmp_path),
+                                  use_cache=False, on_delta=lambda name, text: deltas.setdefault(name, []).append(text))
+    assert errors == {}
+    assert sorted(item['name'] for item in records) == sorted(ESSAYS)
+    for item in records:
+        assert len(deltas[item['name']]) > 1
+        assert ''.join(deltas[item['name']]).startswith(item['feedback'][:200])
+
+
+def test_planned_max_tokens_are_continued_to_the_full_feedback(tmp_path):
+    essay_name = next(iter(ESSAYS))
+    records, errors = mark_essays({essay_name: ESSAYS[essay_name]}, RUBRIC, GUIDANCE, output_dir=str(tmp_path),
+                                  use_cache=False, max_tokens={essay_name: 100})
+    assert errors == {}
+    assert estimate_tokens(records[0]['feedback']) > 300
+    assert records[0]['scores']['source'] == 'json'
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_planned_max_tokens_are_continued_on_the_event_loop(tmp_path, stream):
+    essay_name = next(iter(ESSAYS))
+    records, errors = mark_essays_on_event_loop({essay_name: ESSAYS[essay_name]}, RUBRIC, GUIDANCE,
+                                                output_dir=str(tmp_path), use_cache=False,
+                                                on_delta=(lambda name, text: None) if stream else None,
+                                                max_tokens={essay_name: 100})
+    assert errors == {}
+    assert estimate_tokens(records[0]['feedback']) > 300
+    assert records[0]['scores']['source'] == 'json'
+
+
+def test_event_loop_rejects_packing_and_fanout(tmp_path):
+    with pytest.raises(ValueError):
+        mark_essays_on_event_loop(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path), pack=True)
+    with pytest.raises(ValueError):
+        mark_essays_on_event_loop(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path), fanout=True)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_failed_essays_are_reported_not_raised(tmp_path, monkeypatch, stream):
+    failing = FakeBedrockClient(FakeBedrockConfig(latency_median=0.001, failure_rate=1.0,
+                                                  failure_code='ValidationException'))
+    monkeypatch.setattr(automarking, 'bedrock_runtime', RateLimitedClient(failing, RateLimiter(max_concurrency=4)))
+    records, errors = mark_essays(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path), use_cache=False,
+                                  on_delta=(lambda name, text: None) if stream else None)
+    assert records == []
+    assert sorted(errors) == sorted(ESSAYS)
+    assert all('ValidationException' in error for error in errors.values())
+
+
+def test_fake_backend_feedback_is_kept_out_of_the_real_cache():
+    assert automarking.BEDROCK_BACKEND == 'fake'
+    assert str(feedback_cache.cache_dir) == f"{automarking.FEEDBACK_CACHE_DIR}-fake"
+
+
+def test_uncached_runs_do_not_write_to_the_cache(tmp_path):
+    essays = {"uncached.txt": "An essay that is only marked with the cache off. " * 20}
+    records, errors = mark_essays(essays, RUBRIC, GUIDANCE, output_dir=str(tmp_path), use_cache=False)
+    assert errors == {}
+    params = {**automarking.DEFAULT_INFERENCE_PARAMS, "max_tokens": automarking.ESSAY_MAX_TOKENS}
+    assert feedback_cache.get(automarking.essay_cache_key(essays["uncached.txt"], RUBRIC, GUIDANCE, params)) is None
+
+
+def test_packed_feedback_is_cached_apart_from_single_essay_feedback(tmp_path):
+    essays = {f"packed{index}.txt": f"Packed essay {index}. " + "Homework should be optional. " * 15
+              for index in range(3)}
+    params = {**automarking.DEFAULT_INFERENCE_PARAMS, "max_tokens": automarking.ESSAY_MAX_TOKENS}
+
+    def calls(**kwargs):
+        with record_run(RunMetrics()) as run:
+            records, errors = mark_essays(essays, RUBRIC, GUIDANCE, output_dir=str(tmp_path), **kwargs)
+        assert errors == {} and all(item['scores']['criteria'] for item in records)
+        return sorted(record.kind for record in run.records())
+
+    assert calls(pack=True) == ['packed']
+    for essay_text in essays.values():
+        assert feedback_cache.get(automarking.packed_cache_key(essay_text, RUBRIC, GUIDANCE, params)) is not None
+        assert feedback_cache.get(automarking.essay_cache_key(essay_text, RUBRIC, GUIDANCE, params)) is None
+    assert calls(pack=True) == []
+    assert calls() == ['essay'] * len(essays)
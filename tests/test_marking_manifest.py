@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from automarking import mark_essays
+from marking_manifest import MarkingManifest, mark_essays_incremental
+
+REPO = Path(__file__).resolve().parents[1]
+RUBRIC = (REPO / "rubric" / "rubric1.md").read_text()
+GUIDANCE = (REPO / "feedback_guidance.md").read_text()
+ESSAYS = {f"essay{index}.txt": f"Essay {index}. " + "Renewable energy changes how cities grow. " * 20
+          for index in range(3)}
+
+
+def counting_mark(calls):
+    def mark(essays, *args, **kwargs):
+        essays = dict(essays)
+        calls.append(sorted(essays))
+        return mark_essays(essays, *args, **kwargs)
+    return mark
+
+
+def test_unchanged_essays_are_reused_and_changed_ones_re_marked(tmp_path):
+    calls = []
+    records, errors, reused = mark_essays_incremental(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path),
+                                                      mark=counting_mark(calls), use_cache=False)
+    assert errors == {} and reused == 0
+    assert calls == [sorted(ESSAYS)]
+    assert sorted(MarkingManifest(str(tmp_path)).essays) == sorted(ESSAYS)
+
+    changed = dict(ESSAYS, **{"essay1.txt": ESSAYS["essay1.txt"] + " A new closing paragraph."})
+    again, errors, reused = mark_essays_incremental(changed, RUBRIC, GUIDANCE, output_dir=str(tmp_path),
+                                                    mark=counting_mark(calls), use_cache=False)
+    assert errors == {} and reused == 2
+    assert calls[-1] == ["essay1.txt"]
+    assert [item['name'] for item in again] == list(ESSAYS)
+    assert again[0]['feedback'] == records[0]['feedback']
+
+
+def test_force_bypasses_manifest_reuse(tmp_path):
+    calls = []
+    mark_essays_incremental(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path),
+                            mark=counting_mark(calls), use_cache=False)
+    records, errors, reused = mark_essays_incremental(ESSAYS, RUBRIC, GUIDANCE, output_dir=str(tmp_path), force=True,
+                                                      mark=counting_mark(calls), use_cache=False)
+    assert errors == {} and reused == 0
+    assert calls == [sorted(ESSAYS), sorted(ESSAYS)]
+    assert [item['name'] for item in records] == list(ESSAYS)
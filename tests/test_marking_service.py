@@ -0,0 +1,37 @@
+import marking_service
+import pytest
+
+from marking_service import MARKING_SERVICE_MAX_WEIGHT, BadRequest, essay_stream, request_weight
+
+ESSAY = {'essayName': 'essay.txt', 'essayText': "An essay about rivers."}
+
+
+def flight_key(monkeypatch, essay):
+    keys = []
+    monkeypatch.setattr(marking_service.flights, 'stream', lambda key, generate: (keys.append(key), False))
+    essay_stream(essay, "# Rubric", "Guidance.", use_cache=True)
+    return keys[0]
+
+
+def test_single_flight_key_includes_the_planned_max_tokens(monkeypatch):
+    fixed = flight_key(monkeypatch, ESSAY)
+    planned = flight_key(monkeypatch, {**ESSAY, 'maxTokens': 800})
+    assert planned != fixed
+    assert flight_key(monkeypatch, {**ESSAY, 'maxTokens': 800}) == planned
+    # A limit at or above ESSAY_MAX_TOKENS makes the same call as no limit
+    assert flight_key(monkeypatch, {**ESSAY, 'maxTokens': 100000}) == fixed
+
+
+@pytest.mark.parametrize('max_tokens', [0, -5, "800", 1.5, True])
+def test_invalid_max_tokens_are_rejected(monkeypatch, max_tokens):
+    with pytest.raises(BadRequest):
+        flight_key(monkeypatch, {**ESSAY, 'maxTokens': max_tokens})
+
+
+def test_request_weight_is_capped():
+    assert request_weight(None) is None
+    assert request_weight("2") == 2.0
+    assert request_weight("1e9") == MARKING_SERVICE_MAX_WEIGHT
+    for header in ("heavy", "nan", "inf", "0", "-1"):
+        with pytest.raises(BadRequest):
+            request_weight(header)
@@ -0,0 +1,76 @@
+import json
+import threading
+
+from pathlib import Path
+
+from automarking import METRICS_DIR, call_metrics, mark_essays
+from job_queue import JobQueue
+from marking_worker import MarkingWorker, submit_marking_job
+from metrics import RunMetrics, record_run
+
+REPO = Path(__file__).resolve().parents[1]
+RUBRIC = (REPO / "rubric" / "rubric1.md").read_text()
+GUIDANCE = (REPO / "feedback_guidance.md").read_text()
+
+
+def essays(prefix):
+    return {f"{prefix}{index}.txt": f"{prefix} essay {index}. " + "Public transport shapes a city. " * 20
+            for index in range(3)}
+
+
+def test_overlapping_runs_record_only_their_own_calls(tmp_path):
+    runs = {prefix: RunMetrics(prefix) for prefix in ("first", "second")}
+    both_started = threading.Barrier(2)
+    failures = []
+
+    def mark(prefix):
+        try:
+            with record_run(runs[prefix]):
+                both_started.wait(timeout=5)
+                _, errors = mark_essays(essays(prefix), RUBRIC, GUIDANCE, max_workers=3,
+                                        output_dir=str(tmp_path / prefix), use_cache=False)
+                failures.extend(errors.values())
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=mark, args=(prefix,)) for prefix in runs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == []
+
+    for prefix, run in runs.items():
+        assert sorted(record.essay for record in run.records()) == sorted(essays(prefix))
+        assert run.summary()['essay']['calls'] == 3
+        paths = run.export(str(tmp_path / "metrics"))
+        trace = [json.loads(line) for line in Path(paths['trace']).read_text().splitlines()]
+        assert sorted(record['essay'] for record in trace) == sorted(essays(prefix))
+        assert Path(paths['prometheus']).name == f"run-{prefix}.prom"
+
+    recent = {record.essay for record in call_metrics.records()}
+    assert set(essays("first")) | set(essays("second")) <= recent
+
+
+def test_calls_outside_a_run_are_only_recorded_for_the_process(tmp_path):
+    run = RunMetrics()
+    with record_run(run):
+        pass
+    mark_essays(essays("outside"), RUBRIC, GUIDANCE, output_dir=str(tmp_path), use_cache=False)
+    assert run.records() == [] and run.summary() == {}
+    assert "outside0.txt" in {record.essay for record in call_metrics.records()}
+
+
+def test_a_worker_exports_each_job_on_its_own(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    job_ids = {prefix: submit_marking_job(queue, essays(prefix), "rubric1", RUBRIC, GUIDANCE,
+                                          output_dir=str(tmp_path / prefix), use_cache=False, class_feedback=False)
+               for prefix in ("worker-first", "worker-second")}
+    worker = MarkingWorker(queue, worker_id="test:1", concurrency=2, poll_interval=0.01, exit_when_idle=0.1)
+    worker.run()
+
+    for prefix, job_id in job_ids.items():
+        assert queue.job(job_id)['status'] == 'done'
+        trace = Path(METRICS_DIR) / f"run-job-{job_id}-test-1.jsonl"
+        names = [json.loads(line)['essay'] for line in trace.read_text().splitlines()]
+        assert sorted(names) == sorted(essays(prefix))
@@ -0,0 +1,59 @@
+import json
+
+import model_router
+
+from model_router import CascadePolicy, ModelRouter
+from scoring import parse_rubric
+
+RUBRIC = ("# Rubric\n\n## 1. Content\n- **Band 2** (6-10 points): Strong\n- **Band 1** (1-5 points): Weak\n"
+          "- **Band 0** (0 points): None\n")
+
+
+def counting_estimate(monkeypatch, confidence: float, band: int = 2, points: float = 8):
+    calls = []
+
+    def invoke(prompt, **kwargs):
+        calls.append(prompt)
+        return json.dumps({"criteria": [{"criterion": "Content", "band": band, "points": points}],
+                           "confidence": confidence})
+    monkeypatch.setattr(model_router, 'invoke_claude_sonnet', invoke)
+    return calls
+
+
+def test_estimates_are_cached_so_routing_a_marked_essay_costs_no_call(monkeypatch):
+    calls = counting_estimate(monkeypatch, confidence=0.95)
+    router = ModelRouter(RUBRIC, use_cache=True)
+    first = router("essay", "A cached essay about routing.")
+    assert router("essay", "A cached essay about routing.") == first == router.small_model_id
+    assert len(calls) == 1
+    assert ModelRouter(RUBRIC, use_cache=True)("essay", "A cached essay about routing.") == first
+    assert len(calls) == 1
+
+
+def test_policy_applies_to_cached_estimates_and_no_cache_re_estimates(monkeypatch):
+    calls = counting_estimate(monkeypatch, confidence=0.5)
+    essay = "An uncertain essay about routing."
+    assert ModelRouter(RUBRIC, use_cache=True)("essay", essay) == model_router.BEDROCK_LARGE_MODEL_ID
+    lenient = ModelRouter(RUBRIC, policy=model_router.CascadePolicy(min_confidence=0.4), use_cache=True)
+    assert lenient("essay", essay) == model_router.BEDROCK_SMALL_MODEL_ID
+    assert len(calls) == 1
+    ModelRouter(RUBRIC, use_cache=False)("essay", essay)
+    assert len(calls) == 2
+
+
+def test_rubric_fixture_has_band_ranges():
+    (criterion,) = parse_rubric(RUBRIC)
+    assert criterion.bands == {2: (6, 10), 1: (1, 5), 0: (0, 0)}
+
+
+def test_borderline_and_policy_bands_are_escalated(monkeypatch):
+    counting_estimate(monkeypatch, confidence=0.95, band=2, points=6.5)
+    router = ModelRouter(RUBRIC, use_cache=False)
+    assert router("borderline", "A borderline essay.") == model_router.BEDROCK_LARGE_MODEL_ID
+    assert router.decisions["borderline"]['reason'] == "Content borderline at 6.5 points"
+
+    counting_estimate(monkeypatch, confidence=0.95, band=1, points=3)
+    assert router("clear", "A clear-cut essay.") == model_router.BEDROCK_SMALL_MODEL_ID
+    strict = ModelRouter(RUBRIC, policy=CascadePolicy(escalate_bands=frozenset({1})), use_cache=False)
+    assert strict("reviewed", "A clear-cut essay.") == model_router.BEDROCK_LARGE_MODEL_ID
+    assert strict.decisions["reviewed"]['reason'] == "band 1 requires review"
@@ -0,0 +1,45 @@
+import near_duplicates
+import pytest
+
+from near_duplicates import NearDuplicateIndex, mark_essays_with_reuse
+
+WORDS = [f"word{index}" for index in range(200)]
+
+
+def variant(every: int) -> str:
+    """The base essay with every `every`-th word replaced"""
+    return ' '.join(f"changed{index}" if every and index % every == 0 else word for index, word in enumerate(WORDS))
+
+
+def stub_mark(marked):
+    def mark(essays, rubric_text, feedback_guidance, on_complete=None, **kwargs):
+        marked.extend(essays)
+        return [{'name': name, 'feedback': f"Feedback for {name}", 'scores': {}, 'model': 'stub'}
+                for name in essays], {}
+    return mark
+
+
+@pytest.mark.parametrize('mode', ['reuse', 'adapt'])
+def test_only_near_identical_essays_reuse_feedback_verbatim(tmp_path, monkeypatch, mode):
+    adapted = []
+    monkeypatch.setattr(near_duplicates, 'invoke_claude_sonnet',
+                        lambda prompt, **kwargs: adapted.append(prompt) or "Adapted feedback")
+    index = NearDuplicateIndex(str(tmp_path / "index.db"))
+    essays = {'base': variant(0), 'identical': variant(100), 'similar': variant(20)}
+    marked = []
+    records, errors = mark_essays_with_reuse(essays, "Rubric", "Guidance", index, mode=mode,
+                                             output_dir=str(tmp_path), mark=stub_mark(marked))
+    by_name = {item['name']: item for item in records}
+    assert errors == {}
+    assert by_name['identical']['duplicate_of'] == 'base'
+    assert by_name['identical']['feedback'] == "Feedback for base"
+    if mode == 'reuse':
+        # Similar, but below NEAR_DUPLICATE_REUSE_THRESHOLD: marked rather than given another essay's feedback
+        assert marked == ['base', 'similar']
+        assert 'duplicate_of' not in by_name['similar']
+        assert adapted == []
+    else:
+        assert marked == ['base']
+        assert by_name['similar']['duplicate_of'] == 'base'
+        assert by_name['similar']['feedback'] == "Adapted feedback"
+        assert len(adapted) == 1
@@ -0,0 +1,187 @@
+import gc
+import threading
+import time
+
+import automarking
+import pytest
+
+from automarking import mark_essays
+from botocore.exceptions import ClientError
+from fair_scheduler import FairScheduler, flow_context
+from fake_bedrock import FakeBedrockClient, FakeBedrockConfig
+from rate_limiter import AIMDLimiter, RateLimitedClient, RateLimiter
+
+RUBRIC = "# Rubric\n\n## 1. Content\nRelevant and accurate.\n\n## 2. Style\nClear and fluent.\n"
+
+
+def client_error(code: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'InvokeModel')
+
+
+class PeakSleep:
+    """Sleep function for the fake backend that records the most calls sleeping at once"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, seconds: float):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(seconds)
+        with self._lock:
+            self.in_flight -= 1
+
+
+def test_aimd_halves_on_throttles_and_grows_back_additively():
+    limiter = AIMDLimiter(8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release()
+    assert 4.9 < limiter.limit < 5
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 8
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.limit == limiter.min_limit == 1
+    assert limiter.in_flight == 0
+
+
+def test_reserve_raises_the_limit_up_to_the_ceiling():
+    limiter = AIMDLimiter(8, ceiling=40)
+    with limiter.reserve(32):
+        assert limiter.max_limit == limiter.limit == 32
+        with limiter.reserve(32):
+            assert limiter.max_limit == limiter.limit == 40
+        assert limiter.max_limit == limiter.limit == 32
+    assert limiter.max_limit == limiter.limit == 8
+    # Without a ceiling the limit is fixed
+    fixed = AIMDLimiter(8)
+    with fixed.reserve(32):
+        assert fixed.limit == 8
+
+
+def test_retries_throttles_and_releases_every_slot():
+    limiter = RateLimiter(max_concurrency=4, sleep=lambda seconds: None)
+    failures = [client_error('ThrottlingException'), client_error('ServiceUnavailableException')]
+
+    def call():
+        if failures:
+            raise failures.pop(0)
+        return 'ok'
+
+    assert limiter.call(call) == 'ok'
+    stats = limiter.last_call_stats()
+    assert (stats.attempts, stats.throttles, stats.error) == (3, 1, "")
+    assert limiter.concurrency.in_flight == 0
+    # Halved by the throttle, then +1/limit for each of the other two attempts
+    assert limiter.concurrency.limit == pytest.approx(2.9)
+
+
+def test_non_retryable_errors_are_raised_and_release_the_slot():
+    limiter = RateLimiter(max_concurrency=4, sleep=lambda seconds: None)
+
+    def call():
+        raise client_error('ValidationException')
+
+    with pytest.raises(ClientError):
+        limiter.call(call)
+    assert limiter.last_call_stats().attempts == 1
+    assert limiter.last_call_stats().error == 'ValidationException'
+    assert limiter.concurrency.in_flight == 0
+
+
+def test_retries_stop_at_max_retries():
+    limiter = RateLimiter(max_concurrency=4, max_retries=2, sleep=lambda seconds: None)
+
+    def call():
+        raise client_error('ThrottlingException')
+
+    with pytest.raises(ClientError):
+        limiter.call(call)
+    assert limiter.last_call_stats().attempts == 3
+    assert limiter.concurrency.in_flight == 0
+
+
+def stream_client(scheduler=None):
+    limiter = RateLimiter(max_concurrency=4, scheduler=scheduler)
+    backend = FakeBedrockClient(FakeBedrockConfig(latency_median=0.001, latency_sigma=0, tokens_per_second=1e6))
+    return RateLimitedClient(backend, limiter)
+
+
+def open_stream(client):
+    return client.invoke_model_with_response_stream(
+        modelId='model', body='{"messages": [{"role": "user", "content": "Hello"}], "max_tokens": 50}')['body']
+
+
+def test_stream_releases_its_slot_when_exhausted_or_closed():
+    client = stream_client()
+    stream = open_stream(client)
+    assert client.limiter.concurrency.in_flight == 1
+    list(stream)
+    stream.close()
+    assert client.limiter.concurrency.in_flight == 0
+
+    with open_stream(client) as stream:
+        next(stream)
+    assert client.limiter.concurrency.in_flight == 0
+
+
+def test_abandoned_stream_releases_its_slot_in_its_own_flow():
+    scheduler = FairScheduler(4)
+    client = stream_client(scheduler)
+    with flow_context("abandoned"):
+        stream = open_stream(client)
+        next(stream)
+    assert scheduler.flows["abandoned"].in_flight == 1
+    del stream
+    gc.collect()
+    assert client.limiter.concurrency.in_flight == 0
+    assert scheduler.in_flight == 0
+    assert scheduler.flows["abandoned"].in_flight == 0
+
+
+def test_mark_essays_gets_as_many_calls_in_flight_as_workers(tmp_path, monkeypatch):
+    sleep = PeakSleep()
+    scheduler = FairScheduler(4, ceiling=64)
+    limiter = RateLimiter(scheduler=scheduler)
+    backend = FakeBedrockClient(FakeBedrockConfig(latency_median=0.2, latency_sigma=0, tokens_per_second=1e6),
+                                sleep=sleep)
+    monkeypatch.setattr(automarking, 'bedrock_runtime', RateLimitedClient(backend, limiter))
+
+    essays = {f"essay{index}": f"Essay number {index}." for index in range(16)}
+    records, errors = mark_essays(essays, RUBRIC, "Guidance.", max_workers=16, output_dir=str(tmp_path),
+                                  use_cache=False)
+    assert not errors and len(records) == 16
+    assert sleep.peak == 16
+    assert limiter.concurrency.max_limit == scheduler.max_limit == 4
+
+
+def test_scheduler_is_the_only_admission_point_and_throttles_shrink_its_window():
+    scheduler = FairScheduler(4, ceiling=64)
+    limiter = RateLimiter(max_concurrency=2, scheduler=scheduler, sleep=lambda seconds: None)
+    assert limiter.concurrency is scheduler
+    failures = [client_error('ThrottlingException')]
+
+    def call():
+        if failures:
+            raise failures.pop(0)
+        assert scheduler.in_flight == 1
+        return 'ok'
+
+    with flow_context("throttled"):
+        assert limiter.call(call) == 'ok'
+    # Halved by the throttle, then +1/limit for the successful attempt
+    assert scheduler.limit == pytest.approx(2.5)
+    assert scheduler.in_flight == 0
+    assert limiter.stats()['concurrency_limit'] == 2.5
+    with limiter.reserve(32):
+        assert scheduler.max_limit == 32
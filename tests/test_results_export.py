@@ -0,0 +1,63 @@
+import csv
+import json
+import os
+import pytest
+import zipfile
+
+from results_export import export_latest_run, export_run
+from results_store import ResultsStore
+
+SCORES = {'total': 14.0, 'criteria': {'Content': {'band': 3, 'points': 8.0}, 'Language': {'band': 2, 'points': 6.0}}}
+
+
+def stored_run(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.db"))
+    run_id = store.create_run("rubric1", "# Rubric", "Be kind", metadata={
+        'errors': {'broken.txt': "Throttled", '<class feedback>': "Timed out"},
+        'near_duplicates': {'copy.txt': 'original.txt'},
+    })
+    store.add_feedbacks(run_id, [
+        {'name': 'original.txt', 'feedback': "Clear argument.", 'model': "large", 'seconds': 1.5, 'scores': SCORES},
+        {'name': 'copy.txt', 'feedback': "Same argument.", 'model': "large", 'seconds': 0.1, 'scores': SCORES},
+    ])
+    store.set_class_feedback(run_id, "The class argued well.", "| Criterion | Mean |")
+    return store, run_id
+
+
+def test_export_writes_the_archive_and_consolidated_results(tmp_path):
+    store, run_id = stored_run(tmp_path)
+    paths = export_run(store, run_id, str(tmp_path / "exports"))
+    store.close()
+
+    with zipfile.ZipFile(paths['zip']) as archive:
+        assert sorted(archive.namelist()) == [
+            "class_overall.feedback.md", "class_statistics.md", "feedback/copy.feedback.txt",
+            "feedback/original.feedback.txt", "results.csv", "results.jsonl", "run.json",
+        ]
+        assert archive.read("feedback/original.feedback.txt").decode() == "Clear argument."
+        assert archive.read("class_overall.feedback.md").decode() == "The class argued well."
+        assert json.loads(archive.read("run.json"))['essays'] == 2
+        assert archive.read("results.jsonl").decode() == open(paths['jsonl'], encoding='utf-8').read()
+
+    rows = [json.loads(line) for line in open(paths['jsonl'], encoding='utf-8')]
+    assert [(row['name'], row['status']) for row in rows] == [
+        ('original.txt', 'ok'), ('copy.txt', 'ok'), ('broken.txt', 'failed')]
+    assert rows[0]['scores'] == SCORES and rows[0]['bands'] == "Content: 3; Language: 2"
+    assert rows[1]['duplicate_of'] == 'original.txt'
+    assert rows[2]['error'] == "Throttled"
+
+    with open(paths['csv'], encoding='utf-8', newline='') as f:
+        table = list(csv.DictReader(f))
+    assert [row['name'] for row in table] == ['original.txt', 'copy.txt', 'broken.txt']
+    assert table[0]['total_points'] == '14.0' and table[0]['feedback_file'] == "feedback/original.feedback.txt"
+    assert 'scores' not in table[0]
+    assert [name for name in os.listdir(tmp_path / "exports") if name.endswith('.tmp')] == []
+
+
+def test_export_latest_run_and_unknown_runs(tmp_path):
+    store, run_id = stored_run(tmp_path)
+    with pytest.raises(ValueError):
+        export_run(store, run_id + 1, str(tmp_path / "exports"))
+    store.close()
+    paths = export_latest_run(str(tmp_path / "results.db"), str(tmp_path / "exports"))
+    assert paths['zip'].endswith(f"run-{run_id}.zip") and os.path.exists(paths['zip'])
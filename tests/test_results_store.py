@@ -0,0 +1,59 @@
+from results_store import ResultsStore
+
+
+def make_store(tmp_path):
+    return ResultsStore(str(tmp_path / "results.db"))
+
+
+def test_essays_are_deduplicated_by_name_and_content(tmp_path):
+    store = make_store(tmp_path)
+    ids = store.add_essays({"a.txt": "First essay", "b.txt": "Second essay"})
+    assert store.add_essays({"a.txt": "First essay"}) == {"a.txt": ids["a.txt"]}
+    edited = store.add_essays({"a.txt": "First essay, edited"})
+    assert edited["a.txt"] != ids["a.txt"]
+    assert store.get_essay_texts(ids) == {"a.txt": "First essay", "b.txt": "Second essay"}
+    assert store.get_essay_text(edited["a.txt"]) == "First essay, edited"
+    store.close()
+
+
+def test_runs_keep_metadata_and_class_feedback(tmp_path):
+    store = make_store(tmp_path)
+    assert store.latest_run_id() is None and store.get_run(None) == {}
+    run_id = store.create_run("rubric1", "# Rubric", "Be kind", metadata={'errors': {}, 'reused': 2})
+    store.set_class_feedback(run_id, "The class did well.", "| Criterion | Mean |")
+    run = store.get_run(run_id)
+    assert store.latest_run_id() == run_id
+    assert run['rubric_name'] == "rubric1"
+    assert run['metadata'] == {'errors': {}, 'reused': 2}
+    assert run['class_feedback'] == "The class did well."
+    assert run['class_statistics'] == "| Criterion | Mean |"
+    store.close()
+
+
+def test_feedback_is_paged_searched_and_loaded_on_demand(tmp_path):
+    store = make_store(tmp_path)
+    essays = {f"essay_{index:02d}.txt": f"Essay {index}" for index in range(12)}
+    essays["100%_done.txt"] = "Escaped wildcard"
+    essay_ids = store.add_essays(essays)
+    run_id = store.create_run("rubric1", "# Rubric", "Be kind")
+    store.add_feedbacks(run_id, [{'name': name, 'feedback': f"Feedback on {name}", 'model': "large",
+                                  'scores': {'total': float(index)}}
+                                 for index, name in enumerate(essays)], essay_ids)
+
+    assert store.count_feedback(run_id) == len(essays)
+    assert store.count_feedback(None) == 0 and store.list_feedback(None) == []
+    first_page = store.list_feedback(run_id, limit=5)
+    second_page = store.list_feedback(run_id, limit=5, offset=5)
+    names = [name for _, name, _ in first_page + second_page]
+    assert names == sorted(essays)[:10]
+    assert store.count_feedback(run_id, search="essay_1") == 2
+    assert [name for _, name, _ in store.list_feedback(run_id, search="%")] == ["100%_done.txt"]
+    assert store.count_feedback(run_id, search="essay_") == 12
+
+    feedback_id, name, total = first_page[1]
+    record = store.get_feedback(feedback_id)
+    assert record['name'] == name and record['feedback'] == f"Feedback on {name}"
+    assert record['scores'] == {'total': total} and record['model'] == "large"
+    assert [item['name'] for item in store.iter_feedback(run_id)] == list(essays)
+    assert store.get_feedback(-1) == {}
+    store.close()
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from automarking import class_statistics_table
+from pathlib import Path
+from scoring import class_statistics, extract_scores, parse_rubric
+
+RUBRIC = (Path(__file__).resolve().parents[1] / "rubric" / "rubric1.md").read_text()
+CRITERIA = [criterion.name for criterion in parse_rubric(RUBRIC)]
+
+
+def scores_block(bands):
+    return "<scores>" + json.dumps({"criteria": [{"criterion": name, "band": band, "points": 1}
+                                                 for name, band in zip(CRITERIA, bands)]}) + "</scores>"
+
+
+def test_extracts_bands_from_the_scores_block():
+    feedback, record = extract_scores("Good work.\n" + scores_block([3] * len(CRITERIA)), RUBRIC)
+    assert feedback == "Good work."
+    assert record['source'] == 'json'
+    assert [record['criteria'][name]['band'] for name in CRITERIA] == [3] * len(CRITERIA)
+
+
+@pytest.mark.parametrize('band', [-1, 9, "high"])
+def test_bands_not_in_the_rubric_are_dropped(band):
+    _, record = extract_scores("Feedback.\n" + scores_block([band] + [2] * (len(CRITERIA) - 1)), RUBRIC)
+    assert CRITERIA[0] not in record['criteria']
+    assert record['total'] is None
+    _, record = extract_scores(f"{CRITERIA[0]}: Band {9 if band == 9 else 7}", RUBRIC)
+    assert record['criteria'] == {}
+
+
+def test_class_statistics_ignore_out_of_range_client_scores():
+    records = [
+        {'criteria': {CRITERIA[0]: {'band': 4, 'points': 1}}},
+        {'criteria': {CRITERIA[0]: {'band': -1, 'points': 1}}},
+        {'criteria': {CRITERIA[0]: {'band': 9, 'points': "many"}}},
+        {'criteria': "not a mapping"},
+    ]
+    statistics = class_statistics(records, RUBRIC)
+    first = statistics['criteria'][CRITERIA[0]]
+    assert first['band']['count'] == 1 and first['band']['mean'] == 4
+    assert sum(first['band_histogram'].values()) == 1
+    table = class_statistics_table([{'name': f"e{index}", 'feedback': "", 'scores': record}
+                                    for index, record in enumerate(records)] + [{'scores': "bad"}], RUBRIC)
+    assert CRITERIA[0] in table
@@ -0,0 +1,50 @@
+import threading
+
+from automarking import TokenUsage, add_usage, count_usage, token_usage
+from fair_scheduler import bind_flow
+
+USAGE = {'input_tokens': 100, 'output_tokens': 10}
+
+
+def test_count_usage_adds_to_the_run_and_the_process_totals():
+    run_usage = TokenUsage()
+    before = token_usage.snapshot()['input_tokens']
+    with count_usage(run_usage):
+        add_usage(USAGE)
+    add_usage(USAGE)
+    assert run_usage.snapshot() == {'calls': 1, 'input_tokens': 100, 'output_tokens': 10,
+                                    'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+    assert token_usage.snapshot()['input_tokens'] == before + 200
+
+
+def test_nested_runs_both_count():
+    outer, inner = TokenUsage(), TokenUsage()
+    with count_usage(outer):
+        add_usage(USAGE)
+        with count_usage(inner):
+            add_usage(USAGE)
+    assert outer.snapshot()['calls'] == 2
+    assert inner.snapshot()['calls'] == 1
+
+
+def test_concurrent_runs_do_not_see_each_other():
+    runs = [TokenUsage(), TokenUsage()]
+    barrier = threading.Barrier(2)
+
+    def run(run_usage, calls):
+        with count_usage(run_usage):
+            # Worker threads only count towards the run when started through bind_flow
+            workers = [threading.Thread(target=bind_flow(add_usage), args=(USAGE,)) for _ in range(calls)]
+            barrier.wait()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+    threads = [threading.Thread(target=run, args=(runs[0], 3)), threading.Thread(target=run, args=(runs[1], 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert runs[0].snapshot()['calls'] == 3
+    assert runs[1].snapshot()['calls'] == 5
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+Pre-run token, cost and time planning for a marking run.
+
+plan_marking() counts the prompt tokens of every essay against the chosen
+rubric and guidance, at ~4 characters per token or with the Bedrock
+CountTokens API (PLANNER_TOKEN_COUNTER=bedrock). It predicts each essay's
+output tokens from the output lengths of earlier essay calls, which come from
+the call traces in METRICS_DIR and the calls made by this process. From these
+it totals the run's input and output tokens, cost and wall-clock time at the
+concurrency the run will get (the requested workers, up to
+BEDROCK_MAX_CONCURRENCY) and the rate limits. It also flags essays that are empty,
+unusually long, or whose prompt plus output would not fit the model's context
+window.
+
+Each essay is also given a max_tokens sized to its predicted output plus
+headroom, instead of the fixed ESSAY_MAX_TOKENS, so the rate limiter's token
+reservations and queue slots are not over-reserved. Feedback that reaches its
+planned limit is continued up to ESSAY_MAX_TOKENS (see
+automarking.generate_essay_feedback). Until PLANNER_MIN_HISTORY essay calls
+have been seen, every essay keeps ESSAY_MAX_TOKENS.
+"""
+
+import json
+import logging
+import math
+import numpy as np
+import os
+
+from automarking import (
+    BEDROCK_LARGE_MODEL_ID,
+    BEDROCK_PROMPT_CACHING,
+    BEDROCK_REQUESTS_PER_MINUTE,
+    BEDROCK_TOKENS_PER_MINUTE,
+    DEFAULT_INFERENCE_PARAMS,
+    ESSAY_MAX_TOKENS,
+    MARKING_CONCURRENCY,
+    METRICS_DIR,
+    build_essay_prompt,
+    call_metrics,
+    effective_concurrency,
+    essay_prompt_prefix,
+    estimate_cost,
+    estimate_tokens,
+    get_bedrock_client,
+    prompt_messages,
+    request_body,
+)
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 'estimate' (~4 characters per token) or 'bedrock' (the CountTokens API)
+PLANNER_TOKEN_COUNTER = os.getenv('PLANNER_TOKEN_COUNTER', 'estimate').lower()
+PLANNER_DYNAMIC_MAX_TOKENS = os.getenv('PLANNER_DYNAMIC_MAX_TOKENS', 'true').lower() == 'true'
+PLANNER_MIN_HISTORY = int(os.getenv('PLANNER_MIN_HISTORY', '20'))
+PLANNER_HISTORY_RUNS = int(os.getenv('PLANNER_HISTORY_RUNS', '20'))
+PLANNER_OUTPUT_QUANTILE = float(os.getenv('PLANNER_OUTPUT_QUANTILE', '0.95'))
+PLANNER_HEADROOM = float(os.getenv('PLANNER_HEADROOM', '0.15'))
+PLANNER_MIN_MAX_TOKENS = int(os.getenv('PLANNER_MIN_MAX_TOKENS', '512'))
+PLANNER_LONG_ESSAY_TOKENS = int(os.getenv('PLANNER_LONG_ESSAY_TOKENS', '12000'))
+MODEL_CONTEXT_TOKENS = int(os.getenv('MODEL_CONTEXT_TOKENS', '200000'))
+
+# Used until there is call history: a reply of about half ESSAY_MAX_TOKENS at ~50 tokens/s
+DEFAULT_OUTPUT_TOKENS = ESSAY_MAX_TOKENS // 2
+DEFAULT_FIRST_TOKEN_SECONDS = 2.0
+DEFAULT_SECONDS_PER_TOKEN = 0.02
+
+
+@dataclass
+class OutputModel:
+    """Output tokens and call seconds of essay calls, fitted to earlier calls
+
+    Output tokens are modelled as intercept + slope * prompt tokens, with the
+    PLANNER_OUTPUT_QUANTILE residual as the margin for max_tokens; call
+    seconds as first-token seconds plus seconds per output token.
+    """
+    samples: int = 0
+    intercept: float = DEFAULT_OUTPUT_TOKENS
+    slope: float = 0.0
+    margin: float = 0.0
+    first_token_seconds: float = DEFAULT_FIRST_TOKEN_SECONDS
+    seconds_per_token: float = DEFAULT_SECONDS_PER_TOKEN
+    truncated: int = 0
+
+    @property
+    def fitted(self) -> bool:
+        return self.samples >= PLANNER_MIN_HISTORY
+
+    def predict_output(self, prompt_tokens: int) -> int:
+        return int(max(1, self.intercept + self.slope * prompt_tokens))
+
+    def max_tokens(self, prompt_tokens: int) -> int:
+        """Planned max_tokens: predicted output plus margin and headroom, in steps of 64"""
+        if not self.fitted:
+            return ESSAY_MAX_TOKENS
+        planned = (self.predict_output(prompt_tokens) + self.margin) * (1 + PLANNER_HEADROOM)
+        planned = int(math.ceil(planned / 64) * 64)
+        return max(PLANNER_MIN_MAX_TOKENS, min(ESSAY_MAX_TOKENS, planned))
+
+    def predict_seconds(self, output_tokens: int) -> float:
+        return self.first_token_seconds + self.seconds_per_token * output_tokens
+
+
+def load_call_history(metrics_dir: str = METRICS_DIR, runs: int = PLANNER_HISTORY_RUNS,
+                      kind: str = 'essay') -> List[Dict]:
+    """Successful calls of `kind` from the newest `runs` call traces and from this process"""
+    records = []
+    traces = sorted(Path(metrics_dir).glob("run-*.jsonl"), key=lambda path: path.stat().st_mtime)[-runs:] \
+        if Path(metrics_dir).is_dir() else []
+    for trace in traces:
+        with open(trace, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    records.extend(asdict(record) for record in call_metrics.records())
+
+    # A run exported by this process appears both in its trace and in memory
+    seen = set()
+    history = []
+    for record in records:
+        key = (record.get('timestamp'), record.get('essay'), record.get('model'))
+        if record.get('kind') != kind or record.get('error') or not record.get('output_tokens') or key in seen:
+            continue
+        seen.add(key)
+        history.append(record)
+    return history
+
+
+def fit_output_model(history: List[Dict]) -> OutputModel:
+    """Fit an OutputModel to call records (see load_call_history)"""
+    if not history:
+        return OutputModel()
+    prompt = np.array([record['input_tokens'] + record['cache_read_input_tokens']
+                       + record['cache_creation_input_tokens'] for record in history], dtype=float)
+    output = np.array([record['output_tokens'] for record in history], dtype=float)
+    seconds = np.array([record['wall_seconds'] for record in history], dtype=float)
+    model = OutputModel(samples=len(history),
+                        truncated=sum(1 for record in history if record.get('stop_reason') == 'max_tokens'))
+
+    if len(history) >= 2 and np.ptp(prompt) > 0:
+        model.slope, model.intercept = (float(value) for value in np.polyfit(prompt, output, 1))
+        model.slope = max(0.0, model.slope)
+        if model.slope == 0.0:
+            model.intercept = float(np.mean(output))
+    else:
+        model.intercept = float(np.mean(output))
+    residuals = output - (model.intercept + model.slope * prompt)
+    model.margin = max(0.0, float(np.quantile(residuals, PLANNER_OUTPUT_QUANTILE)))
+
+    if len(history) >= 2 and np.ptp(output) > 0:
+        per_token, first_token = np.polyfit(output, seconds, 1)
+        if per_token > 0 and first_token >= 0:
+            model.seconds_per_token, model.first_token_seconds = float(per_token), float(first_token)
+            return model
+    model.seconds_per_token = float(np.median(seconds / output))
+    model.first_token_seconds = 0.0
+    return model
+
+
+def estimate_prompt_tokens(essay_text: str, rubric_text: str, feedback_guidance: str) -> int:
+    """Prompt tokens of an essay's marking request at ~4 characters per token"""
+    return sum(estimate_tokens(block['text']) for block in build_essay_prompt(essay_text, rubric_text,
+                                                                             feedback_guidance))
+
+
+def count_prompt_tokens(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                        model_id: str = BEDROCK_LARGE_MODEL_ID, counter: str = PLANNER_TOKEN_COUNTER,
+                        max_workers: int = MARKING_CONCURRENCY) -> Dict[str, int]:
+    """Prompt tokens of each essay's marking request
+
+    With counter='bedrock' each prompt is counted by the CountTokens API (in
+    parallel); essays it fails for fall back to the estimate.
+    """
+    def estimate(essay_text: str) -> int:
+        return estimate_prompt_tokens(essay_text, rubric_text, feedback_guidance)
+
+    if counter != 'bedrock':
+        return {name: estimate(text) for name, text in essays.items()}
+
+    client = get_bedrock_client()
+
+    def count(essay_text: str) -> int:
+        body = request_body(prompt_messages(build_essay_prompt(essay_text, rubric_text, feedback_guidance)),
+                            **DEFAULT_INFERENCE_PARAMS)
+        try:
+            response = client.count_tokens(modelId=model_id, input={'invokeModel': {'body': json.dumps(body)}})
+            return int(response['inputTokens'])
+        except Exception as e:
+            logger.warning(f"Token count failed, using the estimate: {str(e)}")
+            return estimate(essay_text)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return dict(zip(essays, executor.map(count, essays.values())))
+
+
+def plan_marking(essays: Dict[str, str], rubric_text: str, feedback_guidance: str,
+                 concurrency: int = MARKING_CONCURRENCY, model_id: str = BEDROCK_LARGE_MODEL_ID,
+                 model: Optional[OutputModel] = None, counter: str = PLANNER_TOKEN_COUNTER) -> Dict:
+    """Plan a marking run: per-essay tokens, max_tokens and flags, and the run's totals
+
+    Returns {'essays': [{'name', 'prompt_tokens', 'predicted_output_tokens',
+    'max_tokens', 'flags'}], 'max_tokens': {name: max_tokens}, 'totals':
+    {...}, 'history': {...}}. Totals are an upper bound: essays served from
+    the feedback cache or reused from earlier runs cost nothing.
+    """
+    model = model or fit_output_model(load_call_history())
+    prompt_tokens = count_prompt_tokens(essays, rubric_text, feedback_guidance, model_id, counter)
+    prefix_tokens = estimate_tokens(essay_prompt_prefix(rubric_text, feedback_guidance)['text'])
+
+    planned = []
+    for name, essay_text in essays.items():
+        tokens = prompt_tokens[name]
+        essay_tokens = estimate_tokens(essay_text)
+        predicted = model.predict_output(tokens)
+        max_tokens = model.max_tokens(tokens)
+        flags = []
+        if not essay_text.strip():
+            flags.append("empty essay")
+        if essay_tokens > PLANNER_LONG_ESSAY_TOKENS:
+            flags.append(f"long essay (~{essay_tokens} tokens)")
+        if tokens + ESSAY_MAX_TOKENS > MODEL_CONTEXT_TOKENS:
+            flags.append(f"prompt plus output exceeds the {MODEL_CONTEXT_TOKENS}-token context window")
+        if predicted > ESSAY_MAX_TOKENS:
+            flags.append(f"predicted feedback ({predicted} tokens) exceeds max_tokens ({ESSAY_MAX_TOKENS})")
+        planned.append({
+            'name': name,
+            'prompt_tokens': tokens,
+            'predicted_output_tokens': min(predicted, ESSAY_MAX_TOKENS),
+            'max_tokens': max_tokens,
+            'flags': flags,
+        })
+
+    count = len(planned)
+    total_prompt = sum(item['prompt_tokens'] for item in planned)
+    if BEDROCK_PROMPT_CACHING and count:
+        # The rubric/guidance prefix is written to the prompt cache once and read by every later essay
+        usage = {
+            'input_tokens': total_prompt - prefix_tokens * count,
+            'cache_creation_input_tokens': prefix_tokens,
+            'cache_read_input_tokens': prefix_tokens * (count - 1),
+        }
+    else:
+        usage = {'input_tokens': total_prompt, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+    usage['output_tokens'] = sum(item['predicted_output_tokens'] for item in planned)
+
+    # Wall-clock time: the slower of the concurrency bound and the request/token rate limits. The run only
+    # gets as many calls in flight as the rate limiter lets it reserve
+    concurrency = effective_concurrency(concurrency)
+    seconds = [model.predict_seconds(item['predicted_output_tokens']) for item in planned]
+    bounds = {'concurrency': max(sum(seconds) / max(1, concurrency), max(seconds, default=0.0))}
+    reserved = sum(item['prompt_tokens'] + item['max_tokens'] for item in planned)
+    if BEDROCK_TOKENS_PER_MINUTE > 0:
+        bounds['tokens_per_minute'] = reserved / BEDROCK_TOKENS_PER_MINUTE * 60
+    if BEDROCK_REQUESTS_PER_MINUTE > 0:
+        bounds['requests_per_minute'] = count / BEDROCK_REQUESTS_PER_MINUTE * 60
+    bottleneck = max(bounds, key=bounds.get)
+
+    return {
+        'essays': planned,
+        'max_tokens': {item['name']: item['max_tokens'] for item in planned},
+        'totals': {
+            'essays': count,
+            'flagged': sum(1 for item in planned if item['flags']),
+            **usage,
+            'reserved_output_tokens': sum(item['max_tokens'] for item in planned),
+            'fixed_reserved_output_tokens': ESSAY_MAX_TOKENS * count,
+            'cost_usd': round(estimate_cost(usage, model_id), 4),
+            'seconds': round(bounds[bottleneck], 1),
+            'bottleneck': bottleneck,
+            'concurrency': concurrency,
+        },
+        'history': {
+            'samples': model.samples,
+            'fitted': model.fitted,
+            'truncated': model.truncated,
+            'seconds_per_output_token': round(model.seconds_per_token, 4),
+        },
+    }